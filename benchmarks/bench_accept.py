@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Connect a burst of debugger engines at once, as when a deploy starts many PHP workers with xdebug enabled, and measure
+how long it takes until the IDE has seen all sessions for different listen backlogs.
+
+With a full backlog the kernel drops connection attempts and the engines retry after a second or more, which shows up
+in the p99 and maximum setup time.
+
+usage: bench_accept.py [--burst N] [--backlogs 5,128] [--engines asyncore,asyncio] [--json]
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from fakes import ProxyProcess, init_packet, read_frame_async, percentile
+
+__author__ = 'gkralik'
+
+
+async def run(proxy, burst):
+    """
+    Connect burst engines at the same time.
+    @return: Dict of results.
+    """
+    arrived = {}
+    done = asyncio.Event()
+
+    async def accept(reader, writer):
+        init = await read_frame_async(reader)
+        arrived[init.split(b'appid="')[1].split(b'"')[0].decode()] = time.perf_counter()
+        if len(arrived) == burst:
+            done.set()
+
+    server = await asyncio.start_server(accept, '127.0.0.1', 0, backlog=4096)
+    reader, writer = await asyncio.open_connection('127.0.0.1', proxy.ideport)
+    writer.write('proxyinit -p {} -k burst\0'.format(server.sockets[0].getsockname()[1]).encode())
+    await read_frame_async(reader)
+    writer.close()
+
+    engines = []
+    failed = 0
+
+    async def engine(appid):
+        nonlocal failed
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', proxy.dbgport)
+        except OSError:
+            failed += 1
+            return
+        writer.write(init_packet('burst', appid))
+        engines.append(writer)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(engine(str(i)) for i in range(burst)))
+    try:
+        await asyncio.wait_for(done.wait(), 30)
+    except asyncio.TimeoutError:
+        pass
+
+    setups = [t - start for t in arrived.values()]
+    for writer in engines:
+        writer.close()
+    server.close()
+    return {'sessions': len(arrived), 'failed': failed, 'setup_p50_ms': percentile(setups, 50) * 1000,
+            'setup_p99_ms': percentile(setups, 99) * 1000, 'setup_max_ms': max(setups, default=0) * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--burst', type=int, default=500, help='engines connecting at once')
+    parser.add_argument('--backlogs', default='5,128', help='comma separated --backlog values')
+    parser.add_argument('--engines', default='asyncore,asyncio')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per engine and backlog')
+    args = parser.parse_args()
+
+    for engine in args.engines.split(','):
+        for backlog in map(int, args.backlogs.split(',')):
+            proxy = ProxyProcess(engine, ['--backlog', str(backlog)])
+            try:
+                result = asyncio.run(run(proxy, args.burst))
+            finally:
+                proxy.stop()
+
+            result.update(engine=engine, backlog=backlog, burst=args.burst)
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print('{engine:8s} backlog {backlog:4d}: {sessions}/{burst} sessions, {failed} failed  setup p50 '
+                      '{setup_p50_ms:7.1f} ms  p99 {setup_p99_ms:7.1f} ms  max {setup_max_ms:7.1f} ms'.format(**result))
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
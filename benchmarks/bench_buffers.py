@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Measure proxy memory while a fast debugger engine streams a large response to an IDE that reads slowly.
+
+usage: bench_buffers.py [--megabytes M] [--buffer-size BYTES] [--read-delay SECONDS] [--json]
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+
+from fakes import ProxyProcess, FakeIDE, connect_engine, recv_exactly, response
+
+__author__ = 'gkralik'
+
+
+def bench(proxy, megabytes, read_delay):
+    """
+    Stream one large response from the engine and read it in 64 KiB steps with a pause after each.
+    @return: Tuple of the RSS growth of the proxy in KiB and MB/s.
+    """
+    ide = FakeIDE(proxy)
+    ide.register()
+    engine = connect_engine(proxy)
+    session = ide.accept()
+
+    message = response(1, megabytes * 1024 * 1024)
+    producer = threading.Thread(target=engine.sendall, args=(message,))
+
+    rss = proxy.rss_kb()
+    peak = rss
+    start = time.perf_counter()
+    producer.start()
+
+    received = 0
+    while received < len(message):
+        received += len(recv_exactly(session, min(65536, len(message) - received)))
+        peak = max(peak, proxy.rss_kb())
+        time.sleep(read_delay)
+
+    elapsed = time.perf_counter() - start
+    producer.join()
+
+    engine.close()
+    session.close()
+    ide.unregister()
+    ide.close()
+
+    return peak - rss, len(message) / 1024 / 1024 / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--megabytes', type=int, default=32)
+    parser.add_argument('--buffer-size', type=int, default=1024 * 1024)
+    parser.add_argument('--read-delay', type=float, default=0.02)
+    parser.add_argument('--engines', default='asyncore,asyncio')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per engine')
+    args = parser.parse_args()
+
+    for engine in args.engines.split(','):
+        proxy = ProxyProcess(engine, ['--buffer-size', str(args.buffer_size)])
+        try:
+            growth, throughput = bench(proxy, args.megabytes, args.read_delay)
+        finally:
+            proxy.stop()
+
+        result = {'engine': engine, 'megabytes': args.megabytes, 'buffer_size': args.buffer_size,
+                  'rss_growth_kb': growth, 'relay_mb_s': throughput}
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('{engine:8s} {megabytes} MB response, buffer {buffer_size} bytes: proxy RSS +{rss_growth_kb} KiB, '
+                  '{relay_mb_s:.1f} MB/s'.format(**result))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""
+Measure the response cache with the commands an IDE sends at the start of every session.
+
+Every session sets features, gets features and the typemap, lists the source of some files and then steps through the
+code. The fake engine takes --engine-delay milliseconds to generate every response and checks nothing; the IDE checks
+that every response carries its transaction id and the expected payload. Reports the session duration with the cache
+off and on, and the hit rate and engine time saved from proxystats.
+
+usage: bench_cache.py [--sessions N] [--files N] [--engine-delay MS] [--cache-size BYTES] [--engines asyncore,asyncio]
+                      [--json]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import re
+import sys
+import time
+
+from fakes import ProxyProcess, frame, init_packet, read_frame_async, percentile
+
+__author__ = 'gkralik'
+
+FEATURES = ['language_supports_threads', 'language_name', 'language_version', 'encoding', 'protocol_version',
+            'supports_async', 'breakpoint_types', 'multiple_sessions']
+
+_STATS = re.compile(rb'<cache hits="(\d+)" misses="(\d+)" entries="(\d+)" bytes="(\d+)" saved_ms="(\d+)"')
+
+
+def payload(command):
+    """
+    @param command: The command without its transaction id (str).
+    @return: The deterministic response body of the fake engine for a command.
+    """
+    rng = random.Random(command)
+    if command.startswith('source'):
+        lines = ('    ' * rng.randint(0, 3) + '$x{} = $this->get({});'.format(i, rng.randint(0, 99))
+                 for i in range(rng.randint(500, 3000)))
+        return '<![CDATA[{}]]>'.format(base64.b64encode('\n'.join(lines).encode()).decode())
+    if command.startswith('typemap_get'):
+        return ''.join('<map type="{0}" name="{0}" xsi:type="xsd:{0}"/>'.format(t)
+                       for t in ('bool', 'int', 'float', 'string', 'null', 'array', 'object', 'resource'))
+    if command.startswith('context_get'):
+        return ''.join('<property name="$v{0}" type="int"><![CDATA[{1}]]></property>'.format(i, rng.randint(0, 999))
+                       for i in range(50))
+    return '<![CDATA[{}]]>'.format(rng.randint(0, 10 ** 6))
+
+
+def message(command, transaction_id):
+    """
+    @return: The framed response of the fake engine.
+    """
+    name = command.split()[0]
+    return frame('<?xml version="1.0" encoding="iso-8859-1"?>\n<response xmlns="urn:debugger_protocol_v1" command="{}" '
+                 'transaction_id="{}">{}</response>'.format(name, transaction_id, payload(command)).encode())
+
+
+def session_commands(files):
+    """
+    @return: The commands of one session, without transaction ids.
+    """
+    commands = ['feature_set -n max_depth -v 1', 'feature_set -n max_children -v 100']
+    commands += ['feature_get -n {}'.format(name) for name in FEATURES]
+    commands.append('typemap_get')
+    commands += ['source -f file:///var/www/src/File{}.php'.format(i) for i in range(files)]
+    for i in range(5):
+        commands += ['step_into', 'context_get -d 0 -c 0']
+    return commands
+
+
+async def engine(port, delay, appid):
+    """
+    Connect a fake engine and answer commands after delay seconds until the connection is closed.
+    """
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(init_packet('cache', appid))
+    try:
+        while True:
+            args = (await reader.readuntil(b'\0'))[:-1].decode().split(' ')
+            i = args.index('-i')
+            transaction_id = args[i + 1]
+            del args[i:i + 2]
+            await asyncio.sleep(delay)
+            writer.write(message(' '.join(args), transaction_id))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def run(proxy, sessions, files, delay):
+    """
+    Run the sessions one after another.
+    @return: Dict of results.
+    """
+    accepted = asyncio.Queue()
+
+    async def accept(reader, writer):
+        await read_frame_async(reader)
+        accepted.put_nowait((reader, writer))
+
+    ide = await asyncio.start_server(accept, '127.0.0.1', 0)
+    reader, writer = await asyncio.open_connection('127.0.0.1', proxy.ideport)
+    writer.write('proxyinit -p {} -k cache -m 1\0'.format(ide.sockets[0].getsockname()[1]).encode())
+    await read_frame_async(reader)
+    writer.close()
+
+    commands = session_commands(files)
+    durations = []
+    for n in range(sessions):
+        task = asyncio.ensure_future(engine(proxy.dbgport, delay, '4711'))
+        reader, writer = await asyncio.wait_for(accepted.get(), 10)
+        start = time.perf_counter()
+        for transaction_id, command in enumerate(commands, 1):
+            writer.write('{} -i {}\0'.format(command, transaction_id).encode())
+            received = await read_frame_async(reader)
+            expected = message(command, transaction_id)
+            if received != expected[expected.index(b'\0') + 1:-1]:
+                raise AssertionError('unexpected response to {}'.format(command))
+        durations.append(time.perf_counter() - start)
+        writer.close()
+        await task
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', proxy.ideport)
+    writer.write(b'proxystats\0')
+    stats = _STATS.search(await read_frame_async(reader))
+    writer.close()
+    ide.close()
+
+    result = {'session_p50_ms': percentile(durations, 50) * 1000, 'first_session_ms': durations[0] * 1000,
+              'hits': 0, 'misses': 0, 'saved_ms': 0}
+    if stats:
+        result.update(hits=int(stats.group(1)), misses=int(stats.group(2)), saved_ms=int(stats.group(5)))
+    result['hit_rate'] = result['hits'] / max(1, result['hits'] + result['misses'])
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--files', type=int, default=10, help='source files listed per session')
+    parser.add_argument('--engine-delay', type=float, default=5.0, help='milliseconds the engine takes per response')
+    parser.add_argument('--cache-size', type=int, default=64 * 1024 * 1024)
+    parser.add_argument('--engines', default='asyncore,asyncio')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per engine and cache setting')
+    args = parser.parse_args()
+
+    for engine_name in args.engines.split(','):
+        for cache_size in (0, args.cache_size):
+            proxy = ProxyProcess(engine_name, ['--cache-size', str(cache_size)])
+            try:
+                result = asyncio.run(run(proxy, args.sessions, args.files, args.engine_delay / 1000))
+            finally:
+                proxy.stop()
+
+            result.update(engine=engine_name, cache_size=cache_size, sessions=args.sessions)
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print('{engine:8s} cache {cache_size:9d}: session p50 {session_p50_ms:7.1f} ms (first '
+                      '{first_session_ms:7.1f} ms)  {hits} hits, {misses} misses ({hit_rate:.0%}), '
+                      '{saved_ms} ms of engine time saved'.format(**result))
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
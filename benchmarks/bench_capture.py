@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""
+Compare relay throughput and proxy CPU usage with traffic capture switched off and on.
+
+usage: bench_capture.py [--megabytes M] [--response-size BYTES] [--json]
+"""
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+
+from bench_relay import bench
+from fakes import ProxyProcess
+
+__author__ = 'gkralik'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--megabytes', type=int, default=64)
+    parser.add_argument('--response-size', type=int, default=64 * 1024)
+    parser.add_argument('--engines', default='asyncore,asyncio')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per engine and capture setting')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        for engine in args.engines.split(','):
+            for capture in (False, True):
+                proxy = ProxyProcess(engine, ['--capture', directory] if capture else [])
+                try:
+                    throughput, cpu = bench(proxy, args.megabytes, args.response_size)
+                finally:
+                    proxy.stop()
+
+                result = {'engine': engine, 'capture': capture, 'relay_mb_s': throughput, 'cpu_ms_per_mb': cpu * 1000}
+                if args.json:
+                    print(json.dumps(result))
+                else:
+                    print('{engine:8s} capture {capture!s:5s} relay {relay_mb_s:8.1f} MB/s  '
+                          'proxy cpu {cpu_ms_per_mb:7.3f} ms/MB'.format(**result))
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
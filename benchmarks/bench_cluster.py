@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""
+Measure what clustering adds to session setup: registration replication delay, and session setup time and command
+round trips for debugger connections landing on the node the IDE registered with, on a node connecting to the IDE
+directly and on a node forwarding to the registering node.
+
+Three proxies started with --cluster-listen and the same --cluster-peer list run on one machine; the third one uses
+--cluster-route forward. The IDE registers with the first one. Direct connections need an IDE address the nodes do
+not treat as node-local, so the nodes and the IDE listen on a non-loopback address of this machine by default (IDEs
+on the loopback interface are always forwarded).
+
+usage: bench_cluster.py [--sessions N] [--commands N] [--registrations N] [--host ADDRESS]
+                        [--engines asyncore,asyncio] [--json]
+"""
+import argparse
+import json
+import socket
+import sys
+import time
+
+from fakes import (ProxyProcess, FakeIDE, connect, connect_engine, free_port, read_frame, recv_exactly, response,
+                   percentile)
+
+__author__ = 'gkralik'
+
+NODES = 3
+
+# paths of a debugger connection, by the node it lands on
+PATHS = ('local', 'direct', 'forward')
+
+# seconds to wait for the nodes to connect to each other
+LINK_TIMEOUT = 30.0
+
+
+def default_host():
+    """
+    @return: A non-loopback IPv4 address of this machine, or 127.0.0.1 if there is none.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # no packet is sent, this only picks the interface of the default route
+        sock.connect(('198.51.100.1', 9))
+        return sock.getsockname()[0]
+    except OSError:
+        return '127.0.0.1'
+    finally:
+        sock.close()
+
+
+def read_command(sock):
+    """
+    @return: The next command received by the fake engine (bytes, without the \\0).
+    """
+    data = bytearray()
+    while not data.endswith(b'\0'):
+        data += recv_exactly(sock, 1)
+    return bytes(data[:-1])
+
+
+def listed(proxy, idekey):
+    """
+    @return: True if the proxy lists a registration of the IDE key.
+    """
+    sock = connect(proxy.host, proxy.ideport)
+    try:
+        sock.sendall(b'proxylist -a\0')
+        return 'idekey="{}"'.format(idekey).encode() in read_frame(sock)
+    finally:
+        sock.close()
+
+
+def wait_listed(proxies, idekey, timeout):
+    """
+    Wait until all proxies list a registration of the IDE key.
+    @raise RuntimeError: If they do not within timeout seconds.
+    """
+    deadline = time.perf_counter() + timeout
+    for proxy in proxies:
+        while not listed(proxy, idekey):
+            if time.perf_counter() > deadline:
+                raise RuntimeError('registration of {} not replicated'.format(idekey))
+            time.sleep(0.0005)
+
+
+def start_cluster(engine, host):
+    """
+    Start the nodes of a cluster.
+    @return: List of ProxyProcess.
+    """
+    cluster_ports = [free_port(host) for i in range(NODES)]
+    peers = []
+    for port in cluster_ports:
+        peers += ['--cluster-peer', '{}:{}'.format(host, port)]
+
+    nodes = []
+    for i, port in enumerate(cluster_ports):
+        args = ['--cluster-listen', '{}:{}'.format(host, port)] + peers
+        if PATHS[i] == 'forward':
+            args += ['--cluster-route', 'forward']
+        nodes.append(ProxyProcess(engine, args, host=host))
+    return nodes
+
+
+def bench(nodes, sessions, commands, registrations, size=512):
+    """
+    Measure replication, then session setup and round trips through every node.
+    @return: Dict of results.
+    """
+    ide = FakeIDE(nodes[0], 'cluster')
+    result = {}
+    try:
+        # the nodes retry connecting to peers that were not up yet
+        ide.register()
+        wait_listed(nodes[1:], ide.idekey, LINK_TIMEOUT)
+
+        replication = []
+        for i in range(registrations):
+            idekey = 'replicated{}'.format(i)
+            start = time.perf_counter()
+            ide.command('proxyinit -p {} -k {} -m 1'.format(ide.port, idekey))
+            wait_listed(nodes[1:], idekey, LINK_TIMEOUT)
+            replication.append(time.perf_counter() - start)
+            ide.command('proxystop -k {}'.format(idekey))
+        result['replication_p50_ms'] = percentile(replication, 50) * 1000
+        result['replication_p99_ms'] = percentile(replication, 99) * 1000
+
+        for path, node in zip(PATHS, nodes):
+            setup = []
+            for i in range(sessions):
+                start = time.perf_counter()
+                engine = connect_engine(node, ide.idekey, appid=str(i))
+                session = ide.accept()
+                setup.append(time.perf_counter() - start)
+                if i < sessions - 1:
+                    engine.close()
+                    session.close()
+
+            roundtrips = []
+            for transaction_id in range(1, commands + 1):
+                message = response(transaction_id, size)
+                start = time.perf_counter()
+                session.sendall('step_over -i {}\0'.format(transaction_id).encode())
+                read_command(engine)
+                engine.sendall(message)
+                read_frame(session)
+                roundtrips.append(time.perf_counter() - start)
+            engine.close()
+            session.close()
+
+            result[path] = {'setup_p50_ms': percentile(setup, 50) * 1000, 'setup_p99_ms': percentile(setup, 99) * 1000,
+                            'rtt_p50_us': percentile(roundtrips, 50) * 1e6,
+                            'rtt_p99_us': percentile(roundtrips, 99) * 1e6}
+        ide.unregister()
+    finally:
+        ide.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=200, help='sessions per node')
+    parser.add_argument('--commands', type=int, default=2000, help='commands through the last session per node')
+    parser.add_argument('--registrations', type=int, default=200, help='registrations timed until replicated')
+    parser.add_argument('--host', default=None, help='address the nodes and the IDE listen on (defaults to a '
+                                                     'non-loopback address of this machine)')
+    parser.add_argument('--engines', default='asyncore,asyncio')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per engine')
+    args = parser.parse_args()
+
+    host = args.host or default_host()
+    for engine_name in args.engines.split(','):
+        nodes = start_cluster(engine_name, host)
+        try:
+            result = bench(nodes, args.sessions, args.commands, args.registrations)
+        finally:
+            for node in nodes:
+                node.stop()
+
+        result['engine'] = engine_name
+        result['host'] = host
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('{engine:8s} replication p50 {replication_p50_ms:6.3f} ms  p99 {replication_p99_ms:6.3f} ms'.format(
+                **result))
+            for path in PATHS:
+                print('{:8s} {:8s} setup p50 {setup_p50_ms:6.3f} ms  p99 {setup_p99_ms:6.3f} ms  '
+                      'round trip p50 {rtt_p50_us:7.1f} us  p99 {rtt_p99_us:7.1f} us'.format(
+                          engine_name, path, **result[path]))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
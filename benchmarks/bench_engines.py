@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Compare session setup latency and relay throughput of the asyncore and asyncio engines.
+
+usage: bench_engines.py [--sessions N] [--megabytes M] [--json]
+"""
+import argparse
+import json
+import sys
+import time
+
+from fakes import ProxyProcess, FakeIDE, connect_engine, read_frame, response, percentile
+
+__author__ = 'gkralik'
+
+
+def bench_setup(proxy, sessions):
+    """
+    Measure the time from the engine connect until the IDE received the init packet.
+    @return: List of latencies in seconds.
+    """
+    ide = FakeIDE(proxy)
+    ide.register()
+    latencies = []
+    for i in range(sessions):
+        start = time.perf_counter()
+        engine = connect_engine(proxy)
+        session = ide.accept()
+        latencies.append(time.perf_counter() - start)
+        engine.close()
+        session.close()
+    ide.unregister()
+    ide.close()
+    return latencies
+
+
+def bench_relay(proxy, megabytes, chunk=65536):
+    """
+    Measure engine -> IDE relay throughput.
+    @return: MB/s.
+    """
+    ide = FakeIDE(proxy)
+    ide.register()
+    engine = connect_engine(proxy)
+    session = ide.accept()
+
+    message = response(1, chunk)
+    count = megabytes * 1024 * 1024 // len(message)
+    start = time.perf_counter()
+    for i in range(count):
+        engine.sendall(message)
+        read_frame(session)
+    elapsed = time.perf_counter() - start
+
+    engine.close()
+    session.close()
+    ide.unregister()
+    ide.close()
+    return count * len(message) / elapsed / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--megabytes', type=int, default=64)
+    parser.add_argument('--engines', default='asyncore,asyncio')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per engine')
+    args = parser.parse_args()
+
+    for engine in args.engines.split(','):
+        proxy = ProxyProcess(engine)
+        try:
+            latencies = bench_setup(proxy, args.sessions)
+            throughput = bench_relay(proxy, args.megabytes)
+        finally:
+            proxy.stop()
+
+        result = {
+            'engine': engine,
+            'setup_p50_ms': percentile(latencies, 50) * 1000,
+            'setup_p99_ms': percentile(latencies, 99) * 1000,
+            'relay_mb_s': throughput,
+        }
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('{engine:10s} setup p50 {setup_p50_ms:7.3f} ms  p99 {setup_p99_ms:7.3f} ms  '
+                  'relay {relay_mb_s:8.1f} MB/s'.format(**result))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
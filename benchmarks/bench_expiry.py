@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Measure the cost of registration TTLs with many registrations.
+
+Every registration is refreshed a number of times and then all of them expire. Compares the ExpiryHeap of
+dbgpproxy.health against one timer per registration that is cancelled and scheduled again on every refresh.
+
+usage: bench_expiry.py [--registrations N] [--refreshes N] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbgpproxy.health import ExpiryHeap
+from dbgpproxy.timers import Scheduler
+
+__author__ = 'gkralik'
+
+
+class Clock:
+    """
+    Manually advanced clock for the Scheduler.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def bench_heap(keys, refreshes, ttl):
+    """
+    @return: Tuple of seconds for the refreshes, seconds for the expiry, heap entries before the expiry.
+    """
+    heap = ExpiryHeap()
+    now = 0.0
+    start = time.perf_counter()
+    for i in range(refreshes + 1):
+        now += 1
+        for key in keys:
+            heap.touch(key, now + ttl)
+    refreshed = time.perf_counter()
+    entries = len(heap._heap)
+    expired = heap.pop_expired(now + ttl)
+    assert len(expired) == len(keys)
+    return refreshed - start, time.perf_counter() - refreshed, entries
+
+
+def bench_timers(keys, refreshes, ttl):
+    """
+    @return: Tuple of seconds for the refreshes, seconds for the expiry, heap entries before the expiry.
+    """
+    clock = Clock()
+    scheduler = Scheduler(clock)
+    timers = {}
+    expired = []
+    start = time.perf_counter()
+    for i in range(refreshes + 1):
+        clock.now += 1
+        for key in keys:
+            timer = timers.get(key)
+            if timer is not None:
+                timer.cancel()
+            timers[key] = scheduler.call_later(ttl, expired.append, key)
+    refreshed = time.perf_counter()
+    entries = len(scheduler._heap)
+    clock.now += ttl
+    scheduler.run()
+    assert len(expired) == len(keys)
+    return refreshed - start, time.perf_counter() - refreshed, entries
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--registrations', type=int, default=50000)
+    parser.add_argument('--refreshes', type=int, default=10, help='refreshes per registration')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per case')
+    args = parser.parse_args()
+
+    keys = ['ide{}'.format(i) for i in range(args.registrations)]
+    for name, func in (('expiry heap', bench_heap), ('timer per key', bench_timers)):
+        refresh_time, expiry_time, entries = func(keys, args.refreshes, 60.0)
+        result = {'case': name, 'registrations': args.registrations,
+                  'refreshes_per_sec': args.registrations * (args.refreshes + 1) / refresh_time,
+                  'expiry_ms': expiry_time * 1000, 'heap_entries': entries}
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('{case:14s} {registrations} registrations: {refreshes_per_sec:10.0f} refreshes/s  '
+                  'expiry {expiry_ms:8.1f} ms  {heap_entries:8d} heap entries'.format(**result))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
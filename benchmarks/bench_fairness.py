@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+Measure command round trips of an interactive session while bulk sessions stream large responses through the same
+proxy, without a relay budget, with --relay-budget and with --relay-budget --relay-priority.
+
+The bulk sessions run in a child process, so the benchmark's own threads do not delay the interactive session.
+
+usage: bench_fairness.py [--bulk N] [--commands N] [--budget BYTES] [--response-size BYTES]
+                         [--engines asyncore,asyncio] [--modes off,budget,priority] [--json]
+"""
+import argparse
+import json
+import multiprocessing
+import sys
+import threading
+import time
+
+from fakes import ProxyProcess, FakeIDE, connect_engine, read_frame, recv_exactly, response, percentile
+
+__author__ = 'gkralik'
+
+MODES = ('off', 'budget', 'priority')
+
+
+def read_command(sock):
+    """
+    @return: The next command received by the fake engine (bytes, without the \\0).
+    """
+    data = bytearray()
+    while not data.endswith(b'\0'):
+        data += recv_exactly(sock, 1)
+    return bytes(data[:-1])
+
+
+def stream(sock, message, stop):
+    """
+    Send a response over and over until stopped or the connection is closed.
+    """
+    try:
+        while not stop.is_set():
+            sock.sendall(message)
+    except OSError:
+        pass
+
+
+def drain(sock, received):
+    """
+    Read and count everything until the connection is closed.
+    @param received: List with one counter, incremented by the bytes read.
+    """
+    buf = bytearray(1024 * 1024)
+    try:
+        while True:
+            n = sock.recv_into(buf)
+            if not n:
+                return
+            received[0] += n
+    except OSError:
+        pass
+
+
+def bulk_load(proxy, sessions, size, ready, stop, result):
+    """
+    Run bulk sessions streaming size byte responses to the IDE until stopped (in a child process).
+    @param ready: Event set once all sessions stream.
+    @param stop: Event to stop streaming.
+    @param result: Queue the received bytes and seconds are put on.
+    """
+    ide = FakeIDE(proxy, 'bulk')
+    ide.register()
+    pairs = []
+    for i in range(sessions):
+        engine = connect_engine(proxy, 'bulk', appid=str(i))
+        pairs.append((engine, ide.accept()))
+
+    message = response(1, size)
+    received = [0]
+    done = threading.Event()
+    threads = []
+    for engine, session in pairs:
+        threads.append(threading.Thread(target=stream, args=(engine, message, done)))
+        threads.append(threading.Thread(target=drain, args=(session, received)))
+    for thread in threads:
+        thread.start()
+
+    ready.set()
+    start = time.perf_counter()
+    stop.wait()
+    elapsed = time.perf_counter() - start
+    total = received[0]
+
+    done.set()
+    for engine, session in pairs:
+        engine.close()
+        session.close()
+    for thread in threads:
+        thread.join()
+    ide.unregister()
+    ide.close()
+    result.put((total, elapsed))
+
+
+def bench(proxy, bulk, commands, size):
+    """
+    Time the commands of an interactive session while the bulk sessions stream.
+    @return: Dict of results.
+    """
+    ide = FakeIDE(proxy, 'interactive')
+    ide.register()
+    engine = connect_engine(proxy, 'interactive')
+    session = ide.accept()
+
+    context = multiprocessing.get_context('fork')
+    ready, stop, result = context.Event(), context.Event(), context.Queue()
+    load = None
+    if bulk:
+        load = context.Process(target=bulk_load, args=(proxy, bulk, size, ready, stop, result))
+        load.start()
+        ready.wait()
+        # let the bulk sessions fill the socket buffers
+        time.sleep(0.5)
+
+    roundtrips = []
+    try:
+        for transaction_id in range(1, commands + 1):
+            message = response(transaction_id, 512)
+            start = time.perf_counter()
+            session.sendall('step_over -i {}\0'.format(transaction_id).encode())
+            read_command(engine)
+            engine.sendall(message)
+            read_frame(session)
+            roundtrips.append(time.perf_counter() - start)
+    finally:
+        throughput = 0.0
+        if load is not None:
+            stop.set()
+            total, elapsed = result.get()
+            load.join()
+            throughput = total / elapsed / 1024 / 1024
+        engine.close()
+        session.close()
+        ide.unregister()
+        ide.close()
+
+    return {'rtt_p50_us': percentile(roundtrips, 50) * 1e6, 'rtt_p99_us': percentile(roundtrips, 99) * 1e6,
+            'rtt_max_us': max(roundtrips) * 1e6, 'bulk_mb_s': throughput}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bulk', type=int, default=4, help='bulk sessions')
+    parser.add_argument('--commands', type=int, default=5000, help='commands of the interactive session')
+    parser.add_argument('--budget', type=int, default=16384, help='--relay-budget of the budget and priority modes')
+    parser.add_argument('--response-size', type=int, default=4 * 1024 * 1024, help='size of the bulk responses')
+    parser.add_argument('--engines', default='asyncore,asyncio')
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--json', action='store_true', help='print one JSON object per engine and mode')
+    args = parser.parse_args()
+
+    for engine_name in args.engines.split(','):
+        for mode in args.modes.split(','):
+            proxy_args = []
+            if mode != 'off':
+                proxy_args += ['--relay-budget', str(args.budget)]
+            if mode == 'priority':
+                proxy_args.append('--relay-priority')
+
+            proxy = ProxyProcess(engine_name, proxy_args)
+            try:
+                result = bench(proxy, args.bulk, args.commands, args.response_size)
+            finally:
+                proxy.stop()
+
+            result.update(engine=engine_name, mode=mode, bulk=args.bulk)
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print('{engine:8s} {mode:8s} {bulk} bulk sessions {bulk_mb_s:7.1f} MB/s  interactive round trip '
+                      'p50 {rtt_p50_us:7.1f} us  p99 {rtt_p99_us:8.1f} us  max {rtt_max_us:8.1f} us'.format(**result))
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
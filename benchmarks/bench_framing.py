@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Measure frames/sec of the incremental framers (dbgpproxy.framing) on fragmented input.
+
+Compares against a naive parser that re-concatenates bytes for every chunk.
+
+usage: bench_framing.py [--frames N] [--json]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbgpproxy.framing import EngineFramer, CommandFramer
+from fakes import frame, response
+
+__author__ = 'gkralik'
+
+
+def naive_engine_frames(chunks):
+    """
+    Parse engine frames by concatenating bytes, as _handle_init_packet used to.
+    @return: Number of frames.
+    """
+    count = 0
+    data = b''
+    for chunk in chunks:
+        data = data + chunk
+        while True:
+            eol = data.find(b'\0')
+            if eol < 0:
+                break
+            length = int(data[:eol])
+            if len(data) <= eol + 1 + length:
+                break
+            data = data[eol + 2 + length:]
+            count += 1
+    return count
+
+
+def framer_frames(framer, chunks):
+    """
+    @return: Number of frames parsed by the framer.
+    """
+    count = 0
+    for chunk in chunks:
+        framer.feed(chunk)
+        for payload in framer:
+            count += 1
+    return count
+
+
+def fragment(data, max_chunk, seed=1):
+    """
+    Split data into chunks of random size.
+    """
+    rnd = random.Random(seed)
+    chunks = []
+    i = 0
+    while i < len(data):
+        n = rnd.randint(1, max_chunk)
+        chunks.append(data[i:i + n])
+        i += n
+    return chunks
+
+
+def run(name, func, chunks, expected):
+    start = time.perf_counter()
+    count = func(chunks)
+    elapsed = time.perf_counter() - start
+    assert count == expected, '{}: parsed {} of {} frames'.format(name, count, expected)
+    return expected / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=20000)
+    parser.add_argument('--json', action='store_true', help='print one JSON object per case')
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    engine_data = b''.join(response(i, rnd.choice((200, 500, 2000, 20000))) for i in range(args.frames))
+    command_data = b''.join(b'property_get -i %d -d 0 -c 0 -n $var%d\0' % (i, i) for i in range(args.frames))
+
+    for max_chunk in (16, 1024, 65536):
+        cases = [
+            ('engine/naive', lambda c: naive_engine_frames(c), fragment(engine_data, max_chunk)),
+            ('engine/framer', lambda c: framer_frames(EngineFramer(), c), fragment(engine_data, max_chunk)),
+            ('command/framer', lambda c: framer_frames(CommandFramer(), c), fragment(command_data, max_chunk)),
+        ]
+        for name, func, chunks in cases:
+            result = {'case': name, 'max_chunk': max_chunk,
+                      'frames_per_sec': run(name, func, chunks, args.frames)}
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print('{case:16s} chunks <= {max_chunk:6d} B  {frames_per_sec:12.0f} frames/s'.format(**result))
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Measure init packets rewritten per second by the byte-level rewriter and by the minidom path.
+
+usage: bench_initpacket.py [--packets N] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from xml.dom import minidom
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbgpproxy.protocol import parse_init_packet, build_init_packet, XML_DECLARATION, frame_message
+from fakes import INIT_TEMPLATE
+
+__author__ = 'gkralik'
+
+
+def rewrite_minidom(data):
+    """
+    The rewrite as done before the byte-level rewriter.
+    """
+    init_packet = minidom.parseString(data.decode()).documentElement
+    init_packet.getAttribute('idekey')
+    init_packet.setAttribute('proxied', '10.0.0.1')
+    init_packet.setAttribute('hostname', '127.0.0.1')
+    return frame_message(XML_DECLARATION + init_packet.toxml())
+
+
+def rewrite_bytes(data):
+    """
+    The rewrite as done by the handlers.
+    """
+    init_packet = parse_init_packet(data)
+    init_packet.getAttribute('idekey')
+    init_packet.setAttribute('proxied', '10.0.0.1')
+    return build_init_packet(init_packet, '127.0.0.1')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--packets', type=int, default=20000)
+    parser.add_argument('--json', action='store_true', help='print one JSON object per implementation')
+    args = parser.parse_args()
+
+    data = INIT_TEMPLATE.format(idekey='PHPSTORM', appid='12345').encode()
+
+    for name, func in (('minidom', rewrite_minidom), ('bytes', rewrite_bytes)):
+        start = time.perf_counter()
+        for i in range(args.packets):
+            func(data)
+        elapsed = time.perf_counter() - start
+
+        result = {'rewriter': name, 'packets_per_sec': args.packets / elapsed}
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('{rewriter:8s} {packets_per_sec:10.0f} init packets/s'.format(**result))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
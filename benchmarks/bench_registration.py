@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Compare registrations/sec with one connection per command, pipelined commands on one connection and bulk proxyinit
+commands.
+
+usage: bench_registration.py [--keys N] [--bulk-size N] [--json]
+"""
+import argparse
+import json
+import socket
+import sys
+import time
+
+from fakes import ProxyProcess, read_frame
+
+__author__ = 'gkralik'
+
+
+def per_connection(proxy, commands):
+    """
+    Send every command on a new connection.
+    """
+    for command in commands:
+        s = socket.create_connection(('127.0.0.1', proxy.ideport))
+        s.sendall(command)
+        read_frame(s)
+        s.close()
+
+
+def pipelined(proxy, commands):
+    """
+    Send all commands on one connection, then read the responses.
+    """
+    s = socket.create_connection(('127.0.0.1', proxy.ideport))
+    s.sendall(b''.join(commands))
+    for command in commands:
+        read_frame(s)
+    s.close()
+
+
+def bench(proxy, mode, keys, bulk_size):
+    """
+    Register and remove keys IDE keys.
+    @return: Tuple of registrations/sec and removals/sec.
+    """
+    idekeys = ['bench{}'.format(i) for i in range(keys)]
+    if mode == 'bulk':
+        chunks = [idekeys[i:i + bulk_size] for i in range(0, keys, bulk_size)]
+        register = [('proxyinit -p 9000 -m 1' + ''.join(' -k ' + k for k in chunk) + '\0').encode() for chunk in chunks]
+        stop = [('proxystop' + ''.join(' -k ' + k for k in chunk) + '\0').encode() for chunk in chunks]
+        send = pipelined
+    else:
+        register = [('proxyinit -p 9000 -m 1 -k {}\0'.format(k)).encode() for k in idekeys]
+        stop = [('proxystop -k {}\0'.format(k)).encode() for k in idekeys]
+        send = per_connection if mode == 'connection' else pipelined
+
+    start = time.perf_counter()
+    send(proxy, register)
+    registered = time.perf_counter()
+    send(proxy, stop)
+    stopped = time.perf_counter()
+    return keys / (registered - start), keys / (stopped - registered)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keys', type=int, default=5000)
+    parser.add_argument('--bulk-size', type=int, default=500, help='IDE keys per bulk command')
+    parser.add_argument('--engines', default='asyncore,asyncio')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per engine and mode')
+    args = parser.parse_args()
+
+    for engine in args.engines.split(','):
+        proxy = ProxyProcess(engine)
+        try:
+            for mode in ('connection', 'pipelined', 'bulk'):
+                registrations, removals = bench(proxy, mode, args.keys, args.bulk_size)
+                result = {'engine': engine, 'mode': mode, 'registrations_s': registrations, 'removals_s': removals}
+                if args.json:
+                    print(json.dumps(result))
+                else:
+                    print('{engine:8s} {mode:10s} {registrations_s:9.0f} registrations/s  {removals_s:9.0f} '
+                          'removals/s'.format(**result))
+                sys.stdout.flush()
+        finally:
+            proxy.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Measure the cost of recording registrations in the registry file and the time to load it at startup.
+
+usage: bench_registry.py [--entries N] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbgpproxy.registry import RegistryLog
+
+__author__ = 'gkralik'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=50000)
+    parser.add_argument('--json', action='store_true', help='print one JSON object')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'registry.log')
+
+    log = RegistryLog(path)
+    log.load()
+    start = time.perf_counter()
+    for i in range(args.entries):
+        log.server_added('idekey{}'.format(i), '10.0.{}.{}'.format(i // 256 % 256, i % 256), 9000, '1')
+    # churn: every second IDE re-registers
+    for i in range(0, args.entries, 2):
+        log.server_removed('idekey{}'.format(i))
+        log.server_added('idekey{}'.format(i), '10.1.{}.{}'.format(i // 256 % 256, i % 256), 9000, '1')
+    enqueue = time.perf_counter() - start
+    ops = args.entries * 2
+    log.close()
+    size = os.path.getsize(path)
+
+    start = time.perf_counter()
+    log = RegistryLog(path)
+    servers = log.load()
+    load = time.perf_counter() - start
+    log.close()
+    assert len(servers) == args.entries
+
+    result = {'entries': args.entries, 'record_us_per_op': enqueue / ops * 1e6, 'log_bytes': size,
+              'load_ms': load * 1000, 'compacted_bytes': os.path.getsize(path)}
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print('{entries} registrations: record {record_us_per_op:.2f} us/op on the loop, log {log_bytes} bytes, '
+              'load {load_ms:.1f} ms, compacted to {compacted_bytes} bytes'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Compare relay throughput and proxy CPU usage of the copy and splice relay modes for large engine responses.
+
+usage: bench_relay.py [--megabytes M] [--response-size BYTES] [--json]
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+
+from fakes import ProxyProcess, FakeIDE, connect_engine, read_frame, response
+
+__author__ = 'gkralik'
+
+
+def bench(proxy, megabytes, size):
+    """
+    Stream large responses from the engine to the IDE.
+    @return: Tuple of MB/s and proxy CPU seconds per MB.
+    """
+    ide = FakeIDE(proxy)
+    ide.register()
+    engine = connect_engine(proxy)
+    session = ide.accept()
+
+    message = response(1, size)
+    count = max(1, megabytes * 1024 * 1024 // len(message))
+
+    def produce():
+        for i in range(count):
+            engine.sendall(message)
+
+    cpu = proxy.cpu_seconds()
+    start = time.perf_counter()
+    producer = threading.Thread(target=produce)
+    producer.start()
+    for i in range(count):
+        read_frame(session)
+    elapsed = time.perf_counter() - start
+    producer.join()
+    cpu = proxy.cpu_seconds() - cpu
+
+    engine.close()
+    session.close()
+    ide.unregister()
+    ide.close()
+
+    total = count * len(message) / 1024 / 1024
+    return total / elapsed, cpu / total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--megabytes', type=int, default=256)
+    parser.add_argument('--response-size', type=int, default=4 * 1024 * 1024)
+    parser.add_argument('--modes', default='copy,splice')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per relay mode')
+    args = parser.parse_args()
+
+    for mode in args.modes.split(','):
+        proxy = ProxyProcess('asyncore', ['--relay', mode])
+        try:
+            throughput, cpu = bench(proxy, args.megabytes, args.response_size)
+        finally:
+            proxy.stop()
+
+        result = {'relay': mode, 'relay_mb_s': throughput, 'cpu_ms_per_mb': cpu * 1000}
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('{relay:8s} relay {relay_mb_s:8.1f} MB/s  proxy cpu {cpu_ms_per_mb:7.3f} ms/MB'.format(**result))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
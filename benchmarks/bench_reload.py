@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""
+Restart the proxy under load with --handoff and check that nobody notices.
+
+Long sessions send commands back to back for the whole run, new short sessions are started and registrations made and
+removed continuously. Meanwhile the proxy is replaced --reloads times by a new process started with --handoff on the
+same ports. Reports the connection attempts that were refused, the sessions that broke (a response missing, late or
+with a wrong transaction id), the commands answered and the slowest one, and how long each old process took to exit.
+
+usage: bench_reload.py [--sessions N] [--reloads N] [--interval SECONDS] [--cache-size BYTES]
+                       [--engines asyncore,asyncio] [--json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+from fakes import ProxyProcess, frame, init_packet, read_frame_async, percentile
+
+__author__ = 'gkralik'
+
+IDEKEY = 'reload'
+
+# seconds a response may take before the session counts as broken
+RESPONSE_TIMEOUT = 5.0
+
+# commands of the long sessions, feature_get is answered from the response cache if there is one
+COMMANDS = ['step_over', 'context_get -d 0', 'feature_get -n encoding', 'property_get -n $x']
+
+
+def response(command, transaction_id):
+    """
+    @return: The framed response of the fake engine.
+    """
+    return frame('<?xml version="1.0" encoding="iso-8859-1"?>\n<response xmlns="urn:debugger_protocol_v1" '
+                 'command="{}" transaction_id="{}"><![CDATA[{}]]></response>'
+                 .format(command.split()[0], transaction_id, 'x' * 200).encode())
+
+
+class Load:
+    """
+    The fake IDE and debugger engines generating the load, and the counters.
+    """
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.refused = 0
+        self.broken = 0
+        self.commands = 0
+        self.sessions = 0
+        self.registrations = 0
+        self.times = []
+        self.running = True
+        self._accepted = {}
+        self._appid = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._accept, '127.0.0.1', 0, backlog=1024)
+        await self.register(IDEKEY)
+
+    async def _accept(self, reader, writer):
+        init = await read_frame_async(reader)
+        appid = init.split(b'appid="', 1)[1].split(b'"', 1)[0].decode()
+        self._accepted.pop(appid).set_result((reader, writer))
+
+    async def _connect(self, port):
+        """
+        Connect to the proxy, counting refused attempts.
+        """
+        while True:
+            try:
+                return await asyncio.open_connection('127.0.0.1', port)
+            except ConnectionRefusedError:
+                self.refused += 1
+                await asyncio.sleep(0.01)
+
+    async def register(self, idekey, stop=False):
+        reader, writer = await self._connect(self.proxy.ideport)
+        if stop:
+            writer.write('proxystop -k {}\0'.format(idekey).encode())
+        else:
+            port = self._server.sockets[0].getsockname()[1]
+            writer.write('proxyinit -p {} -k {} -m 1\0'.format(port, idekey).encode())
+        reply = await read_frame_async(reader)
+        writer.close()
+        if b'success="1"' not in reply:
+            raise AssertionError('registration failed: {}'.format(reply.decode(errors='replace')))
+        self.registrations += 1
+
+    async def session(self, commands=None):
+        """
+        Run a session, until the load stops if commands is None.
+        """
+        self._appid += 1
+        appid = str(self._appid)
+        accepted = self._accepted[appid] = asyncio.get_running_loop().create_future()
+        reader, writer = await self._connect(self.proxy.dbgport)
+        engine_task = asyncio.ensure_future(engine_session(reader, writer, appid))
+        try:
+            ide_reader, ide_writer = await asyncio.wait_for(accepted, RESPONSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.broken += 1
+            engine_task.cancel()
+            return
+
+        transaction_id = 0
+        try:
+            while self.running if commands is None else transaction_id < commands:
+                transaction_id += 1
+                command = COMMANDS[transaction_id % len(COMMANDS)]
+                sent = time.perf_counter()
+                ide_writer.write('{} -i {}\0'.format(command, transaction_id).encode())
+                received = await asyncio.wait_for(read_frame_async(ide_reader), RESPONSE_TIMEOUT)
+                if 'transaction_id="{}"'.format(transaction_id).encode() not in received:
+                    raise AssertionError('wrong response')
+                self.times.append(time.perf_counter() - sent)
+                self.commands += 1
+        except (AssertionError, asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            self.broken += 1
+        else:
+            self.sessions += 1
+        ide_writer.close()
+        writer.close()
+        await asyncio.gather(engine_task, return_exceptions=True)
+
+    async def churn(self):
+        """
+        Start short sessions and make and remove registrations until the load stops.
+        """
+        n = 0
+        while self.running:
+            n += 1
+            await self.session(commands=5)
+            await self.register('churn{}'.format((n + 1) // 2), stop=n % 2 == 0)
+
+    def close(self):
+        self._server.close()
+
+
+async def engine_session(reader, writer, appid):
+    """
+    Answer the commands of a session on an established engine connection.
+    """
+    writer.write(init_packet(IDEKEY, appid))
+    try:
+        while True:
+            args = (await reader.readuntil(b'\0'))[:-1].decode().split(' ')
+            i = args.index('-i')
+            transaction_id = args[i + 1]
+            del args[i:i + 2]
+            writer.write(response(' '.join(args), transaction_id))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def run(engine_name, sessions, reloads, interval, cache_size):
+    """
+    Run the load and reload the proxy.
+    @return: Dict of results.
+    """
+    path = os.path.join(tempfile.mkdtemp(prefix='dbgpproxy-'), 'handoff.sock')
+    args = ['--handoff', path, '--cache-size', str(cache_size)]
+    proxy = ProxyProcess(engine_name, args)
+    load = Load(proxy)
+    exits = []
+    try:
+        await load.start()
+        tasks = [asyncio.ensure_future(load.session()) for i in range(sessions)]
+        tasks.append(asyncio.ensure_future(load.churn()))
+
+        for i in range(reloads):
+            await asyncio.sleep(interval)
+            successor = ProxyProcess(engine_name, args, ideport=proxy.ideport, dbgport=proxy.dbgport, wait=False)
+            start = time.perf_counter()
+            while proxy.process.poll() is None and time.perf_counter() - start < 30:
+                await asyncio.sleep(0.01)
+            exits.append(time.perf_counter() - start if proxy.process.poll() is not None else None)
+            if proxy.process.poll() is None:
+                proxy.stop()
+            proxy = load.proxy = successor
+
+        await asyncio.sleep(interval)
+        load.running = False
+        await asyncio.gather(*tasks)
+    finally:
+        proxy.stop()
+        load.close()
+
+    return {'refused': load.refused, 'broken': load.broken, 'sessions_completed': load.sessions,
+            'commands': load.commands, 'registrations': load.registrations,
+            'response_p50_ms': percentile(load.times, 50) * 1000, 'response_max_ms': max(load.times) * 1000,
+            'exits': exits}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=20, help='long sessions kept open during the reloads')
+    parser.add_argument('--reloads', type=int, default=3)
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between reloads')
+    parser.add_argument('--cache-size', type=int, default=0)
+    parser.add_argument('--engines', default='asyncore,asyncio')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per engine')
+    args = parser.parse_args()
+
+    for engine_name in args.engines.split(','):
+        result = asyncio.run(run(engine_name, args.sessions, args.reloads, args.interval, args.cache_size))
+        result.update(engine=engine_name, sessions=args.sessions, reloads=args.reloads)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            exits = ', '.join('{:.2f} s'.format(e) if e is not None else 'never' for e in result['exits'])
+        print('{engine:8s}: {reloads} reloads, {refused} refused connections, {broken} broken sessions, '
+                  '{sessions_completed} sessions completed, {commands} commands (p50 {response_p50_ms:.2f} ms, max '
+                  '{response_max_ms:.1f} ms), {registrations} registrations, old processes exited after {exits_s}'
+                  .format(exits_s=exits, **result))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Debug a parallel test suite through one IDE key: workers run tests one after another, every test opens a debug
+session, and the IDE runs a few commands per session and then ends it. Reports tests/s, the most sessions the IDE had
+open at once and how long tests waited until the IDE saw their session, for each --max-sessions value.
+
+usage: bench_sessions.py [--workers N] [--tests N] [--commands N] [--max-sessions 0,1,4] [--json]
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from fakes import ProxyProcess, init_packet, response, command_id, read_frame_async, percentile
+
+__author__ = 'gkralik'
+
+
+class IDE:
+    """
+    IDE that answers every proxied session with a number of commands and then closes it.
+    """
+
+    def __init__(self, commands):
+        self.commands = commands
+        self.open = 0
+        self.peak = 0
+        # appid -> time the session reached the IDE
+        self.started = {}
+
+    async def handle(self, reader, writer):
+        init = await read_frame_async(reader)
+        self.started[init.split(b'appid="')[1].split(b'"')[0].decode()] = time.perf_counter()
+        self.open += 1
+        self.peak = max(self.peak, self.open)
+        try:
+            for i in range(self.commands):
+                writer.write('property_get -i {} -n $x\0'.format(i).encode())
+                await read_frame_async(reader)
+        finally:
+            self.open -= 1
+            writer.close()
+
+
+async def engine(proxy, appid):
+    """
+    Run one test: open a session and answer commands until the IDE ends it.
+    @return: Time the engine connected.
+    """
+    reader, writer = await asyncio.open_connection('127.0.0.1', proxy.dbgport)
+    connected = time.perf_counter()
+    writer.write(init_packet('suite', appid))
+    try:
+        while True:
+            command = (await reader.readuntil(b'\0'))[:-1]
+            writer.write(response(command_id(command), 256))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+    return connected
+
+
+async def run(proxy, workers, tests, commands):
+    """
+    Run the suite against one proxy.
+    @return: Dict of results.
+    """
+    ide = IDE(commands)
+    server = await asyncio.start_server(ide.handle, '127.0.0.1', 0, backlog=1024)
+    port = server.sockets[0].getsockname()[1]
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', proxy.ideport)
+    writer.write('proxyinit -p {} -k suite -m 1\0'.format(port).encode())
+    await read_frame_async(reader)
+    writer.close()
+
+    connected = {}
+
+    async def worker(n):
+        for i in range(tests):
+            appid = '{}-{}'.format(n, i)
+            connected[appid] = await engine(proxy, appid)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(n) for n in range(workers)))
+    elapsed = time.perf_counter() - start
+    server.close()
+
+    waits = [ide.started[appid] - connected[appid] for appid in connected if appid in ide.started]
+    return {'tests_s': len(ide.started) / elapsed, 'failed': len(connected) - len(ide.started), 'peak_open': ide.peak,
+            'wait_p50_ms': percentile(waits, 50) * 1000, 'wait_p99_ms': percentile(waits, 99) * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=16, help='tests running in parallel')
+    parser.add_argument('--tests', type=int, default=50, help='tests per worker')
+    parser.add_argument('--commands', type=int, default=20, help='commands the IDE sends per session')
+    parser.add_argument('--max-sessions', default='0,1,4', help='comma separated --max-sessions values')
+    parser.add_argument('--engines', default='asyncore,asyncio')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per engine and limit')
+    args = parser.parse_args()
+
+    for engine in args.engines.split(','):
+        for max_sessions in map(int, args.max_sessions.split(',')):
+            proxy = ProxyProcess(engine, ['--max-sessions', str(max_sessions), '--session-queue',
+                                          str(args.workers)])
+            try:
+                result = asyncio.run(run(proxy, args.workers, args.tests, args.commands))
+            finally:
+                proxy.stop()
+
+            result.update(engine=engine, max_sessions=max_sessions, workers=args.workers)
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print('{engine:8s} max {max_sessions:2d}: {tests_s:7.1f} tests/s  {failed} failed  IDE peak '
+                      '{peak_open:2d} open  wait p50 {wait_p50_ms:7.2f} ms  p99 {wait_p99_ms:7.2f} ms'.format(**result))
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""
+Compare bytes on the wire and command round-trip latency of a heavy debug session between plain relaying and a
+tunnel link.
+
+The datacenter proxy and the developer's IDE are separated by a counting forwarder standing in for the VPN, which can
+add a round-trip time. Plain: the datacenter proxy connects to the IDE through the forwarder for every session.
+Tunnel: a developer-side proxy started with --tunnel keeps one link through the forwarder to the datacenter proxy
+started with --tunnel-listen, and the IDE registers with the developer-side proxy.
+
+The session is synthesized (source listings, context_get with many variables, property_get of base64 encoded
+values) or replayed from a file written with --capture.
+
+usage: bench_tunnel.py [--sessions N] [--steps N] [--rtt MS] [--capture FILE] [--engines asyncore,asyncio] [--json]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import sys
+import time
+
+from fakes import ProxyProcess, free_port, frame, init_packet, read_frame_async, percentile, wait_for_port
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbgpproxy.capture import TO_ENGINE, TO_IDE, read_capture
+
+__author__ = 'gkralik'
+
+RESPONSE_HEAD = ('<?xml version="1.0" encoding="iso-8859-1"?>\n<response xmlns="urn:debugger_protocol_v1" '
+                 'xmlns:xdebug="http://xdebug.org/dbgp/xdebug" command="{command}" transaction_id="{{id}}">')
+
+
+def synthesize_session(steps):
+    """
+    Build the commands and responses of a heavy session: every step lists a source file, gets the local context and
+    a large variable.
+    @param steps: Number of steps.
+    @return: List of (command, response) tuples, the command without transaction id and the response with a {id}
+             placeholder.
+    """
+    rng = random.Random(1)
+    words = ['$user', '$request', '$this->container', 'return', 'foreach', 'array', '=>', 'if', 'null', '$items',
+             'function', 'public', 'static', '$query', '->get(', '->where(', "'id'", "'name'", ';', '{', '}']
+    session = []
+    for step in range(steps):
+        source = '\n'.join('    ' * rng.randint(0, 4) + ' '.join(rng.choice(words) for i in range(rng.randint(2, 12)))
+                           for line in range(400)).encode()
+        session.append(('source -f file:///var/www/src/Controller{}.php'.format(step % 20),
+                        RESPONSE_HEAD.format(command='source') + '<![CDATA[' +
+                        base64.b64encode(source).decode() + ']]></response>'))
+
+        properties = ''.join('<property name="$var{0}" fullname="$var{0}" type="string" size="{1}" encoding="base64">'
+                             '<![CDATA[{2}]]></property>'.format(i, rng.randint(1, 64),
+                                                                 base64.b64encode(rng.choice(words).encode()).decode())
+                             for i in range(200))
+        session.append(('context_get -d 0 -c 0', RESPONSE_HEAD.format(command='context_get') + properties +
+                        '</response>'))
+
+        value = json.dumps([{'id': rng.randint(1, 10 ** 6), 'name': rng.choice(words), 'active': rng.random() < 0.5}
+                            for i in range(1000)]).encode()
+        session.append(('property_get -n $items -m 0', RESPONSE_HEAD.format(command='property_get') +
+                        '<property name="$items" type="string" encoding="base64"><![CDATA[' +
+                        base64.b64encode(value).decode() + ']]></property></response>'))
+
+        session.append(('step_over', RESPONSE_HEAD.format(command='step_over') + '<xdebug:message '
+                        'filename="file:///var/www/src/Controller{}.php" lineno="{}"/></response>'
+                        .format(step % 20, rng.randint(1, 400))))
+    return session
+
+
+def load_session(path):
+    """
+    Pair the commands and responses of a capture file.
+    @param path: The capture file.
+    @return: List of (command, response) tuples like synthesize_session().
+    """
+    to_engine = bytearray()
+    to_ide = bytearray()
+    for timestamp, direction, data in read_capture(path):
+        if direction == TO_ENGINE:
+            to_engine += data
+        elif direction == TO_IDE:
+            to_ide += data
+
+    commands = [c for c in bytes(to_engine).split(b'\0') if c]
+    responses = []
+    offset = 0
+    while True:
+        end = to_ide.find(b'\0', offset)
+        if end < 0:
+            break
+        length = int(to_ide[offset:end])
+        responses.append(bytes(to_ide[end + 1:end + 1 + length]))
+        offset = end + 2 + length
+    # drop the init packet
+    responses = [r for r in responses if b'<init' not in r[:200]]
+
+    session = []
+    for command, response in zip(commands, responses):
+        args = command.decode('utf-8', 'replace').split()
+        transaction_id = args[args.index('-i') + 1] if '-i' in args else None
+        if '-i' in args:
+            del args[args.index('-i'):args.index('-i') + 2]
+        text = response.decode('iso-8859-1').replace('{', '{{').replace('}', '}}')
+        if transaction_id is not None:
+            text = text.replace('transaction_id="{}"'.format(transaction_id), 'transaction_id="{id}"')
+        session.append((' '.join(args), text))
+    return session
+
+
+class Forwarder:
+    """
+    TCP forwarder counting the bytes in both directions and delaying them by half the round-trip time each way.
+    """
+
+    def __init__(self, target_port, rtt):
+        self.target_port = target_port
+        self.delay = rtt / 2
+        self.bytes = 0
+        self.connections = 0
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        try:
+            target_reader, target_writer = await asyncio.open_connection('127.0.0.1', self.target_port)
+        except OSError:
+            writer.close()
+            return
+        try:
+            await asyncio.gather(self._pipe(reader, target_writer), self._pipe(target_reader, writer))
+        except asyncio.CancelledError:
+            # the link is still open when the benchmark ends
+            pass
+
+    async def _pipe(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        async def deliver():
+            while True:
+                due, data = await queue.get()
+                if data is None:
+                    break
+                if due > loop.time():
+                    await asyncio.sleep(due - loop.time())
+                writer.write(data)
+                await writer.drain()
+            writer.close()
+
+        task = asyncio.ensure_future(deliver())
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                self.bytes += len(data)
+                queue.put_nowait((loop.time() + self.delay, data))
+        except OSError:
+            pass
+        queue.put_nowait((0, None))
+        try:
+            await task
+        except OSError:
+            pass
+
+    def close(self):
+        self.server.close()
+
+
+async def run(engine, mode, session, sessions, rtt):
+    """
+    Run the sessions one after another in the given mode.
+    @return: Dict of results.
+    """
+    accepted = asyncio.Queue()
+
+    async def accept(reader, writer):
+        await read_frame_async(reader)
+        accepted.put_nowait((reader, writer))
+
+    ide = await asyncio.start_server(accept, '127.0.0.1', 0)
+    ide_port = ide.sockets[0].getsockname()[1]
+
+    proxies = []
+    if mode == 'plain':
+        hub = ProxyProcess(engine)
+        proxies.append(hub)
+        forwarder = Forwarder(ide_port, rtt)
+        await forwarder.start()
+        register_port, register_as = hub.ideport, forwarder.port
+    else:
+        tunnel_port = free_port()
+        hub = ProxyProcess(engine, ['--tunnel-listen', '127.0.0.1:{}'.format(tunnel_port)])
+        proxies.append(hub)
+        wait_for_port(tunnel_port)
+        forwarder = Forwarder(tunnel_port, rtt)
+        await forwarder.start()
+        edge = ProxyProcess(engine, ['--tunnel', '127.0.0.1:{}'.format(forwarder.port)])
+        proxies.append(edge)
+        register_port, register_as = edge.ideport, ide_port
+
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', register_port)
+        writer.write('proxyinit -p {} -k tunnel -m 1\0'.format(register_as).encode())
+        await read_frame_async(reader)
+        writer.close()
+
+        if mode == 'tunnel':
+            # wait for the registration to reach the datacenter proxy
+            while True:
+                reader, writer = await asyncio.open_connection('127.0.0.1', hub.ideport)
+                writer.write(b'proxylist\0')
+                listed = await read_frame_async(reader)
+                writer.close()
+                if b'idekey="tunnel"' in listed:
+                    break
+                await asyncio.sleep(0.05)
+
+        registered_bytes = forwarder.bytes
+        times = []
+        payload = 0
+        start = time.perf_counter()
+        for i in range(sessions):
+            engine_reader, engine_writer = await asyncio.open_connection('127.0.0.1', hub.dbgport)
+            engine_writer.write(init_packet('tunnel', str(i)))
+            ide_reader, ide_writer = await asyncio.wait_for(accepted.get(), 30)
+
+            for transaction_id, (command, response) in enumerate(session):
+                sent = time.perf_counter()
+                ide_writer.write('{} -i {}\0'.format(command, transaction_id).encode())
+                await engine_reader.readuntil(b'\0')
+                data = frame(response.format(id=transaction_id).encode('iso-8859-1'))
+                payload += len(data)
+                engine_writer.write(data)
+                await read_frame_async(ide_reader)
+                times.append(time.perf_counter() - sent)
+
+            engine_writer.close()
+            await ide_reader.read()
+            ide_writer.close()
+        duration = time.perf_counter() - start
+    finally:
+        for proxy in proxies:
+            proxy.stop()
+        forwarder.close()
+        ide.close()
+
+    return {'payload_bytes': payload, 'wire_bytes': forwarder.bytes - registered_bytes,
+            'vpn_connections': forwarder.connections, 'rtt_p50_ms': percentile(times, 50) * 1000,
+            'rtt_p99_ms': percentile(times, 99) * 1000, 'duration_s': duration}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=5, help='sessions run one after another')
+    parser.add_argument('--steps', type=int, default=20, help='steps of the synthesized session')
+    parser.add_argument('--rtt', type=float, default=0.0, help='round-trip time added by the VPN in milliseconds')
+    parser.add_argument('--capture', help='replay the session of a capture file instead of a synthesized one')
+    parser.add_argument('--engines', default='asyncore,asyncio')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per engine and mode')
+    args = parser.parse_args()
+
+    session = load_session(args.capture) if args.capture else synthesize_session(args.steps)
+    for engine in args.engines.split(','):
+        for mode in ('plain', 'tunnel'):
+            result = asyncio.run(run(engine, mode, session, args.sessions, args.rtt / 1000))
+            result.update(engine=engine, mode=mode, sessions=args.sessions, commands=len(session) * args.sessions)
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print('{engine:8s} {mode:6s}: {payload_bytes} bytes of frames, {wire_bytes:10d} bytes on the VPN '
+                      '({vpn_connections} connections)  round trip p50 {rtt_p50_ms:7.2f} ms  p99 {rtt_p99_ms:7.2f} ms'
+                      '  {duration_s:6.2f} s'.format(**result))
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Compare session setup and relay latency of the proxy over loopback TCP, IPv6 loopback TCP and Unix domain sockets.
+
+The debugger engine, the proxy and the IDE all talk over the same transport: the proxy listens on 127.0.0.1, ::1 or
+unix:/path and the IDE registers an address of the same kind. Session setup is the time from the engine connecting
+until the IDE has received the init packet, relay latency the round trip of a command through the proxy to the engine
+and of its response back.
+
+usage: bench_unix.py [--sessions N] [--commands N] [--response-size BYTES] [--transports tcp,tcp6,unix]
+                     [--engines asyncore,asyncio] [--json]
+"""
+import argparse
+import json
+import sys
+import time
+
+from fakes import ProxyProcess, FakeIDE, connect_engine, read_frame, recv_exactly, response, percentile
+
+__author__ = 'gkralik'
+
+HOSTS = {'tcp': '127.0.0.1', 'tcp6': '::1', 'unix': 'unix'}
+
+
+def read_command(sock):
+    """
+    @return: The next command received by the fake engine (bytes, without the \\0).
+    """
+    data = bytearray()
+    while not data.endswith(b'\0'):
+        data += recv_exactly(sock, 1)
+    return bytes(data[:-1])
+
+
+def bench(proxy, sessions, commands, size):
+    """
+    Start sessions one after the other, then send commands through the last one.
+    @return: Tuple of the setup times and the round trip times (seconds).
+    """
+    ide = FakeIDE(proxy)
+    ide.register()
+
+    setup = []
+    for i in range(sessions):
+        start = time.perf_counter()
+        engine = connect_engine(proxy, appid=str(i))
+        session = ide.accept()
+        setup.append(time.perf_counter() - start)
+        if i < sessions - 1:
+            engine.close()
+            session.close()
+
+    roundtrips = []
+    for transaction_id in range(1, commands + 1):
+        message = response(transaction_id, size)
+        start = time.perf_counter()
+        session.sendall('step_over -i {}\0'.format(transaction_id).encode())
+        read_command(engine)
+        engine.sendall(message)
+        read_frame(session)
+        roundtrips.append(time.perf_counter() - start)
+
+    engine.close()
+    session.close()
+    ide.unregister()
+    ide.close()
+    return setup, roundtrips
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=500)
+    parser.add_argument('--commands', type=int, default=5000)
+    parser.add_argument('--response-size', type=int, default=512)
+    parser.add_argument('--transports', default='tcp,tcp6,unix')
+    parser.add_argument('--engines', default='asyncore,asyncio')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per engine and transport')
+    args = parser.parse_args()
+
+    for engine_name in args.engines.split(','):
+        for transport in args.transports.split(','):
+            proxy = ProxyProcess(engine_name, host=HOSTS[transport])
+            try:
+                setup, roundtrips = bench(proxy, args.sessions, args.commands, args.response_size)
+            finally:
+                proxy.stop()
+
+            result = {'engine': engine_name, 'transport': transport,
+                      'setup_p50_ms': percentile(setup, 50) * 1000, 'setup_p99_ms': percentile(setup, 99) * 1000,
+                      'rtt_p50_us': percentile(roundtrips, 50) * 1e6, 'rtt_p99_us': percentile(roundtrips, 99) * 1e6}
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print('{engine:8s} {transport:5s} setup p50 {setup_p50_ms:6.3f} ms  p99 {setup_p99_ms:6.3f} ms  '
+                      'round trip p50 {rtt_p50_us:7.1f} us  p99 {rtt_p99_us:7.1f} us'.format(**result))
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
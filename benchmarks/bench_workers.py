@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Measure session setups/sec with different numbers of worker processes (--workers).
+
+Every client process registers its own IDE key and sets up sessions back to back for the given duration.
+
+usage: bench_workers.py [--workers 1,2,4] [--clients N] [--duration SECONDS] [--json]
+"""
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+
+from fakes import ProxyProcess, FakeIDE, connect_engine
+
+__author__ = 'gkralik'
+
+
+def client(proxy, idekey, duration, results):
+    """
+    Set up sessions until the duration is over.
+    """
+    ide = FakeIDE(proxy, idekey)
+    ide.register()
+    # wait for the registration to reach all workers
+    time.sleep(0.2)
+
+    count = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        engine = connect_engine(proxy, idekey)
+        session = ide.accept()
+        engine.close()
+        session.close()
+        count += 1
+
+    ide.close()
+    results.put(count)
+
+
+def bench(workers, clients, duration):
+    """
+    @return: Session setups per second.
+    """
+    proxy = ProxyProcess(args=['--workers', str(workers)])
+    try:
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=client, args=(proxy, 'bench{}'.format(i), duration, results))
+                     for i in range(clients)]
+        for p in processes:
+            p.start()
+        total = sum(results.get() for p in processes)
+        for p in processes:
+            p.join()
+    finally:
+        proxy.stop()
+
+    return total / duration
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default='1,2,4')
+    parser.add_argument('--clients', type=int, default=multiprocessing.cpu_count() * 2)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--json', action='store_true', help='print one JSON object per worker count')
+    args = parser.parse_args()
+
+    for workers in [int(w) for w in args.workers.split(',')]:
+        result = {'workers': workers, 'clients': args.clients,
+                  'sessions_per_sec': bench(workers, args.clients, args.duration)}
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('{workers:3d} workers  {clients:3d} clients  {sessions_per_sec:9.1f} sessions/s'.format(**result))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    multiprocessing.set_start_method('fork')
+    main()
@@ -0,0 +1,450 @@
+"""
+In-process stand-ins for the debugger engine and the IDE, used by the benchmarks.
+
+Both talk to a dbgpproxy started as a subprocess from bin/dbgpproxy.
+"""
+import asyncio
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+__author__ = 'gkralik'
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BIN = os.path.join(ROOT, 'bin', 'dbgpproxy')
+
+INIT_TEMPLATE = ('<?xml version="1.0" encoding="iso-8859-1"?>\n'
+                 '<init xmlns="urn:debugger_protocol_v1" xmlns:xdebug="http://xdebug.org/dbgp/xdebug" '
+                 'fileuri="file:///var/www/index.php" language="PHP" xdebug:language_version="8.2.0" '
+                 'protocol_version="1.0" appid="{appid}" idekey="{idekey}">'
+                 '<engine version="3.2.0"><![CDATA[Xdebug]]></engine></init>')
+
+
+def free_port(host='127.0.0.1'):
+    """
+    Get a free TCP port on the loopback interface.
+    @param host: The loopback address, 127.0.0.1 or ::1.
+    @return: The port.
+    """
+    s = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    s.bind((host, 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def connect(host, port):
+    """
+    Connect to a loopback port or a Unix domain socket.
+    @param host: The loopback address, or 'unix' for a Unix domain socket.
+    @param port: The port, or the path of the Unix domain socket.
+    @return: The connected socket.
+    """
+    if host == 'unix':
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(port)
+        return sock
+    sock = socket.create_connection((host, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def socket_path(name):
+    """
+    @return: A path for a Unix domain socket in a new temporary directory.
+    """
+    return os.path.join(tempfile.mkdtemp(prefix='dbgpproxy-'), name)
+
+
+def wait_for_port(port, timeout=10.0, host='127.0.0.1'):
+    """
+    Wait until something listens on the given loopback port.
+    @param port: The port, or the path of a Unix domain socket.
+    @param timeout: Seconds to wait.
+    @param host: The loopback address, or 'unix' for a Unix domain socket.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if host == 'unix':
+                s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                s.settimeout(0.2)
+                s.connect(port)
+                s.close()
+            else:
+                socket.create_connection((host, port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.02)
+    raise RuntimeError('nothing listening on port {}'.format(port))
+
+
+class ProxyProcess:
+    def __init__(self, engine=None, args=(), ideport=None, dbgport=None, wait=True, host='127.0.0.1'):
+        """
+        Start bin/dbgpproxy on free loopback ports.
+        @param engine: The engine to select with -e (None for the default).
+        @param args: Additional command line arguments.
+        @param ideport: The IDE port (defaults to a free one), the socket path for host 'unix'.
+        @param dbgport: The debugger engine port (defaults to a free one), the socket path for host 'unix'.
+        @param wait: Wait until the proxy listens on both ports.
+        @param host: The loopback address to listen on, 127.0.0.1 or ::1, or 'unix' for Unix domain sockets.
+        """
+        self.host = host
+        if host == 'unix':
+            self.ideport = ideport or socket_path('ide.sock')
+            self.dbgport = dbgport or socket_path('dbg.sock')
+        else:
+            self.ideport = ideport or free_port(host)
+            self.dbgport = dbgport or free_port(host)
+        cmd = [sys.executable, BIN, '-i', self._address(self.ideport), '-d', self._address(self.dbgport), '-l', 'WARN']
+        if engine:
+            cmd += ['-e', engine]
+        cmd += list(args)
+        self.process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+        if wait:
+            wait_for_port(self.ideport, host=host)
+            wait_for_port(self.dbgport, host=host)
+
+    def _address(self, port):
+        """
+        @return: The -i/-d argument for a port.
+        """
+        if self.host == 'unix':
+            return 'unix:{}'.format(port)
+        return ('[{}]:{}' if ':' in self.host else '{}:{}').format(self.host, port)
+
+    def rss_kb(self):
+        """
+        @return: The resident set size of the proxy in KiB (Linux only).
+        """
+        return rss_kb(self.process.pid)
+
+    def cpu_seconds(self):
+        """
+        @return: User plus system CPU time of the proxy in seconds (Linux only).
+        """
+        return cpu_seconds(self.process.pid)
+
+    def stop(self):
+        """
+        Terminate the proxy.
+        """
+        self.process.terminate()
+        self.process.wait()
+
+
+def rss_kb(pid):
+    """
+    @return: The resident set size of a process in KiB (Linux only).
+    """
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def cpu_seconds(pid):
+    """
+    @return: User plus system CPU time of a process in seconds (Linux only).
+    """
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def recv_exactly(sock, n):
+    """
+    Receive exactly n bytes.
+    @param sock: The socket.
+    @param n: Number of bytes.
+    @return: The data.
+    """
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(min(n - len(buf), 262144))
+        if not chunk:
+            raise EOFError('connection closed')
+        buf += chunk
+    return bytes(buf)
+
+
+def read_frame(sock):
+    """
+    Read one len\\0xml\\0 frame.
+    @param sock: The socket.
+    @return: The XML payload.
+    """
+    prefix = bytearray()
+    while True:
+        c = sock.recv(1)
+        if not c:
+            raise EOFError('connection closed')
+        if c == b'\0':
+            break
+        prefix += c
+    return recv_exactly(sock, int(prefix) + 1)[:-1]
+
+
+def frame(payload):
+    """
+    Frame an engine message.
+    @param payload: The XML payload (bytes).
+    @return: The framed message.
+    """
+    return str(len(payload)).encode() + b'\0' + payload + b'\0'
+
+
+def init_packet(idekey, appid='1'):
+    """
+    @return: A framed init packet for the given IDE key.
+    """
+    return frame(INIT_TEMPLATE.format(idekey=idekey, appid=appid).encode())
+
+
+def response(transaction_id, size):
+    """
+    Build a framed engine response with a payload of roughly size bytes.
+    @param transaction_id: The transaction id.
+    @param size: Payload size.
+    @return: The framed response.
+    """
+    head = ('<?xml version="1.0" encoding="iso-8859-1"?>\n<response xmlns="urn:debugger_protocol_v1" '
+            'command="property_get" transaction_id="{}"><property encoding="base64"><![CDATA['
+            .format(transaction_id)).encode()
+    tail = b']]></property></response>'
+    return frame(head + b'A' * max(0, size - len(head) - len(tail)) + tail)
+
+
+def command_id(command):
+    """
+    Extract the transaction id of an IDE command.
+    @param command: The command without the trailing \\0 (bytes).
+    @return: The transaction id (str).
+    """
+    args = command.split()
+    return args[args.index(b'-i') + 1].decode()
+
+
+class FakeIDE:
+    def __init__(self, proxy, idekey='bench'):
+        """
+        Listen for debug sessions and register at the proxy.
+        @param proxy: The ProxyProcess.
+        @param idekey: The IDE key to register.
+        """
+        self.proxy = proxy
+        self.idekey = idekey
+        if proxy.host == 'unix':
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.port = 'unix:' + socket_path('ide.sock')
+            self.listener.bind(self.port[5:])
+        else:
+            self.listener = socket.socket(socket.AF_INET6 if ':' in proxy.host else socket.AF_INET,
+                                          socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind((proxy.host, 0))
+            self.port = self.listener.getsockname()[1]
+        self.listener.listen(1024)
+
+    def command(self, line):
+        """
+        Send a command to the registration port.
+        @param line: The command (str).
+        @return: The response payload.
+        """
+        s = connect(self.proxy.host, self.proxy.ideport)
+        try:
+            s.sendall(line.encode() + b'\0')
+            return read_frame(s)
+        finally:
+            s.close()
+
+    def register(self):
+        """
+        Send proxyinit for this IDE.
+        @return: The response payload.
+        """
+        return self.command('proxyinit -p {} -k {} -m 1'.format(self.port, self.idekey))
+
+    def unregister(self):
+        """
+        Send proxystop for this IDE.
+        @return: The response payload.
+        """
+        return self.command('proxystop -k {}'.format(self.idekey))
+
+    def accept(self):
+        """
+        Accept a proxied debug session and read its init packet.
+        @return: The session socket.
+        """
+        sock, addr = self.listener.accept()
+        read_frame(sock)
+        return sock
+
+    def close(self):
+        self.listener.close()
+
+
+def connect_engine(proxy, idekey='bench', appid='1'):
+    """
+    Connect a fake debugger engine to the proxy and send the init packet.
+    @param proxy: The ProxyProcess.
+    @param idekey: The IDE key.
+    @return: The engine socket.
+    """
+    sock = connect(proxy.host, proxy.dbgport)
+    sock.sendall(init_packet(idekey, appid))
+    return sock
+
+
+def percentile(values, p):
+    """
+    @return: The p-th percentile of values (nearest rank).
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[k]
+
+
+async def read_frame_async(reader):
+    """
+    Read one len\\0xml\\0 frame from an asyncio stream.
+    @param reader: The StreamReader.
+    @return: The XML payload.
+    """
+    prefix = await reader.readuntil(b'\0')
+    return (await reader.readexactly(int(prefix[:-1]) + 1))[:-1]
+
+
+class AsyncFakeEngine:
+    """
+    Debugger engine that answers every command with a response of -m bytes (or response_size if -m is missing).
+    """
+
+    def __init__(self, proxy, idekey, response_size=512):
+        """
+        @param proxy: The ProxyProcess.
+        @param idekey: The IDE key sent in the init packet.
+        @param response_size: Default response size.
+        """
+        self.proxy = proxy
+        self.idekey = idekey
+        self.response_size = response_size
+        self.writer = None
+
+    async def connect(self):
+        """
+        Connect to the proxy, send the init packet and answer commands until the connection is closed.
+        """
+        reader, self.writer = await asyncio.open_connection('127.0.0.1', self.proxy.dbgport)
+        self.writer.write(init_packet(self.idekey))
+        return asyncio.ensure_future(self._serve(reader))
+
+    async def _serve(self, reader):
+        try:
+            while True:
+                command = (await reader.readuntil(b'\0'))[:-1]
+                args = command.split()
+                size = int(args[args.index(b'-m') + 1]) if b'-m' in args else self.response_size
+                self.writer.write(response(command_id(command), size))
+                await self.writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.writer.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class AsyncFakeIDE:
+    """
+    IDE that registers any number of IDE keys for one listener and sends commands to the proxied sessions.
+    """
+    _IDEKEY = re.compile(rb'idekey="([^"]*)"')
+
+    def __init__(self, proxy):
+        """
+        @param proxy: The ProxyProcess.
+        """
+        self.proxy = proxy
+        self.port = None
+        # idekey -> (reader, writer)
+        self.sessions = {}
+        self._server = None
+        self._changed = None
+        self._transaction_id = 0
+
+    async def start(self):
+        """
+        Start listening for proxied sessions.
+        """
+        self._changed = asyncio.Event()
+        self._server = await asyncio.start_server(self._accept, '127.0.0.1', 0, backlog=4096)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def _accept(self, reader, writer):
+        init = await read_frame_async(reader)
+        self.sessions[self._IDEKEY.search(init).group(1).decode()] = (reader, writer)
+        self._changed.set()
+
+    async def wait_session(self, idekey):
+        """
+        Wait until the session of an IDE key has been proxied.
+        """
+        while idekey not in self.sessions:
+            self._changed.clear()
+            await self._changed.wait()
+
+    async def command(self, line):
+        """
+        Send a command to the registration port.
+        @param line: The command (str).
+        @return: The response payload.
+        """
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.proxy.ideport)
+        try:
+            writer.write(line.encode() + b'\0')
+            return await read_frame_async(reader)
+        finally:
+            writer.close()
+
+    async def register(self, idekey):
+        """
+        Send proxyinit for an IDE key.
+        """
+        return await self.command('proxyinit -p {} -k {} -m 1'.format(self.port, idekey))
+
+    async def roundtrip(self, idekey, size=None):
+        """
+        Send a command to a session and wait for the response.
+        @param idekey: The IDE key of the session.
+        @param size: Response size requested from the AsyncFakeEngine (-m).
+        @return: Tuple of seconds until the response arrived and the response size.
+        """
+        reader, writer = self.sessions[idekey]
+        self._transaction_id += 1
+        line = 'property_get -i {} -n $x'.format(self._transaction_id)
+        if size is not None:
+            line += ' -m {}'.format(size)
+
+        start = time.perf_counter()
+        writer.write(line.encode() + b'\0')
+        data = await read_frame_async(reader)
+        return time.perf_counter() - start, len(data)
+
+    def close(self):
+        for reader, writer in self.sessions.values():
+            writer.close()
+        if self._server is not None:
+            self._server.close()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+Load test: registrations/sec, session setups/sec, command round-trip latency, relay throughput and proxy memory at
+different numbers of concurrent sessions.
+
+For every engine and session count a fresh proxy is started. Fake IDEs register one IDE key per session, fake engines
+connect and the IDE then sends commands to all sessions at the same time: first small ones for the latency numbers,
+then ones with large responses for the throughput.
+
+usage: loadtest.py [--sessions 1,100,1000] [--engines asyncore,asyncio] [--commands N] [--response-size BYTES]
+                   [--megabytes M] [--concurrency N] [--json]
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from fakes import ProxyProcess, AsyncFakeEngine, AsyncFakeIDE, percentile
+
+__author__ = 'gkralik'
+
+# responses requested in the throughput phase
+BULK_RESPONSE_SIZE = 256 * 1024
+
+
+async def limited(coroutines, concurrency):
+    """
+    Run coroutines with at most concurrency of them at a time.
+    @return: List of results.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(run(c) for c in coroutines))
+
+
+async def sample_rss(proxy, peak):
+    """
+    Record the peak RSS of the proxy in peak[0] until cancelled.
+    """
+    while True:
+        peak[0] = max(peak[0], proxy.rss_kb())
+        await asyncio.sleep(0.05)
+
+
+async def run(proxy, sessions, commands, response_size, megabytes, concurrency):
+    """
+    Run all phases against one proxy.
+    @return: Dict of results.
+    """
+    ide = AsyncFakeIDE(proxy)
+    await ide.start()
+    idekeys = ['load{}'.format(i) for i in range(sessions)]
+    result = {'sessions': sessions, 'rss_start_kb': proxy.rss_kb()}
+
+    peak = [0]
+    sampler = asyncio.ensure_future(sample_rss(proxy, peak))
+    engines = []
+    try:
+        start = time.perf_counter()
+        await limited((ide.register(idekey) for idekey in idekeys), concurrency)
+        result['registrations_s'] = sessions / (time.perf_counter() - start)
+
+        async def setup(engine):
+            await engine.connect()
+            await ide.wait_session(engine.idekey)
+
+        engines = [AsyncFakeEngine(proxy, idekey, response_size) for idekey in idekeys]
+        start = time.perf_counter()
+        await limited((setup(engine) for engine in engines), concurrency)
+        result['setups_s'] = sessions / (time.perf_counter() - start)
+        result['rss_sessions_kb'] = proxy.rss_kb()
+
+        async def roundtrips(idekey, count, size=None):
+            return [await ide.roundtrip(idekey, size) for i in range(count)]
+
+        results = await asyncio.gather(*(roundtrips(idekey, commands) for idekey in idekeys))
+        latencies = [latency for session in results for latency, size in session]
+        result['rtt_p50_ms'] = percentile(latencies, 50) * 1000
+        result['rtt_p99_ms'] = percentile(latencies, 99) * 1000
+
+        per_session = max(1, megabytes * 1024 * 1024 // BULK_RESPONSE_SIZE // sessions)
+        start = time.perf_counter()
+        results = await asyncio.gather(*(roundtrips(idekey, per_session, BULK_RESPONSE_SIZE) for idekey in idekeys))
+        elapsed = time.perf_counter() - start
+        result['relay_mb_s'] = sum(size for session in results for latency, size in session) / elapsed / 1024 / 1024
+    finally:
+        sampler.cancel()
+        for engine in engines:
+            engine.close()
+        ide.close()
+
+    result['rss_peak_kb'] = peak[0]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', default='1,100,1000', help='comma separated numbers of concurrent sessions')
+    parser.add_argument('--engines', default='asyncore,asyncio')
+    parser.add_argument('--commands', type=int, default=20, help='small commands per session')
+    parser.add_argument('--response-size', type=int, default=512, help='size of responses to small commands')
+    parser.add_argument('--megabytes', type=int, default=256, help='data relayed in the throughput phase')
+    parser.add_argument('--concurrency', type=int, default=64,
+                        help='registrations and session setups in flight (keep below the proxy\'s --backlog)')
+    parser.add_argument('--args', default='', help='additional proxy arguments')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per engine and session count')
+    args = parser.parse_args()
+
+    for engine in args.engines.split(','):
+        for sessions in map(int, args.sessions.split(',')):
+            proxy = ProxyProcess(engine, args.args.split())
+            try:
+                result = asyncio.run(run(proxy, sessions, args.commands, args.response_size, args.megabytes,
+                                         args.concurrency))
+            finally:
+                proxy.stop()
+
+            result['engine'] = engine
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print('{engine:8s} {sessions:5d} sessions: {registrations_s:8.0f} reg/s  {setups_s:7.0f} setups/s  '
+                      'rtt p50 {rtt_p50_ms:7.3f} ms  p99 {rtt_p99_ms:8.3f} ms  relay {relay_mb_s:7.1f} MB/s  '
+                      'rss {rss_sessions_kb} KiB (peak {rss_peak_kb} KiB)'.format(**result))
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
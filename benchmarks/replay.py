@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+"""
+Load test the proxy by replaying sessions recorded with --capture at N times their speed.
+
+Every replayed session plays both ends of a recording: a fake IDE registers through the registration port and
+listens for the session, a fake debugger engine connects to the debugger port and sends the recorded init packet,
+then both sides send their recorded messages with the recorded think time divided by --speed. A message is only sent
+once the messages the other side had sent before it in the recording have arrived, so a response never overtakes its
+command however fast the replay runs. The init packet carries an IDE key of its own per replayed session.
+
+Sessions are replayed --concurrency at a time from the given capture files (and the capture files in the given
+directories) in turn, against a proxy started per engine or, with --ide and --dbg, against a running proxy. Reported
+are session setup and command round-trip latencies, how much faster than recorded the sessions ran, and the CPU time
+and peak RSS of the proxy (with --pid for a running proxy).
+
+usage: replay.py CAPTURE [CAPTURE ...] [--speed X] [--concurrency N] [--sessions N] [--engines asyncore,asyncio]
+                 [--args ARGS] [--ide ADDRESS --dbg ADDRESS [--pid PID]] [--json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+
+from fakes import ProxyProcess, cpu_seconds, frame, percentile, read_frame_async, rss_kb
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbgpproxy.address import UNIX, parse_address
+from dbgpproxy.capture import TO_ENGINE, TO_IDE, read_capture
+
+__author__ = 'gkralik'
+
+# sides of a replayed session, the one sending a message
+IDE = 0
+ENGINE = 1
+
+# seconds a side waits for the next message of the other side before the session counts as failed
+MESSAGE_TIMEOUT = 30.0
+
+_IDEKEY = re.compile(rb'idekey="[^"]*"')
+_TRANSACTION_ID = re.compile(rb'transaction_id="([^"]*)"')
+_COMMAND_ID = re.compile(rb'(?:^| )-i ([^ ]+)')
+
+
+class Script:
+    """
+    The messages of a recorded session in the order they were relayed.
+
+    Each step is a tuple of the sending side, the seconds since the previous message of either side, the number of
+    messages of the other side sent before it and the message: an IDE command without its \\0 or the payload of a
+    frame of the engine.
+    """
+
+    def __init__(self, path):
+        """
+        Load a capture file.
+        @param path: The capture file.
+        @raise ValueError: If it holds no init packet.
+        """
+        self.path = path
+        self.init = None
+        self.steps = []
+        # messages per side
+        self.counts = [0, 0]
+        self.duration = 0.0
+
+        buffers = {TO_ENGINE: bytearray(), TO_IDE: bytearray()}
+        first = last = None
+        for timestamp, direction, data in read_capture(path):
+            if first is None:
+                first = last = timestamp
+            buffer = buffers[direction]
+            buffer += data
+            for message in (self._commands(buffer) if direction == TO_ENGINE else self._frames(buffer)):
+                if direction == TO_IDE and self.init is None:
+                    self.init = message
+                    last = timestamp
+                    continue
+                side = IDE if direction == TO_ENGINE else ENGINE
+                self.steps.append((side, max(0.0, timestamp - last), self.counts[1 - side], message))
+                self.counts[side] += 1
+                last = timestamp
+        if self.init is None:
+            raise ValueError('no init packet in {}'.format(path))
+        if first is not None:
+            self.duration = last - first
+
+    @staticmethod
+    def _commands(buffer):
+        """
+        Take the complete commands off the front of a buffer.
+        @return: List of commands (bytes, without the \\0).
+        """
+        *commands, rest = bytes(buffer).split(b'\0')
+        del buffer[:len(buffer) - len(rest)]
+        return commands
+
+    @staticmethod
+    def _frames(buffer):
+        """
+        Take the complete frames off the front of a buffer.
+        @return: List of frame payloads (bytes).
+        """
+        payloads = []
+        start = 0
+        while True:
+            end = buffer.find(b'\0', start)
+            if end < 0:
+                break
+            length = int(buffer[start:end])
+            if len(buffer) < end + 2 + length:
+                break
+            payloads.append(bytes(buffer[end + 1:end + 1 + length]))
+            start = end + 2 + length
+        del buffer[:start]
+        return payloads
+
+    def init_packet(self, idekey):
+        """
+        @return: The recorded init packet with another IDE key, framed.
+        """
+        return frame(_IDEKEY.sub('idekey="{}"'.format(idekey).encode(), self.init, count=1))
+
+
+def find_captures(paths):
+    """
+    @param paths: Capture files and directories of capture files.
+    @return: Sorted list of capture files.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if os.path.isfile(os.path.join(path, name))))
+        else:
+            files.append(path)
+    return files
+
+
+async def open_connection(host, port):
+    """
+    Connect to an address of the proxy, a Unix domain socket if the host is UNIX.
+    @return: Tuple of the stream reader and writer.
+    """
+    if host == UNIX:
+        return await asyncio.open_unix_connection(port)
+    return await asyncio.open_connection(host, port)
+
+
+class Target:
+    """
+    The proxy the sessions are replayed against.
+    """
+
+    def __init__(self, ide_address, dbg_address, pid=None):
+        """
+        @param ide_address: Tuple of host and port of the registration port.
+        @param dbg_address: Tuple of host and port of the debugger port.
+        @param pid: Process id of the proxy, to read its CPU time and RSS, or None.
+        """
+        self.ide_address = ide_address
+        self.dbg_address = dbg_address
+        self.pid = pid
+
+    @classmethod
+    def of(cls, proxy):
+        """
+        @param proxy: The ProxyProcess.
+        @return: The Target for a proxy started by the benchmark.
+        """
+        return cls((proxy.host, proxy.ideport), (proxy.host, proxy.dbgport), proxy.process.pid)
+
+    def rss_kb(self):
+        return rss_kb(self.pid) if self.pid else 0
+
+    def cpu_seconds(self):
+        return cpu_seconds(self.pid) if self.pid else 0.0
+
+
+class ReplayIDE:
+    """
+    Listens for the replayed sessions and hands each one to the session waiting for its IDE key.
+    """
+
+    def __init__(self, target):
+        """
+        @param target: The Target.
+        """
+        self.target = target
+        self.port = None
+        # idekey -> future of (reader, writer, init packet arrival time)
+        self._waiting = {}
+        self._server = None
+
+    async def start(self):
+        """
+        Start listening for proxied sessions.
+        """
+        self._server = await asyncio.start_server(self._accept, '127.0.0.1', 0, backlog=4096)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def _accept(self, reader, writer):
+        try:
+            init = await read_frame_async(reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        arrived = time.perf_counter()
+        match = re.search(rb'idekey="([^"]*)"', init)
+        future = self._waiting.pop(match.group(1).decode(), None) if match else None
+        if future is None or future.done():
+            writer.close()
+        else:
+            future.set_result((reader, writer, arrived))
+
+    def expect(self, idekey):
+        """
+        @return: Future of the stream reader, writer and arrival time of the init packet of an IDE key's session.
+        """
+        future = self._waiting[idekey] = asyncio.get_running_loop().create_future()
+        return future
+
+    async def command(self, line):
+        """
+        Send a command to the registration port.
+        @param line: The command (str).
+        @return: The response payload.
+        """
+        reader, writer = await open_connection(*self.target.ide_address)
+        try:
+            writer.write(line.encode() + b'\0')
+            return await read_frame_async(reader)
+        finally:
+            writer.close()
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+
+
+class Side:
+    """
+    One side of a replayed session: sends its messages and counts the messages of the other side.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.received = 0
+        self.last_received = 0.0
+        self.changed = asyncio.Event()
+
+    async def wait_for(self, count):
+        """
+        Wait until count messages of the other side have arrived.
+        @return: The time the last of them arrived.
+        @raise asyncio.TimeoutError: If no message arrives for MESSAGE_TIMEOUT seconds.
+        """
+        while self.received < count:
+            self.changed.clear()
+            await asyncio.wait_for(self.changed.wait(), MESSAGE_TIMEOUT)
+        return self.last_received
+
+    def arrived(self):
+        self.received += 1
+        self.last_received = time.perf_counter()
+        self.changed.set()
+
+
+async def replay(target, ide, script, idekey, speed, latencies):
+    """
+    Replay one recorded session.
+    @param target: The Target.
+    @param ide: The ReplayIDE.
+    @param script: The Script.
+    @param idekey: IDE key of the replayed session.
+    @param speed: Factor the think time is divided by, 0 for none.
+    @param latencies: List the command round trips (seconds) are appended to.
+    @return: Dict of the session setup time and the replay duration (seconds), or None if the session failed.
+    """
+    session = ide.expect(idekey)
+    engine_writer = ide_writer = None
+    try:
+        await ide.command('proxyinit -p {} -k {} -m 1'.format(ide.port, idekey))
+        start = time.perf_counter()
+        engine_reader, engine_writer = await open_connection(*target.dbg_address)
+        engine_writer.write(script.init_packet(idekey))
+        ide_reader, ide_writer, arrived = await asyncio.wait_for(session, MESSAGE_TIMEOUT)
+        setup = arrived - start
+
+        sides = {IDE: Side(ide_reader, ide_writer), ENGINE: Side(engine_reader, engine_writer)}
+        # transaction id -> times the command was sent
+        sent = {}
+
+        async def receive_commands(side):
+            try:
+                while side.received < script.counts[IDE]:
+                    await side.reader.readuntil(b'\0')
+                    side.arrived()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+
+        async def receive_frames(side):
+            try:
+                while side.received < script.counts[ENGINE]:
+                    payload = await read_frame_async(side.reader)
+                    side.arrived()
+                    match = _TRANSACTION_ID.search(payload, 0, 512)
+                    times = sent.get(match.group(1)) if match else None
+                    if times:
+                        latencies.append(side.last_received - times.pop(0))
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+
+        async def play(sender):
+            side = sides[sender]
+            last = arrived
+            for step_sender, gap, need, message in script.steps:
+                if step_sender != sender:
+                    continue
+                # the think time counts from the later of the own last message and the one waited for
+                ready = max(last, await side.wait_for(need))
+                if speed:
+                    delay = ready + gap / speed - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                if sender == IDE:
+                    match = _COMMAND_ID.search(message)
+                    if match:
+                        sent.setdefault(match.group(1), []).append(time.perf_counter())
+                    side.writer.write(message + b'\0')
+                else:
+                    side.writer.write(frame(message))
+                await side.writer.drain()
+                last = time.perf_counter()
+            await side.wait_for(script.counts[1 - sender])
+
+        receivers = [asyncio.ensure_future(receive_frames(sides[IDE])),
+                     asyncio.ensure_future(receive_commands(sides[ENGINE]))]
+        try:
+            await asyncio.gather(play(IDE), play(ENGINE))
+        finally:
+            for receiver in receivers:
+                receiver.cancel()
+        return {'setup': setup, 'duration': time.perf_counter() - arrived}
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+        print('session {} ({}) failed: {!r}'.format(idekey, script.path, e), file=sys.stderr)
+        return None
+    finally:
+        if not session.done():
+            session.cancel()
+        for writer in (engine_writer, ide_writer):
+            if writer is not None:
+                writer.close()
+        try:
+            await ide.command('proxystop -k {}'.format(idekey))
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+
+
+async def sample_rss(target, peak):
+    """
+    Record the peak RSS of the proxy in peak[0] until cancelled.
+    """
+    while True:
+        peak[0] = max(peak[0], target.rss_kb())
+        await asyncio.sleep(0.05)
+
+
+async def run(target, scripts, sessions, concurrency, speed):
+    """
+    Replay sessions against one proxy.
+    @return: Dict of results.
+    """
+    ide = ReplayIDE(target)
+    await ide.start()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def limited(i):
+        async with semaphore:
+            return await replay(target, ide, scripts[i % len(scripts)], 'replay{}'.format(i), speed, latencies)
+
+    result = {'sessions': sessions, 'concurrency': concurrency, 'speed': speed, 'rss_start_kb': target.rss_kb()}
+    peak = [0]
+    sampler = asyncio.ensure_future(sample_rss(target, peak))
+    cpu = target.cpu_seconds()
+    start = time.perf_counter()
+    try:
+        replayed = await asyncio.gather(*(limited(i) for i in range(sessions)))
+    finally:
+        sampler.cancel()
+        ide.close()
+    elapsed = time.perf_counter() - start
+    result['proxy_cpu_s'] = target.cpu_seconds() - cpu
+
+    completed = [(session, scripts[i % len(scripts)]) for i, session in enumerate(replayed) if session is not None]
+    setups = [session['setup'] for session, script in completed]
+    result['completed'] = len(completed)
+    result['failed'] = sessions - len(completed)
+    result['commands'] = len(latencies)
+    result['elapsed_s'] = elapsed
+    result['proxy_cpu_percent'] = result['proxy_cpu_s'] * 100 / elapsed
+    result['setup_p50_ms'] = percentile(setups, 50) * 1000 if setups else 0.0
+    result['setup_p99_ms'] = percentile(setups, 99) * 1000 if setups else 0.0
+    for p in (50, 90, 99):
+        result['rtt_p{}_ms'.format(p)] = percentile(latencies, p) * 1000 if latencies else 0.0
+    result['rtt_max_ms'] = max(latencies) * 1000 if latencies else 0.0
+    # recorded over replayed duration, at most --speed unless the proxy or the replay falls behind
+    recorded = sum(script.duration for session, script in completed)
+    replayed_duration = sum(session['duration'] for session, script in completed)
+    result['speedup'] = recorded / replayed_duration if replayed_duration else 0.0
+    result['rss_peak_kb'] = peak[0]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('captures', nargs='+', help='capture files or directories of capture files')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='factor the recorded think time is divided by, 0 to send as soon as possible')
+    parser.add_argument('--concurrency', type=int, default=10, help='sessions replayed at the same time')
+    parser.add_argument('--sessions', type=int, default=None,
+                        help='sessions to replay, cycling through the captures (default: each capture once)')
+    parser.add_argument('--engines', default='asyncore,asyncio')
+    parser.add_argument('--args', default='', help='additional proxy arguments')
+    parser.add_argument('--ide', help='registration port of a running proxy (hostname:port or unix:/path)')
+    parser.add_argument('--dbg', help='debugger port of a running proxy (hostname:port or unix:/path)')
+    parser.add_argument('--pid', type=int, help='process id of the running proxy, for its CPU time and RSS')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per engine')
+    args = parser.parse_args()
+
+    if (args.ide is None) != (args.dbg is None):
+        parser.error('--ide and --dbg go together')
+    scripts = []
+    for path in find_captures(args.captures):
+        try:
+            scripts.append(Script(path))
+        except (OSError, ValueError) as e:
+            print('skipping {}: {}'.format(path, e), file=sys.stderr)
+    if not scripts:
+        parser.error('no usable capture files')
+    sessions = args.sessions or len(scripts)
+    if not args.json:
+        for script in scripts:
+            print('{}: {} commands, {} engine messages, {:.1f} s'.format(
+                script.path, script.counts[IDE], script.counts[ENGINE], script.duration))
+
+    if args.ide is not None:
+        runs = [('running', None)]
+    else:
+        runs = [(engine, None) for engine in args.engines.split(',')]
+
+    for engine, proxy in runs:
+        if args.ide is not None:
+            target = Target(parse_address(args.ide), parse_address(args.dbg), args.pid)
+        else:
+            proxy = ProxyProcess(engine, args.args.split())
+            target = Target.of(proxy)
+        try:
+            result = asyncio.run(run(target, scripts, sessions, args.concurrency, args.speed))
+        finally:
+            if proxy is not None:
+                proxy.stop()
+
+        result['engine'] = engine
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('{engine:8s} {completed}/{sessions} sessions x{speed:g}: setup p50 {setup_p50_ms:.3f} ms  '
+                  'rtt p50 {rtt_p50_ms:.3f} ms  p90 {rtt_p90_ms:.3f} ms  p99 {rtt_p99_ms:.3f} ms  '
+                  'max {rtt_max_ms:.3f} ms  ({commands} commands)  speedup {speedup:.1f}  '
+                  'proxy cpu {proxy_cpu_s:.2f} s ({proxy_cpu_percent:.0f}%)  rss peak {rss_peak_kb} KiB'
+                  .format(**result))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
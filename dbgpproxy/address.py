@@ -0,0 +1,116 @@
+import os
+import socket
+import stat
+
+__author__ = 'gkralik'
+
+# host of Unix domain socket addresses, the port is the path of the socket
+UNIX = 'unix'
+
+# host of peers connected over a Unix domain socket, they run on this host
+LOCALHOST = '127.0.0.1'
+
+
+def parse_address(value):
+    """
+    Parse an address given as hostname:port, [IPv6 address]:port or unix:/path.
+    @param value: The address (str).
+    @return: Tuple of host and port (int), or of UNIX and the path.
+    @raise ValueError: If the address is invalid.
+    """
+    if value.startswith(UNIX + ':'):
+        path = value[len(UNIX) + 1:]
+        if not path:
+            raise ValueError('missing socket path in {}'.format(value))
+        return UNIX, path
+
+    if value.startswith('['):
+        host, sep, port = value[1:].partition(']:')
+        if not sep:
+            raise ValueError('invalid IPv6 address {}'.format(value))
+    else:
+        host, sep, port = value.rpartition(':')
+        if not sep or ':' in host:
+            raise ValueError('expected hostname:port or [address]:port, got {}'.format(value))
+    return host, int(port)
+
+
+def format_address(host, port):
+    """
+    @return: The address in the form parse_address() accepts (str).
+    """
+    if host == UNIX:
+        return '{}:{}'.format(UNIX, port)
+    if ':' in host:
+        return '[{}]:{}'.format(host, port)
+    return '{}:{}'.format(host, port)
+
+
+def address_family(host):
+    """
+    @return: The socket family of a host: AF_UNIX for UNIX, AF_INET6 for IPv6 addresses and AF_INET otherwise.
+    """
+    if host == UNIX:
+        return socket.AF_UNIX
+    if ':' in host:
+        return socket.AF_INET6
+    return socket.AF_INET
+
+
+def socket_address(host, port):
+    """
+    @return: The address to pass to bind() and connect() for a host and port.
+    """
+    return port if host == UNIX else (host, port)
+
+
+def create_socket(host):
+    """
+    Create a stream socket for connecting to or listening on a host. TCP sockets have Nagle's algorithm disabled.
+    @param host: The host, UNIX for a Unix domain socket.
+    @return: The socket.
+    """
+    sock = socket.socket(address_family(host), socket.SOCK_STREAM)
+    set_nodelay(sock)
+    return sock
+
+
+def set_nodelay(sock):
+    """
+    Send small writes right away on a TCP socket. Unix domain sockets do not delay them anyway.
+    @param sock: The socket.
+    """
+    if sock.family != socket.AF_UNIX:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def peer_address(sock, peername):
+    """
+    @param sock: The connected socket.
+    @param peername: Its peer address, as returned by accept() or getpeername().
+    @return: The peer address as a tuple starting with host and port, (LOCALHOST, 0) for Unix domain sockets.
+    """
+    if sock.family == socket.AF_UNIX:
+        return LOCALHOST, 0
+    return peername
+
+
+def is_local(host):
+    """
+    @return: True if the host is the loopback interface, where Unix domain sockets of this host can be reached.
+    """
+    return host in (LOCALHOST, '::1', 'localhost')
+
+
+def bind_unix(sock, path):
+    """
+    Bind a Unix domain socket, replacing a socket file left behind by a previous process.
+    @param sock: The socket.
+    @param path: The path.
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock.bind(path)
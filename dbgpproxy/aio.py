@@ -0,0 +1,1007 @@
+import asyncio
+import logging
+import selectors
+import socket
+import time
+from functools import partial
+from dbgpproxy.address import UNIX, address_family, format_address, peer_address
+from dbgpproxy.capture import TO_IDE, TO_ENGINE
+from dbgpproxy.framing import EngineFramer, FrameError
+from dbgpproxy.protocol import RegistrationCommands, parse_init_packet, build_init_packet, frame_message
+from dbgpproxy.relay import create_forwarder
+from dbgpproxy.sessions import START, QUEUED
+
+__author__ = 'gkralik'
+
+_handle_run = asyncio.Handle._run
+
+# MonitoredEventLoops running now, asyncio.Handle._run is replaced while there are any
+_monitored_loops = 0
+
+
+def _run_monitored(handle):
+    """
+    Run a callback of the event loop, timed by the LoopMonitor of a MonitoredEventLoop.
+    @param handle: The asyncio.Handle.
+    """
+    monitor = getattr(handle._loop, 'monitor', None)
+    if monitor is None:
+        return _handle_run(handle)
+    return monitor.call(handle._callback, _handle_run, handle)
+
+
+class MonitoredSelector(selectors.DefaultSelector):
+    """
+    Reports the time the event loop spends between two waits for events to a LoopMonitor.
+    """
+
+    def __init__(self, monitor):
+        """
+        Initialize the MonitoredSelector.
+        @param monitor: The LoopMonitor.
+        """
+        super().__init__()
+        self._monitor = monitor
+        self._woken = None
+
+    def select(self, timeout=None):
+        """
+        Record the iteration that just ended and wait for events.
+        """
+        if self._woken is not None:
+            self._monitor.iteration(time.perf_counter() - self._woken)
+        ready = super().select(timeout)
+        self._woken = time.perf_counter()
+        return ready
+
+
+class MonitoredEventLoop(asyncio.SelectorEventLoop):
+    """
+    Event loop timing its iterations and callbacks with a LoopMonitor (see dbgpproxy.monitor).
+
+    asyncio has no public hook around callbacks (its debug mode logs slow ones, but slows down the whole loop), so
+    asyncio.Handle._run is replaced while a MonitoredEventLoop runs and restored once it stops. Callbacks of other loops
+    running meanwhile are run unchanged.
+    """
+
+    def __init__(self, monitor):
+        """
+        Initialize the MonitoredEventLoop.
+        @param monitor: The LoopMonitor.
+        """
+        super().__init__(MonitoredSelector(monitor))
+        self.monitor = monitor
+
+    def run_forever(self):
+        """
+        Run the event loop with its callbacks timed.
+        """
+        global _monitored_loops
+        if not _monitored_loops:
+            asyncio.Handle._run = _run_monitored
+        _monitored_loops += 1
+        try:
+            super().run_forever()
+        finally:
+            _monitored_loops -= 1
+            if not _monitored_loops:
+                asyncio.Handle._run = _handle_run
+
+
+class RegistrationServer:
+    def __init__(self, idehost, ideport, dbghost, dbgport, proxy_manager):
+        """
+        Initialize the RegistrationServer.
+
+        The listening socket is created by start().
+        @param idehost: The host to listen on for IDE requests.
+        @param ideport: The port to listen on for IDE requests.
+        @param dbghost: The host that the DebugConnectionServer is listening on for requests from the debugging engine.
+        @param dbgport: The port that the DebugConnectionServer is listening on for requests from the debugging engine.
+        @param proxy_manager: The proxy manager instance.
+        """
+        self._ideport = ideport
+        self._idehost = idehost
+
+        self._dbghost = dbghost
+        self._dbgport = dbgport
+
+        self._proxy_manager = proxy_manager
+        self._server = None
+
+        self.logger = logging.getLogger('dbgpproxy.ide')
+
+    async def start(self):
+        """
+        Create the listening socket and start accepting registration connections.
+        """
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_server(
+            lambda: RegistrationHandler(self._proxy_manager, dbghost=self._dbghost, dbgport=self._dbgport),
+            sock=self._proxy_manager.create_listener('ide', self._idehost, self._ideport),
+            backlog=self._proxy_manager.backlog)
+
+        self.logger.info('listening for registration requests on {}:{}...'.format(self._idehost, self._ideport))
+
+    def close(self):
+        """
+        Stop listening.
+        """
+        if self._server is not None:
+            self._server.close()
+
+
+class RegistrationHandler(RegistrationCommands, asyncio.Protocol):
+    def __init__(self, proxy_manager, dbghost=None, dbgport=None):
+        """
+        Initialize the RegistrationHandler.
+        @param proxy_manager: The proxy manger instance.
+        @param dbghost: The host that the DebugConnectionServer is listening on for requests from the debugging engine.
+        @param dbgport: The port that the DebugConnectionServer is listening on for requests from the debugging engine.
+        """
+        self.logger = logging.getLogger('dbgpproxy.ide')
+        self._proxy_manager = proxy_manager
+        self._transport = None
+        self._peer_host = None
+
+        self._dbghost = dbghost
+        self._dbgport = dbgport
+
+    def connection_made(self, transport):
+        """
+        Remember the transport and the address of the IDE.
+        @param transport: The transport.
+        """
+        self._transport = transport
+        self._peer_host = peer_address(transport.get_extra_info('socket'), transport.get_extra_info('peername'))[0]
+        self._proxy_manager.registration_handlers.add(self)
+        self.logger.debug('incoming registration connection from {}'.format(self._peer_host))
+
+    def data_received(self, data):
+        """
+        Handle commands sent by the IDE.
+        @param data: The received data.
+        """
+        self.handle_data(data)
+
+    def connection_lost(self, exc):
+        """
+        Handle socket close.
+        @param exc: The exception or None on EOF.
+        """
+        self.stop_commands()
+        self._proxy_manager.registration_handlers.discard(self)
+
+    def send_message(self, data):
+        """
+        Send a message to the IDE.
+        @param data: The message (str).
+        """
+        self._transport.write(frame_message(data))
+
+    def close(self):
+        """
+        Close the connection once pending data has been written.
+        """
+        self._transport.close()
+
+    def handoff_state(self):
+        """
+        @return: The socket if the connection can be handed off to another process now, i.e. no partial command or
+                 response is buffered, otherwise None.
+        """
+        if self.commands_idle() and not self._transport.is_closing() and not self._transport.get_write_buffer_size():
+            return self._transport.get_extra_info('socket')
+        return None
+
+    def detach(self):
+        """
+        Close the connection in this process after it has been handed off.
+        """
+        self.stop_commands()
+        self._transport.close()
+
+
+class RelayProtocol(asyncio.Protocol):
+    """
+    Protocol of one side of a session. Reading from its transport is paused for one or more reasons at once, the other
+    side not keeping up, the IDE connection being set up and the relay budget (see dbgpproxy.fairness), and resumed
+    once none is left. All pauses and resumes go through hold_reading() and release_reading().
+    """
+    _pauses = frozenset()
+
+    def hold_reading(self, reason):
+        """
+        Pause reading.
+        @param reason: The reason (str).
+        """
+        if not self._pauses and not self.transport.is_closing():
+            self.transport.pause_reading()
+        self._pauses = self._pauses | {reason}
+
+    def release_reading(self, reason):
+        """
+        Resume reading unless it is paused for another reason.
+        @param reason: The reason passed to hold_reading().
+        """
+        if reason not in self._pauses:
+            return
+        self._pauses = self._pauses - {reason}
+        # held sessions are released in the next loop iteration, maybe after they have been closed
+        if not self._pauses and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def relayed(self, session, data):
+        """
+        Count relayed data with the RelayScheduler and stop reading until the next loop iteration once the session
+        has used up its budget.
+        @param session: The session (its DebugConnectionHandler).
+        @param data: The data.
+        """
+        relay = session._proxy_manager.relay_scheduler
+        if relay is not None and relay.relayed(session, data):
+            self.hold_reading('budget')
+            relay.hold(partial(self.release_reading, 'budget'))
+
+
+def duplicate_socket(transport):
+    """
+    @param transport: The transport.
+    @return: A non-blocking socket on a duplicate of the transport's descriptor.
+    """
+    sock = transport.get_extra_info('socket')
+    dup = socket.fromfd(sock.fileno(), sock.family, sock.type, sock.proto)
+    dup.setblocking(False)
+    return dup
+
+
+class SpliceRelay:
+    """
+    Forwards an established session with Forwarders (see dbgpproxy.relay), in splice relay mode.
+
+    The loop does not let a descriptor of a transport be watched directly, so the forwarders work on duplicates of the
+    sockets, watched with add_reader()/add_writer() of the proxy manager. The transports stay open without reading or
+    writing until the session ends, then they are closed as usual.
+    """
+
+    def __init__(self, debug_handler):
+        """
+        Initialize the SpliceRelay and start forwarding.
+        @param debug_handler: The DebugConnectionHandler of the session, both write buffers must be empty.
+        """
+        self._debug_handler = debug_handler
+        self._proxy_manager = debug_handler._proxy_manager
+        self._engine_sock = duplicate_socket(debug_handler.transport)
+        self._ide_sock = duplicate_socket(debug_handler._ide_handler.transport)
+        self._to_ide = create_forwarder(self._engine_sock, self._ide_sock)
+        self._to_engine = create_forwarder(self._ide_sock, self._engine_sock)
+        self._writing = set()
+        self.closed = False
+
+        self._proxy_manager.add_reader(self._engine_sock, partial(self._read, self._to_ide, self._engine_sock,
+                                                                  self._ide_sock))
+        self._proxy_manager.add_reader(self._ide_sock, partial(self._read, self._to_engine, self._ide_sock,
+                                                               self._engine_sock))
+
+    @property
+    def pending(self):
+        """
+        @return: True if forwarded data has not been written yet.
+        """
+        return bool(self._to_ide.pending or self._to_engine.pending)
+
+    def _read(self, forwarder, src, dst):
+        """
+        Forward available data from src to dst.
+        """
+        try:
+            n = forwarder.read()
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close()
+            return
+
+        if not n:
+            self.close()
+            return
+
+        if forwarder is self._to_ide:
+            self._debug_handler.metrics.bytes_to_ide += n
+        else:
+            self._debug_handler.metrics.bytes_to_engine += n
+        self._write(forwarder, src, dst)
+
+    def _write(self, forwarder, src, dst):
+        """
+        Write the pending data of a forwarder. src is not read from until it has been written completely.
+        """
+        try:
+            while forwarder.pending:
+                forwarder.write()
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.close()
+            return
+
+        if forwarder.pending and dst not in self._writing:
+            self._writing.add(dst)
+            self._proxy_manager.remove_reader(src)
+            self._proxy_manager.add_writer(dst, partial(self._write, forwarder, src, dst))
+        elif not forwarder.pending and dst in self._writing:
+            self._writing.discard(dst)
+            self._proxy_manager.remove_writer(dst)
+            self._proxy_manager.add_reader(src, partial(self._read, forwarder, src, dst))
+
+    def close(self):
+        """
+        Stop forwarding and close the session.
+        """
+        if self.closed:
+            return
+        self.closed = True
+
+        for sock in (self._engine_sock, self._ide_sock):
+            self._proxy_manager.remove_reader(sock)
+            if sock in self._writing:
+                self._proxy_manager.remove_writer(sock)
+            sock.close()
+        self._writing.clear()
+        self._to_ide.close()
+        self._to_engine.close()
+
+        self._debug_handler._ide_handler.transport.close()
+        self._debug_handler.transport.close()
+
+
+class ToIDEHandler(RelayProtocol):
+    def __init__(self, debug_handler):
+        """
+        Initialize the ToIDEHandler.
+        @param debug_handler: The DebugConnectionHandler of the debugger engine.
+        """
+        self._debug_handler = debug_handler
+        self.transport = None
+        self.logger = logging.getLogger('dbgpproxy.dbg')
+
+    @property
+    def idekey(self):
+        """
+        @return: The IDE key of the session.
+        """
+        return self._debug_handler.idekey
+
+    def connection_made(self, transport):
+        """
+        Remember the transport.
+        @param transport: The transport.
+        """
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self._debug_handler.buffer_size)
+
+    def data_received(self, data):
+        """
+        Handle data sent by the IDE and forward to the debugging engine.
+        @param data: The received data.
+        """
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('<-- {}'.format(data.decode(errors='replace')))
+        self._debug_handler.send(data)
+        self.relayed(self._debug_handler, data)
+
+    def pause_writing(self):
+        """
+        Stop reading from the debugger engine while the IDE does not keep up.
+        """
+        self._debug_handler.hold_reading('ide')
+
+    def resume_writing(self):
+        """
+        Resume reading from the debugger engine.
+        """
+        self._debug_handler.release_reading('ide')
+        self._debug_handler.try_splice()
+
+    def connection_lost(self, exc):
+        """
+        Handle socket close.
+
+        Also closes the debugger engine connection.
+        @param exc: The exception or None on EOF.
+        """
+        self._debug_handler.transport.close()
+
+
+class DebugConnectionServer:
+    def __init__(self, host, port, proxy_manager):
+        """
+        Initialize the DebugConnectionServer.
+
+        The listening socket is created by start().
+        @param host: The host to listen on.
+        @param port: The port to listen on.
+        @param proxy_manager: The proxy manager instance.
+        """
+        self._host = host
+        self._port = port
+        self._proxy_manager = proxy_manager
+        self._server = None
+
+        self.logger = logging.getLogger('dbgpproxy.dbg')
+
+    async def start(self):
+        """
+        Create the listening socket and start accepting debugger engine connections.
+
+        asyncio accepts up to backlog pending connections per readiness event. Connections not admitted by the
+        session table are aborted in DebugConnectionHandler.connection_made().
+        """
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_server(
+            lambda: DebugConnectionHandler(self._proxy_manager, dbghost=self._host, dbgport=self._port),
+            sock=self._proxy_manager.create_listener('dbg', self._host, self._port),
+            backlog=self._proxy_manager.backlog)
+
+        self.logger.info('listening for debugger connections on {}:{}'.format(self._host, self._port))
+
+    def close(self):
+        """
+        Stop listening.
+        """
+        if self._server is not None:
+            self._server.close()
+
+
+class DebugConnectionHandler(RelayProtocol):
+    def __init__(self, proxy_manager, dbghost=None, dbgport=None, adopted=None):
+        """
+        Initialize the DebugConnectionHandler.
+        @param proxy_manager: The proxy manager instance.
+        @param dbghost: The host that the DebugConnectionServer is listening on for requests.
+        @param dbgport: The port that the DebugConnectionServer is listening on for requests.
+        @param adopted: For a session handed over by another process, the dict describing it (see handoff_state()).
+        """
+        self._proxy_manager = proxy_manager
+        self._adopted = adopted
+        self._initialized = False
+        self._connecting = False
+        self._framer = EngineFramer()
+        self._ide_handler = None
+        self._idekey = None
+        self._init_packet = None
+        self._ide_addr = None
+        self._acquired = False
+        self._admitted = False
+        self._peak_to_ide = 0
+        self._peak_to_engine = 0
+        self._capture = None
+        self._cache = None
+        self.metrics = None
+        self._splice = None
+        self._splice_waiting = False
+
+        self._dbghost = dbghost
+        self._dbgport = dbgport
+        self._enginehost = None
+
+        self.transport = None
+        self.logger = logging.getLogger('dbgpproxy.dbg')
+
+    def connection_made(self, transport):
+        """
+        Remember the transport and the address of the debugger engine.
+        @param transport: The transport.
+        """
+        self.transport = transport
+        if self._adopted is not None:
+            self._adopt(self._adopted)
+            return
+        if not self._proxy_manager.sessions.admit():
+            transport.abort()
+            return
+        self._admitted = True
+        transport.set_write_buffer_limits(high=self.buffer_size)
+        self._enginehost = peer_address(transport.get_extra_info('socket'), transport.get_extra_info('peername'))
+        self.logger.debug('incoming debugger connection from {}'.format(repr(self._enginehost)))
+
+    def _adopt(self, state):
+        """
+        Continue an established session handed over by another process. Reading stays paused until the IDE transport
+        has been set up (see ide_adopted()).
+        @param state: Dict describing the session, see handoff_state().
+        """
+        self._idekey = state['idekey']
+        self._ide_addr = tuple(state['ide'])
+        self._enginehost = tuple(state['engine'])
+        self._connecting = True
+        self._admitted = self._acquired = True
+        self._proxy_manager.sessions.adopt(self._idekey, self)
+        self.transport.set_write_buffer_limits(high=self.buffer_size)
+        self.hold_reading('connect')
+
+        self.metrics = self._proxy_manager.metrics.open_session(self._idekey)
+        if self._proxy_manager.capture is not None:
+            self._capture = self._proxy_manager.capture.open_session(self._idekey, self._enginehost[0])
+        # without the state of the previous process, responses cannot be told apart
+        if state['cache'] is not None and self._proxy_manager.cache is not None:
+            self._cache = self._proxy_manager.cache.resume_session(state['cache'])
+
+    def adopt_ide(self):
+        """
+        Create the protocol of the IDE connection of an adopted session.
+        @return: The ToIDEHandler.
+        """
+        self._ide_handler = ToIDEHandler(self)
+        return self._ide_handler
+
+    def ide_adopted(self):
+        """
+        Start relaying an adopted session once the IDE transport has been set up.
+        """
+        if self.transport.is_closing():
+            self._ide_handler.transport.close()
+            return
+        self._start_relay()
+
+    def data_received(self, data):
+        """
+        Handle data sent by the debugger engine.
+
+        Until the connection to the IDE is established, data is buffered and the init packet is handled once it is
+        complete. While the session waits for a free slot or for the IDE, further data stays in the framer.
+        Afterwards, data is just sent to the IDE handler.
+        @param data: The received data.
+        """
+        if self._initialized:
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('--> {}'.format(data.decode(errors='replace')))
+            self.send_to_ide(data)
+            self.relayed(self, data)
+            return
+
+        self._framer.feed(data)
+        if not self._connecting:
+            self._handle_init_packet()
+        elif self._framer.buffered() >= self.buffer_size:
+            self.hold_reading('connect')
+
+    def _handle_init_packet(self):
+        """
+        Handle an init packet from the debugger engine.
+
+        Waits until the complete init packet has been received, gets the server (IDE) from the proxy manager instance
+        based on the IDE key and starts connecting to the IDE. Also sets the 'proxied' attribute of the init packet to
+        the hostname of the debugger engine unless it is set already.
+        On failure, the connection is closed.
+        @return: void
+        """
+        try:
+            data = self._framer.next_frame()
+        except FrameError as e:
+            self.logger.error('invalid protocol ({})'.format(e))
+            self.transport.close()
+            return
+
+        # wait for the rest of the init packet
+        if data is None:
+            return
+
+        self.logger.debug('handle init packet')
+        init_packet = parse_init_packet(data)
+        packet_type = init_packet.localName
+
+        if packet_type != 'init':
+            self.logger.error('expected init packet, got {}'.format(packet_type))
+            self.transport.close()
+            return
+
+        # get/set information from/in init packet
+        idekey = init_packet.getAttribute('idekey')
+        server = self._proxy_manager.get_server(idekey)
+        if not server:
+            self.logger.warning('no server with IDE key [{}], aborting request'.format(idekey))
+            self.transport.close()
+            return
+
+        # a chained proxy (see dbgpproxy.tunnel) keeps the host seen by the first proxy
+        if not init_packet.hasAttribute('proxied'):
+            init_packet.setAttribute('proxied', self._enginehost[0])
+
+        self._idekey = idekey
+        self._init_packet = init_packet
+        self._connecting = True
+        self._acquired = True
+
+        state = self._proxy_manager.sessions.acquire(idekey, self)
+        if state == START:
+            self.start_session()
+        elif state != QUEUED:
+            self.transport.close()
+
+    def start_session(self):
+        """
+        Connect to the IDE once the session table has given the session a slot.
+
+        The IDE is looked up again, it may have re-registered while the session was waiting.
+        """
+        server = self._proxy_manager.get_server(self._idekey)
+        if not server:
+            self.logger.warning('no server with IDE key [{}], aborting request'.format(self._idekey))
+            self.transport.close()
+            return
+
+        asyncio.get_running_loop().create_task(self.connect_to_ide(server, self._init_packet, self._idekey))
+
+    def reject_session(self, reason):
+        """
+        Close a session that did not get a slot.
+        @param reason: Description of the reason.
+        """
+        self.logger.warning('rejecting debugger connection for IDE key [{}]: {}'.format(self._idekey, reason))
+        self.transport.close()
+
+    async def connect_to_ide(self, server, init_packet, idekey):
+        """
+        Connect to the IDE and send the init packet.
+
+        Data received from the debugger engine in the meantime is sent after the init packet.
+        If the IDE has other sessions open, a failure puts the session back into the queue of the session table.
+        Otherwise, the server is removed from the proxy manager and the connection is closed.
+        @param server: The IDE address (list with hostname and port, see dbgpproxy.address).
+        @param init_packet: The init packet (see parse_init_packet())
+        @param idekey: The IDE key.
+        """
+        server_addr = self._ide_addr = server[0]
+        loop = asyncio.get_running_loop()
+
+        try:
+            self.logger.debug('trying to connect to {}'.format(format_address(*server_addr)))
+            if server_addr[0] == UNIX:
+                connection = loop.create_unix_connection(lambda: ToIDEHandler(self), server_addr[1])
+            else:
+                connection = loop.create_connection(lambda: ToIDEHandler(self), server_addr[0], server_addr[1],
+                                                    family=address_family(server_addr[0]))
+            transport, self._ide_handler = await asyncio.wait_for(connection, self._proxy_manager.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            if self.transport.is_closing():
+                return
+            reason = 'timed out' if isinstance(e, asyncio.TimeoutError) else e.strerror
+            self.logger.warning('unable to connect to {} ({})'.format(format_address(*server_addr), reason))
+            if self._proxy_manager.sessions.refused(idekey, self):
+                return
+            self.logger.warning(
+                'unable to connect to server with IDE key [{}], aborting and removing server'.format(idekey))
+            self._proxy_manager.remove_server(idekey)
+            self.transport.close()
+            return
+
+        if self.transport.is_closing():
+            transport.close()
+            return
+
+        self.metrics = self._proxy_manager.metrics.open_session(idekey)
+        if self._proxy_manager.capture is not None:
+            self._capture = self._proxy_manager.capture.open_session(idekey, self._enginehost[0])
+        if self._proxy_manager.cache is not None:
+            self._cache = self._proxy_manager.cache.open_session(init_packet)
+
+        # send the init packet to the server (IDE)
+        self.send_to_ide(build_init_packet(init_packet, self._dbghost))
+        self._start_relay()
+
+    def _start_relay(self):
+        """
+        Send the data received from the debugger engine while connecting to the IDE and relay from now on.
+        """
+        data = self._framer.remaining()
+        if data:
+            self.send_to_ide(data)
+        self._framer = None
+
+        self._initialized = True
+        self._connecting = False
+        self.release_reading('connect')
+        self._start_splice()
+
+    def _start_splice(self):
+        """
+        In splice relay mode, stop reading from both transports and switch the session to a SpliceRelay once their
+        write buffers have been sent.
+        """
+        # captured and cached sessions are copied, spliced data never passes through the proxy
+        if self._proxy_manager.relay != 'splice' or self._capture is not None or self._cache is not None:
+            return
+
+        self._splice_waiting = True
+        self.hold_reading('splice')
+        self._ide_handler.hold_reading('splice')
+        # resume_writing() is called once a write buffer is empty
+        self.transport.set_write_buffer_limits(high=0)
+        self._ide_handler.transport.set_write_buffer_limits(high=0)
+        self.try_splice()
+
+    def try_splice(self):
+        """
+        Switch to the SpliceRelay if the session is waiting for it and the write buffers are empty.
+        """
+        if not self._splice_waiting or self.transport.is_closing() or self._ide_handler.transport.is_closing():
+            return
+        if self.transport.get_write_buffer_size() or self._ide_handler.transport.get_write_buffer_size():
+            return
+
+        self._splice_waiting = False
+        self._splice = SpliceRelay(self)
+
+    def handoff_state(self):
+        """
+        Describe the session for another process if it can be handed off now, i.e. the IDE is connected and no data
+        of the session is buffered in this process.
+        @return: Tuple of the debugger engine socket, the IDE socket and a JSON serializable dict, or None.
+        """
+        if not self._initialized or self.transport.is_closing():
+            return None
+        ide_transport = self._ide_handler.transport
+        if ide_transport.is_closing():
+            return None
+        if self.transport.get_write_buffer_size() or ide_transport.get_write_buffer_size():
+            return None
+        if self._cache is not None and not self._cache.idle():
+            return None
+        if self._splice_waiting or (self._splice is not None and self._splice.pending):
+            return None
+
+        return self.transport.get_extra_info('socket'), ide_transport.get_extra_info('socket'), {
+            'idekey': self._idekey, 'engine': list(self._enginehost[:2]), 'ide': list(self._ide_addr),
+            'cache': self._cache.snapshot() if self._cache is not None else None}
+
+    def detach(self):
+        """
+        Close the session in this process after it has been handed off. The connections stay open in the other one.
+        """
+        if self._splice is not None:
+            self._splice.close()
+        self._ide_handler.transport.close()
+        self.transport.close()
+
+    @property
+    def buffer_size(self):
+        """
+        @return: High watermark of the write buffers of the session (bytes).
+        """
+        return self._proxy_manager.buffer_size
+
+    @property
+    def idekey(self):
+        """
+        @return: The IDE key of the session, None until the init packet has been received.
+        """
+        return self._idekey
+
+    @property
+    def closed(self):
+        """
+        @return: True once the debugger engine connection is closing.
+        """
+        return self.transport.is_closing()
+
+    @property
+    def peak_buffered(self):
+        """
+        @return: Tuple of the most bytes buffered at once for the IDE and for the debugger engine in this session.
+        """
+        return self._peak_to_ide, self._peak_to_engine
+
+    def send_to_ide(self, data, cached=False):
+        """
+        Record data for the session's metrics, capture and response cache and send it to the IDE.
+        @param data: The data.
+        @param cached: True for a response served from the response cache instead of by the debugger engine.
+        """
+        self.metrics.to_ide(data)
+        if self._capture is not None:
+            self._capture.record(TO_IDE, data)
+        if self._cache is not None and not cached:
+            self._cache.from_engine(data)
+        transport = self._ide_handler.transport
+        transport.write(data)
+        self._peak_to_ide = max(self._peak_to_ide, transport.get_write_buffer_size())
+
+    def send(self, data):
+        """
+        Send data from the IDE to the debugger engine, or answer its commands from the response cache.
+        @param data: The data.
+        """
+        if self.metrics is not None:
+            self.metrics.to_engine(data)
+        if self._capture is not None:
+            self._capture.record(TO_ENGINE, data)
+        if self._cache is not None:
+            data, responses = self._cache.from_ide(data)
+            for response in responses:
+                self.send_to_ide(response, cached=True)
+            if not data:
+                return
+        self.transport.write(data)
+        self._peak_to_engine = max(self._peak_to_engine, self.transport.get_write_buffer_size())
+
+    def pause_writing(self):
+        """
+        Stop reading from the IDE while the debugger engine does not keep up.
+        """
+        if self._ide_handler is not None:
+            self._ide_handler.hold_reading('engine')
+
+    def resume_writing(self):
+        """
+        Resume reading from the IDE.
+        """
+        if self._ide_handler is not None:
+            self._ide_handler.release_reading('engine')
+        self.try_splice()
+
+    def connection_lost(self, exc):
+        """
+        Handle closing of the socket.
+
+        Also closes the IDE connection if it has been established.
+        @param exc: The exception or None on EOF.
+        """
+        self._splice_waiting = False
+        if self._splice is not None:
+            self._splice.close()
+        if self._idekey is not None:
+            self.logger.debug('session [{}] closed, peak buffered bytes: {} to IDE, {} to engine'.format(
+                self._idekey, *self.peak_buffered))
+        if self._acquired:
+            self._acquired = False
+            self._proxy_manager.sessions.release(self._idekey, self)
+        if self._admitted:
+            self._admitted = False
+            self._proxy_manager.sessions.connection_closed()
+        if self._capture is not None:
+            self._capture.close()
+            self._capture = None
+        if self.metrics is not None:
+            self.metrics.close(self.peak_buffered)
+            self.metrics = None
+        if self._proxy_manager.relay_scheduler is not None:
+            self._proxy_manager.relay_scheduler.discard(self)
+        if self._ide_handler is not None and self._ide_handler.transport is not None:
+            self.logger.debug('closing IDE socket')
+            self._ide_handler.transport.close()
+
+
+class AsyncioEngine:
+    def __init__(self, idehost, ideport, dbghost, dbgport, proxy_manager):
+        """
+        Initialize the asyncio engine.
+
+        Sets up the RegistrationServer and DebugConnectionServer instances on a new event loop.
+        @param idehost: The host to listen on for IDE requests.
+        @param ideport: The port to listen on for IDE requests.
+        @param dbghost: The host to listen on for debugger engine requests.
+        @param dbgport: The port to listen on for debugger engine requests.
+        @param proxy_manager: The proxy manager instance.
+        """
+        self.logger = logging.getLogger('dbgpproxy')
+
+        if proxy_manager.monitor is not None:
+            self._loop = MonitoredEventLoop(proxy_manager.monitor)
+        else:
+            self._loop = asyncio.new_event_loop()
+        self._proxy_manager = proxy_manager
+        self._dbghost = dbghost
+        self._dbgport = dbgport
+        self._registration_server = RegistrationServer(idehost, ideport, dbghost, dbgport, proxy_manager)
+        self._debugger_connection_server = DebugConnectionServer(dbghost, dbgport, proxy_manager)
+
+        # bind immediately, like the asyncore dispatchers do
+        self._loop.run_until_complete(self._registration_server.start())
+        self._loop.run_until_complete(self._debugger_connection_server.start())
+
+    def start(self):
+        """
+        Run the event loop.
+        """
+        self._loop.run_forever()
+
+    def call_later(self, delay, callback, *args):
+        """
+        Schedule a callback on the loop.
+        @param delay: Delay in seconds.
+        @param callback: The callback.
+        @param args: Arguments to the callback.
+        @return: A timer with a cancel() method.
+        """
+        return self._loop.call_later(delay, callback, *args)
+
+    def call_soon(self, callback, *args):
+        """
+        Call back at the start of the next loop iteration, before its readiness events.
+        @param callback: The callback.
+        @param args: Arguments to the callback.
+        """
+        self._loop.call_soon(callback, *args)
+
+    def add_signal_handler(self, signum, callback):
+        """
+        Call back on the loop when a signal is received. Must be called from the main thread.
+        @param signum: The signal number.
+        @param callback: Called without arguments.
+        """
+        self._loop.add_signal_handler(signum, callback)
+
+    def close_listeners(self):
+        """
+        Stop accepting registration and debugger connections.
+        """
+        self._registration_server.close()
+        self._debugger_connection_server.close()
+
+    def adopt_session(self, engine_sock, ide_sock, state):
+        """
+        Continue an established session handed over by another process.
+        @param engine_sock: The debugger engine socket.
+        @param ide_sock: The IDE socket.
+        @param state: Dict describing the session, see DebugConnectionHandler.handoff_state().
+        """
+        self._loop.create_task(self._adopt_session(engine_sock, ide_sock, state))
+
+    async def _adopt_session(self, engine_sock, ide_sock, state):
+        """
+        Set up the transports of an adopted session.
+        """
+        handler = DebugConnectionHandler(self._proxy_manager, self._dbghost, self._dbgport, adopted=state)
+        await self._loop.connect_accepted_socket(lambda: handler, engine_sock)
+        await self._loop.connect_accepted_socket(handler.adopt_ide, ide_sock)
+        handler.ide_adopted()
+
+    def adopt_registration(self, sock):
+        """
+        Continue handling the commands of a registration connection handed over by another process.
+        @param sock: The socket.
+        """
+        self._loop.create_task(self._loop.connect_accepted_socket(
+            lambda: RegistrationHandler(self._proxy_manager, dbghost=self._dbghost, dbgport=self._dbgport), sock))
+
+    def add_reader(self, sock, callback):
+        """
+        Watch a socket on the loop.
+        @param sock: The socket.
+        @param callback: Called whenever the socket is readable.
+        """
+        self._loop.add_reader(sock.fileno(), callback)
+
+    def remove_reader(self, sock):
+        """
+        Stop watching a socket for readability.
+        @param sock: The socket.
+        """
+        self._loop.remove_reader(sock.fileno())
+
+    def add_writer(self, sock, callback):
+        """
+        Watch a socket for writability.
+        @param sock: The socket.
+        @param callback: Called whenever the socket is writable.
+        """
+        self._loop.add_writer(sock.fileno(), callback)
+
+    def remove_writer(self, sock):
+        """
+        Stop watching a socket for writability.
+        @param sock: The socket.
+        """
+        self._loop.remove_writer(sock.fileno())
+
+    def stop(self):
+        """
+        Close the listening sockets and the event loop.
+        """
+        self._registration_server.close()
+        self._debugger_connection_server.close()
+        if not self._loop.is_running():
+            self._loop.close()
+        else:
+            self._loop.stop()
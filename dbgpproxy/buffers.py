@@ -0,0 +1,91 @@
+from collections import deque
+
+__author__ = 'gkralik'
+
+# default high watermark of the per-direction send buffers, the low watermark is a quarter of it
+HIGH_WATER = 1024 * 1024
+
+# chunks handed to one sendmsg() call
+MAX_IOV = 64
+
+
+class SendBuffer:
+    """
+    Queue of chunks waiting to be sent.
+
+    Chunks are kept as they were appended; a partial send only moves an offset into the first chunk, so nothing is
+    copied. Once more than high_water bytes are queued the buffer is paused until it has drained to low_water; the
+    handler producing the data stops reading while the buffer is paused.
+    """
+
+    def __init__(self, high_water=HIGH_WATER, low_water=None):
+        """
+        Initialize the SendBuffer.
+        @param high_water: Pause at this many queued bytes.
+        @param low_water: Resume at this many queued bytes (defaults to a quarter of high_water).
+        """
+        self._chunks = deque()
+        self._offset = 0
+        self._size = 0
+        self._high_water = high_water
+        self._low_water = high_water // 4 if low_water is None else low_water
+
+        self.paused = False
+        self.peak = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, data):
+        """
+        Queue data.
+        @param data: The data (bytes-like).
+        """
+        if not data:
+            return
+
+        self._chunks.append(data)
+        self._size += len(data)
+
+        if self._size > self.peak:
+            self.peak = self._size
+        if self._size >= self._high_water:
+            self.paused = True
+
+    def peek(self, max_chunks=MAX_IOV):
+        """
+        Get the queued data without removing it.
+        @param max_chunks: Maximum number of chunks to return.
+        @return: List of bytes-like objects, the first one starting at the current offset.
+        """
+        chunks = []
+        for chunk in self._chunks:
+            if not chunks and self._offset:
+                chunk = memoryview(chunk)[self._offset:]
+            chunks.append(chunk)
+            if len(chunks) == max_chunks:
+                break
+        return chunks
+
+    def consume(self, n):
+        """
+        Remove sent data.
+        @param n: Number of bytes sent.
+        """
+        self._size -= n
+        n += self._offset
+        while n and n >= len(self._chunks[0]):
+            n -= len(self._chunks.popleft())
+        self._offset = n
+
+        if self.paused and self._size <= self._low_water:
+            self.paused = False
+
+    def clear(self):
+        """
+        Drop all queued data.
+        """
+        self._chunks.clear()
+        self._offset = 0
+        self._size = 0
+        self.paused = False
@@ -0,0 +1,293 @@
+import re
+import time
+from collections import OrderedDict
+from dbgpproxy.framing import CommandFramer, MAX_PREFIX_SIZE
+
+__author__ = 'gkralik'
+
+# commands whose response only depends on the engine and the features set in the session
+CACHEABLE = frozenset([b'feature_get', b'typemap_get', b'source'])
+
+# commands changing the responses of cacheable commands, they become part of the cache key
+STATEFUL = frozenset([b'feature_set'])
+
+# init packet attributes identifying the engine (proxied is the host of the debugger engine)
+IDENTITY = ('proxied', 'language', 'appid', 'fileuri')
+
+# seconds a cached response is served, so source listings pick up changed files
+CACHE_TTL = 300.0
+
+# largest response that is cached
+MAX_ENTRY_SIZE = 1024 * 1024
+
+# bytes at the start of an engine message that are searched for the transaction id
+HEADER_SIZE = 512
+
+# commands sent without a response are forgotten after this many newer ones
+MAX_PENDING = 1000
+
+_RESPONSE_ID = re.compile(rb'transaction_id="([^"]*)"')
+
+
+class ResponseCache:
+    """
+    LRU cache of responses to idempotent commands, shared by all sessions of a proxy manager.
+
+    Responses are stored without their transaction id, as the parts before and after it, and are keyed on the engine
+    identity from the init packet, the features set in the session and the command without its transaction id.
+    """
+
+    def __init__(self, max_size, ttl=CACHE_TTL):
+        """
+        Initialize the ResponseCache.
+        @param max_size: Bytes of responses kept.
+        @param ttl: Seconds a response is served after it has been cached.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+        # key -> (head, tail, expires, latency)
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        # engine response time of the served responses (seconds)
+        self.saved = 0.0
+
+    def __len__(self):
+        """
+        @return: The number of cached responses.
+        """
+        return len(self._entries)
+
+    def open_session(self, init_packet):
+        """
+        Start caching for a session.
+        @param init_packet: The init packet of the session (see parse_init_packet()).
+        @return: The SessionCache.
+        """
+        return SessionCache(self, tuple(init_packet.getAttribute(name) for name in IDENTITY))
+
+    def resume_session(self, snapshot):
+        """
+        Continue caching for a session handed over by another process.
+        @param snapshot: The result of SessionCache.snapshot().
+        @return: The SessionCache.
+        """
+        session = SessionCache(self, tuple(snapshot['identity']))
+        session._state = tuple(command.encode('latin-1') for command in snapshot['state'])
+        for transaction_id in snapshot['pending']:
+            session._pending[transaction_id.encode('latin-1')] = (None, time.monotonic())
+        return session
+
+    def get(self, key):
+        """
+        Look up a response and count the hit or miss.
+        @param key: The cache key.
+        @return: Tuple of the response parts before and after the transaction id, or None.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] < time.monotonic():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self.saved += entry[3]
+        return entry[0], entry[1]
+
+    def put(self, key, head, tail, latency):
+        """
+        Cache a response, evicting the least recently used ones as needed.
+        @param key: The cache key.
+        @param head: The response up to the transaction id (bytes).
+        @param tail: The response after the transaction id (bytes).
+        @param latency: Seconds the engine took to respond.
+        """
+        size = len(head) + len(tail)
+        if size > min(MAX_ENTRY_SIZE, self.max_size):
+            return
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (head, tail, time.monotonic() + self.ttl, latency)
+        self.size += size
+        while self.size > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        """
+        Remove a cached response.
+        """
+        head, tail, expires, latency = self._entries.pop(key)
+        self.size -= len(head) + len(tail)
+
+
+class SessionCache:
+    """
+    Serves cacheable commands of one session from the ResponseCache and caches the engine's responses.
+
+    The relay handlers pass every chunk from the IDE to from_ide() and forward what it returns, and every chunk from
+    the debugger engine to from_engine(). The engine data is not copied unless it is a response to a cacheable
+    command; only the message boundaries are followed, so a cached response is only sent to the IDE between two engine
+    messages, and only while no command is waiting for the engine.
+    """
+
+    def __init__(self, cache, identity):
+        """
+        Initialize the SessionCache. Use ResponseCache.open_session() to create instances.
+        @param cache: The ResponseCache.
+        @param identity: Tuple identifying the debugger engine.
+        """
+        self._cache = cache
+        self._identity = identity
+        # normalized feature_set commands of the session
+        self._state = ()
+        self._commands = CommandFramer()
+        # transaction id -> (cache key or None, time the command was sent)
+        self._pending = {}
+
+        # length prefix of the engine message being received
+        self._prefix = bytearray()
+        # bytes of the engine message (including its \0) still to be received, 0 between messages
+        self._remaining = 0
+        # the engine message being received, if it may be a response to a pending command
+        self._message = None
+        self._message_size = 0
+        # True if the whole message is kept, not just the start with the transaction id
+        self._whole = False
+        # set on data that does not follow the DBGp framing, the session is relayed without caching from then on
+        self._broken = False
+
+    def idle(self):
+        """
+        @return: True if no partial command or engine message is buffered, so the session can be handed off.
+        """
+        return self._broken or not (self._remaining or self._prefix or self._commands.buffered())
+
+    def snapshot(self):
+        """
+        @return: The state of an idle session as a JSON serializable dict, see ResponseCache.resume_session(), or None
+                 if the session is not cached any more.
+        """
+        if self._broken:
+            return None
+        return {'identity': list(self._identity), 'state': [command.decode('latin-1') for command in self._state],
+                'pending': [transaction_id.decode('latin-1') for transaction_id in self._pending]}
+
+    def from_ide(self, data):
+        """
+        Handle a chunk sent by the IDE.
+        @param data: The chunk (bytes).
+        @return: Tuple of the data to forward to the debugger engine (bytes) and a list of cached responses to send
+                 to the IDE (framed messages).
+        """
+        if self._broken:
+            return self._commands.remaining() + data, []
+
+        self._commands.feed(data)
+        forward = []
+        responses = []
+        for command in self._commands:
+            args = command.split(b' ')
+            name = args[0]
+            transaction_id = None
+            if b'-i' in args[1:-1]:
+                i = args.index(b'-i', 1)
+                transaction_id = args[i + 1]
+                del args[i:i + 2]
+
+            key = None
+            if name in CACHEABLE and transaction_id is not None and (name != b'source' or b'-f' in args):
+                key = (self._identity, self._state, b' '.join(args))
+                if not self._pending and not self._remaining and not self._prefix:
+                    cached = self._cache.get(key)
+                    if cached is not None:
+                        message = cached[0] + transaction_id + cached[1]
+                        responses.append(str(len(message)).encode() + b'\0' + message + b'\0')
+                        continue
+                else:
+                    self._cache.misses += 1
+            elif name in STATEFUL:
+                self._state += (b' '.join(args),)
+
+            if transaction_id is not None:
+                if len(self._pending) >= MAX_PENDING:
+                    del self._pending[next(iter(self._pending))]
+                self._pending[transaction_id] = (key, time.monotonic())
+            forward.append(command)
+            forward.append(b'\0')
+
+        return b''.join(forward), responses
+
+    def from_engine(self, data):
+        """
+        Follow a chunk sent by the debugger engine and cache the responses to cacheable commands.
+        @param data: The chunk (bytes).
+        """
+        if self._broken:
+            return
+
+        pos = 0
+        end = len(data)
+        while pos < end:
+            if not self._remaining:
+                nul = data.find(b'\0', pos)
+                if nul < 0:
+                    self._prefix += data[pos:]
+                    if len(self._prefix) > MAX_PREFIX_SIZE:
+                        self._break()
+                    return
+                self._prefix += data[pos:nul]
+                if not self._prefix.isdigit():
+                    self._break()
+                    return
+
+                self._message_size = int(self._prefix)
+                self._remaining = self._message_size + 1
+                self._prefix.clear()
+                self._message = bytearray() if self._pending else None
+                self._whole = self._message_size <= MAX_ENTRY_SIZE and any(
+                    key is not None for key, sent in self._pending.values())
+                pos = nul + 1
+                continue
+
+            n = min(self._remaining, end - pos)
+            message = self._message
+            if message is not None and (self._whole or len(message) < HEADER_SIZE):
+                message += data[pos:pos + n]
+            self._remaining -= n
+            pos += n
+            if not self._remaining and message is not None:
+                self._message = None
+                self._handle_response(message)
+
+    def _handle_response(self, message):
+        """
+        Match a complete engine message to a pending command and cache it if the command is cacheable.
+        @param message: The message, the payload followed by \\0, or just its start if it is not cached.
+        """
+        match = _RESPONSE_ID.search(message, 0, HEADER_SIZE)
+        if match is None:
+            return
+
+        pending = self._pending.pop(bytes(match.group(1)), None)
+        if pending is None or pending[0] is None or len(message) != self._message_size + 1:
+            return
+        if b'<error' in message:
+            return
+
+        key, sent = pending
+        self._cache.put(key, bytes(message[:match.start(1)]), bytes(message[match.end(1):-1]),
+                        time.monotonic() - sent)
+
+    def _break(self):
+        """
+        Stop caching after unexpected data.
+        """
+        self._broken = True
+        self._pending.clear()
+        self._message = None
@@ -0,0 +1,207 @@
+import itertools
+import logging
+import os
+import re
+import struct
+import threading
+import time
+from collections import deque
+
+__author__ = 'gkralik'
+
+MAGIC = b'DBGPCAP1'
+
+# directions of captured chunks
+TO_IDE = 0
+TO_ENGINE = 1
+
+# record header: timestamp (seconds since the epoch), direction, length of the chunk
+RECORD = struct.Struct('<dBI')
+
+# bytes waiting for the writer thread, further chunks are dropped
+QUEUE_SIZE = 64 * 1024 * 1024
+
+# seconds the writer thread sleeps when there is nothing to write
+WRITE_INTERVAL = 0.05
+
+_UNSAFE = re.compile(r'[^A-Za-z0-9._-]')
+
+
+class Capture:
+    """
+    Records the traffic of selected sessions to one binary file per session.
+
+    A capture file starts with MAGIC, followed by one record per relayed chunk: a RECORD header and the raw bytes.
+    The event loop only appends chunks to a deque, which needs no lock; a background thread polls it and writes them.
+    The backlog is the difference of two byte counters, each of them only updated by one thread. If the writer falls
+    behind, chunks are dropped instead of blocking the loop, and the number of dropped chunks is logged when the
+    session ends. A session whose file cannot be written is no longer recorded.
+    """
+
+    def __init__(self, directory, idekeys=(), hosts=(), queue_size=QUEUE_SIZE):
+        """
+        Initialize the Capture and start the writer thread.
+        @param directory: Directory the capture files are written to.
+        @param idekeys: Capture sessions with these IDE keys.
+        @param hosts: Capture sessions of debugger engines on these hosts.
+        If neither idekeys nor hosts are given, all sessions are captured.
+        @param queue_size: Maximum number of bytes waiting for the writer thread.
+        """
+        self._directory = directory
+        self._idekeys = frozenset(idekeys)
+        self._hosts = frozenset(hosts)
+        self._queue = deque()
+        self._queue_size = queue_size
+        self._stopped = threading.Event()
+
+        # bytes queued by the event loop and bytes taken by the writer thread
+        self.queued = 0
+        self.written = 0
+        self._counter = itertools.count(1)
+
+        self.logger = logging.getLogger('dbgpproxy.capture')
+
+        os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='capture', daemon=True)
+        self._thread.start()
+
+    def open_session(self, idekey, enginehost):
+        """
+        Start capturing a session if it matches the filters.
+        @param idekey: The IDE key of the session.
+        @param enginehost: The host of the debugger engine.
+        @return: A SessionCapture or None if the session is not captured.
+        """
+        if (self._idekeys or self._hosts) and idekey not in self._idekeys and enginehost not in self._hosts:
+            return None
+
+        name = '{}-{}-{}-{}-{}.dbgpcap'.format(_UNSAFE.sub('_', idekey), _UNSAFE.sub('_', enginehost),
+                                                time.strftime('%Y%m%d-%H%M%S'), os.getpid(), next(self._counter))
+        path = os.path.join(self._directory, name)
+        self.logger.info('capturing session [{}] to {}'.format(idekey, path))
+        return SessionCapture(self, path)
+
+    def close(self):
+        """
+        Write all queued chunks and stop the writer thread.
+        """
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        """
+        Writer thread: write queued chunks, flush when the queue is empty.
+        """
+        # SessionCapture -> file
+        files = {}
+        while True:
+            stopped = self._stopped.wait(WRITE_INTERVAL)
+            while self._queue:
+                item = self._queue.popleft()
+                self._write(files, *item)
+                if item[3] is not None:
+                    self.written += len(item[3])
+
+            for f in files.values():
+                f.flush()
+
+            if stopped:
+                for f in files.values():
+                    f.close()
+                return
+
+    def _write(self, files, session, timestamp, direction, data):
+        """
+        Write one chunk, or close the file of a session if data is None.
+        @param files: Dict of SessionCapture -> open file.
+        """
+        f = files.get(session)
+        if data is None:
+            if f is not None:
+                f.close()
+                del files[session]
+            if session.dropped:
+                self.logger.warning('dropped {} chunks while capturing to {}'.format(session.dropped, session.path))
+            return
+
+        # chunks queued before the session stopped recording
+        if session.failed:
+            return
+
+        try:
+            if f is None:
+                f = files[session] = open(session.path, 'wb')
+                f.write(MAGIC)
+            f.write(RECORD.pack(timestamp, direction, len(data)))
+            f.write(data)
+        except OSError as e:
+            self.logger.error('unable to write {}, no longer capturing the session: {}'.format(session.path, e))
+            session.failed = True
+            files.pop(session, None)
+            if f is not None:
+                try:
+                    f.close()
+                except OSError:
+                    pass
+
+
+class SessionCapture:
+    """
+    Handle for recording the traffic of one session, see Capture.open_session().
+    """
+
+    def __init__(self, capture, path):
+        """
+        Initialize the SessionCapture.
+        @param capture: The Capture.
+        @param path: The path of the capture file.
+        """
+        self._capture = capture
+        self.path = path
+        self.dropped = 0
+        # set by the writer thread once the file cannot be written
+        self.failed = False
+
+    def record(self, direction, data):
+        """
+        Queue a relayed chunk.
+        @param direction: TO_IDE or TO_ENGINE.
+        @param data: The chunk (bytes). It must not be modified afterwards.
+        """
+        if self.failed:
+            return
+        capture = self._capture
+        if capture.queued - capture.written >= capture._queue_size:
+            self.dropped += 1
+            return
+        capture.queued += len(data)
+        capture._queue.append((self, time.time(), direction, data))
+
+    def close(self):
+        """
+        Close the capture file once all queued chunks have been written.
+        """
+        self._capture._queue.append((self, 0.0, TO_IDE, None))
+
+
+def read_capture(path):
+    """
+    Read a capture file.
+    @param path: The path of the capture file.
+    @return: Iterator of (timestamp, direction, data) tuples.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a capture file'.format(path))
+
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, direction, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield timestamp, direction, data
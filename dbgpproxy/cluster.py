@@ -0,0 +1,445 @@
+import errno
+import json
+import logging
+import socket
+import struct
+from dbgpproxy.address import UNIX, address_family, format_address, is_local, set_nodelay, socket_address
+from dbgpproxy.tunnel import ACCEPT_BUDGET, MAX_RECONNECT_DELAY, RECONNECT_DELAY, RECV_SIZE, Channel
+from dbgpproxy.workers import apply_update
+
+__author__ = 'gkralik'
+
+# how debugger connections for IDE keys registered with another node reach the IDE
+CLUSTER_ROUTES = ('direct', 'forward')
+
+# length of the JSON body of a message
+HEADER = struct.Struct('!I')
+
+# longest accepted message body, a snapshot of about 100000 registrations
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+# hosts the debugger port listens on all interfaces with, not an address other nodes can connect to
+WILDCARD_HOSTS = ('', '0.0.0.0', '::')
+
+
+def advertised_address(dbg_address):
+    """
+    @param dbg_address: Tuple of host and port the debugger port listens on.
+    @return: The address other nodes can reach the debugger port at, with this host's name for wildcard addresses.
+    """
+    host, port = dbg_address
+    if host in WILDCARD_HOSTS:
+        host = socket.getfqdn()
+    return host, port
+
+
+def _is_registration(host, port, multi):
+    """
+    @return: True if host, port and multi are valid fields of a registration.
+    """
+    return (isinstance(host, str) and isinstance(port, (int, str)) and not isinstance(port, bool) and
+            (multi is None or isinstance(multi, str)))
+
+
+def check_message(message):
+    """
+    Check the fields of a message of a peer.
+    @param message: The decoded message.
+    @raise ValueError: If the message is not valid.
+    """
+    if not isinstance(message, dict):
+        raise ValueError('message is not an object')
+    op = message.get('op')
+    if op == 'hello':
+        dbg = message.get('dbg')
+        if not isinstance(message.get('node'), str) or not isinstance(dbg, list) or len(dbg) != 2 or \
+                not isinstance(dbg[0], str) or not isinstance(dbg[1], int):
+            raise ValueError('invalid hello')
+    elif op == 'snapshot':
+        servers = message.get('servers')
+        if not isinstance(servers, dict) or not all(
+                isinstance(server, list) and len(server) == 3 and _is_registration(*server)
+                for server in servers.values()):
+            raise ValueError('invalid snapshot')
+    elif op == 'add':
+        if not isinstance(message.get('idekey'), str) or not _is_registration(
+                message.get('host'), message.get('port'), message.get('multi')):
+            raise ValueError('invalid add')
+    elif op == 'remove':
+        if not isinstance(message.get('idekey'), str):
+            raise ValueError('invalid remove')
+    else:
+        raise ValueError('unknown op {!r}'.format(op))
+
+
+class PeerLink(Channel):
+    """
+    A link between two nodes. Messages are JSON documents, each preceded by its length (HEADER).
+
+    Every node connects to each of its peers and sends its own registrations over that link only; the links the peers
+    made are read from. So a link carries messages in one direction, the other end only notices when it is closed.
+    """
+
+    def __init__(self, node, sock):
+        """
+        Initialize the PeerLink and start reading.
+        @param node: The ClusterNode.
+        @param sock: The connected socket.
+        """
+        super().__init__(node._proxy_manager, sock)
+        set_nodelay(sock)
+        self._node = node
+        self._data = bytearray()
+        # name of the node at the other end, once it has said hello
+        self.name = None
+        self.start_reading()
+
+    def send(self, message):
+        """
+        Send a message.
+        @param message: JSON serializable dict.
+        """
+        body = json.dumps(message).encode()
+        self.write(HEADER.pack(len(body)) + body)
+
+    def handle_read(self):
+        """
+        Pass the complete messages received to the node.
+        """
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+
+        if not data:
+            self.close()
+            return
+
+        self._data += data
+        buffer = self._data
+        offset = 0
+        while len(buffer) - offset >= HEADER.size:
+            length = HEADER.unpack_from(buffer, offset)[0]
+            if length > MAX_MESSAGE_SIZE:
+                self._node.logger.error('message of {} bytes from cluster node {} exceeds {} bytes'.format(
+                    length, self.name, MAX_MESSAGE_SIZE))
+                self.close()
+                return
+            end = offset + HEADER.size + length
+            if len(buffer) < end:
+                break
+            try:
+                message = json.loads(bytes(buffer[offset + HEADER.size:end]).decode())
+            except ValueError as e:
+                self._node.logger.error('invalid message from cluster node {}: {}'.format(self.name, e))
+                self.close()
+                return
+            offset = end
+
+            self._node.handle_message(self, message)
+            if self.closed:
+                return
+        del buffer[:offset]
+
+    def close(self):
+        """
+        Close the link and tell the node.
+        """
+        if self.closed:
+            return
+
+        super().close()
+        self._node.link_closed(self)
+
+
+class PeerClient:
+    """
+    Keeps the link to one peer and reconnects it when it is lost.
+    """
+
+    def __init__(self, node, address):
+        """
+        Initialize the PeerClient and start connecting.
+        @param node: The ClusterNode.
+        @param address: Tuple of host and port of the peer's cluster listener.
+        """
+        self._node = node
+        self._proxy_manager = node._proxy_manager
+        self._address = address
+        self._delay = RECONNECT_DELAY
+        self._sock = None
+        self._timer = None
+        self._closed = False
+        self.link = None
+        self._connect()
+
+    def _connect(self):
+        """
+        Start connecting the link.
+        """
+        self._timer = None
+        self._sock = socket.socket(address_family(self._address[0]), socket.SOCK_STREAM)
+        self._sock.setblocking(False)
+        error = self._sock.connect_ex(socket_address(*self._address))
+        if error not in (0, errno.EINPROGRESS):
+            self._connect_failed(errno.errorcode.get(error))
+            return
+        self._proxy_manager.add_writer(self._sock, self._handle_connect)
+
+    def _handle_connect(self):
+        """
+        Finish connecting the link, introduce this node and send its registrations.
+        """
+        self._proxy_manager.remove_writer(self._sock)
+        error = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self._connect_failed(errno.errorcode.get(error))
+            return
+
+        sock, self._sock = self._sock, None
+        self._delay = RECONNECT_DELAY
+        self.link = PeerLink(self._node, sock)
+        self._node.logger.info('connected to cluster node at {}'.format(format_address(*self._address)))
+        self.link.send({'op': 'hello', 'node': self._node.name, 'dbg': list(self._node.advertise)})
+        self.link.send({'op': 'snapshot', 'servers': self._node.own_servers()})
+
+    def _connect_failed(self, reason):
+        """
+        Retry connecting later.
+        """
+        self._sock.close()
+        self._sock = None
+        self._node.logger.warning('unable to connect to cluster node at {} ({}), retrying in {:g}s'.format(
+            format_address(*self._address), reason, self._delay))
+        self._schedule_connect()
+
+    def _schedule_connect(self):
+        """
+        Connect again after the current delay and double the delay.
+        """
+        if not self._closed:
+            self._timer = self._proxy_manager.call_later(self._delay, self._connect)
+            self._delay = min(self._delay * 2, MAX_RECONNECT_DELAY)
+
+    def link_closed(self):
+        """
+        Called by the node when the link has been lost.
+        """
+        self.link = None
+        self._schedule_connect()
+
+    def close(self):
+        """
+        Close the link and stop reconnecting.
+        """
+        self._closed = True
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._sock is not None:
+            self._proxy_manager.remove_writer(self._sock)
+            self._sock.close()
+        if self.link is not None:
+            self.link.close()
+
+
+class ClusterNode:
+    """
+    Shares the registrations of this proxy with the other proxies (nodes) of a cluster, e.g. behind a load balancer
+    for the debugger port, so a debugger connection can land on any of them.
+
+    Every registration is owned by the node it was made with. Changes are sent to all peers, which apply them without
+    notifying their registry listeners, like the registrations of other workers (see dbgpproxy.workers); a node
+    sends all of its registrations when it connects, replacing the ones the peer had from it before. A debugger
+    connection for an IDE key owned by another node is connected to the IDE directly, or forwarded to the owner's
+    debugger port like to an IDE if the IDE address only works on the owner's host (a Unix domain socket or the
+    loopback interface) or with the forward route. The owner keeps the 'proxied' attribute of the init packet, as
+    for chained proxies.
+
+    Registrations of a node whose link is lost are kept, its IDEs may still be reachable. Only the owner expires and
+    probes a registration, the removal is passed on.
+    """
+
+    def __init__(self, proxy_manager, host, port, peers=(), advertise=None, route='direct'):
+        """
+        Initialize the ClusterNode, register it as a registry listener, listen for peers and connect to them.
+        @param proxy_manager: The proxy manager instance.
+        @param host: The host to listen for links of peers on.
+        @param port: The port to listen for links of peers on.
+        @param peers: Tuples of host and port of the cluster listeners of the peers. The address of this node is
+                      skipped, so all nodes can be given the same list.
+        @param advertise: Tuple of host and port other nodes forward debugger connections to (defaults to the
+                          debugger port, see advertised_address()).
+        @param route: How debugger connections for IDEs registered with other nodes reach the IDE, one of
+                      CLUSTER_ROUTES.
+        """
+        self._proxy_manager = proxy_manager
+        self.advertise = tuple(advertise or advertised_address(proxy_manager.dbg_address))
+        self.name = format_address(*self.advertise)
+        self.route_mode = route
+        # idekey -> name of the node owning it, for registrations of other nodes
+        self._owners = {}
+        # node name -> tuple of host and port of its debugger port
+        self.nodes = {}
+        # links made by the peers
+        self.links = set()
+        self.logger = logging.getLogger('dbgpproxy.cluster')
+
+        proxy_manager.add_registry_listener(self)
+        self._sock = proxy_manager.create_listener('cluster', host, port)
+        proxy_manager.add_reader(self._sock, self._accept)
+        self.logger.info('cluster node {} listening on {}'.format(self.name, format_address(host, port)))
+        if host in WILDCARD_HOSTS:
+            self.logger.warning('cluster links are not authenticated, listening on all interfaces lets every host '
+                                'that can connect change the registrations')
+
+        self._clients = [PeerClient(self, tuple(peer)) for peer in peers if tuple(peer) != (host, port)]
+
+    def _accept(self):
+        """
+        Accept pending links of peers.
+        """
+        for i in range(ACCEPT_BUDGET):
+            try:
+                sock, addr = self._sock.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                self.logger.error('unable to accept cluster link: {}'.format(e))
+                return
+            self.links.add(PeerLink(self, sock))
+
+    def owner(self, idekey):
+        """
+        @param idekey: The IDE key.
+        @return: The name of the node owning the registration, None if it is owned by this node (or unknown).
+        """
+        return self._owners.get(idekey)
+
+    def own_servers(self):
+        """
+        @return: Dict of IDE key to [host, port, multi] of the registrations owned by this node.
+        """
+        return {idekey: [host, port, multi] for idekey, ((host, port), multi) in self._proxy_manager.list_servers()
+                if idekey not in self._owners}
+
+    def route(self, idekey, server):
+        """
+        Find the address to connect a debugger connection for an IDE key to.
+        @param idekey: The IDE key.
+        @param server: The registration (see Proxy.get_server()).
+        @return: The registration, one with the address of the owner's debugger port if the connection is forwarded,
+                 or None if an address on the owner's host cannot be forwarded yet.
+        """
+        owner = self._owners.get(idekey)
+        if owner is None:
+            return server
+        host = server[0][0]
+        node_local = host == UNIX or is_local(host)
+        if self.route_mode == 'direct' and not node_local:
+            return server
+        address = self.nodes.get(owner)
+        if address is None:
+            # the owner has not said hello on this link yet; an address on the owner's host must not be connected to
+            # on this one, it would reach whatever listens there
+            return None if node_local else server
+        return [list(address), server[1]]
+
+    def handle_message(self, link, message):
+        """
+        Apply a message of a peer.
+        @param link: The PeerLink it was received on.
+        @param message: The decoded message, the link is closed if it is not valid.
+        """
+        try:
+            check_message(message)
+        except ValueError as e:
+            self.logger.error('invalid message from cluster node {}: {}, closing link'.format(link.name, e))
+            link.close()
+            return
+
+        op = message['op']
+        if op == 'hello':
+            link.name = message['node']
+            self.nodes[link.name] = tuple(message['dbg'])
+            self.logger.info('cluster node {} connected'.format(link.name))
+            return
+        if link.name is None:
+            self.logger.warning('message from cluster node before hello, closing link')
+            link.close()
+            return
+
+        if op == 'snapshot':
+            # registrations the node no longer has
+            for idekey in [idekey for idekey, owner in self._owners.items()
+                           if owner == link.name and idekey not in message['servers']]:
+                del self._owners[idekey]
+                self._proxy_manager.discard_server(idekey)
+            for idekey in message['servers']:
+                self._owners[idekey] = link.name
+            apply_update(self._proxy_manager, message)
+            self.logger.debug('{} registrations from cluster node {}'.format(len(message['servers']), link.name))
+        elif op == 'add':
+            self._owners[message['idekey']] = link.name
+            apply_update(self._proxy_manager, message)
+        elif op == 'remove':
+            # only the owner removes a registration
+            idekey = message['idekey']
+            owner = self._owners.get(idekey)
+            if owner != link.name:
+                if owner is not None or self._proxy_manager.get_server(idekey) is not None:
+                    self.logger.warning('cluster node {} removed IDE key [{}] it does not own, ignoring'.format(
+                        link.name, idekey))
+                return
+            del self._owners[idekey]
+            self._proxy_manager.discard_server(idekey)
+
+    def link_closed(self, link):
+        """
+        Called by a PeerLink when it has been closed.
+        @param link: The PeerLink.
+        """
+        if link in self.links:
+            self.links.discard(link)
+            self.logger.info('cluster node {} disconnected'.format(link.name))
+            return
+        for client in self._clients:
+            if client.link is link:
+                client.link_closed()
+
+    def _broadcast(self, message):
+        """
+        Send a message to all connected peers.
+        @param message: The message (dict).
+        """
+        for client in self._clients:
+            if client.link is not None:
+                client.link.send(message)
+
+    def server_added(self, idekey, host, port, multi):
+        """
+        Take over and pass on a registration made with this node.
+        """
+        self._owners.pop(idekey, None)
+        self._broadcast({'op': 'add', 'idekey': idekey, 'host': host, 'port': port, 'multi': multi})
+
+    def server_removed(self, idekey):
+        """
+        Pass on the removal of a registration owned by this node. A registration of another node removed here (e.g.
+        because its IDE was unreachable) is only dropped on this node, until the owner sends its registrations again.
+        """
+        if self._owners.pop(idekey, None) is None:
+            self._broadcast({'op': 'remove', 'idekey': idekey})
+
+    def close(self):
+        """
+        Stop listening and close all links.
+        """
+        self._proxy_manager.remove_reader(self._sock)
+        self._sock.close()
+        for client in self._clients:
+            client.close()
+        for link in list(self.links):
+            link.close()
+        self.links.clear()
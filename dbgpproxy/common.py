@@ -1,6 +1,11 @@
 import sys
 import logging
 import dbgpproxy
+from dbgpproxy.proxy import ENGINES, DEFAULT_ENGINE, BACKLOG
+from dbgpproxy.relay import RELAY_MODES
+from dbgpproxy.buffers import HIGH_WATER
+from dbgpproxy.cache import CACHE_TTL
+from dbgpproxy.cluster import CLUSTER_ROUTES
 
 __author__ = 'gkralik'
 
@@ -35,13 +40,98 @@ if sys.version_info < (3, 2):
         """
         parser = optparse.OptionParser(version=dbgpproxy.__version__)
         parser.add_option('-i', type=str, metavar="hostname:port", dest="ide",
-                          help="listener port for IDE processes (defaults to 127.0.0.1:9001", default="127.0.0.1:9001")
+                          help="listener port for IDE processes, [address]:port for IPv6 or unix:/path for a Unix "
+                               "domain socket (defaults to 127.0.0.1:9001", default="127.0.0.1:9001")
         parser.add_option('-d', type=str, metavar="hostname:port", dest="dbg",
-                          help="listener port for debug processes (defaults to 127.0.0.1:9000",
+                          help="listener port for debug processes, [address]:port for IPv6 or unix:/path for a Unix "
+                               "domain socket (defaults to 127.0.0.1:9000",
                           default="127.0.0.1:9000")
         parser.add_option('-l', type=str, metavar="LOGLEVEL", dest="loglevel",
                           help="Log verbosity. Accepted values are CRITICAL, ERROR, WARN, INFO (default), DEBUG",
                           default="INFO")
+        parser.add_option('-e', type="choice", choices=list(ENGINES), metavar="ENGINE", dest="engine",
+                          help="event loop implementation, asyncore or asyncio (defaults to %s)" % DEFAULT_ENGINE,
+                          default=DEFAULT_ENGINE)
+        parser.add_option('--relay', type="choice", choices=list(RELAY_MODES), metavar="MODE", dest="relay",
+                          help="relay mode for established sessions, copy (default) or splice (kernel-side forwarding)",
+                          default="copy")
+        parser.add_option('--connect-timeout', type=float, metavar="SECONDS", dest="connect_timeout",
+                          help="timeout for connecting to an IDE (defaults to 5)", default=5.0)
+        parser.add_option('--workers', type=int, metavar="N", dest="workers",
+                          help="number of worker processes sharing the listener ports (defaults to 1)", default=1)
+        parser.add_option('--registry', type=str, metavar="FILE", dest="registry",
+                          help="keep registered IDEs in FILE across restarts", default=None)
+        parser.add_option('--buffer-size', type=int, metavar="BYTES", dest="buffer_size",
+                          help="bytes buffered per direction of a session before the sender is paused "
+                               "(defaults to %d)" % HIGH_WATER, default=HIGH_WATER)
+        parser.add_option('--capture', type=str, metavar="DIR", dest="capture",
+                          help="capture session traffic to one file per session in DIR", default=None)
+        parser.add_option('--capture-idekey', type=str, metavar="IDEKEY", dest="capture_idekeys", action="append",
+                          help="only capture sessions with this IDE key (can be repeated)", default=[])
+        parser.add_option('--capture-host', type=str, metavar="HOST", dest="capture_hosts", action="append",
+                          help="only capture sessions of debugger engines on this host (can be repeated)", default=[])
+        parser.add_option('--stats', type=str, metavar="hostname:port", dest="stats",
+                          help="serve statistics in text format on this address", default=None)
+        parser.add_option('--max-sessions', type=int, metavar="N", dest="max_sessions",
+                          help="parallel sessions per IDE key of IDEs registered with -m 1 or without -m, further "
+                               "debugger connections are queued (defaults to 0, no limit)", default=0)
+        parser.add_option('--session-queue', type=int, metavar="N", dest="session_queue",
+                          help="debugger connections waiting per IDE key (defaults to 64)", default=64)
+        parser.add_option('--queue-timeout', type=float, metavar="SECONDS", dest="queue_timeout",
+                          help="time a debugger connection waits for a free session (defaults to 30)", default=30.0)
+        parser.add_option('--registration-ttl', type=float, metavar="SECONDS", dest="registration_ttl",
+                          help="remove registrations not renewed by proxyinit within SECONDS (defaults to never)",
+                          default=None)
+        parser.add_option('--probe-interval', type=float, metavar="SECONDS", dest="probe_interval",
+                          help="check every SECONDS that registered IDEs accept connections and remove unreachable "
+                               "ones (defaults to never)", default=None)
+        parser.add_option('--backlog', type=int, metavar="N", dest="backlog",
+                          help="pending connections queued by the listening sockets (defaults to %d)" % BACKLOG,
+                          default=BACKLOG)
+        parser.add_option('--max-connections', type=int, metavar="N", dest="max_connections",
+                          help="debugger connections open at a time, further ones are closed right away (defaults "
+                               "to 0, no limit)", default=0)
+        parser.add_option('--tunnel-listen', type=str, metavar="hostname:port", dest="tunnel_listen",
+                          help="accept tunnel links from proxies started with --tunnel on hostname:port",
+                          default=None)
+        parser.add_option('--tunnel', type=str, metavar="hostname:port", dest="tunnel",
+                          help="keep a compressed tunnel link to the proxy at hostname:port and relay its sessions "
+                               "for the IDEs registered here", default=None)
+        parser.add_option('--cache-size', type=int, metavar="BYTES", dest="cache_size",
+                          help="cache responses to feature_get, typemap_get and source -f of up to BYTES in total "
+                               "across sessions (defaults to 0, no cache)", default=0)
+        parser.add_option('--cache-ttl', type=float, metavar="SECONDS", dest="cache_ttl",
+                          help="serve cached responses for SECONDS (defaults to %g)" % CACHE_TTL, default=CACHE_TTL)
+        parser.add_option('--handoff', metavar="PATH", dest="handoff",
+                          help="take over listeners, registrations and sessions from the process listening on the "
+                               "Unix socket PATH, and listen on it for the next process (zero-downtime restart)",
+                          default=None)
+        parser.add_option('--slow-callback', type=float, metavar="MS", dest="slow_callback",
+                          help="time event loop iterations and callbacks, and log callbacks taking longer than MS "
+                               "milliseconds (defaults to off)", default=None)
+        parser.add_option('--profile-dir', metavar="DIR", dest="profile_dir",
+                          help="write the sampling profiles started and stopped with SIGUSR2 to DIR (defaults to "
+                               "the temporary directory)", default=None)
+        parser.add_option('--cluster-listen', type=str, metavar="hostname:port", dest="cluster_listen",
+                          help="accept links from the other proxies of a cluster on hostname:port", default=None)
+        parser.add_option('--cluster-peer', type=str, metavar="hostname:port", dest="cluster_peers",
+                          action="append",
+                          help="--cluster-listen address of another proxy of the cluster to share registrations "
+                               "with (can be repeated)", default=[])
+        parser.add_option('--cluster-advertise', type=str, metavar="hostname:port", dest="cluster_advertise",
+                          help="address the other proxies forward debugger connections to (defaults to the -d "
+                               "address, with this host's name if it listens on all interfaces)", default=None)
+        parser.add_option('--cluster-route', type="choice", choices=list(CLUSTER_ROUTES), metavar="ROUTE",
+                          dest="cluster_route",
+                          help="connect debugger connections for IDEs registered with another proxy directly to "
+                               "the IDE (direct, the default) or forward them to that proxy (forward)",
+                          default="direct")
+        parser.add_option('--relay-budget', type=int, metavar="BYTES", dest="relay_budget",
+                          help="bytes a session may relay per event loop iteration, so bulk transfers do not hold up "
+                               "the other sessions (defaults to 0, no limit)", default=0)
+        parser.add_option('--relay-priority', action="store_true", dest="relay_priority",
+                          help="with --relay-budget, only limit bulk transfers and relay small frames first",
+                          default=False)
 
         return parser.parse_args()[0]
 else:
@@ -57,12 +147,100 @@ else:
         parser.add_argument('-v', '--version', action="version", version=dbgpproxy.__version__,
                             help="print version info and exit.")
         parser.add_argument('-i', type=str, metavar="hostname:port", dest="ide",
-                            help="listener port for IDE processes (defaults to 127.0.0.1:9001)",
+                            help="listener port for IDE processes, [address]:port for IPv6 or unix:/path for a "
+                                 "Unix domain socket (defaults to 127.0.0.1:9001)",
                             default="127.0.0.1:9001")
         parser.add_argument('-d', type=str, metavar="hostname:port", dest="dbg",
-                            help="listener port for debug processes (defaults to 127.0.0.1:9000)",
+                            help="listener port for debug processes, [address]:port for IPv6 or unix:/path for a "
+                                 "Unix domain socket (defaults to 127.0.0.1:9000)",
                             default="127.0.0.1:9000")
         parser.add_argument('-l', type=str, metavar="LOGLEVEL", dest="loglevel",
                             help="Log verbosity. Accepted values are CRITICAL, ERROR, WARN, INFO (default), DEBUG",
                             default="INFO")
+        parser.add_argument('-e', '--engine', type=str, metavar="ENGINE", dest="engine", choices=ENGINES,
+                            help="event loop implementation, asyncore or asyncio (defaults to %s)" % DEFAULT_ENGINE,
+                            default=DEFAULT_ENGINE)
+        parser.add_argument('--relay', type=str, metavar="MODE", dest="relay", choices=RELAY_MODES,
+                            help="relay mode for established sessions, copy (default) or splice (kernel-side "
+                                 "forwarding)",
+                            default="copy")
+        parser.add_argument('--connect-timeout', type=float, metavar="SECONDS", dest="connect_timeout",
+                            help="timeout for connecting to an IDE (defaults to 5)", default=5.0)
+        parser.add_argument('--workers', type=int, metavar="N", dest="workers",
+                            help="number of worker processes sharing the listener ports (defaults to 1)", default=1)
+        parser.add_argument('--registry', type=str, metavar="FILE", dest="registry",
+                            help="keep registered IDEs in FILE across restarts", default=None)
+        parser.add_argument('--buffer-size', type=int, metavar="BYTES", dest="buffer_size",
+                            help="bytes buffered per direction of a session before the sender is paused "
+                                 "(defaults to %d)" % HIGH_WATER, default=HIGH_WATER)
+        parser.add_argument('--capture', type=str, metavar="DIR", dest="capture",
+                            help="capture session traffic to one file per session in DIR", default=None)
+        parser.add_argument('--capture-idekey', type=str, metavar="IDEKEY", dest="capture_idekeys", action="append",
+                            help="only capture sessions with this IDE key (can be repeated)", default=[])
+        parser.add_argument('--capture-host', type=str, metavar="HOST", dest="capture_hosts", action="append",
+                            help="only capture sessions of debugger engines on this host (can be repeated)",
+                            default=[])
+        parser.add_argument('--stats', type=str, metavar="hostname:port", dest="stats",
+                            help="serve statistics in text format on this address", default=None)
+        parser.add_argument('--max-sessions', type=int, metavar="N", dest="max_sessions",
+                            help="parallel sessions per IDE key of IDEs registered with -m 1 or without -m, further "
+                                 "debugger connections are queued (defaults to 0, no limit)", default=0)
+        parser.add_argument('--session-queue', type=int, metavar="N", dest="session_queue",
+                            help="debugger connections waiting per IDE key (defaults to 64)", default=64)
+        parser.add_argument('--queue-timeout', type=float, metavar="SECONDS", dest="queue_timeout",
+                            help="time a debugger connection waits for a free session (defaults to 30)",
+                            default=30.0)
+        parser.add_argument('--registration-ttl', type=float, metavar="SECONDS", dest="registration_ttl",
+                            help="remove registrations not renewed by proxyinit within SECONDS (defaults to never)",
+                            default=None)
+        parser.add_argument('--probe-interval', type=float, metavar="SECONDS", dest="probe_interval",
+                            help="check every SECONDS that registered IDEs accept connections and remove unreachable "
+                                 "ones (defaults to never)", default=None)
+        parser.add_argument('--backlog', type=int, metavar="N", dest="backlog",
+                            help="pending connections queued by the listening sockets (defaults to %d)" % BACKLOG,
+                            default=BACKLOG)
+        parser.add_argument('--max-connections', type=int, metavar="N", dest="max_connections",
+                            help="debugger connections open at a time, further ones are closed right away (defaults "
+                                 "to 0, no limit)", default=0)
+        parser.add_argument('--tunnel-listen', type=str, metavar="hostname:port", dest="tunnel_listen",
+                            help="accept tunnel links from proxies started with --tunnel on hostname:port",
+                            default=None)
+        parser.add_argument('--tunnel', type=str, metavar="hostname:port", dest="tunnel",
+                            help="keep a compressed tunnel link to the proxy at hostname:port and relay its sessions "
+                                 "for the IDEs registered here", default=None)
+        parser.add_argument('--cache-size', type=int, metavar="BYTES", dest="cache_size",
+                            help="cache responses to feature_get, typemap_get and source -f of up to BYTES in total "
+                                 "across sessions (defaults to 0, no cache)", default=0)
+        parser.add_argument('--cache-ttl', type=float, metavar="SECONDS", dest="cache_ttl",
+                            help="serve cached responses for SECONDS (defaults to %g)" % CACHE_TTL, default=CACHE_TTL)
+        parser.add_argument('--handoff', metavar="PATH", dest="handoff",
+                            help="take over listeners, registrations and sessions from the process listening on the "
+                                 "Unix socket PATH, and listen on it for the next process (zero-downtime restart)",
+                            default=None)
+        parser.add_argument('--slow-callback', type=float, metavar="MS", dest="slow_callback",
+                            help="time event loop iterations and callbacks, and log callbacks taking longer than MS "
+                                 "milliseconds (defaults to off)", default=None)
+        parser.add_argument('--profile-dir', metavar="DIR", dest="profile_dir",
+                            help="write the sampling profiles started and stopped with SIGUSR2 to DIR (defaults to "
+                                 "the temporary directory)", default=None)
+        parser.add_argument('--cluster-listen', type=str, metavar="hostname:port", dest="cluster_listen",
+                            help="accept links from the other proxies of a cluster on hostname:port", default=None)
+        parser.add_argument('--cluster-peer', type=str, metavar="hostname:port", dest="cluster_peers",
+                            action="append",
+                            help="--cluster-listen address of another proxy of the cluster to share registrations "
+                                 "with (can be repeated)", default=[])
+        parser.add_argument('--cluster-advertise', type=str, metavar="hostname:port", dest="cluster_advertise",
+                            help="address the other proxies forward debugger connections to (defaults to the -d "
+                                 "address, with this host's name if it listens on all interfaces)", default=None)
+        parser.add_argument('--cluster-route', type=str, metavar="ROUTE", dest="cluster_route",
+                            choices=CLUSTER_ROUTES,
+                            help="connect debugger connections for IDEs registered with another proxy directly to "
+                                 "the IDE (direct, the default) or forward them to that proxy (forward)",
+                            default="direct")
+        parser.add_argument('--relay-budget', type=int, metavar="BYTES", dest="relay_budget",
+                            help="bytes a session may relay per event loop iteration, so bulk transfers do not hold "
+                                 "up the other sessions (defaults to 0, no limit)", default=0)
+        parser.add_argument('--relay-priority', action="store_true", dest="relay_priority",
+                            help="with --relay-budget, only limit bulk transfers and relay small frames first",
+                            default=False)
         return parser.parse_args()
\ No newline at end of file
@@ -1,19 +1,179 @@
-import getopt
+import errno
 import logging
 import asyncore
+import select
+import signal
 import socket
-from re import split
-from xml.dom import minidom
+import time
+from dbgpproxy.address import address_family, format_address, peer_address, set_nodelay, socket_address
+from dbgpproxy.buffers import SendBuffer
+from dbgpproxy.capture import TO_IDE, TO_ENGINE
+from dbgpproxy.protocol import E_NO_ERROR, E_PARSE_ERROR, E_INVALID_OPTIONS, E_UNIMPLEMENTED_COMMAND, \
+    RegistrationCommands, frame_message, parse_init_packet, build_init_packet
+from dbgpproxy.framing import EngineFramer, FrameError
+from dbgpproxy.relay import create_forwarder
+from dbgpproxy.sessions import START, QUEUED
+from dbgpproxy.timers import Scheduler
 
 __author__ = 'gkralik'
 
-E_NO_ERROR = 0
-E_PARSE_ERROR = 1
-E_INVALID_OPTIONS = 3
-E_UNIMPLEMENTED_COMMAND = 4
+# send errors meaning the other side has gone away (as in asyncore)
+_DISCONNECTED = frozenset((errno.ECONNRESET, errno.ENOTCONN, errno.ESHUTDOWN, errno.ECONNABORTED, errno.EPIPE,
+                           errno.EBADF))
 
+# bytes read per relay step; with TCP_NODELAY every read becomes at least one segment to the peer
+RECV_SIZE = 65536
 
-class RegistrationServer(asyncore.dispatcher):
+# connections accepted per readiness event of a listening socket
+ACCEPT_BUDGET = 64
+
+# seconds a listening socket is not watched after the process ran out of file descriptors
+ACCEPT_RETRY_DELAY = 1.0
+
+# accept errors that persist while connections are pending, retrying right away would spin the loop
+_ACCEPT_EXHAUSTED = frozenset((errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM))
+
+
+class BufferedDispatcher(asyncore.dispatcher):
+    """
+    Dispatcher sending from a bounded SendBuffer (see dbgpproxy.buffers).
+
+    Unlike dispatcher_with_send, partial sends do not copy the buffered data and several chunks are written with one
+    sendmsg() call. While the buffer of the consumer (the handler this handler's data is forwarded to) is above its
+    high watermark, this handler stops reading, so the other side is slowed down by TCP instead of the proxy
+    buffering without limit.
+    """
+    _consumer = None
+    _closed = False
+
+    def __init__(self, sock=None, map=None, buffer_size=None):
+        """
+        Initialize the BufferedDispatcher.
+        @param sock: The socket.
+        @param map: The socket map.
+        @param buffer_size: High watermark of the send buffer (bytes).
+        """
+        super().__init__(sock, map)
+        self.send_buffer = SendBuffer() if buffer_size is None else SendBuffer(buffer_size)
+
+    def set_consumer(self, consumer):
+        """
+        Set the handler data read by this handler is sent to.
+        @param consumer: The BufferedDispatcher of the other side.
+        """
+        self._consumer = consumer
+
+    def readable(self):
+        """
+        Stop reading while the consumer does not keep up.
+        """
+        return self._consumer is None or not self._consumer.send_buffer.paused
+
+    def writable(self):
+        """
+        Wait for the connection to be established or for buffered data.
+        """
+        return not self.connected or len(self.send_buffer) > 0
+
+    def handle_write(self):
+        """
+        Send buffered data.
+        """
+        self.initiate_send()
+
+    def send(self, data):
+        """
+        Buffer data and send as much as possible right away. Data for a closed handler is dropped.
+        @param data: The data.
+        """
+        if self._closed:
+            return
+
+        self.send_buffer.append(data)
+        if self.connected:
+            self.initiate_send()
+
+    def initiate_send(self):
+        """
+        Send buffered data until the buffer is empty or the socket would block.
+        """
+        while self.send_buffer:
+            chunks = self.send_buffer.peek()
+            try:
+                n = self.socket.sendmsg(chunks)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                if e.errno in _DISCONNECTED:
+                    self.handle_close()
+                    return
+                raise
+
+            self.send_buffer.consume(n)
+            if n < sum(map(len, chunks)):
+                return
+
+    def close(self):
+        """
+        Close the socket and drop buffered data, so the producer does not stay paused.
+        """
+        self._closed = True
+        self.send_buffer.clear()
+        super().close()
+
+
+class ListeningDispatcher(asyncore.dispatcher):
+    """
+    Dispatcher of a listening socket that can stop accepting for a while (see accept_pending()).
+    """
+    _paused = False
+
+    def readable(self):
+        """
+        @return: False while accepting is paused.
+        """
+        return not self._paused
+
+    def pause_accepting(self, delay):
+        """
+        Stop watching the socket for a while. The pending connections stay queued.
+        @param delay: Seconds.
+        """
+        if not self._paused:
+            self._paused = True
+            self._proxy_manager.call_later(delay, self._resume_accepting)
+
+    def _resume_accepting(self):
+        """
+        Watch the socket again.
+        """
+        self._paused = False
+
+
+def accept_pending(server):
+    """
+    Accept the connections waiting on a listening dispatcher.
+    @param server: The ListeningDispatcher.
+    @return: Iterator of up to ACCEPT_BUDGET (socket, address) tuples.
+    """
+    for i in range(ACCEPT_BUDGET):
+        try:
+            pair = server.accept()
+        except OSError as e:
+            # keep listening, asyncore would close the dispatcher
+            if e.errno in _ACCEPT_EXHAUSTED:
+                server.logger.error('unable to accept connection: {}, retrying in {} seconds'.format(
+                    e, ACCEPT_RETRY_DELAY))
+                server.pause_accepting(ACCEPT_RETRY_DELAY)
+            else:
+                server.logger.error('unable to accept connection: {}'.format(e))
+            return
+        if pair is None:
+            return
+        yield pair
+
+
+class RegistrationServer(ListeningDispatcher):
     def __init__(self, idehost, ideport, dbghost, dbgport, proxy_manager):
         """
         Initialize the RegistrationServer.
@@ -36,27 +196,24 @@ class RegistrationServer(asyncore.dispatcher):
 
         self.logger = logging.getLogger('dbgpproxy.ide')
 
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.set_reuse_addr()
-        self.bind((idehost, ideport))
+        self.set_socket(proxy_manager.create_listener('ide', idehost, ideport))
+        self.accepting = True
 
         self.logger.info('listening for registration requests on {}:{}...'.format(idehost, ideport))
-        self.listen(5)
 
     def handle_accept(self):
         """
         Handle incoming IDE requests.
 
-        Dispatches a RegistrationHandler.
+        Accepts up to ACCEPT_BUDGET pending connections and dispatches a RegistrationHandler for each.
         """
-        pair = self.accept()
-        if pair is not None:
+        for pair in accept_pending(self):
             sock, addr = pair
             self.logger.debug('incoming registration connection from {}'.format(repr(addr)))
             handler = RegistrationHandler(self._proxy_manager, dbghost=self._dbghost, dbgport=self._dbgport, sock=sock)
 
 
-class RegistrationHandler(asyncore.dispatcher_with_send):
+class RegistrationHandler(RegistrationCommands, BufferedDispatcher):
     def __init__(self, proxy_manager, dbghost=None, dbgport=None, sock=None, map=None):
         """
         Initialize the RegistrationHandler.
@@ -73,168 +230,277 @@ class RegistrationHandler(asyncore.dispatcher_with_send):
 
         self._dbghost = dbghost
         self._dbgport = dbgport
+        proxy_manager.registration_handlers.add(self)
 
-    def send(self, data):
+    @property
+    def _peer_host(self):
         """
-        Send data.
-
-        Uses the format from the DBGp specification (message length followed by a \0 character, then the message
-        terminated with a \0 character).
-        @param data:
+        The host of the IDE that sent the registration request.
         """
-        l = len(data)
-        data = '{0:d}\0{1:s}\0'.format(l, data)
+        return peer_address(self.socket, self.addr)[0]
 
-        super().send(data.encode())
+    def send_message(self, data):
+        """
+        Send a message to the IDE.
+        @param data: The message (str).
+        """
+        self.send(frame_message(data))
 
-    @staticmethod
-    def _parse_line(line):
+    def handle_read(self):
         """
-        Parse an IDE command line.
-        @param line: The line.
-        @return: A tuple consisting of the command, a list of arguments and the full line.
+        Handle commands sent by the IDE.
         """
-        line = line.strip().rstrip('\0')
-        if not line:
-            return None, None, line
+        data = self.recv(RECV_SIZE)
+        if data:
+            self.handle_data(data)
 
-        command, args = split(' ', line, maxsplit=1)
+    def handle_close(self):
+        """
+        Handle socket close.
+        """
+        self.stop_commands()
+        self.close()
 
-        return command, args.split(), line
+    def close(self):
+        """
+        Close the socket.
+        """
+        self._proxy_manager.registration_handlers.discard(self)
+        super().close()
 
-    def handle_read(self):
+    def handoff_state(self):
+        """
+        @return: The socket if the connection can be handed off to another process now, i.e. no partial command or
+                 response is buffered, otherwise None.
         """
-        Handle proxyinit and proxystop commands sent by the IDE.
+        if self.commands_idle() and not self.send_buffer:
+            return self.socket
+        return None
 
-        No other commands are recognized and responded to with a proxyerror.
+    def detach(self):
         """
-        data = self.recv(1024)
-        if data:
-            command, args, line = self._parse_line(data.decode())
+        Close the connection in this process after it has been handed off.
+        """
+        self.handle_close()
 
-            if not command:
-                self._error('proxyerror', 'Failed to parse command.', E_PARSE_ERROR)
 
-            self.logger.debug('command = %s, args = %s' % (command, args))
+class RelayMixin:
+    """
+    Forwarding of a socket pair with a Forwarder (see dbgpproxy.relay) instead of recv()/send().
 
-            if command == 'proxyinit':
-                self._handle_proxyinit(args)
-            elif command == 'proxystop':
-                self._handle_proxystop(args)
-            else:
-                self._error('proxyerror', 'Unknown command [{0:s}]'.format(command), E_UNIMPLEMENTED_COMMAND)
+    Used by the engine and IDE handlers once the session has been established and relay mode is enabled.
+    """
+    _relay_peer = None
+    _relay_read = None
+    _relay_write = None
 
-    def _handle_proxyinit(self, args):
+    def start_relay(self, peer, read_forwarder, write_forwarder):
         """
-        Handle a proxyinit command sent by the IDE.
-
-        Parses the args and adds the IDE to the proxy manager's server list. A proxyinit success message is sent
-        afterwards.
-        If anything fails, a proxyerror is sent to the IDE.
-        @param args: A list of args to the proxyinit command.
-        @return: void
+        Switch the handler to forwarding.
+        @param peer: The handler of the other side of the session.
+        @param read_forwarder: The Forwarder reading from this handler's socket.
+        @param write_forwarder: The Forwarder writing to this handler's socket.
         """
-        self.logger.debug('got proxyinit command: %s' % (args,))
+        self._relay_peer = peer
+        self._relay_read = read_forwarder
+        self._relay_write = write_forwarder
 
-        idekey = port = multi = None
-        opts, args = getopt.getopt(args, 'p:k:m:')
+    def readable(self):
+        """
+        Stop reading while the previous chunk has not been written to the peer.
+        """
+        if self._relay_read is not None:
+            return not self._relay_read.pending
+        return super().readable()
 
-        for o, a in opts:
-            if o == '-p':
-                port = int(a)
-            elif o == '-k':
-                idekey = a
-            elif o == '-m':
-                multi = a
+    def writable(self):
+        """
+        Wait for writability while forwarded data is pending.
+        """
+        if self._relay_write is not None and self._relay_write.pending:
+            return True
+        return super().writable()
 
-        if not idekey:
-            self._error('proxyinit', 'No IDE key defined for proxy.', E_INVALID_OPTIONS)
+    def handle_write(self):
+        """
+        Send buffered data first, then pending forwarded data.
+        """
+        if not self.connected:
             return
 
-        if not port:
-            self._error('proxyinit', 'No port defined for proxy.', E_INVALID_OPTIONS)
-            return
+        if self.send_buffer:
+            super().handle_write()
+        self.flush_relay()
 
-        id = self._proxy_manager.add_server(idekey, self.addr[0], port, multi)
-        if id:
-            msg = '<?xml version="1.0" encoding="UTF-8"?>\n<proxyinit success="1" idekey="{0:s}" address="{1:s}" port="{2:d}"/>'.format(
-                id, self._dbghost, self._dbgport)
-            self.send(msg)
-            return
-        else:
-            self._error('proxyinit', 'IDE Key already exists.', E_INVALID_OPTIONS)
+    def flush_relay(self):
+        """
+        Write pending forwarded data to this handler's socket.
+        """
+        if self.send_buffer or self._relay_write is None or not self._relay_write.pending:
             return
 
-    def _handle_proxystop(self, args):
-        """
-        Handle a proxystop command sent by the IDE.
+        try:
+            self._relay_write.write()
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.handle_close()
 
-        Parses the args and removes the IDE from the proxy manager's server list. Sends a proxystop success message if
-        everything ok.
-        If a failure occurs, sends a proxyerror.
-        @param args: List of args to the proxystop command.
-        @return: void
+    def relay(self):
         """
-        self.logger.debug('got proxystop command: %s' % (args))
-
-        opts, args = getopt.getopt(args, 'k:')
-        idekey = None
-        for o, a in opts:
-            if o == '-k':
-                idekey = a
+        Forward available data from this handler's socket to the peer.
+        """
+        try:
+            n = self._relay_read.read()
+        except BlockingIOError:
+            return
+        except OSError:
+            self.handle_close()
+            return
 
-        if not idekey:
-            self._error('proxystop', 'No IDE key.', E_INVALID_OPTIONS)
+        if not n:
+            self.handle_close()
             return
 
-        id = self._proxy_manager.remove_server(idekey)
-        msg = '<?xml version="1.0" encoding="UTF-8"?>\n<proxystop success="1" idekey="{0:s}"/>'.format(id)
-        self.send(msg)
-        return
+        self.relayed(n)
+        self._relay_peer.flush_relay()
 
-    def _error(self, command, message, code=E_NO_ERROR):
+    def relayed(self, n):
         """
-        Send a proxyerror and shutdown the dispatcher.
-        @param command: The command that caused the error.
-        @param message: The error message to send (UI usable by the IDE).
-        @param code: The error code (defaults to E_NO_ERROR).
+        Called after forwarding data read from this handler's socket.
+        @param n: Number of bytes.
         """
-        error = '<?xml version="1.0" encoding="UTF-8"?>\n<{0:s} success="0"><error id="{1:d}"><message>{2:s}</message></error></{0:s}>'.format(
-            command, code, message)
+        pass
 
-        self.logger.error(message)
-        self.send(error)
-        self.close()
+    def close(self):
+        """
+        Close the socket and release the forwarders.
 
+        A forwarded session cannot outlive one of its sockets, so the peer is closed as well.
+        """
+        peer = self._relay_peer
+        for forwarder in (self._relay_read, self._relay_write):
+            if forwarder is not None:
+                forwarder.close()
+        self._relay_peer = self._relay_read = self._relay_write = None
+        super().close()
 
-class ToIDEHandler(asyncore.dispatcher_with_send):
-    def __init__(self, sock, debug_sock):
+        if peer is not None and peer._relay_peer is not None:
+            peer.close()
+
+
+class ToIDEHandler(RelayMixin, BufferedDispatcher):
+    def __init__(self, sock, debug_sock, buffer_size=None, capture=None, metrics=None, cache=None):
         """
         Initialize the ToIDEHandler.
-        @param sock: The IDE socket.
+
+        Data sent while still connecting is buffered until the connection is established.
+        @param sock: The IDE socket or None if the handler connects itself.
         @param debug_sock: The debugger engine socket.
+        @param buffer_size: High watermark of the send buffer (bytes).
+        @param capture: The SessionCapture of the session (optional).
+        @param metrics: The SessionMetrics of the session (optional).
+        @param cache: The SessionCache of the session (optional).
         """
-        super().__init__(sock)
+        super().__init__(sock, buffer_size=buffer_size)
         self._debug_sock = debug_sock
+        self._capture = capture
+        self._metrics = metrics
+        self._cache = cache
+        self.set_consumer(debug_sock)
         self.logger = logging.getLogger('dbgpproxy.dbg')
 
+    @property
+    def idekey(self):
+        """
+        @return: The IDE key of the session.
+        """
+        return self._debug_sock.idekey
+
+    @property
+    def relay_session(self):
+        """
+        @return: The session the handler relays data of, for the RelayScheduler (see dbgpproxy.fairness).
+        """
+        return self._debug_sock
+
+    def handle_connect_event(self):
+        """
+        Finish connecting and notify the debugger engine handler about the outcome.
+        """
+        try:
+            super().handle_connect_event()
+        except OSError as e:
+            self._debug_sock.ide_connect_failed(e.strerror)
+
+    def handle_connect(self):
+        """
+        Handle the established connection. Buffered data is sent by handle_write().
+        """
+        self._debug_sock.ide_connected()
+
     def handle_read(self):
         """
         Handle data sent by the IDE and forward to the debugging engine.
         """
-        data = self.recv(1024)
+        if not self.connected:
+            return
+
+        if self._relay_read is not None:
+            self.relay()
+            return
+
+        relay = self._debug_sock._proxy_manager.relay_scheduler
+        size = RECV_SIZE
+        if relay is not None:
+            size = relay.allowance(self._debug_sock, size)
+            if not size:
+                return
+
+        try:
+            data = self.recv(size)
+        except BlockingIOError:
+            # asyncore calls handle_read() right after finishing the connect
+            return
+
         if data:
-            self.logger.debug('<-- {}'.format(data.decode()))
+            if relay is not None:
+                relay.relayed(self._debug_sock, data)
+            if self._metrics is not None:
+                self._metrics.to_engine(data)
+            if self._capture is not None:
+                self._capture.record(TO_ENGINE, data)
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('<-- {}'.format(data.decode(errors='replace')))
+            if self._cache is not None:
+                data, responses = self._cache.from_ide(data)
+                for response in responses:
+                    self._debug_sock.send_to_ide(response, cached=True)
+                if not data:
+                    return
             self._debug_sock.send(data)
 
+    def relayed(self, n):
+        """
+        Count forwarded data.
+        @param n: Number of bytes.
+        """
+        if self._metrics is not None:
+            self._metrics.bytes_to_engine += n
+
     def handle_close(self):
         """
         Handle socket close.
+
+        The session ends with the IDE connection, so the debugger engine connection is closed as well (unless the
+        debugger engine handler has already dropped this handler after a failed connect).
         """
         self.close()
+        if self._debug_sock._ide_handler is self and not self._debug_sock._closed:
+            self._debug_sock.handle_close()
 
 
-class DebugConnectionServer(asyncore.dispatcher):
+class DebugConnectionServer(ListeningDispatcher):
     def __init__(self, host, port, proxy_manager):
         """
         Initialize the DebugConnectionServer.
@@ -252,28 +518,29 @@ class DebugConnectionServer(asyncore.dispatcher):
 
         self.logger = logging.getLogger('dbgpproxy.dbg')
 
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.set_reuse_addr()
-        self.bind((host, port))
+        self.set_socket(proxy_manager.create_listener('dbg', host, port))
+        self.accepting = True
 
         self.logger.info('listening for debugger connections on {}:{}'.format(host, port))
-        self.listen(5)
 
     def handle_accept(self):
         """
         Handle incoming requests from the debugger engine.
 
-        Dispatches a DebugConnectionHandler.
+        Accepts up to ACCEPT_BUDGET pending connections and dispatches a DebugConnectionHandler for each connection
+        admitted by the session table. Others are closed right away.
         """
-        pair = self.accept()
-        if pair is not None:
+        for pair in accept_pending(self):
             sock, addr = pair
+            if not self._proxy_manager.sessions.admit():
+                sock.close()
+                continue
             self.logger.debug('incoming debugger connection from {}'.format(repr(addr)))
             handler = DebugConnectionHandler(self._proxy_manager, sock=sock, dbghost=self._host, dbgport=self._port,
-                                             enginehost=addr)
+                                             enginehost=peer_address(sock, addr))
 
 
-class DebugConnectionHandler(asyncore.dispatcher_with_send):
+class DebugConnectionHandler(RelayMixin, BufferedDispatcher):
     def __init__(self, proxy_manager, dbghost=None, dbgport=None, enginehost=None, sock=None, map=None):
         """
         Initialize the DebugConnectionHandler.
@@ -284,12 +551,26 @@ class DebugConnectionHandler(asyncore.dispatcher_with_send):
         @param sock: The socket.
         @param map: Not used.
         """
-        super().__init__(sock, map)
+        super().__init__(sock, map, buffer_size=proxy_manager.buffer_size)
+        # relayed chunks are small, don't let them wait for the ACK of the previous one (asyncio does the same)
+        set_nodelay(self.socket)
 
         self._proxy_manager = proxy_manager
         self._initialized = False
+        self._framer = EngineFramer()
         self._ide_socket = None
         self._ide_handler = None
+        self._idekey = None
+        self._init_packet = None
+        self._ide_addr = None
+        self._connect_timer = None
+        self._capture = None
+        self._cache = None
+        self.metrics = None
+
+        # data from the debugger engine waiting for the connection to the IDE
+        self._held = None
+        self._held_size = 0
 
         self._dbghost = dbghost
         self._dbgport = dbgport
@@ -297,11 +578,20 @@ class DebugConnectionHandler(asyncore.dispatcher_with_send):
 
         self.logger = logging.getLogger('dbgpproxy.dbg')
 
+    def readable(self):
+        """
+        Stop reading while too much data is waiting for the connection to the IDE.
+        """
+        if self._held is not None:
+            return self._held_size < self._proxy_manager.buffer_size
+        return super().readable()
+
     def handle_read(self):
         """
         Handle data sent by the debugger engine.
 
         If the connection has not been initialized, _handle_init_packet() is called.
+        While the session waits for a free slot or for the IDE connection, data is held back.
         Else, data is just sent to the IDE handler.
         @return:
         """
@@ -310,54 +600,81 @@ class DebugConnectionHandler(asyncore.dispatcher_with_send):
             self._handle_init_packet()
             return
 
+        if self._relay_read is not None:
+            self.relay()
+            return
+
+        relay = self._proxy_manager.relay_scheduler
+        size = RECV_SIZE
+        if relay is not None and self._held is None:
+            size = relay.allowance(self, size)
+            if not size:
+                # the session has used up its budget, poll() reports the socket again in the next pass
+                return
+
         # now play man in the middle ;)
-        data = self.recv(1024)
+        data = self.recv(size)
         if data:
-            self.logger.debug('--> {}'.format(data.decode()))
-            self._ide_handler.send(data)
+            if self._held is not None:
+                self._held.append(data)
+                self._held_size += len(data)
+                return
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('--> {}'.format(data.decode(errors='replace')))
+            self.send_to_ide(data)
+            if relay is not None:
+                relay.relayed(self, data)
+
+    def send_to_ide(self, data, cached=False):
+        """
+        Record data for the session's metrics, capture and response cache and send it to the IDE handler.
+        @param data: The data.
+        @param cached: True for a response served from the response cache instead of by the debugger engine.
+        """
+        self.metrics.to_ide(data)
+        if self._capture is not None:
+            self._capture.record(TO_IDE, data)
+        if self._cache is not None and not cached:
+            self._cache.from_engine(data)
+        self._ide_handler.send(data)
+
+    def relayed(self, n):
+        """
+        Count forwarded data.
+        @param n: Number of bytes.
+        """
+        self.metrics.bytes_to_ide += n
 
     def _handle_init_packet(self):
         """
         Handle an init packet from the debugger engine.
 
-        Gets the server (IDE) from the proxy manager instance based on the IDE key from the init packet and tries to
-        connect to the IDE. Also sets the 'proxied' attribute of the init packet to the hostname of the debugger
-        engine.
+        Buffers data until the init packet is complete. Then gets the server (IDE) from the proxy manager instance
+        based on the IDE key from the init packet and asks the session table for a slot (see
+        dbgpproxy.sessions.SessionTable). Also sets the 'proxied' attribute of the init packet to the hostname of the
+        debugger engine unless it is set already.
         On failure, a proxyerror is sent and the socket is closed.
         @return: void
         """
-        self.logger.debug('handle init packet')
-        data = self.recv(100)
-
-        # look for first NUL byte
-        eol = data.find(b'\x00')
+        data = self.recv(4096)
+        if not data:
+            return
 
-        # extract message length
+        self._framer.feed(data)
         try:
-            msg_len = int(data[:eol])
-        except ValueError:
-            self.logger.error('invalid protocol')
+            data = self._framer.next_frame()
+        except FrameError as e:
+            self.logger.error('invalid protocol ({})'.format(e))
             # TODO send error to debugging engine
             self.close()
             return
 
-        # skip \x00
-        data = data[eol + 1:]
-
-        # calculate remaining data length
-        remaining_size = msg_len - len(data) + 1
-
-        # get remaining data for init packet
-        while remaining_size > 0:
-            new_data = self.recv(remaining_size)
-            data = data + new_data
-            remaining_size -= len(new_data)
-
-        # skip \x00
-        data = data[:msg_len]
+        # wait for the rest of the init packet
+        if data is None:
+            return
 
-        dom = minidom.parseString(data.decode())
-        init_packet = dom.documentElement
+        self.logger.debug('handle init packet')
+        init_packet = parse_init_packet(data)
         packet_type = init_packet.localName
 
         if packet_type != 'init':
@@ -375,49 +692,234 @@ class DebugConnectionHandler(asyncore.dispatcher_with_send):
             self.close()
             return
 
-        init_packet.setAttribute('proxied', self._enginehost[0])
+        # a chained proxy (see dbgpproxy.tunnel) keeps the host seen by the first proxy
+        if not init_packet.hasAttribute('proxied'):
+            init_packet.setAttribute('proxied', self._enginehost[0])
 
-        if not self.connect_to_ide(server, init_packet):
-            self.logger.warn(
-                'unable to connect to server with IDE key [{}], aborting and removing server'.format(idekey))
+        self._idekey = idekey
+        self._init_packet = init_packet
+        self._initialized = True
+
+        # hold anything the engine sent after the init packet until the IDE is connected
+        remaining = self._framer.remaining()
+        self._held = [remaining] if remaining else []
+        self._held_size = len(remaining)
+        self._framer = None
+
+        state = self._proxy_manager.sessions.acquire(idekey, self)
+        if state == START:
+            self.start_session()
+        elif state != QUEUED:
             # TODO send error (proxyerror)
-            self._proxy_manager.remove_server(idekey)
             self.close()
+
+    def start_session(self):
+        """
+        Connect to the IDE once the session table has given the session a slot.
+
+        The IDE is looked up again, it may have re-registered while the session was waiting.
+        """
+        server = self._proxy_manager.get_server(self._idekey)
+        if not server:
+            self.logger.warn('no server with IDE key [{}], aborting request'.format(self._idekey))
+            self.handle_close()
             return
 
-        self._initialized = True
+        if self.metrics is None:
+            self.metrics = self._proxy_manager.metrics.open_session(self._idekey)
+        if self._capture is None and self._proxy_manager.capture is not None:
+            self._capture = self._proxy_manager.capture.open_session(self._idekey, self._enginehost[0])
+        if self._cache is None and self._proxy_manager.cache is not None:
+            self._cache = self._proxy_manager.cache.open_session(self._init_packet)
+
+        if not self.connect_to_ide(server):
+            self.logger.warn(
+                'unable to connect to server with IDE key [{}], aborting and removing server'.format(self._idekey))
+            self._proxy_manager.remove_server(self._idekey)
+            self.handle_close()
 
-    def connect_to_ide(self, server, init_packet):
+    def reject_session(self, reason):
         """
-        Connect to the IDE.
+        Close a session that did not get a slot.
+        @param reason: Description of the reason.
+        """
+        self.logger.warn('rejecting debugger connection for IDE key [{}]: {}'.format(self._idekey, reason))
+        self.handle_close()
+
+    def connect_to_ide(self, server):
+        """
+        Start connecting to the IDE.
 
-        On success, adds the 'hostname' attribute to the init packet, specifying the proxy hostname.
-        @param server: The IDE address (list with hostname and port).
-        @param init_packet: The init packet (minidom node)
-        @return: True if connection succeeded, False otherwise.
+        The connection is established without blocking the loop. ide_connected() or ide_connect_failed() is called
+        once the outcome is known.
+        @param server: The IDE address (list with hostname and port, see dbgpproxy.address).
+        @return: True if connecting has been started, False otherwise.
         """
-        server_addr = server[0]
+        server_addr = self._ide_addr = server[0]
+        self._ide_handler = ToIDEHandler(None, self, buffer_size=self._proxy_manager.buffer_size,
+                                         capture=self._capture, metrics=self.metrics, cache=self._cache)
+        self.set_consumer(self._ide_handler)
 
         try:
-            self.logger.debug('trying to connect to {}:{}'.format(server_addr[0], server_addr[1]))
-            self._ide_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._ide_socket.connect((server_addr[0], server_addr[1]))
+            self.logger.debug('trying to connect to {}'.format(format_address(*server_addr)))
+            self._ide_handler.create_socket(address_family(server_addr[0]), socket.SOCK_STREAM)
+            set_nodelay(self._ide_handler.socket)
+            self._ide_socket = self._ide_handler.socket
+            # Unix domain sockets connect right away, ide_connected() is called from within connect()
+            self._connect_timer = self._proxy_manager.call_later(self._proxy_manager.connect_timeout,
+                                                                 self.ide_connect_failed, 'timed out')
+            self._ide_handler.connect(socket_address(*server_addr))
         except socket.error:
-            self.logger.warn('unable to connect to {}:{}'.format(server_addr[0], server_addr[1]))
+            self.logger.warn('unable to connect to {}'.format(format_address(*server_addr)))
+            self._cancel_connect_timer()
+            self._ide_handler.close()
+            self._ide_handler = self._ide_socket = None
+            self.set_consumer(None)
             return False
 
-        if not init_packet.hasAttribute('hostname') or not init_packet.getAttribute('hostname'):
-            init_packet.setAttribute('hostname', self._dbghost)
+        return True
 
-        # send the init packet to the server (IDE)
-        response = '<?xml version="1.0" encoding="UTF-8"?>\n'
-        response += init_packet.toxml()
-        l = len(response)
-        self.logger.debug('sending init to IDE {0:d}\0{1:s}\0'.format(l, response))
-        self._ide_socket.send('{0:d}\0{1:s}\0'.format(l, response).encode())
-        self._ide_handler = ToIDEHandler(self._ide_socket, self)
+    def ide_connected(self):
+        """
+        Called by the IDE handler once the connection to the IDE is established.
 
-        return True
+        Sends the init packet, with the 'hostname' attribute specifying the proxy hostname added, and the data held
+        back in the meantime.
+        """
+        self._cancel_connect_timer()
+
+        response = build_init_packet(self._init_packet, self._dbghost)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('sending init to IDE {}'.format(response.decode(errors='replace')))
+        self.send_to_ide(response)
+
+        held = self._held
+        self._held = None
+        self._held_size = 0
+        for data in held:
+            self.send_to_ide(data)
+
+        self._start_forwarding()
+
+    def _start_forwarding(self):
+        """
+        Switch an established session to a Forwarder in splice relay mode.
+        """
+        # captured and cached sessions are copied, spliced data never passes through the proxy
+        if self._proxy_manager.relay == 'splice' and self._capture is None and self._cache is None:
+            to_ide = create_forwarder(self.socket, self._ide_socket)
+            to_engine = create_forwarder(self._ide_socket, self.socket)
+            self.start_relay(self._ide_handler, to_ide, to_engine)
+            self._ide_handler.start_relay(self, to_engine, to_ide)
+
+    def adopt(self, ide_sock, state):
+        """
+        Continue an established session handed over by another process (see dbgpproxy.handoff).
+        @param ide_sock: The IDE socket.
+        @param state: Dict describing the session, see handoff_state().
+        """
+        self._initialized = True
+        self._idekey = state['idekey']
+        self._ide_addr = state['ide']
+        self._proxy_manager.sessions.adopt(self._idekey, self)
+
+        self.metrics = self._proxy_manager.metrics.open_session(self._idekey)
+        if self._proxy_manager.capture is not None:
+            self._capture = self._proxy_manager.capture.open_session(self._idekey, self._enginehost[0])
+        # without the state of the previous process, responses cannot be told apart
+        if state['cache'] is not None and self._proxy_manager.cache is not None:
+            self._cache = self._proxy_manager.cache.resume_session(state['cache'])
+
+        self._ide_handler = ToIDEHandler(ide_sock, self, buffer_size=self._proxy_manager.buffer_size,
+                                         capture=self._capture, metrics=self.metrics, cache=self._cache)
+        self._ide_socket = ide_sock
+        self.set_consumer(self._ide_handler)
+        self._start_forwarding()
+
+    def handoff_state(self):
+        """
+        Describe the session for another process if it can be handed off now, i.e. the IDE is connected and no data
+        of the session is buffered in this process.
+        @return: Tuple of the debugger engine socket, the IDE socket and a JSON serializable dict, or None.
+        """
+        ide_handler = self._ide_handler
+        if (self._held is not None or ide_handler is None or not ide_handler.connected or self.send_buffer
+                or ide_handler.send_buffer):
+            return None
+        for forwarder in (self._relay_read, self._relay_write):
+            if forwarder is not None and forwarder.pending:
+                return None
+        if self._cache is not None and not self._cache.idle():
+            return None
+
+        return self.socket, self._ide_socket, {
+            'idekey': self._idekey, 'engine': list(self._enginehost), 'ide': list(self._ide_addr),
+            'cache': self._cache.snapshot() if self._cache is not None else None}
+
+    def detach(self):
+        """
+        Close the session in this process after it has been handed off. The connections stay open in the other one.
+        """
+        self.handle_close()
+
+    def ide_connect_failed(self, reason):
+        """
+        Called if connecting to the IDE failed or timed out.
+
+        If the IDE has other sessions open, it is assumed to refuse parallel sessions and the session waits for one
+        of them to end. Otherwise the server is removed from the proxy manager and the session is closed.
+        @param reason: Description of the failure.
+        """
+        self._cancel_connect_timer()
+        self.logger.warn('unable to connect to {} ({})'.format(format_address(*self._ide_addr), reason))
+
+        if self._proxy_manager.sessions.refused(self._idekey, self):
+            self._ide_handler.close()
+            self._ide_handler = self._ide_socket = None
+            self.set_consumer(None)
+            return
+
+        self.logger.warn(
+            'unable to connect to server with IDE key [{}], aborting and removing server'.format(self._idekey))
+        self._proxy_manager.remove_server(self._idekey)
+        self.handle_close()
+
+    def _cancel_connect_timer(self):
+        """
+        Cancel the IDE connect timeout.
+        """
+        if self._connect_timer is not None:
+            self._connect_timer.cancel()
+            self._connect_timer = None
+
+    @property
+    def idekey(self):
+        """
+        @return: The IDE key of the session, None until the init packet has been received.
+        """
+        return self._idekey
+
+    @property
+    def relay_session(self):
+        """
+        @return: The session the handler relays data of, for the RelayScheduler (see dbgpproxy.fairness).
+        """
+        return self
+
+    @property
+    def closed(self):
+        """
+        @return: True once the debugger engine connection has been closed.
+        """
+        return self._closed
+
+    @property
+    def peak_buffered(self):
+        """
+        @return: Tuple of the most bytes buffered at once for the IDE and for the debugger engine in this session.
+        """
+        to_ide = self._ide_handler.send_buffer.peak if self._ide_handler is not None else 0
+        return to_ide, self.send_buffer.peak
 
     def handle_close(self):
         """
@@ -425,7 +927,307 @@ class DebugConnectionHandler(asyncore.dispatcher_with_send):
 
         Also closes the IDE handler if it has been initialized.
         """
+        self._cancel_connect_timer()
+        if self._idekey is not None:
+            self.logger.debug('session [{}] closed, peak buffered bytes: {} to IDE, {} to engine'.format(
+                self._idekey, *self.peak_buffered))
         if self._ide_handler is not None:
             self.logger.debug('closing IDE socket')
             self._ide_handler.close()
         self.close()
+
+    def close(self):
+        """
+        Close the socket, the capture file and the metrics of the session and give up its slot.
+        """
+        if not self._closed:
+            if self._idekey is not None:
+                self._proxy_manager.sessions.release(self._idekey, self)
+            self._proxy_manager.sessions.connection_closed()
+        if self._capture is not None:
+            self._capture.close()
+            self._capture = None
+        if self.metrics is not None:
+            self.metrics.close(self.peak_buffered)
+            self.metrics = None
+        if self._proxy_manager.relay_scheduler is not None:
+            self._proxy_manager.relay_scheduler.discard(self)
+        super().close()
+
+
+class WatchDispatcher(asyncore.dispatcher):
+    """
+    Calls back when a socket owned by someone else becomes readable or writable (see AsyncoreEngine.add_reader()).
+    """
+
+    def __init__(self, sock):
+        """
+        Initialize the WatchDispatcher.
+        @param sock: The socket to watch.
+        """
+        super().__init__(sock)
+        self.on_read = None
+        self.on_write = None
+        self.logger = logging.getLogger('dbgpproxy')
+
+    def readable(self):
+        """
+        Watch readability if there is a read callback.
+        """
+        return self.on_read is not None
+
+    def writable(self):
+        """
+        Watch writability if there is a write callback.
+        """
+        return self.on_write is not None
+
+    def handle_read(self):
+        """
+        Call the read callback.
+        """
+        if self.on_read is not None:
+            self.on_read()
+
+    def handle_write(self):
+        """
+        Call the write callback.
+        """
+        if self.on_write is not None:
+            self.on_write()
+
+    def handle_close(self):
+        """
+        Let the owner find out about the hang-up by reading or writing; the socket is closed by its owner.
+        """
+        if self.on_read is not None:
+            self.on_read()
+        elif self.on_write is not None:
+            self.on_write()
+
+    def handle_error(self):
+        """
+        Log the error and stop watching, leaving the socket to its owner.
+        """
+        self.logger.exception('error in socket callback')
+        self.on_read = self.on_write = None
+        self.del_channel()
+
+
+class AsyncoreEngine:
+    def __init__(self, idehost, ideport, dbghost, dbgport, proxy_manager):
+        """
+        Initialize the asyncore engine.
+
+        Sets up the RegistrationServer and DebugConnectionServer instances.
+        @param idehost: The host to listen on for IDE requests.
+        @param ideport: The port to listen on for IDE requests.
+        @param dbghost: The host to listen on for debugger engine requests.
+        @param dbgport: The port to listen on for debugger engine requests.
+        @param proxy_manager: The proxy manager instance.
+        """
+        self._scheduler = Scheduler()
+        # socket -> WatchDispatcher
+        self._watched = {}
+        # signal number -> callback, and the socket pair the signal numbers are written to (see signal.set_wakeup_fd)
+        self._signal_handlers = {}
+        self._signal_sockets = None
+        self._proxy_manager = proxy_manager
+        self._dbghost = dbghost
+        self._dbgport = dbgport
+        self._registration_server = RegistrationServer(idehost, ideport, dbghost, dbgport, proxy_manager)
+        self._debugger_connection_server = DebugConnectionServer(dbghost, dbgport, proxy_manager)
+
+    def start(self):
+        """
+        Start the asyncore loop.
+
+        Runs one asyncore pass at a time so due timers are run in between. poll() is used where available, select()
+        cannot watch file descriptors above FD_SETSIZE (1024). With a LoopMonitor or relay priority, the passes are run
+        by _poll_pass() (poll() only).
+        """
+        use_poll = hasattr(select, 'poll')
+        monitor = self._proxy_manager.monitor
+        relay = self._proxy_manager.relay_scheduler
+        own_pass = use_poll and (monitor is not None or (relay is not None and relay.priority))
+        while asyncore.socket_map:
+            if own_pass:
+                self._poll_pass(monitor, relay)
+                continue
+            asyncore.loop(timeout=self._scheduler.timeout(30.0), use_poll=use_poll, count=1)
+            self._scheduler.run()
+
+    def _poll_pass(self, monitor, relay):
+        """
+        Run one loop pass like asyncore.poll2(). With a LoopMonitor, every callback and the whole iteration are timed.
+        With relay priority, the readiness events of sessions relaying bulk transfers are handled last.
+        @param monitor: The LoopMonitor or None.
+        @param relay: The RelayScheduler or None.
+        """
+        pollster = select.poll()
+        for fd, obj in list(asyncore.socket_map.items()):
+            flags = 0
+            if obj.readable():
+                flags |= select.POLLIN | select.POLLPRI
+            # accepting sockets should not be writable
+            if obj.writable() and not obj.accepting:
+                flags |= select.POLLOUT
+            if flags:
+                pollster.register(fd, flags | select.POLLERR | select.POLLHUP | select.POLLNVAL)
+
+        try:
+            events = pollster.poll(self._scheduler.timeout(30.0) * 1000)
+        except InterruptedError:
+            events = []
+
+        start = time.perf_counter()
+        if relay is not None and relay.priority:
+            # sorting is stable, the other events keep their order
+            events.sort(key=lambda event: relay.bulk(getattr(asyncore.socket_map.get(event[0]), 'relay_session', None)))
+        for fd, flags in events:
+            obj = asyncore.socket_map.get(fd)
+            if obj is None:
+                continue
+            if monitor is None:
+                asyncore.readwrite(obj, flags)
+            else:
+                monitor.call(obj, asyncore.readwrite, obj, flags)
+        self._scheduler.run(monitor)
+        if monitor is not None:
+            monitor.iteration(time.perf_counter() - start)
+
+    def call_later(self, delay, callback, *args):
+        """
+        Schedule a callback on the loop.
+        @param delay: Delay in seconds.
+        @param callback: The callback.
+        @param args: Arguments to the callback.
+        @return: A timer with a cancel() method.
+        """
+        return self._scheduler.call_later(delay, callback, *args)
+
+    def call_soon(self, callback, *args):
+        """
+        Call back after the readiness events of the current pass, with the due timers.
+        @param callback: The callback.
+        @param args: Arguments to the callback.
+        """
+        self._scheduler.call_later(0, callback, *args)
+
+    def add_signal_handler(self, signum, callback):
+        """
+        Call back on the loop when a signal is received. Must be called from the main thread.
+
+        The signal numbers are written to a socket pair by the interpreter (see signal.set_wakeup_fd()), so a signal
+        wakes up the loop and the callback runs in between two loop callbacks.
+        @param signum: The signal number.
+        @param callback: Called without arguments.
+        """
+        if self._signal_sockets is None:
+            self._signal_sockets = socket.socketpair()
+            for sock in self._signal_sockets:
+                sock.setblocking(False)
+            signal.set_wakeup_fd(self._signal_sockets[1].fileno(), warn_on_full_buffer=False)
+            self.add_reader(self._signal_sockets[0], self._handle_signals)
+
+        self._signal_handlers[signum] = callback
+        # the interpreter only writes to the wakeup socket for signals with a Python handler
+        signal.signal(signum, lambda signum, frame: None)
+
+    def _handle_signals(self):
+        """
+        Call the callbacks of the signals received.
+        """
+        try:
+            data = self._signal_sockets[0].recv(4096)
+        except BlockingIOError:
+            return
+
+        for signum in data:
+            callback = self._signal_handlers.get(signum)
+            if callback is not None:
+                callback()
+
+    def close_listeners(self):
+        """
+        Stop accepting registration and debugger connections.
+        """
+        self._registration_server.close()
+        self._debugger_connection_server.close()
+
+    def adopt_session(self, engine_sock, ide_sock, state):
+        """
+        Continue an established session handed over by another process.
+        @param engine_sock: The debugger engine socket.
+        @param ide_sock: The IDE socket.
+        @param state: Dict describing the session, see DebugConnectionHandler.handoff_state().
+        """
+        handler = DebugConnectionHandler(self._proxy_manager, dbghost=self._dbghost, dbgport=self._dbgport,
+                                         enginehost=tuple(state['engine']), sock=engine_sock)
+        handler.adopt(ide_sock, state)
+
+    def adopt_registration(self, sock):
+        """
+        Continue handling the commands of a registration connection handed over by another process.
+        @param sock: The socket.
+        """
+        RegistrationHandler(self._proxy_manager, dbghost=self._dbghost, dbgport=self._dbgport, sock=sock)
+
+    def add_reader(self, sock, callback):
+        """
+        Watch a socket on the loop.
+        @param sock: The socket.
+        @param callback: Called whenever the socket is readable.
+        """
+        self._watch(sock).on_read = callback
+
+    def remove_reader(self, sock):
+        """
+        Stop watching a socket for readability.
+        @param sock: The socket.
+        """
+        self._unwatch(sock, 'on_read')
+
+    def add_writer(self, sock, callback):
+        """
+        Watch a socket for writability.
+        @param sock: The socket.
+        @param callback: Called whenever the socket is writable.
+        """
+        self._watch(sock).on_write = callback
+
+    def remove_writer(self, sock):
+        """
+        Stop watching a socket for writability.
+        @param sock: The socket.
+        """
+        self._unwatch(sock, 'on_write')
+
+    def _watch(self, sock):
+        """
+        @return: The WatchDispatcher of a socket, created if needed.
+        """
+        watcher = self._watched.get(sock)
+        if watcher is None:
+            watcher = self._watched[sock] = WatchDispatcher(sock)
+        return watcher
+
+    def _unwatch(self, sock, callback):
+        """
+        Remove a callback and drop the WatchDispatcher once it has none left.
+        """
+        watcher = self._watched.get(sock)
+        if watcher is None:
+            return
+
+        setattr(watcher, callback, None)
+        if watcher.on_read is None and watcher.on_write is None:
+            del self._watched[sock]
+            watcher.del_channel()
+
+    @staticmethod
+    def stop():
+        """
+        Close all sockets handled by asyncore.
+        """
+        asyncore.close_all()
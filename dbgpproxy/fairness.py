@@ -0,0 +1,119 @@
+__author__ = 'gkralik'
+
+# bytes a session relays without the end of a frame before it counts as a bulk transfer
+BULK_BYTES = 65536
+
+
+class RelayScheduler:
+    """
+    Shares the event loop between the sessions relaying data.
+
+    Every session may relay budget bytes per loop iteration, both directions together. Once a session has used up its
+    budget, it is not read from until the next iteration, so a session streaming a large response cannot take up most
+    of an iteration while the readiness events of the other sessions wait. The budgets are reset with call_soon(),
+    between the readiness events of two iterations.
+
+    A session that has relayed more than BULK_BYTES since the end of a frame (a \\0) is a bulk transfer until a chunk
+    ends a frame again. With priority, only bulk transfers are held to the budget, and the asyncore engine handles the
+    readiness events of the other sessions first in every iteration.
+    """
+
+    def __init__(self, proxy_manager, budget, priority=False):
+        """
+        Initialize the RelayScheduler.
+        @param proxy_manager: The proxy manager instance, to schedule the resets on.
+        @param budget: Bytes a session may relay per loop iteration.
+        @param priority: Let sessions relaying small frames go first and ignore their budget.
+        """
+        self._proxy_manager = proxy_manager
+        self.budget = budget
+        self.priority = priority
+        # session -> bytes relayed in this iteration
+        self._used = {}
+        # session -> bytes relayed since the end of the last frame
+        self._streaks = {}
+        # callbacks resuming the sessions held until the next iteration
+        self._held = []
+        self._reset_pending = False
+        # reads put off to the next iteration
+        self.deferred = 0
+
+    def bulk(self, session):
+        """
+        @param session: The session (its debugger engine handler).
+        @return: True if the session is relaying a bulk transfer.
+        """
+        return self._streaks.get(session, 0) > BULK_BYTES
+
+    def limited(self, session):
+        """
+        @param session: The session.
+        @return: True if the session is held to the budget.
+        """
+        return not self.priority or self.bulk(session)
+
+    def allowance(self, session, size):
+        """
+        Get the bytes a session may read now.
+        @param session: The session.
+        @param size: The bytes the caller would read.
+        @return: Up to size bytes, 0 if the session has used up its budget (the read is counted as deferred).
+        """
+        if not self.limited(session):
+            return size
+        allowed = min(size, self.budget - self._used.get(session, 0))
+        if allowed <= 0:
+            self.deferred += 1
+            return 0
+        return allowed
+
+    def relayed(self, session, data):
+        """
+        Count data relayed by a session.
+        @param session: The session.
+        @param data: The chunk (bytes).
+        @return: True if the session has used up its budget for this iteration.
+        """
+        if data.endswith(b'\0'):
+            self._streaks[session] = 0
+        else:
+            self._streaks[session] = self._streaks.get(session, 0) + len(data)
+
+        used = self._used[session] = self._used.get(session, 0) + len(data)
+        self._schedule_reset()
+        return used >= self.budget and self.limited(session)
+
+    def hold(self, resume):
+        """
+        Resume a session that has used up its budget in the next iteration.
+        @param resume: Called without arguments once the budgets have been reset.
+        """
+        self.deferred += 1
+        self._held.append(resume)
+        self._schedule_reset()
+
+    def discard(self, session):
+        """
+        Forget a closed session.
+        @param session: The session.
+        """
+        self._used.pop(session, None)
+        self._streaks.pop(session, None)
+
+    def _schedule_reset(self):
+        """
+        Reset the budgets once the readiness events of this iteration have been handled.
+        """
+        if not self._reset_pending:
+            self._reset_pending = True
+            self._proxy_manager.call_soon(self._reset)
+
+    def _reset(self):
+        """
+        Start a new iteration: reset the budgets and resume the held sessions.
+        """
+        self._reset_pending = False
+        self._used.clear()
+        held, self._held = self._held, []
+        for resume in held:
+            resume()
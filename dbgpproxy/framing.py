@@ -0,0 +1,176 @@
+import re
+
+__author__ = 'gkralik'
+
+# longest accepted length prefix of an engine frame
+MAX_PREFIX_SIZE = 20
+
+# largest accepted payload of an engine frame (the init packet), larger lengths are rejected before buffering them
+MAX_FRAME_SIZE = 4 * 1024 * 1024
+
+# buffered bytes that are already parsed are dropped once they exceed this size
+COMPACT_SIZE = 65536
+
+
+class FrameError(ValueError):
+    """
+    Raised for data that does not follow the DBGp framing.
+    """
+    pass
+
+
+class _Framer:
+    """
+    Base class of the incremental framers.
+
+    Data is appended to one bytearray and parsed in place. Consumed bytes are only dropped from the front of the buffer
+    once they make up most of it, so feeding many small chunks does not re-concatenate the buffered data.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # start of the unparsed data
+        self._start = 0
+        # position up to which the buffer has been searched for a terminator
+        self._scan = 0
+
+    def feed(self, data):
+        """
+        Append received data.
+        @param data: The data (bytes-like).
+        """
+        self._buffer += data
+
+    def next_frame(self):
+        """
+        Get the next complete frame.
+        @return: The payload (bytes) or None if no complete frame is buffered.
+        """
+        raise NotImplementedError
+
+    def __iter__(self):
+        """
+        Iterate over all complete frames.
+        """
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def buffered(self):
+        """
+        @return: The number of buffered, unparsed bytes.
+        """
+        return len(self._buffer) - self._start
+
+    def remaining(self):
+        """
+        Take the unparsed data out of the framer.
+        @return: The unparsed data (bytes).
+        """
+        with memoryview(self._buffer) as view:
+            data = bytes(view[self._start:])
+        self._reset()
+        return data
+
+    def _take(self, start, end, skip):
+        """
+        Extract a payload and advance behind it.
+        @param start: Start of the payload.
+        @param end: End of the payload.
+        @param skip: Number of bytes after the payload to skip (terminator).
+        @return: The payload (bytes).
+        """
+        with memoryview(self._buffer) as view:
+            payload = bytes(view[start:end])
+
+        self._start = self._scan = end + skip
+        if self._start == len(self._buffer):
+            self._reset()
+        elif self._start > COMPACT_SIZE and self._start * 2 > len(self._buffer):
+            del self._buffer[:self._start]
+            self._scan -= self._start
+            self._start = 0
+
+        return payload
+
+    def _reset(self):
+        self._buffer.clear()
+        self._start = self._scan = 0
+
+
+class EngineFramer(_Framer):
+    """
+    Incremental parser for messages sent by the debugger engine (length, \0, XML, \0).
+    """
+
+    def __init__(self, max_size=MAX_FRAME_SIZE):
+        """
+        Initialize the EngineFramer.
+        @param max_size: The largest accepted payload length.
+        """
+        super().__init__()
+        self._max_size = max_size
+        # payload length of the current frame, None while its prefix has not been parsed
+        self._length = None
+
+    def next_frame(self):
+        buf = self._buffer
+
+        if self._length is None:
+            eol = buf.find(b'\0', self._start)
+            if eol < 0:
+                if len(buf) - self._start > MAX_PREFIX_SIZE:
+                    raise FrameError('length prefix too long')
+                return None
+
+            prefix = buf[self._start:eol]
+            if not prefix.isdigit():
+                raise FrameError('invalid length prefix')
+
+            length = int(prefix)
+            if length > self._max_size:
+                raise FrameError('frame of {} bytes exceeds {} bytes'.format(length, self._max_size))
+
+            self._length = length
+            self._start = self._scan = eol + 1
+
+        end = self._start + self._length
+        if len(buf) <= end:
+            return None
+
+        if buf[end] != 0:
+            raise FrameError('frame not terminated by \\0')
+
+        self._length = None
+        return self._take(self._start, end, 1)
+
+    def _reset(self):
+        super()._reset()
+        self._length = None
+
+
+class CommandFramer(_Framer):
+    """
+    Incremental parser for commands sent by the IDE.
+
+    Commands are terminated by a \0 character. The registration port also accepts \n, as some clients terminate
+    proxyinit/proxystop that way.
+    """
+
+    def __init__(self, terminators=b'\0'):
+        """
+        Initialize the CommandFramer.
+        @param terminators: The bytes that terminate a command.
+        """
+        super().__init__()
+        self._pattern = re.compile(b'[' + re.escape(terminators) + b']')
+
+    def next_frame(self):
+        match = self._pattern.search(self._buffer, self._scan)
+        if match is None:
+            self._scan = len(self._buffer)
+            return None
+
+        return self._take(self._start, match.start(), 1)
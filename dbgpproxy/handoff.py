@@ -0,0 +1,356 @@
+import array
+import json
+import logging
+import os
+import socket
+import struct
+from dbgpproxy.address import UNIX
+
+__author__ = 'gkralik'
+
+# length of the JSON body of a control message
+HEADER = struct.Struct('!I')
+
+# most file descriptors passed with one control message
+MAX_FDS = 16
+
+# seconds between attempts to hand off the sessions that are busy
+RETRY_INTERVAL = 0.1
+
+# seconds a control message may take to be sent or received
+IO_TIMEOUT = 10.0
+
+# first file descriptor passed by systemd socket activation (sd_listen_fds(3))
+SD_LISTEN_FDS_START = 3
+
+
+def send_message(sock, message, fds=()):
+    """
+    Send a control message, optionally with file descriptors.
+    @param sock: The connected Unix socket.
+    @param message: JSON serializable dict.
+    @param fds: File descriptors to pass along.
+    """
+    body = json.dumps(message).encode()
+    ancillary = []
+    if fds:
+        ancillary.append((socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds)))
+    # the descriptors travel with the header, the body follows
+    sock.sendmsg([HEADER.pack(len(body))], ancillary)
+    sock.sendall(body)
+
+
+def recv_message(sock):
+    """
+    Receive a control message.
+    @param sock: The connected Unix socket.
+    @return: Tuple of the message (dict) and the list of passed file descriptors, or (None, []) on EOF.
+    """
+    fds = array.array('i')
+    header, ancillary, flags, address = sock.recvmsg(HEADER.size, socket.CMSG_SPACE(MAX_FDS * fds.itemsize))
+    for level, kind, data in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    if not header:
+        return None, list(fds)
+
+    header += _recv_exactly(sock, HEADER.size - len(header))
+    body = _recv_exactly(sock, HEADER.unpack(header)[0])
+    return json.loads(body.decode()), list(fds)
+
+
+def _recv_exactly(sock, size):
+    """
+    @return: The next size bytes received from a socket.
+    """
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('connection closed in the middle of a control message')
+        data += chunk
+    return bytes(data)
+
+
+def inherited_sockets(addresses):
+    """
+    Take the listening sockets passed by systemd socket activation (LISTEN_FDS, see sd_listen_fds(3)).
+
+    Sockets are matched to listeners by their FileDescriptorName, or else by the port or path they are bound to. The
+    environment variables are removed, so child processes do not take the sockets again.
+    @param addresses: Dict of listener name to (host, port) of the listeners (see dbgpproxy.address), or None.
+    @return: Dict of listener name to socket.
+    """
+    logger = logging.getLogger('dbgpproxy.handoff')
+    try:
+        if int(os.environ.get('LISTEN_PID', '0')) != os.getpid():
+            return {}
+        count = int(os.environ.get('LISTEN_FDS', '0'))
+    except ValueError:
+        return {}
+    names = os.environ.get('LISTEN_FDNAMES', '').split(':')
+    for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+        os.environ.pop(name, None)
+
+    sockets = {}
+    for i in range(count):
+        sock = socket.socket(fileno=SD_LISTEN_FDS_START + i)
+        name = names[i] if i < len(names) else ''
+        if name not in addresses:
+            if sock.family == socket.AF_UNIX:
+                bound = (UNIX, sock.getsockname())
+            else:
+                bound = (None, sock.getsockname()[1])
+            name = next((n for n, address in addresses.items() if address is not None and
+                         address[1] == bound[1] and (address[0] == UNIX) == (bound[0] == UNIX)), None)
+        if name is None or name in sockets:
+            logger.warning('ignoring inherited socket {}'.format(sock.getsockname()))
+            sock.close()
+            continue
+        logger.info('listening on inherited socket {} for {}'.format(sock.getsockname(), name))
+        sockets[name] = sock
+    return sockets
+
+
+class Handoff:
+    """
+    Hands the listeners, the registrations and the established sessions of a proxy manager to a new process.
+
+    Every process started with a handoff path listens on it (a Unix socket). A new process first connects to it and
+    receives the listening sockets and registrations of the running one, which stops accepting connections right away,
+    so no connection attempt is refused. The running process then passes each established session, the debugger engine
+    and IDE sockets, and each registration connection as soon as none of its data is buffered in it, and exits once it
+    has no connections left.
+    Neither end of a session notices, the new process just continues relaying on the same connections.
+    """
+
+    def __init__(self, proxy_manager, path):
+        """
+        Initialize the Handoff.
+        @param proxy_manager: The proxy manager instance.
+        @param path: Path of the Unix socket.
+        """
+        self._proxy_manager = proxy_manager
+        self._path = path
+        # listening for the next process
+        self._listener = None
+        self._listener_inode = None
+        # connection to the process the sockets are taken over from
+        self._predecessor = None
+        # connection to the process the sockets are handed to
+        self._successor = None
+        self._retry_timer = None
+        self.logger = logging.getLogger('dbgpproxy.handoff')
+
+    def take_over(self):
+        """
+        Take the listening sockets and the registrations over from the running process, if there is one.
+
+        Called before the listeners are created.
+        @return: Dict of listener name to listening socket.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(IO_TIMEOUT)
+        try:
+            sock.connect(self._path)
+            message, fds = recv_message(sock)
+        except OSError as e:
+            self.logger.debug('no process to take over from at {} ({})'.format(self._path, e))
+            sock.close()
+            return {}
+        if message is None or message.get('type') != 'state':
+            self.logger.warning('unexpected reply from {}, not taking over'.format(self._path))
+            for fd in fds:
+                os.close(fd)
+            sock.close()
+            return {}
+
+        self._predecessor = sock
+        for idekey, host, port, multi in message['servers']:
+            self._proxy_manager.restore_server(idekey, host, port, multi)
+        self.logger.info('taking over {} listeners and {} registrations from process {}'.format(
+            len(fds), len(message['servers']), message['pid']))
+        return {name: socket.socket(fileno=fd) for name, fd in zip(message['listeners'], fds)}
+
+    def start(self):
+        """
+        Receive the sessions of the previous process and listen for the next one. Called once the engine is set up.
+        """
+        if self._predecessor is not None:
+            self._proxy_manager.add_reader(self._predecessor, self._receive)
+
+        # bind next to the path and move it into place, a process still connecting to the old socket is not affected
+        temporary = '{}.{}'.format(self._path, os.getpid())
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+            listener.bind(temporary)
+            os.rename(temporary, self._path)
+        except OSError as e:
+            self.logger.error('unable to listen for handoff on {} ({})'.format(self._path, e))
+            listener.close()
+            return
+        listener.listen(1)
+        listener.setblocking(False)
+        self._listener = listener
+        self._listener_inode = os.stat(self._path).st_ino
+        self._proxy_manager.add_reader(listener, self._accept)
+
+    def _receive(self):
+        """
+        Handle a control message of the previous process.
+        """
+        # the loop may have made the socket non-blocking, the rest of a message follows right away
+        self._predecessor.settimeout(IO_TIMEOUT)
+        try:
+            message, fds = recv_message(self._predecessor)
+        except (OSError, ValueError) as e:
+            self.logger.warning('lost connection to the previous process ({})'.format(e))
+            message, fds = None, []
+
+        if message is None or message['type'] == 'done':
+            self.logger.info('took over all sessions of the previous process')
+            self._proxy_manager.remove_reader(self._predecessor)
+            self._predecessor.close()
+            self._predecessor = None
+            return
+
+        if message['type'] == 'registration':
+            self._proxy_manager.adopt_registration(socket.socket(fileno=fds[0]))
+        elif message['type'] == 'session':
+            engine_sock, ide_sock = (socket.socket(fileno=fd) for fd in fds)
+            self.logger.debug('adopting session [{}] from the previous process'.format(message['idekey']))
+            self._proxy_manager.adopt_session(engine_sock, ide_sock, message)
+        elif message['type'] == 'add':
+            self._proxy_manager.add_server(message['idekey'], message['host'], message['port'], message['multi'])
+        elif message['type'] == 'remove':
+            self._proxy_manager.remove_server(message['idekey'])
+
+    def _accept(self):
+        """
+        Hand the listeners and registrations to a new process and stop accepting connections.
+        """
+        try:
+            sock, address = self._listener.accept()
+        except OSError:
+            return
+        if self._predecessor is not None:
+            # still taking over, the sessions of the previous process could not be passed on
+            self.logger.warning('refusing handoff, still taking over from the previous process')
+            sock.close()
+            return
+
+        self._proxy_manager.remove_reader(self._listener)
+        self._listener.close()
+        self._listener = None
+
+        sock.settimeout(IO_TIMEOUT)
+        names = list(self._proxy_manager.listeners)
+        # the registrations of other cluster nodes come from them again
+        cluster = self._proxy_manager.cluster
+        servers = [[idekey, server[0][0], server[0][1], server[1]]
+                   for idekey, server in self._proxy_manager.list_servers()
+                   if cluster is None or cluster.owner(idekey) is None]
+        try:
+            send_message(sock, {'type': 'state', 'pid': os.getpid(), 'servers': servers, 'listeners': names},
+                         [self._proxy_manager.listeners[name].fileno() for name in names])
+        except OSError as e:
+            self.logger.error('handoff to new process failed ({}), keeping on'.format(e))
+            sock.close()
+            self.start()
+            return
+
+        self.logger.info('handing off to a new process, no longer accepting connections')
+        self._successor = sock
+        self._proxy_manager.add_registry_listener(self)
+        self._proxy_manager.retire()
+        # the asyncio engine sets up connections accepted just before in tasks, they are only counted afterwards
+        self._retry_timer = self._proxy_manager.call_later(RETRY_INTERVAL, self._transfer)
+
+    def _transfer(self):
+        """
+        Hand off the sessions that can be handed off now, and stop once no connections are left.
+        """
+        self._retry_timer = None
+        sessions = self._proxy_manager.sessions
+        for session in sessions.sessions():
+            if self._successor is None:
+                break
+            state = session.handoff_state()
+            if state is None:
+                continue
+            engine_sock, ide_sock, message = state
+            message['type'] = 'session'
+            if not self._send(message, [engine_sock.fileno(), ide_sock.fileno()]):
+                break
+            session.detach()
+
+        for handler in list(self._proxy_manager.registration_handlers):
+            if self._successor is None:
+                break
+            sock = handler.handoff_state()
+            if sock is None:
+                continue
+            if not self._send({'type': 'registration'}, [sock.fileno()]):
+                break
+            handler.detach()
+
+        if sessions.connections > 0 or self._proxy_manager.registration_handlers:
+            self._retry_timer = self._proxy_manager.call_later(RETRY_INTERVAL, self._transfer)
+            return
+
+        self._send({'type': 'done'})
+        self.logger.info('handoff complete, exiting')
+        self._proxy_manager.stop()
+
+    def _send(self, message, fds=()):
+        """
+        Send a control message to the new process. If it is gone, the remaining sessions are kept until they end.
+        @return: True if the message has been sent.
+        """
+        if self._successor is None:
+            return False
+        try:
+            send_message(self._successor, message, fds)
+            return True
+        except OSError as e:
+            self.logger.error('lost connection to the new process ({}), keeping the remaining sessions'.format(e))
+            self._successor.close()
+            self._successor = None
+            return False
+
+    def server_added(self, idekey, host, port, multi):
+        """
+        Pass on a registration made after the handoff started.
+        """
+        self._send({'type': 'add', 'idekey': idekey, 'host': host, 'port': port, 'multi': multi})
+
+    def server_removed(self, idekey):
+        """
+        Pass on a registration removed after the handoff started.
+        """
+        self._send({'type': 'remove', 'idekey': idekey})
+
+    def close(self):
+        """
+        Close the control sockets. The path is only removed if no newer process has taken it.
+        """
+        if self._retry_timer is not None:
+            self._retry_timer.cancel()
+            self._retry_timer = None
+        if self._listener is not None:
+            self._proxy_manager.remove_reader(self._listener)
+            self._listener.close()
+            self._listener = None
+            try:
+                if os.stat(self._path).st_ino == self._listener_inode:
+                    os.unlink(self._path)
+            except OSError:
+                pass
+        if self._predecessor is not None:
+            self._proxy_manager.remove_reader(self._predecessor)
+            self._predecessor.close()
+        if self._successor is not None:
+            self._successor.close()
+        self._predecessor = self._successor = None
@@ -0,0 +1,291 @@
+import errno
+import heapq
+import itertools
+import logging
+import socket
+import time
+from dbgpproxy.address import address_family, socket_address
+
+__author__ = 'gkralik'
+
+# failed probes in a row after which the IDE keys of an endpoint are removed
+PROBE_FAILURES = 2
+
+# endpoints probed per round, larger registries are probed in turns
+MAX_PROBES = 1024
+
+
+class ExpiryHeap:
+    """
+    Deadlines of many keys with cheap refreshes.
+
+    Every key has one entry in a heap ordered by deadline. Moving a deadline later only updates the entry; when the
+    entry reaches the top of the heap with its old deadline, it is pushed again with the current one. So refreshing a
+    registration, by far the most frequent operation, does not touch the heap, and removed keys are dropped lazily.
+    """
+
+    def __init__(self):
+        """
+        Initialize the ExpiryHeap.
+        """
+        # key -> [key, deadline, alive]
+        self._entries = {}
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        """
+        @return: The number of keys.
+        """
+        return len(self._entries)
+
+    def touch(self, key, deadline):
+        """
+        Set the deadline of a key.
+        @param key: The key.
+        @param deadline: The new deadline.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [key, deadline, True]
+        elif deadline >= entry[1]:
+            entry[1] = deadline
+            return
+        else:
+            entry[1] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._counter), entry))
+
+    def discard(self, key):
+        """
+        Remove a key.
+        @param key: The key.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry[2] = False
+
+    def next_deadline(self):
+        """
+        @return: The earliest deadline in the heap or None. Deadlines that have been moved later may make this
+                 earlier than the earliest deadline of a key.
+        """
+        while self._heap and not self._heap[0][2][2]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def pop_expired(self, now):
+        """
+        Remove the keys whose deadline has passed.
+        @param now: The current time.
+        @return: List of the expired keys.
+        """
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, counter, entry = heapq.heappop(self._heap)
+            if not entry[2] or entry[1] < deadline:
+                # removed, or a duplicate after the deadline had been moved earlier
+                continue
+            if entry[1] > now:
+                heapq.heappush(self._heap, (entry[1], next(self._counter), entry))
+                continue
+            entry[2] = False
+            del self._entries[entry[0]]
+            expired.append(entry[0])
+        return expired
+
+
+class HealthMonitor:
+    """
+    Removes registrations that are not refreshed in time or whose IDE cannot be reached.
+
+    With a TTL, every registration expires TTL seconds after the last proxyinit for it. With a probe interval, the
+    IDE endpoints of all registrations without an open session are probed with a non-blocking connect every interval;
+    the IDE keys of an endpoint that cannot be connected to PROBE_FAILURES times in a row are removed. A probe is
+    judged after the connect timeout of the proxy manager, so no socket is added to the event loop.
+    """
+
+    def __init__(self, proxy_manager, ttl=None, probe_interval=None):
+        """
+        Initialize the HealthMonitor, register it as a registry listener and start its timers.
+        @param proxy_manager: The proxy manager instance.
+        @param ttl: Seconds a registration lives without being refreshed (None for no expiry).
+        @param probe_interval: Seconds between probes of the IDE endpoints (None for no probes).
+        """
+        self._proxy_manager = proxy_manager
+        self._ttl = ttl
+        self._probe_interval = probe_interval
+
+        self._expiry = ExpiryHeap()
+        self._expiry_timer = None
+        self._expiry_deadline = None
+
+        self._probe_timer = None
+        self._probe_offset = 0
+        # (host, port) -> failed probes in a row
+        self._failures = {}
+        self._probes = []
+
+        self.logger = logging.getLogger('dbgpproxy.health')
+
+        proxy_manager.add_registry_listener(self)
+        if ttl:
+            for idekey, server in proxy_manager.list_servers():
+                self.refresh(idekey)
+        if probe_interval:
+            self._probe_timer = proxy_manager.call_later(probe_interval, self._probe)
+
+    def refresh(self, idekey):
+        """
+        Restart the TTL of a registration.
+        @param idekey: The IDE key.
+        """
+        if not self._ttl:
+            return
+        cluster = self._proxy_manager.cluster
+        if cluster is not None and cluster.owner(idekey) is not None:
+            # expired by the proxy it is registered with
+            self._expiry.discard(idekey)
+            return
+
+        deadline = time.monotonic() + self._ttl
+        self._expiry.touch(idekey, deadline)
+        if self._expiry_deadline is None or deadline < self._expiry_deadline:
+            self._schedule_expiry(deadline)
+
+    def forget(self, idekey):
+        """
+        Stop tracking a registration.
+        @param idekey: The IDE key.
+        """
+        self._expiry.discard(idekey)
+
+    def server_added(self, idekey, host, port, multi):
+        """
+        Start or restart the TTL of a registration.
+        """
+        self.refresh(idekey)
+
+    def server_removed(self, idekey):
+        """
+        Stop tracking a removed registration.
+        """
+        self.forget(idekey)
+
+    def close(self):
+        """
+        Cancel the timers and close pending probes.
+        """
+        for timer in (self._expiry_timer, self._probe_timer):
+            if timer is not None:
+                timer.cancel()
+        self._expiry_timer = self._probe_timer = None
+        for address, idekeys, sock in self._probes:
+            sock.close()
+        self._probes = []
+
+    def _schedule_expiry(self, deadline):
+        """
+        Run _expire() at a deadline, replacing the current expiry timer.
+        """
+        if self._expiry_timer is not None:
+            self._expiry_timer.cancel()
+        self._expiry_deadline = deadline
+        self._expiry_timer = self._proxy_manager.call_later(max(0.0, deadline - time.monotonic()), self._expire)
+
+    def _expire(self):
+        """
+        Remove the expired registrations and schedule the next expiry.
+        """
+        self._expiry_timer = self._expiry_deadline = None
+        for idekey in self._expiry.pop_expired(time.monotonic()):
+            self.logger.info('registration of IDE key [{}] expired'.format(idekey))
+            self._proxy_manager.remove_server(idekey)
+
+        deadline = self._expiry.next_deadline()
+        if deadline is not None:
+            self._schedule_expiry(deadline)
+
+    def _probe(self):
+        """
+        Start connecting to the IDE endpoints without open sessions, and check the outcome after the connect timeout.
+        """
+        self._probe_timer = self._proxy_manager.call_later(self._probe_interval, self._probe)
+        if self._probes:
+            # the previous round has not been judged yet
+            return
+
+        sessions = self._proxy_manager.sessions
+        cluster = self._proxy_manager.cluster
+        endpoints = {}
+        for idekey, ((host, port), multi) in self._proxy_manager.list_servers():
+            # IDEs registered with another proxy of a cluster are probed by that proxy
+            if cluster is not None and cluster.owner(idekey) is not None:
+                continue
+            if not sessions.active(idekey):
+                endpoints.setdefault((host, port), []).append(idekey)
+        for address in [address for address in self._failures if address not in endpoints]:
+            del self._failures[address]
+
+        addresses = list(endpoints)
+        if len(addresses) > MAX_PROBES:
+            start = self._probe_offset % len(addresses)
+            addresses = (addresses[start:] + addresses[:start])[:MAX_PROBES]
+            self._probe_offset = start + MAX_PROBES
+
+        for address in addresses:
+            sock = socket.socket(address_family(address[0]), socket.SOCK_STREAM)
+            sock.setblocking(False)
+            try:
+                error = sock.connect_ex(socket_address(*address))
+            except OSError as e:
+                error = e.errno
+            if error not in (0, errno.EINPROGRESS):
+                sock.close()
+                self._probed(address, endpoints[address], False)
+                continue
+            self._probes.append((address, endpoints[address], sock))
+
+        if self._probes:
+            self._proxy_manager.call_later(self._proxy_manager.connect_timeout, self._check_probes)
+
+    def _check_probes(self):
+        """
+        Judge the probes started by _probe(): a probe succeeded if its socket is connected.
+        """
+        probes, self._probes = self._probes, []
+        for address, idekeys, sock in probes:
+            reachable = False
+            if not sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                try:
+                    sock.getpeername()
+                    reachable = True
+                except OSError:
+                    # still connecting
+                    pass
+            sock.close()
+            self._probed(address, idekeys, reachable)
+
+    def _probed(self, address, idekeys, reachable):
+        """
+        Count the outcome of a probe and remove the IDE keys of an endpoint that failed too often.
+        @param address: Tuple of host and port.
+        @param idekeys: The IDE keys registered for the endpoint when the probe started.
+        @param reachable: True if the connection has been established.
+        """
+        if reachable:
+            self._failures.pop(address, None)
+            return
+
+        failures = self._failures[address] = self._failures.get(address, 0) + 1
+        self.logger.debug('unable to reach IDE at {}:{} ({} times)'.format(address[0], address[1], failures))
+        if failures < PROBE_FAILURES:
+            return
+
+        del self._failures[address]
+        for idekey in idekeys:
+            server = self._proxy_manager.get_server(idekey)
+            # the IDE key may have been registered again in the meantime
+            if server is not None and tuple(server[0]) == address and not self._proxy_manager.sessions.active(idekey):
+                self.logger.info('IDE at {}:{} is unreachable, removing IDE key [{}]'.format(address[0], address[1],
+                                                                                            idekey))
+                self._proxy_manager.remove_server(idekey)
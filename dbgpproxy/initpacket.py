@@ -0,0 +1,99 @@
+import codecs
+import re
+from xml.sax.saxutils import escape, unescape
+
+__author__ = 'gkralik'
+
+# optional XML declaration followed by the <init ...> start tag
+_START_TAG = re.compile(br'\s*(<\?xml\s[^>]*\?>)?\s*<init((?:\s+[^\s=/<>]+\s*=\s*(?:"[^"<]*"|\'[^\'<]*\'))*)\s*/?>')
+_ATTRIBUTE = re.compile(br'\s+([^\s=/<>]+)\s*=\s*(?:"([^"<]*)"|\'([^\'<]*)\')')
+_ENCODING = re.compile(br'encoding\s*=\s*["\']([A-Za-z0-9._-]+)["\']')
+
+_UNESCAPE = {'&quot;': '"', '&apos;': "'"}
+_ESCAPE = {'"': '&quot;'}
+
+
+class InitPacket:
+    """
+    An init packet that is rewritten without building a DOM.
+
+    Only the attributes of the <init> start tag are parsed, everything else is passed on byte for byte. Provides the
+    part of the minidom element API the handlers use, so it can stand in for the minidom fallback.
+    """
+    localName = 'init'
+
+    def __init__(self, data, match, encoding):
+        """
+        Initialize the InitPacket. Use parse() to create instances.
+        @param data: The XML payload (bytes).
+        @param match: The _START_TAG match.
+        @param encoding: The encoding of the document.
+        """
+        self._head = data[:match.start(2)]
+        self._tail = data[match.end(2):]
+        self._encoding = encoding
+
+        # attribute name -> escaped value, in document order
+        self._attributes = {}
+        for attr in _ATTRIBUTE.finditer(match.group(2)):
+            if attr.group(2) is not None:
+                value = attr.group(2).decode(encoding)
+            else:
+                # re-quoted with " on output
+                value = attr.group(3).decode(encoding).replace('"', '&quot;')
+            self._attributes[attr.group(1).decode(encoding)] = value
+
+    @classmethod
+    def parse(cls, data):
+        """
+        Parse the start tag of an init packet.
+        @param data: The XML payload (bytes).
+        @return: The InitPacket or None if the data does not start with an <init> element that can be rewritten.
+        """
+        match = _START_TAG.match(data)
+        if match is None:
+            return None
+
+        encoding = 'utf-8'
+        if match.group(1):
+            declared = _ENCODING.search(match.group(1))
+            if declared:
+                encoding = declared.group(1).decode('ascii')
+
+        try:
+            codecs.lookup(encoding)
+            return cls(data, match, encoding)
+        except (LookupError, UnicodeDecodeError):
+            return None
+
+    def hasAttribute(self, name):
+        """
+        @param name: The attribute name.
+        @return: True if the start tag has the attribute.
+        """
+        return name in self._attributes
+
+    def getAttribute(self, name):
+        """
+        @param name: The attribute name.
+        @return: The unescaped value or an empty string if the attribute does not exist.
+        """
+        if name not in self._attributes:
+            return ''
+        return unescape(self._attributes[name], _UNESCAPE)
+
+    def setAttribute(self, name, value):
+        """
+        Add or replace an attribute.
+        @param name: The attribute name.
+        @param value: The value (str).
+        """
+        self._attributes[name] = escape(value, _ESCAPE)
+
+    def to_bytes(self):
+        """
+        Serialize the packet.
+        @return: The XML payload (bytes).
+        """
+        attributes = ''.join(' {}="{}"'.format(name, value) for name, value in self._attributes.items())
+        return self._head + attributes.encode(self._encoding, 'xmlcharrefreplace') + self._tail
@@ -0,0 +1,470 @@
+import bisect
+import logging
+import re
+import socket
+import time
+from xml.sax.saxutils import quoteattr
+
+__author__ = 'gkralik'
+
+# upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)  # milliseconds
+DURATION_BUCKETS = (1, 10, 60, 300, 900, 3600, 14400, 86400)  # seconds
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # bytes, 1 KiB to 256 MiB
+
+# commands sent without a response are forgotten after this many newer ones
+MAX_PENDING = 1000
+
+_COMMAND_ID = re.compile(rb' -i (\d+)')
+_RESPONSE_ID = re.compile(rb'transaction_id="(\d+)"')
+
+# bytes kept from the end of a chunk to find ids split across two chunks
+_TAIL = 32
+
+
+class Histogram:
+    """
+    Counts observed values in fixed buckets.
+    """
+
+    def __init__(self, bounds):
+        """
+        Initialize the Histogram.
+        @param bounds: Ascending upper bounds of the buckets. Larger values are counted in an overflow bucket.
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        """
+        Count a value.
+        @param value: The value.
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        Estimate a percentile.
+        @param p: The percentile (0-100).
+        @return: The upper bound of the bucket containing the percentile (the maximum for the overflow bucket).
+        """
+        if not self.count:
+            return 0
+
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    """
+    Traffic and latency statistics of all sessions of a proxy manager.
+    """
+
+    def __init__(self):
+        """
+        Initialize the Metrics.
+        """
+        self.started = time.time()
+        self.sessions_total = 0
+        self.sessions = set()
+        # debugger engine connections closed by admission control or the session queues
+        self.rejected = 0
+        # the ResponseCache of the proxy manager (optional)
+        self.cache = None
+        # the LoopMonitor of the proxy manager (optional)
+        self.loop = None
+        # the RelayScheduler of the proxy manager (optional)
+        self.relay = None
+
+        # totals of closed sessions, see totals() for all sessions
+        self._closed = [0, 0, 0, 0]
+
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.duration = Histogram(DURATION_BUCKETS)
+        self.peak_buffered = Histogram(SIZE_BUCKETS)
+
+    def open_session(self, idekey):
+        """
+        Start tracking a session.
+        @param idekey: The IDE key of the session.
+        @return: The SessionMetrics.
+        """
+        session = SessionMetrics(self, idekey)
+        self.sessions_total += 1
+        self.sessions.add(session)
+        return session
+
+    def session_closed(self, session, peak_buffered):
+        """
+        Add the numbers of a closed session to the totals.
+        @param session: The SessionMetrics.
+        @param peak_buffered: Tuple of the most bytes buffered for the IDE and for the debugger engine.
+        """
+        self.sessions.discard(session)
+        for i, value in enumerate(session.totals()):
+            self._closed[i] += value
+        self.duration.observe(session.duration())
+        self.peak_buffered.observe(max(peak_buffered))
+
+    def totals(self):
+        """
+        @return: List of bytes to the IDE, bytes to the debugger engine, frames to the IDE and frames to the debugger
+                 engine of all sessions.
+        """
+        totals = list(self._closed)
+        for session in self.sessions:
+            for i, value in enumerate(session.totals()):
+                totals[i] += value
+        return totals
+
+    def to_xml(self):
+        """
+        @return: The response to the proxystats command (str).
+        """
+        bytes_to_ide, bytes_to_engine, frames_to_ide, frames_to_engine = self.totals()
+        parts = [
+            '<?xml version="1.0" encoding="UTF-8"?>\n<proxystats success="1" uptime="{:.0f}">'.format(
+                time.time() - self.started),
+            '<sessions total="{}" active="{}" rejected="{}"/>'.format(self.sessions_total, len(self.sessions),
+                                                                      self.rejected),
+            '<traffic bytes_to_ide="{}" bytes_to_engine="{}" frames_to_ide="{}" frames_to_engine="{}"/>'.format(
+                bytes_to_ide, bytes_to_engine, frames_to_ide, frames_to_engine),
+        ]
+        if self.cache is not None:
+            parts.append('<cache hits="{}" misses="{}" entries="{}" bytes="{}" saved_ms="{:.0f}"/>'.format(
+                self.cache.hits, self.cache.misses, len(self.cache), self.cache.size, self.cache.saved * 1000))
+        if self.loop is not None:
+            parts.append('<loop slow_callbacks="{}">'.format(self.loop.slow))
+            for handler, (count, seconds, most) in sorted(self.loop.handlers.items()):
+                parts.append('<callbacks handler={} count="{}" total_ms="{:.1f}" max_ms="{:.1f}"/>'.format(
+                    quoteattr(handler), count, seconds * 1000, most * 1000))
+            parts.append('</loop>')
+        if self.relay is not None:
+            parts.append('<relay budget="{}" priority="{}" deferred="{}"/>'.format(
+                self.relay.budget, int(self.relay.priority), self.relay.deferred))
+        for name, unit, histogram in self._histograms():
+            parts.append('<{} unit="{}" count="{}" p50="{:g}" p90="{:g}" p99="{:g}" max="{:g}"/>'.format(
+                name, unit, histogram.count, histogram.percentile(50), histogram.percentile(90),
+                histogram.percentile(99), histogram.max))
+        for session in self.sessions:
+            parts.append('<session idekey={} duration="{:.1f}" bytes_to_ide="{}" bytes_to_engine="{}" '
+                         'frames_to_ide="{}" frames_to_engine="{}"/>'.format(quoteattr(session.idekey),
+                                                                            session.duration(), *session.totals()))
+        parts.append('</proxystats>')
+        return ''.join(parts)
+
+    def to_text(self):
+        """
+        @return: The statistics in the Prometheus text format (str).
+        """
+        bytes_to_ide, bytes_to_engine, frames_to_ide, frames_to_engine = self.totals()
+        lines = [
+            'dbgpproxy_uptime_seconds {:.0f}'.format(time.time() - self.started),
+            'dbgpproxy_sessions_total {}'.format(self.sessions_total),
+            'dbgpproxy_sessions_active {}'.format(len(self.sessions)),
+            'dbgpproxy_sessions_rejected_total {}'.format(self.rejected),
+            'dbgpproxy_bytes_total{{direction="to_ide"}} {}'.format(bytes_to_ide),
+            'dbgpproxy_bytes_total{{direction="to_engine"}} {}'.format(bytes_to_engine),
+            'dbgpproxy_frames_total{{direction="to_ide"}} {}'.format(frames_to_ide),
+            'dbgpproxy_frames_total{{direction="to_engine"}} {}'.format(frames_to_engine),
+        ]
+        if self.cache is not None:
+            lines += [
+                'dbgpproxy_cache_hits_total {}'.format(self.cache.hits),
+                'dbgpproxy_cache_misses_total {}'.format(self.cache.misses),
+                'dbgpproxy_cache_entries {}'.format(len(self.cache)),
+                'dbgpproxy_cache_bytes {}'.format(self.cache.size),
+                'dbgpproxy_cache_saved_seconds_total {:g}'.format(self.cache.saved),
+            ]
+        if self.loop is not None:
+            lines.append('dbgpproxy_slow_callbacks_total {}'.format(self.loop.slow))
+            for handler, (count, seconds, most) in sorted(self.loop.handlers.items()):
+                lines.append('dbgpproxy_callbacks_total{{handler="{}"}} {}'.format(handler, count))
+                lines.append('dbgpproxy_callback_seconds_total{{handler="{}"}} {:g}'.format(handler, seconds))
+        if self.relay is not None:
+            lines.append('dbgpproxy_relay_deferred_total {}'.format(self.relay.deferred))
+        for name, unit, histogram in self._histograms():
+            metric = 'dbgpproxy_{}_{}'.format(name, unit)
+            seen = 0
+            for bound, count in zip(histogram.bounds, histogram.counts):
+                seen += count
+                lines.append('{}_bucket{{le="{:g}"}} {}'.format(metric, bound, seen))
+            lines.append('{}_bucket{{le="+Inf"}} {}'.format(metric, histogram.count))
+            lines.append('{}_sum {:g}'.format(metric, histogram.sum))
+            lines.append('{}_count {}'.format(metric, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def _histograms(self):
+        """
+        @return: List of (name, unit, Histogram) tuples.
+        """
+        histograms = [('latency', 'ms', self.latency), ('duration', 'seconds', self.duration),
+                      ('peak_buffered', 'bytes', self.peak_buffered)]
+        if self.loop is not None:
+            histograms += [('loop_iteration', 'ms', self.loop.iterations), ('loop_lag', 'ms', self.loop.lag)]
+        return histograms
+
+
+class SessionMetrics:
+    """
+    Traffic and command latency of one session.
+
+    The relay handlers pass every chunk to to_ide() or to_engine(). Frames are counted by their \\0 terminators. The
+    transaction ids of IDE commands are remembered, and engine data is only searched for a transaction_id attribute
+    while a command is waiting for its response, so large responses are scanned at most until their header has been
+    found.
+    """
+
+    def __init__(self, metrics, idekey):
+        """
+        Initialize the SessionMetrics. Use Metrics.open_session() to create instances.
+        @param metrics: The Metrics of the proxy manager.
+        @param idekey: The IDE key of the session.
+        """
+        self._metrics = metrics
+        self.idekey = idekey
+        self.started = time.monotonic()
+
+        self.bytes_to_ide = 0
+        self.bytes_to_engine = 0
+        # engine messages are terminated by two \0 (after the length and after the XML)
+        self._nuls_to_ide = 0
+        self.frames_to_engine = 0
+
+        # transaction id -> time the command was sent
+        self._pending = {}
+        self._ide_tail = b''
+        self._engine_tail = b''
+
+    def totals(self):
+        """
+        @return: Tuple of bytes to the IDE, bytes to the debugger engine, frames to the IDE and frames to the debugger
+                 engine.
+        """
+        return self.bytes_to_ide, self.bytes_to_engine, self._nuls_to_ide // 2, self.frames_to_engine
+
+    def duration(self):
+        """
+        @return: Seconds since the session started.
+        """
+        return time.monotonic() - self.started
+
+    def to_ide(self, data):
+        """
+        Count a chunk sent by the debugger engine and match responses to pending commands.
+        @param data: The chunk (bytes).
+        """
+        self.bytes_to_ide += len(data)
+        self._nuls_to_ide += data.count(b'\0')
+
+        if self._pending:
+            now = time.monotonic()
+            for transaction_id in _find_all(_RESPONSE_ID, self._engine_tail, data):
+                sent = self._pending.pop(transaction_id, None)
+                if sent is not None:
+                    self._metrics.latency.observe((now - sent) * 1000)
+            self._engine_tail = data[-_TAIL:]
+        elif self._engine_tail:
+            self._engine_tail = b''
+
+    def to_engine(self, data):
+        """
+        Count a chunk sent by the IDE and remember the transaction ids of its commands.
+        @param data: The chunk (bytes).
+        """
+        self.bytes_to_engine += len(data)
+        self.frames_to_engine += data.count(b'\0')
+
+        now = time.monotonic()
+        for transaction_id in _find_all(_COMMAND_ID, self._ide_tail, data):
+            if len(self._pending) >= MAX_PENDING:
+                del self._pending[next(iter(self._pending))]
+            self._pending[transaction_id] = now
+        self._ide_tail = data[-_TAIL:]
+
+    def close(self, peak_buffered=(0, 0)):
+        """
+        Stop tracking the session.
+        @param peak_buffered: Tuple of the most bytes buffered for the IDE and for the debugger engine.
+        """
+        self._metrics.session_closed(self, peak_buffered)
+
+
+def _find_all(pattern, tail, data):
+    """
+    Find the ids matched by a pattern in a chunk, including a match that starts in the end of the previous chunk.
+    @param pattern: The compiled pattern with one group.
+    @param tail: The end of the previous chunk.
+    @param data: The chunk.
+    @return: List of the matched ids (bytes).
+    """
+    ids = pattern.findall(data)
+    if tail:
+        joined = tail + data[:_TAIL]
+        for match in pattern.finditer(joined):
+            if match.start() < len(tail) < match.end():
+                ids.insert(0, match.group(1))
+    return ids
+
+
+# bytes of an HTTP request read before the statistics are sent anyway
+MAX_REQUEST = 8192
+# seconds a client of the StatsEndpoint has to send its request
+REQUEST_TIMEOUT = 10.0
+
+
+class StatsEndpoint:
+    """
+    Serves the statistics in the Prometheus text format to every client connecting to a local TCP port.
+    """
+
+    def __init__(self, proxy_manager, host, port):
+        """
+        Initialize the StatsEndpoint and watch the listening socket on the proxy manager's event loop.
+        @param proxy_manager: The proxy manager instance.
+        @param host: The host to listen on.
+        @param port: The port to listen on.
+        """
+        self._proxy_manager = proxy_manager
+        self.logger = logging.getLogger('dbgpproxy.stats')
+        self.clients = set()
+
+        self._sock = proxy_manager.create_listener('stats', host, port, 5)
+
+        self.logger.info('serving statistics on {}:{}'.format(host, port))
+        proxy_manager.add_reader(self._sock, self.handle_accept)
+
+    def handle_accept(self):
+        """
+        Accept a new client, see StatsClient.
+        """
+        try:
+            client, addr = self._sock.accept()
+        except BlockingIOError:
+            return
+
+        client.setblocking(False)
+        self.clients.add(StatsClient(self._proxy_manager, self, client, addr))
+
+    def close(self):
+        """
+        Stop listening and close the connections of the clients.
+        """
+        self._proxy_manager.remove_reader(self._sock)
+        self._sock.close()
+        for client in list(self.clients):
+            client.close()
+
+
+class StatsClient:
+    """
+    Connection of a client of the StatsEndpoint. Reads the HTTP request up to the end of its headers, then sends the
+    statistics and closes the connection.
+    """
+
+    def __init__(self, proxy_manager, endpoint, sock, addr):
+        """
+        Initialize the StatsClient and wait for the request.
+        @param proxy_manager: The proxy manager instance.
+        @param endpoint: The StatsEndpoint.
+        @param sock: The non-blocking client socket.
+        @param addr: The address of the client.
+        """
+        self._proxy_manager = proxy_manager
+        self._endpoint = endpoint
+        self._sock = sock
+        self._addr = addr
+        self._request = b''
+        self._response = None
+        self.logger = logging.getLogger('dbgpproxy.stats')
+
+        self._timer = proxy_manager.call_later(REQUEST_TIMEOUT, self._timed_out)
+        proxy_manager.add_reader(sock, self.handle_read)
+
+    def handle_read(self):
+        """
+        Read the request. The statistics are sent once the headers are complete.
+        """
+        try:
+            data = self._sock.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.logger.debug('unable to read request from {}: {}'.format(self._addr, e))
+            self.close()
+            return
+
+        if not data:
+            self.close()
+            return
+
+        self._request += data
+        if b'\r\n\r\n' in self._request or len(self._request) >= MAX_REQUEST:
+            self._respond()
+
+    def _respond(self):
+        """
+        Stop reading and start sending the statistics.
+        """
+        self._proxy_manager.remove_reader(self._sock)
+        self._timer.cancel()
+
+        body = self._proxy_manager.metrics.to_text().encode()
+        header = 'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {}\r\n\r\n'.format(
+            len(body)).encode()
+        self._response = memoryview(header + body)
+        self._proxy_manager.add_writer(self._sock, self.handle_write)
+        self.handle_write()
+
+    def handle_write(self):
+        """
+        Send as much of the response as the socket takes, and close the connection once all of it has been sent.
+        """
+        try:
+            while self._response:
+                self._response = self._response[self._sock.send(self._response):]
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.logger.debug('unable to send statistics to {}: {}'.format(self._addr, e))
+            self.close()
+            return
+
+        try:
+            self._sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        self.close()
+
+    def _timed_out(self):
+        """
+        Close the connection of a client that has not sent its request in time.
+        """
+        self.logger.debug('no request from {} within {} seconds'.format(self._addr, REQUEST_TIMEOUT))
+        self.close()
+
+    def close(self):
+        """
+        Close the connection.
+        """
+        if self._sock is None:
+            return
+
+        self._timer.cancel()
+        self._proxy_manager.remove_reader(self._sock)
+        self._proxy_manager.remove_writer(self._sock)
+        self._sock.close()
+        self._sock = None
+        self._endpoint.clients.discard(self)
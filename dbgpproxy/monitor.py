@@ -0,0 +1,298 @@
+import logging
+import os
+import signal
+import time
+from collections import Counter
+from functools import partial
+from dbgpproxy.metrics import Histogram, LATENCY_BUCKETS
+
+__author__ = 'gkralik'
+
+# seconds between two lag probes of the loop monitor
+LAG_INTERVAL = 0.5
+
+# seconds of CPU time between two samples of the sampling profiler
+SAMPLE_INTERVAL = 0.005
+
+# functions listed in the log when the sampling profiler is stopped
+PROFILE_TOP = 10
+
+
+def describe(callback):
+    """
+    Find the handler a loop callback belongs to.
+
+    Callbacks of asyncio transports are attributed to their protocol, steps of asyncio tasks to their coroutine and
+    the sockets watched with add_reader() or add_writer() to their callback.
+    @param callback: The callback, or the asyncore dispatcher handling a readiness event.
+    @return: Tuple of the handler type (str) and the handler, the object to ask for the IDE key with idekey().
+    """
+    if isinstance(callback, partial):
+        callback = callback.func
+    owner = getattr(callback, '__self__', callback)
+    if hasattr(owner, 'get_protocol'):
+        owner = owner.get_protocol()
+    elif hasattr(owner, 'get_coro'):
+        coro = owner.get_coro()
+        return getattr(coro, '__qualname__', type(coro).__name__), coro
+    elif getattr(owner, 'on_read', None) is not None or getattr(owner, 'on_write', None) is not None:
+        return describe(owner.on_read or owner.on_write)
+
+    if owner is callback and hasattr(callback, '__qualname__'):
+        return callback.__qualname__, None
+    return type(owner).__name__, owner
+
+
+def idekey(handler):
+    """
+    @param handler: The handler returned by describe().
+    @return: The IDE key of the session the handler belongs to, or None.
+    """
+    # a coroutine of an asyncio task, the method of a handler
+    frame = getattr(handler, 'cr_frame', None)
+    if frame is not None:
+        handler = frame.f_locals.get('self')
+    return getattr(handler, 'idekey', None)
+
+
+class LoopMonitor:
+    """
+    Records how long the event loop takes per iteration and per callback, and how late timers run.
+
+    The engines pass every readiness and timer callback through call() and report the time spent between two waits
+    for events with iteration(). A timer scheduled every LAG_INTERVAL measures the loop lag, the time it ran late.
+    Callbacks taking longer than the slow callback threshold are logged with their handler type and IDE key.
+    """
+
+    def __init__(self, slow_callback):
+        """
+        Initialize the LoopMonitor.
+        @param slow_callback: Seconds a callback may take before it is logged.
+        """
+        self.slow_callback = slow_callback
+        self.slow = 0
+        self.iterations = Histogram(LATENCY_BUCKETS)
+        self.lag = Histogram(LATENCY_BUCKETS)
+        # handler type -> [callbacks, seconds, most seconds]
+        self.handlers = {}
+
+        self._proxy_manager = None
+        self._timer = None
+        self._due = 0
+        self.logger = logging.getLogger('dbgpproxy.monitor')
+
+    def start(self, proxy_manager):
+        """
+        Start probing the loop lag.
+        @param proxy_manager: The proxy manager instance, to schedule the probes on.
+        """
+        self._proxy_manager = proxy_manager
+        self._schedule()
+
+    def _schedule(self):
+        """
+        Schedule the next lag probe.
+        """
+        self._due = time.monotonic() + LAG_INTERVAL
+        self._timer = self._proxy_manager.call_later(LAG_INTERVAL, self._probe)
+
+    def _probe(self):
+        """
+        Record how late the probe runs.
+        """
+        self.lag.observe(max(0.0, time.monotonic() - self._due) * 1000)
+        self._schedule()
+
+    def call(self, handler, callback, *args):
+        """
+        Run a callback and record its duration.
+        @param handler: The callback or dispatcher to attribute the duration to (see describe()).
+        @param callback: The function to run.
+        @param args: Arguments to the function.
+        @return: The result of the function.
+        """
+        # transports forget their protocol once the connection is lost
+        name, owner = describe(handler)
+        start = time.perf_counter()
+        try:
+            return callback(*args)
+        finally:
+            self.observe(name, owner, time.perf_counter() - start)
+
+    def observe(self, name, owner, seconds):
+        """
+        Record the duration of a callback and log it if it is slow.
+        @param name: The handler type (see describe()).
+        @param owner: The handler.
+        @param seconds: The duration.
+        """
+        stats = self.handlers.get(name)
+        if stats is None:
+            stats = self.handlers[name] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += seconds
+        if seconds > stats[2]:
+            stats[2] = seconds
+
+        if seconds >= self.slow_callback:
+            self.slow += 1
+            self.logger.warning('slow callback: {} [{}] took {:.1f} ms'.format(name, idekey(owner), seconds * 1000))
+
+    def iteration(self, seconds):
+        """
+        Record the time a loop iteration spent running callbacks.
+        @param seconds: The duration.
+        """
+        self.iterations.observe(seconds * 1000)
+
+    def close(self):
+        """
+        Stop probing the loop lag.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+class SamplingProfiler:
+    """
+    Samples the Python stack on SIGPROF, which fires every SAMPLE_INTERVAL of CPU time of the process.
+
+    The samples are written as collapsed stacks, one line per stack with its count, the input format of flame graph
+    tools such as flamegraph.pl or speedscope.
+    """
+
+    def __init__(self, directory):
+        """
+        Initialize the SamplingProfiler.
+        @param directory: Directory the profiles are written to.
+        """
+        self._directory = directory
+        self._samples = None
+        self._started = 0
+        self.logger = logging.getLogger('dbgpproxy.monitor')
+
+    @property
+    def running(self):
+        """
+        @return: True while sampling.
+        """
+        return self._samples is not None
+
+    def start(self):
+        """
+        Start sampling.
+        """
+        self._samples = Counter()
+        self._started = time.time()
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, SAMPLE_INTERVAL, SAMPLE_INTERVAL)
+        self.logger.warning('sampling profiler started')
+
+    def stop(self):
+        """
+        Stop sampling and write the profile.
+        @return: The path of the profile, or None if it could not be written.
+        """
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        samples, self._samples = self._samples, None
+
+        path = os.path.join(self._directory, 'dbgpproxy-{}-{}.folded'.format(
+            os.getpid(), time.strftime('%Y%m%d-%H%M%S', time.localtime(self._started))))
+        try:
+            with open(path, 'w') as f:
+                for stack, count in samples.most_common():
+                    f.write('{} {}\n'.format(stack, count))
+        except OSError as e:
+            self.logger.error('unable to write profile to {}: {}'.format(path, e))
+            path = None
+
+        total = sum(samples.values())
+        self.logger.warning('sampling profiler stopped after {:.1f} s, {} samples{}'.format(
+            time.time() - self._started, total, ' written to {}'.format(path) if path else ''))
+        functions = Counter()
+        for stack, count in samples.items():
+            functions[stack.rsplit(';', 1)[-1]] += count
+        for function, count in functions.most_common(PROFILE_TOP):
+            self.logger.warning('{:5.1f}% {}'.format(count * 100 / total, function))
+        return path
+
+    def toggle(self):
+        """
+        Start sampling, or stop and write the profile if sampling.
+        """
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def _sample(self, signum, frame):
+        """
+        Count the stack of the interrupted frame.
+        """
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        stack.reverse()
+        self._samples[';'.join(stack)] += 1
+
+
+class Diagnostics:
+    """
+    Dumps the sessions and loop statistics on SIGUSR1 and starts or stops the sampling profiler on SIGUSR2.
+
+    The output is logged at warning level, so it shows with every log level up to WARN.
+    """
+
+    def __init__(self, proxy_manager, profile_dir):
+        """
+        Initialize the Diagnostics and install the signal handlers on the proxy manager's event loop.
+        @param proxy_manager: The proxy manager instance.
+        @param profile_dir: Directory the sampling profiles are written to.
+        """
+        self._proxy_manager = proxy_manager
+        self._profiler = SamplingProfiler(profile_dir)
+        self.logger = logging.getLogger('dbgpproxy.monitor')
+
+        proxy_manager.add_signal_handler(signal.SIGUSR1, self.dump)
+        proxy_manager.add_signal_handler(signal.SIGUSR2, self._profiler.toggle)
+
+    def dump(self):
+        """
+        Log the live sessions, the session queues and the loop statistics.
+        """
+        proxy_manager = self._proxy_manager
+        metrics = proxy_manager.metrics
+        sessions = proxy_manager.sessions
+        lines = ['state of process {}: uptime {:.0f} s, {} registrations, {} registration connections, '
+                 '{} debugger connections, {} sessions'.format(
+                     os.getpid(), time.time() - metrics.started, len(proxy_manager.list_servers()),
+                     len(proxy_manager.registration_handlers), sessions.connections, len(metrics.sessions))]
+        for session in sorted(metrics.sessions, key=lambda s: s.started):
+            lines.append('  session [{}]: {:.1f} s, {} bytes / {} frames to the IDE, {} bytes / {} frames to the '
+                         'engine'.format(session.idekey, session.duration(), session.bytes_to_ide,
+                                         session.totals()[2], session.bytes_to_engine, session.frames_to_engine))
+        for queued_idekey, waiting in sorted(sessions.queues().items()):
+            lines.append('  queue [{}]: {} debugger connections waiting'.format(queued_idekey, waiting))
+
+        monitor = proxy_manager.monitor
+        if monitor is not None:
+            for name, histogram in (('iteration', monitor.iterations), ('lag', monitor.lag)):
+                lines.append('  loop {}: {} samples, p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms'.format(
+                    name, histogram.count, histogram.percentile(50), histogram.percentile(99), histogram.max))
+            lines.append('  {} slow callbacks'.format(monitor.slow))
+            for name, (count, seconds, most) in sorted(monitor.handlers.items(), key=lambda item: -item[1][1]):
+                lines.append('  callbacks {}: {}, {:.1f} ms total, {:.1f} ms max'.format(
+                    name, count, seconds * 1000, most * 1000))
+
+        self.logger.warning('\n'.join(lines))
+
+    def close(self):
+        """
+        Stop the sampling profiler if it is running.
+        """
+        if self._profiler.running:
+            self._profiler.stop()
@@ -0,0 +1,385 @@
+import getopt
+import logging
+from xml.dom import minidom
+from xml.sax.saxutils import escape, quoteattr
+from dbgpproxy.address import UNIX, LOCALHOST, is_local
+from dbgpproxy.framing import CommandFramer
+from dbgpproxy.initpacket import InitPacket
+
+__author__ = 'gkralik'
+
+E_NO_ERROR = 0
+E_PARSE_ERROR = 1
+E_INVALID_OPTIONS = 3
+E_UNIMPLEMENTED_COMMAND = 4
+
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+
+# seconds to wait before a command that lacks its terminator is handled anyway
+UNTERMINATED_COMMAND_DELAY = 0.2
+
+
+def frame_message(data):
+    """
+    Frame a message sent to the IDE.
+
+    Uses the format from the DBGp specification (message length followed by a \0 character, then the message
+    terminated with a \0 character).
+    @param data: The message (str).
+    @return: The framed message (bytes).
+    """
+    return frame_bytes(data.encode())
+
+
+def frame_bytes(data):
+    """
+    Frame an encoded message.
+    @param data: The message (bytes).
+    @return: The framed message (bytes).
+    """
+    return b'%d\0%s\0' % (len(data), data)
+
+
+def parse_init_packet(data):
+    """
+    Parse the XML payload of an init packet sent by the debugger engine.
+
+    The <init> start tag is parsed without building a DOM. Payloads it cannot handle are parsed with minidom.
+    @param data: The XML payload without the length prefix and the trailing \0 (bytes).
+    @return: An InitPacket or the document element (minidom node), both providing localName, hasAttribute(),
+             getAttribute() and setAttribute().
+    """
+    init_packet = InitPacket.parse(data)
+    if init_packet is not None:
+        return init_packet
+
+    dom = minidom.parseString(data.decode())
+    return dom.documentElement
+
+
+def build_init_packet(init_packet, dbghost):
+    """
+    Build the init packet forwarded to the IDE.
+
+    Adds the 'hostname' attribute specifying the proxy hostname if the engine did not set one.
+    @param init_packet: The init packet (InitPacket or minidom node).
+    @param dbghost: The host that the DebugConnectionServer is listening on.
+    @return: The framed init packet (bytes).
+    """
+    if not init_packet.hasAttribute('hostname') or not init_packet.getAttribute('hostname'):
+        init_packet.setAttribute('hostname', LOCALHOST if dbghost == UNIX else dbghost)
+
+    if isinstance(init_packet, InitPacket):
+        return frame_bytes(init_packet.to_bytes())
+
+    return frame_message(XML_DECLARATION + init_packet.toxml())
+
+
+class RegistrationCommands:
+    """
+    Mixin implementing the proxyinit/proxystop/proxylist/proxystats commands sent by the IDE.
+
+    Any number of commands can be sent over one connection, they are answered in order. proxyinit and proxystop accept
+    several -k options to register or remove many IDE keys at once.
+
+    Shared by the registration handlers of all engines. Subclasses provide send_message(), close(), the
+    _proxy_manager, _dbghost and _dbgport attributes and the peer host in _peer_host, pass received data to
+    handle_data() and call stop_commands() when the connection is closed.
+    """
+    logger = logging.getLogger('dbgpproxy.ide')
+
+    _framer = None
+    _flush_timer = None
+    _stopped = False
+
+    def handle_data(self, data):
+        """
+        Handle data sent by the IDE.
+
+        Every complete command is handled in order. Older clients do not terminate their command, so a remainder that
+        is not followed by more data is handled as a command after UNTERMINATED_COMMAND_DELAY.
+        @param data: The received data.
+        """
+        if self._framer is None:
+            self._framer = CommandFramer(b'\0\n')
+
+        self._cancel_flush()
+        self._framer.feed(data)
+
+        for command in self._framer:
+            if command.strip():
+                self.handle_command(command)
+            if self._stopped:
+                return
+
+        if self._framer.buffered():
+            self._flush_timer = self._proxy_manager.call_later(UNTERMINATED_COMMAND_DELAY, self._flush_command)
+
+    def _flush_command(self):
+        """
+        Handle the buffered unterminated command.
+        """
+        self._flush_timer = None
+        if not self._stopped and self._framer.buffered():
+            self.handle_command(self._framer.remaining())
+
+    def _cancel_flush(self):
+        """
+        Cancel handling of the buffered unterminated command.
+        """
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+    def commands_idle(self):
+        """
+        @return: True if no partial command is buffered.
+        """
+        return not self._stopped and self._flush_timer is None and (self._framer is None or not self._framer.buffered())
+
+    def stop_commands(self):
+        """
+        Stop handling commands, the connection is closed.
+        """
+        self._stopped = True
+        self._cancel_flush()
+
+    @staticmethod
+    def _parse_line(line):
+        """
+        Parse an IDE command line.
+        @param line: The line.
+        @return: A tuple consisting of the command, a list of arguments and the full line.
+        """
+        line = line.strip().rstrip('\0')
+        if not line:
+            return None, None, line
+
+        command, _, args = line.partition(' ')
+
+        return command, args.split(), line
+
+    def handle_command(self, data):
+        """
+        Handle proxyinit, proxystop, proxylist and proxystats commands sent by the IDE.
+
+        No other commands are recognized and responded to with a proxyerror.
+        @param data: The raw command (bytes).
+        """
+        try:
+            command, args, line = self._parse_line(data.decode())
+        except UnicodeDecodeError:
+            self._error('proxyerror', 'Command is not valid UTF-8.', E_PARSE_ERROR, close=False)
+            return
+
+        if not command:
+            self._error('proxyerror', 'Failed to parse command.', E_PARSE_ERROR)
+            return
+
+        self.logger.debug('command = %s, args = %s' % (command, args))
+
+        if command == 'proxyinit':
+            self._handle_proxyinit(args)
+        elif command == 'proxystop':
+            self._handle_proxystop(args)
+        elif command == 'proxylist':
+            self._handle_proxylist(args)
+        elif command == 'proxystats':
+            self.send_message(self._proxy_manager.metrics.to_xml())
+        else:
+            self._error('proxyerror', 'Unknown command [{0:s}]'.format(command), E_UNIMPLEMENTED_COMMAND)
+
+    def _handle_proxyinit(self, args):
+        """
+        Handle a proxyinit command sent by the IDE.
+
+        Parses the args and adds the IDE to the proxy manager's server list. A proxyinit success message is sent
+        afterwards.
+        With several -k options, every IDE key is registered with the port given by the -p option at the same
+        position, or with the only -p option. The response then lists the outcome for every IDE key.
+        An IDE listening on a Unix domain socket passes -p unix:/path instead of a port, which is only accepted from
+        the local host (the loopback interface or a Unix domain socket registration listener).
+        If anything fails, a proxyerror is sent to the IDE.
+        @param args: A list of args to the proxyinit command.
+        @return: void
+        """
+        self.logger.debug('got proxyinit command: %s' % (args,))
+
+        opts = self._getopt('proxyinit', args, 'p:k:m:')
+        if opts is None:
+            return
+
+        idekeys = []
+        ports = []
+        multi = None
+        for o, a in opts:
+            if o == '-p':
+                ports.append(self._parse_port(a))
+            elif o == '-k':
+                idekeys.append(a)
+            elif o == '-m':
+                multi = a
+
+        if not idekeys or not all(idekeys):
+            self._error('proxyinit', 'No IDE key defined for proxy.', E_INVALID_OPTIONS, close=False)
+            return
+
+        if not ports or not all(ports):
+            self._error('proxyinit', 'No port defined for proxy.', E_INVALID_OPTIONS, close=False)
+            return
+
+        # the proxy would connect to any socket file of this host for the peer
+        if not is_local(self._peer_host) and any(host == UNIX for host, port in ports):
+            self._error('proxyerror', 'Unix domain sockets can only be registered from the local host.',
+                        E_INVALID_OPTIONS, close=False)
+            return
+
+        if len(ports) == 1:
+            ports *= len(idekeys)
+        elif len(ports) != len(idekeys):
+            self._error('proxyinit', 'Number of ports does not match number of IDE keys.', E_INVALID_OPTIONS,
+                        close=False)
+            return
+
+        if len(idekeys) > 1:
+            results = []
+            for idekey, (host, port) in zip(idekeys, ports):
+                if self._proxy_manager.add_server(idekey, host, port, multi):
+                    results.append('<server idekey={} port={} success="1"/>'.format(quoteattr(idekey),
+                                                                                   quoteattr(str(port))))
+                else:
+                    results.append(self._bulk_error(idekey, 'IDE Key already exists.', E_INVALID_OPTIONS))
+            self._send_bulk('proxyinit', results, ' address={} port={}'.format(quoteattr(self._dbghost),
+                                                                               quoteattr(str(self._dbgport))))
+            return
+
+        id = self._proxy_manager.add_server(idekeys[0], ports[0][0], ports[0][1], multi)
+        if id:
+            msg = '<?xml version="1.0" encoding="UTF-8"?>\n<proxyinit success="1" idekey={0:s} address={1:s} port={2:s}/>'.format(
+                quoteattr(id), quoteattr(self._dbghost), quoteattr(str(self._dbgport)))
+            self.send_message(msg)
+            return
+        else:
+            self._error('proxyinit', 'IDE Key already exists.', E_INVALID_OPTIONS, close=False)
+            return
+
+    def _handle_proxystop(self, args):
+        """
+        Handle a proxystop command sent by the IDE.
+
+        Parses the args and removes the IDE from the proxy manager's server list. Sends a proxystop success message if
+        everything ok, also if the IDE key was not registered. With several -k options, all of the IDE keys are
+        removed and the response lists them.
+        If a failure occurs, sends a proxyerror.
+        @param args: List of args to the proxystop command.
+        @return: void
+        """
+        self.logger.debug('got proxystop command: %s' % (args))
+
+        opts = self._getopt('proxystop', args, 'k:')
+        if opts is None:
+            return
+
+        idekeys = [a for o, a in opts if o == '-k']
+        if not idekeys or not all(idekeys):
+            self._error('proxystop', 'No IDE key.', E_INVALID_OPTIONS, close=False)
+            return
+
+        if len(idekeys) > 1:
+            results = []
+            for idekey in idekeys:
+                self._proxy_manager.remove_server(idekey)
+                results.append('<server idekey={} success="1"/>'.format(quoteattr(idekey)))
+            self._send_bulk('proxystop', results)
+            return
+
+        self._proxy_manager.remove_server(idekeys[0])
+        msg = '<?xml version="1.0" encoding="UTF-8"?>\n<proxystop success="1" idekey={0:s}/>'.format(
+            quoteattr(idekeys[0]))
+        self.send_message(msg)
+        return
+
+    def _handle_proxylist(self, args):
+        """
+        Handle a proxylist command sent by the IDE.
+
+        Lists the servers registered from the IDE's host, or all servers with -a.
+        @param args: List of args to the proxylist command.
+        """
+        opts = self._getopt('proxylist', args, 'a')
+        if opts is None:
+            return
+
+        host = None if opts else self._peer_host
+        servers = []
+        for idekey, ((server_host, port), multi) in self._proxy_manager.list_servers(host):
+            servers.append('<server idekey={} address={} port={}{}/>'.format(
+                quoteattr(idekey), quoteattr(server_host), quoteattr(str(port)),
+                '' if multi is None else ' multi={}'.format(quoteattr(str(multi)))))
+        self._send_bulk('proxylist', servers)
+
+    def _parse_port(self, value):
+        """
+        Parse the -p option of proxyinit.
+        @param value: A port of the requesting host, or unix:/path.
+        @return: Tuple of the IDE host and port, or None if the value is invalid.
+        """
+        if value.startswith(UNIX + ':'):
+            return (UNIX, value[len(UNIX) + 1:]) if len(value) > len(UNIX) + 1 else None
+        try:
+            port = int(value)
+        except ValueError:
+            return None
+        return (self._peer_host, port) if 0 < port < 65536 else None
+
+    def _getopt(self, command, args, shortopts):
+        """
+        Parse the options of a command, sending a proxyerror if they are invalid.
+        @param command: The command.
+        @param args: List of args.
+        @param shortopts: The options (see getopt.getopt()).
+        @return: List of (option, value) tuples or None if the options are invalid.
+        """
+        try:
+            opts, args = getopt.getopt(args, shortopts)
+        except getopt.GetoptError as e:
+            self._error(command, 'Invalid options ({}).'.format(e.msg), E_INVALID_OPTIONS, close=False)
+            return None
+        return opts
+
+    @staticmethod
+    def _bulk_error(idekey, message, code):
+        """
+        @return: The result element of an IDE key that failed in a bulk command (str).
+        """
+        return '<server idekey={} success="0"><error id="{:d}"><message>{}</message></error></server>'.format(
+            quoteattr(idekey), code, escape(message))
+
+    def _send_bulk(self, command, results, attributes=''):
+        """
+        Send the response to a bulk command or proxylist.
+        @param command: The command.
+        @param results: List of result elements (str).
+        @param attributes: Additional attributes of the response element (str).
+        """
+        success = '0' if any(' success="0"' in result for result in results) else '1'
+        self.send_message('<?xml version="1.0" encoding="UTF-8"?>\n<{0:s} success="{1:s}"{2:s}>{3:s}</{0:s}>'.format(
+            command, success, attributes, ''.join(results)))
+
+    def _error(self, command, message, code=E_NO_ERROR, close=True):
+        """
+        Send a proxyerror and shutdown the handler.
+        @param command: The command that caused the error.
+        @param message: The error message to send (UI usable by the IDE).
+        @param code: The error code (defaults to E_NO_ERROR).
+        @param close: Shutdown the handler. Errors of a single command leave the connection open for the commands
+                      pipelined after it.
+        """
+        error = '<?xml version="1.0" encoding="UTF-8"?>\n<{0:s} success="0"><error id="{1:d}"><message>{2:s}</message></error></{0:s}>'.format(
+            command, code, escape(message))
+
+        self.logger.error(message)
+        self.send_message(error)
+        if close:
+            self.stop_commands()
+            self.close()
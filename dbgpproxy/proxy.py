@@ -1,56 +1,370 @@
-import asyncore
 import logging
-from dbgpproxy.dispatcher import RegistrationServer, DebugConnectionServer
+import socket
+import tempfile
+from importlib.util import find_spec
+from dbgpproxy.address import UNIX, address_family, bind_unix, is_local
+from dbgpproxy.buffers import HIGH_WATER
+from dbgpproxy.cache import CACHE_TTL
+from dbgpproxy.metrics import Metrics, StatsEndpoint
+from dbgpproxy.sessions import SessionTable
 
 __author__ = 'gkralik'
 
+ENGINES = ('asyncore', 'asyncio')
+
+# default length of the queue of pending connections of the listening sockets
+BACKLOG = 128
+
+# asyncore has been removed in Python 3.12
+DEFAULT_ENGINE = 'asyncore' if find_spec('asyncore') is not None else 'asyncio'
+
 
 class Proxy:
-    def __init__(self, idehost=None, ideport=None, dbghost=None, dbgport=None):
+    def __init__(self, idehost=None, ideport=None, dbghost=None, dbgport=None, engine=DEFAULT_ENGINE, relay='copy',
+                 connect_timeout=5.0, reuse_port=False, registry_file=None, buffer_size=HIGH_WATER,
+                 capture_dir=None, capture_idekeys=(), capture_hosts=(), stats_address=None, max_sessions=0,
+                 session_queue=64, queue_timeout=30.0, registration_ttl=None, probe_interval=None, backlog=BACKLOG,
+                 max_connections=0, tunnel_listen=None, tunnel_connect=None, cache_size=0, cache_ttl=CACHE_TTL,
+                 listen_sockets=None, handoff_path=None, slow_callback=None, signals=False, profile_dir=None,
+                 cluster_listen=None, cluster_peers=(), cluster_advertise=None, cluster_route='direct', relay_budget=0,
+                 relay_priority=False):
         """
         Initialize the Proxy manager.
 
-        Sets up the RegistrationServer and DebugConnectionServer instances.
-        @param idehost: The host to listen on for IDE requests.
-        @param ideport: The port to listen on for IDE requests.
-        @param dbghost: The host to listen on for debugger engine requests.
-        @param dbgport: The port to listen on for debugger engine requests.
+        Sets up the RegistrationServer and DebugConnectionServer instances of the selected engine.
+        @param idehost: The host to listen on for IDE requests, UNIX (see dbgpproxy.address) for a Unix domain socket.
+        @param ideport: The port to listen on for IDE requests, or the path of the Unix domain socket.
+        @param dbghost: The host to listen on for debugger engine requests, UNIX for a Unix domain socket.
+        @param dbgport: The port to listen on for debugger engine requests, or the path of the Unix domain socket.
+        @param engine: The event loop implementation, one of ENGINES.
+        @param relay: How established sessions are relayed, one of dbgpproxy.relay.RELAY_MODES.
+        @param connect_timeout: Seconds to wait for the connection to an IDE.
+        @param reuse_port: Bind the listening sockets with SO_REUSEPORT (used by worker processes).
+        @param registry_file: File to keep the list of known servers in across restarts (optional).
+        @param buffer_size: Bytes buffered per direction of a session before reading from the sender is paused.
+        @param capture_dir: Directory to capture session traffic to (optional).
+        @param capture_idekeys: Only capture sessions with these IDE keys or...
+        @param capture_hosts: ...of debugger engines on these hosts (all sessions if both are empty).
+        @param stats_address: Tuple of host and port to serve statistics on in text format (optional).
+        @param max_sessions: Parallel sessions per IDE key of IDEs supporting multiple sessions (0 for no limit).
+        @param session_queue: Debugger engine connections waiting per IDE key for a free session slot.
+        @param queue_timeout: Seconds a debugger engine connection waits for a free session slot.
+        @param registration_ttl: Seconds a registration lives unless the IDE registers again (optional).
+        @param probe_interval: Seconds between connection probes of the registered IDEs (optional).
+        @param backlog: Length of the queue of pending connections of the listening sockets.
+        @param max_connections: Debugger engine connections open at a time, further ones are closed (0 for no limit).
+        @param tunnel_listen: Tuple of host and port to accept tunnel links from other proxies on (optional).
+        @param tunnel_connect: Tuple of host and port of a proxy to relay all sessions from over a tunnel (optional).
+        @param cache_size: Bytes of responses to idempotent commands cached across sessions (0 for no cache).
+        @param cache_ttl: Seconds a cached response is served.
+        @param listen_sockets: Dict of listener name ('ide', 'dbg', 'stats', 'tunnel' or 'cluster') to a listening
+                               socket to use instead of binding a new one (optional, see
+                               dbgpproxy.handoff.inherited_sockets()).
+        @param handoff_path: Path of a Unix socket to take over listeners, registrations and sessions from a running
+                             process, and to hand them to the next one (optional).
+        @param slow_callback: Seconds an event loop callback may take before it is logged. Enables the LoopMonitor,
+                              which times the loop iterations and callbacks (optional).
+        @param signals: Dump the state on SIGUSR1 and start or stop the sampling profiler on SIGUSR2. The proxy
+                        manager must be created in the main thread.
+        @param profile_dir: Directory the sampling profiles are written to (defaults to the temporary directory).
+        @param cluster_listen: Tuple of host and port to accept links from the other proxies of a cluster on. Enables
+                               the ClusterNode, which shares the registrations with them (optional).
+        @param cluster_peers: Tuples of host and port of the cluster listeners of the other proxies.
+        @param cluster_advertise: Tuple of host and port other proxies forward debugger connections to (defaults to
+                                  the debugger port).
+        @param cluster_route: How debugger connections for IDEs registered with another proxy reach the IDE, one of
+                              dbgpproxy.cluster.CLUSTER_ROUTES.
+        @param relay_budget: Bytes a session may relay per event loop iteration, enables the RelayScheduler (0 for no
+                             limit, see dbgpproxy.fairness). Spliced sessions are not limited.
+        @param relay_priority: Let sessions relaying small frames go first and ignore their budget.
         """
         self.logger = logging.getLogger('dbgpproxy')
         self._servers = {}
+        self._registry_listeners = []
+
+        self.relay = relay
+        self.connect_timeout = connect_timeout
+        self.reuse_port = reuse_port
+        self.buffer_size = buffer_size
+        self.registration_ttl = registration_ttl
+        self.backlog = backlog
+        self.dbg_address = (dbghost, dbgport)
+
+        # sockets to listen on instead of binding new ones, and the listening sockets in use, by listener name
+        self.listen_sockets = dict(listen_sockets or {})
+        self.listeners = {}
+        # open registration connections (handlers of the engine)
+        self.registration_handlers = set()
+
+        self.metrics = Metrics()
+
+        self.monitor = None
+        if slow_callback is not None:
+            from dbgpproxy.monitor import LoopMonitor
+            self.monitor = self.metrics.loop = LoopMonitor(slow_callback)
+
+        self.relay_scheduler = None
+        if relay_budget:
+            from dbgpproxy.fairness import RelayScheduler
+            self.relay_scheduler = self.metrics.relay = RelayScheduler(self, relay_budget, relay_priority)
+            if relay == 'splice':
+                self.logger.warning('the relay budget does not apply to spliced sessions')
+
+        self.cache = None
+        if cache_size:
+            from dbgpproxy.cache import ResponseCache
+            self.cache = self.metrics.cache = ResponseCache(cache_size, cache_ttl)
+        self.sessions = SessionTable(self, max_sessions, session_queue, queue_timeout, max_connections)
+        # created once the engine can schedule timers
+        self._health = None
+        self.cluster = None
+
+        self.capture = None
+        if capture_dir:
+            from dbgpproxy.capture import Capture
+            self.capture = Capture(capture_dir, capture_idekeys, capture_hosts)
+
+        self._registry_log = None
+        if registry_file:
+            from dbgpproxy.registry import RegistryLog
+            self._registry_log = RegistryLog(registry_file)
+            for idekey, (host, port, multi) in self._registry_log.load().items():
+                self.restore_server(idekey, host, port, multi)
+            self.add_registry_listener(self._registry_log)
+
+        self._handoff = None
+        if handoff_path:
+            from dbgpproxy.handoff import Handoff
+            self._handoff = Handoff(self, handoff_path)
+            self.listen_sockets.update(self._handoff.take_over())
+
+        if engine == 'asyncio':
+            from dbgpproxy.aio import AsyncioEngine
+            self._engine = AsyncioEngine(idehost, ideport, dbghost, dbgport, proxy_manager=self)
+        elif engine == 'asyncore':
+            from dbgpproxy.dispatcher import AsyncoreEngine
+            self._engine = AsyncoreEngine(idehost, ideport, dbghost, dbgport, proxy_manager=self)
+        else:
+            raise ValueError('unknown engine [{}]'.format(engine))
+
+        self.logger.debug('using {} engine'.format(engine))
+
+        if self.monitor is not None:
+            self.monitor.start(self)
+
+        self._diagnostics = None
+        if signals:
+            from dbgpproxy.monitor import Diagnostics
+            self._diagnostics = Diagnostics(self, profile_dir or tempfile.gettempdir())
+
+        self._stats_endpoint = None
+        if stats_address:
+            self._stats_endpoint = StatsEndpoint(self, *stats_address)
+
+        if registration_ttl or probe_interval:
+            from dbgpproxy.health import HealthMonitor
+            self._health = HealthMonitor(self, registration_ttl, probe_interval)
+
+        self._tunnels = []
+        if tunnel_listen:
+            from dbgpproxy.tunnel import TunnelServer
+            self._tunnels.append(TunnelServer(self, *tunnel_listen))
+        if tunnel_connect:
+            from dbgpproxy.tunnel import TunnelClient
+            self._tunnels.append(TunnelClient(self, *tunnel_connect))
+
+        if cluster_listen:
+            from dbgpproxy.cluster import ClusterNode
+            self.cluster = ClusterNode(self, cluster_listen[0], cluster_listen[1], cluster_peers, cluster_advertise,
+                                       cluster_route)
+
+        if self._handoff is not None:
+            self._handoff.start()
+
+    def start(self):
+        """
+        Start the event loop.
+        """
+        self._engine.start()
+
+    def stop(self):
+        """
+        Close all sockets handled by the event loop.
+        """
+        self._engine.stop()
+        if self._diagnostics is not None:
+            self._diagnostics.close()
+        if self.monitor is not None:
+            self.monitor.close()
+        if self._handoff is not None:
+            self._handoff.close()
+        for tunnel in self._tunnels:
+            tunnel.close()
+        if self.cluster is not None:
+            self.cluster.close()
+        if self._health is not None:
+            self._health.close()
+        if self._stats_endpoint is not None:
+            self._stats_endpoint.close()
+        if self._registry_log is not None:
+            self._registry_log.close()
+        if self.capture is not None:
+            self.capture.close()
+
+    def retire(self):
+        """
+        Stop accepting connections and registrations once the listeners have been handed to another process.
+
+        Established sessions keep running until they have been handed off as well or end. Tunnel and cluster links
+        are closed, their peers connect to the new process.
+        """
+        self._engine.close_listeners()
+        for tunnel in self._tunnels:
+            tunnel.close()
+        self._tunnels = []
+        if self.cluster is not None:
+            self.cluster.close()
+            self.cluster = None
+        if self._health is not None:
+            self._health.close()
+            self._health = None
+        if self._stats_endpoint is not None:
+            self._stats_endpoint.close()
+            self._stats_endpoint = None
+        if self._registry_log is not None:
+            # the new process records registrations from now on
+            self._registry_listeners.remove(self._registry_log)
+            self._registry_log.close()
+            self._registry_log = None
+        self.listeners.clear()
+
+    def create_listener(self, name, host, port, backlog=None):
+        """
+        Create a listening socket, or use the one passed for the listener name.
+        @param name: The listener name ('ide', 'dbg', 'stats', 'tunnel' or 'cluster').
+        @param host: The host to listen on, UNIX for a Unix domain socket.
+        @param port: The port to listen on, or the path of the Unix domain socket.
+        @param backlog: Length of the queue of pending connections (defaults to the backlog of the proxy manager).
+        @return: The non-blocking listening socket.
+        """
+        sock = self.listen_sockets.pop(name, None)
+        if sock is None and host == UNIX:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            bind_unix(sock, port)
+        elif sock is None:
+            sock = socket.socket(address_family(host), socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind((host, port))
+        else:
+            self.logger.debug('using inherited socket for {} listener on {}'.format(name, sock.getsockname()))
+        sock.listen(backlog or self.backlog)
+        sock.setblocking(False)
+        self.listeners[name] = sock
+        return sock
+
+    def adopt_session(self, engine_sock, ide_sock, state):
+        """
+        Continue an established session handed over by another process.
+        @param engine_sock: The debugger engine socket.
+        @param ide_sock: The IDE socket.
+        @param state: Dict describing the session, see the handoff_state() method of the engine handlers.
+        """
+        self._engine.adopt_session(engine_sock, ide_sock, state)
+
+    def adopt_registration(self, sock):
+        """
+        Continue handling the commands of a registration connection handed over by another process.
+        @param sock: The socket.
+        """
+        self._engine.adopt_registration(sock)
+
+    def call_later(self, delay, callback, *args):
+        """
+        Schedule a callback on the event loop.
+        @param delay: Delay in seconds.
+        @param callback: The callback.
+        @param args: Arguments to the callback.
+        @return: A timer with a cancel() method.
+        """
+        return self._engine.call_later(delay, callback, *args)
 
-        self._registration_server = RegistrationServer(idehost, ideport, dbghost, dbgport, proxy_manager=self)
-        self._debugger_connection_server = DebugConnectionServer(dbghost, dbgport, proxy_manager=self)
+    def call_soon(self, callback, *args):
+        """
+        Call back once the readiness events of the current event loop iteration have been handled.
+        @param callback: The callback.
+        @param args: Arguments to the callback.
+        """
+        self._engine.call_soon(callback, *args)
+
+    def add_reader(self, sock, callback):
+        """
+        Watch a socket on the event loop.
+        @param sock: The socket.
+        @param callback: Called without arguments whenever the socket is readable.
+        """
+        self._engine.add_reader(sock, callback)
+
+    def remove_reader(self, sock):
+        """
+        Stop watching a socket for readability. Must be called before the socket is closed.
+        @param sock: The socket.
+        """
+        self._engine.remove_reader(sock)
+
+    def add_writer(self, sock, callback):
+        """
+        Watch a socket for writability on the event loop.
+        @param sock: The socket.
+        @param callback: Called without arguments whenever the socket is writable.
+        """
+        self._engine.add_writer(sock, callback)
+
+    def remove_writer(self, sock):
+        """
+        Stop watching a socket for writability. Must be called before the socket is closed.
+        @param sock: The socket.
+        """
+        self._engine.remove_writer(sock)
 
-    @staticmethod
-    def start():
+    def add_signal_handler(self, signum, callback):
         """
-        Start the asyncore loop.
+        Call back on the event loop when a signal is received. Must be called from the main thread.
+        @param signum: The signal number.
+        @param callback: Called without arguments.
         """
-        asyncore.loop()
+        self._engine.add_signal_handler(signum, callback)
 
-    @staticmethod
-    def stop():
+    def add_registry_listener(self, listener):
         """
-        Close all sockets handled by asyncore.
+        Add a listener that is notified about changes to the list of known servers.
+
+        The listener must provide server_added(idekey, host, port, multi) and server_removed(idekey).
+        @param listener: The listener.
         """
-        asyncore.close_all()
+        self._registry_listeners.append(listener)
 
     def add_server(self, idekey, host, port, multi):
         """
         Add a server (IDE) to the list of known servers.
         @param idekey: The IDEKEY identifying the server.
-        @param host: The host of the IDE process.
-        @param port: The port of the IDE process.
-        @param multi: Not used.
-        @return: The IDEKEY or None if IDEKEY is already registered.
+        @param host: The host of the IDE process, UNIX (see dbgpproxy.address) if it listens on a Unix domain socket.
+        @param port: The port of the IDE process, or the path of its Unix domain socket.
+        @param multi: The -m flag of the registration, '0' if the IDE does not support multiple sessions.
+        @return: The IDEKEY or None if IDEKEY is already registered. With a registration TTL, registering the same
+                 host and port again refreshes the registration instead.
         """
         if idekey in self._servers:
-            return None
+            if not self.registration_ttl or self._servers[idekey][0] != [host, port]:
+                return None
+            self.logger.debug('refreshing registration of idekey = {}'.format(idekey))
 
         self.logger.debug('add_server: idekey = {}, host = {}, port = {}, multi = {}'.format(idekey, host, port, multi))
 
         self._servers[idekey] = [[host, port], multi]
+        for listener in self._registry_listeners:
+            listener.server_added(idekey, host, port, multi)
         return idekey
 
     def remove_server(self, idekey):
@@ -62,17 +376,59 @@ class Proxy:
         if idekey in self._servers:
             self.logger.debug('remove_server: idekey = {}'.format(idekey))
             del self._servers[idekey]
+            for listener in self._registry_listeners:
+                listener.server_removed(idekey)
             return idekey
 
         return None
 
+    def restore_server(self, idekey, host, port, multi):
+        """
+        Add or replace a server without notifying the registry listeners.
+
+        Used for registrations that have been made elsewhere (another worker, a previous run).
+        @param idekey: The IDEKEY identifying the server.
+        @param host: The host of the IDE process.
+        @param port: The port of the IDE process.
+        @param multi: The -m flag of the registration.
+        """
+        self._servers[idekey] = [[host, port], multi]
+        if self._health is not None:
+            self._health.refresh(idekey)
+
+    def discard_server(self, idekey):
+        """
+        Remove a server without notifying the registry listeners. Engine connections waiting for it are rejected like
+        after remove_server().
+        @param idekey: The IDEKEY identifying the server.
+        """
+        if self._servers.pop(idekey, None) is not None:
+            self.sessions.server_removed(idekey)
+        if self._health is not None:
+            self._health.forget(idekey)
+
+    def list_servers(self, host=None):
+        """
+        List the known servers.
+        @param host: Only list servers (IDEs) on this host (optional). IDEs listening on Unix domain sockets are on the
+                     local host.
+        @return: List of (IDEKEY, server) tuples, see get_server().
+        """
+        hosts = (host, UNIX) if host is not None and is_local(host) else (host,)
+        return [(idekey, server) for idekey, server in self._servers.items() if host is None or server[0][0] in hosts]
+
     def get_server(self, idekey):
         """
         Get a server by its IDEKEY.
+
+        In a cluster, the address of a server registered with another proxy may be replaced by the address of that
+        proxy's debugger port (see dbgpproxy.cluster.ClusterNode.route()).
         @param idekey: The IDEKEY identifying the server.
         @return: The IDEKEY or None if the server is not registered.
         """
         if idekey in self._servers:
+            if self.cluster is not None:
+                return self.cluster.route(idekey, self._servers[idekey])
             return self._servers[idekey]
 
         return None
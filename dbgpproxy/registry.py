@@ -0,0 +1,182 @@
+import json
+import logging
+import os
+import queue
+import threading
+
+__author__ = 'gkralik'
+
+# the log is compacted once it has this many lines and twice as many as there are registrations
+COMPACT_MIN_LINES = 1000
+
+
+def _valid_entry(entry):
+    """
+    @return: True if entry is a registration or removal line of the log.
+    """
+    if not isinstance(entry, list) or len(entry) < 2 or not isinstance(entry[1], str):
+        return False
+    if entry[0] == '+':
+        return (len(entry) == 5 and isinstance(entry[2], str) and isinstance(entry[3], (int, str)) and
+                not isinstance(entry[3], bool) and (entry[4] is None or isinstance(entry[4], str)))
+    return entry[0] == '-' and len(entry) == 2
+
+
+class RegistryLog:
+    """
+    Keeps the list of known servers in an append-only file, so registrations survive restarts.
+
+    Every line is a JSON array, either ["+", idekey, host, port, multi] or ["-", idekey]. The event loop only puts
+    changes on a queue; a background thread appends them to the file and rewrites the file from its own copy of the
+    registrations when most of it is outdated.
+    """
+
+    def __init__(self, path):
+        """
+        Initialize the RegistryLog.
+        @param path: The path of the log file.
+        """
+        self._path = path
+        self._queue = queue.Queue()
+        # idekey -> [host, port, multi], only used by the writer thread after load()
+        self._servers = {}
+        self._lines = 0
+        self._file = None
+        self._thread = None
+
+        self.logger = logging.getLogger('dbgpproxy.registry')
+
+    def load(self):
+        """
+        Read the registrations from the file and start the writer thread.
+        @return: Dict of idekey -> [host, port, multi].
+        """
+        try:
+            with open(self._path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+
+        lines = data.split(b'\n')
+        if lines[-1]:
+            # the last line of a log that was cut off by a crash, drop it before appending
+            self.logger.warning('skipping incomplete last line in {}'.format(self._path))
+            os.truncate(self._path, len(data) - len(lines[-1]))
+        lines.pop()
+
+        try:
+            # parsing the whole log in one go is several times faster than line by line
+            entries = json.loads(b'[' + b','.join(lines) + b']')
+        except ValueError:
+            entries = []
+            for number, line in enumerate(lines, 1):
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    self.logger.warning('skipping invalid line {} in {}'.format(number, self._path))
+
+        servers = {}
+        for entry in entries:
+            if not _valid_entry(entry):
+                self.logger.warning('skipping invalid entry {} in {}'.format(json.dumps(entry), self._path))
+            elif entry[0] == '+':
+                servers[entry[1]] = entry[2:5]
+            elif entry[0] == '-':
+                servers.pop(entry[1], None)
+
+        self.logger.info('loaded {} registrations from {}'.format(len(servers), self._path))
+
+        self._servers = dict(servers)
+        self._lines = len(lines)
+        self._file = open(self._path, 'ab')
+        self._thread = threading.Thread(target=self._run, name='registry-log', daemon=True)
+        self._thread.start()
+
+        return servers
+
+    def server_added(self, idekey, host, port, multi):
+        """
+        Record a registration.
+        """
+        self._queue.put(['+', idekey, host, port, multi])
+
+    def server_removed(self, idekey):
+        """
+        Record a removal.
+        """
+        self._queue.put(['-', idekey])
+
+    def close(self):
+        """
+        Write all queued changes and stop the writer thread.
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        """
+        Writer thread: append queued changes, flush when the queue is empty.
+        """
+        self._maybe_compact()
+
+        while True:
+            entry = self._queue.get()
+            while entry is not None:
+                self._append(entry)
+                try:
+                    entry = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            try:
+                self._file.flush()
+            except OSError as e:
+                self.logger.error('unable to write {}: {}'.format(self._path, e))
+
+            if entry is None:
+                self._file.close()
+                return
+
+            self._maybe_compact()
+
+    def _append(self, entry):
+        """
+        Append one change to the file and to the writer's copy of the registrations.
+        @param entry: The change.
+        """
+        if entry[0] == '+':
+            self._servers[entry[1]] = entry[2:5]
+        else:
+            self._servers.pop(entry[1], None)
+
+        try:
+            self._file.write(json.dumps(entry).encode() + b'\n')
+            self._lines += 1
+        except OSError as e:
+            self.logger.error('unable to write {}: {}'.format(self._path, e))
+
+    def _maybe_compact(self):
+        """
+        Rewrite the file with only the current registrations if most of it is outdated.
+        """
+        if self._lines < COMPACT_MIN_LINES or self._lines < 2 * len(self._servers):
+            return
+
+        tmp_path = self._path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                for idekey, server in self._servers.items():
+                    f.write(json.dumps(['+', idekey] + list(server)).encode() + b'\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self._path)
+        except OSError as e:
+            self.logger.error('unable to compact {}: {}'.format(self._path, e))
+            return
+
+        self._file.close()
+        self._file = open(self._path, 'ab')
+        self.logger.debug('compacted {} lines to {}'.format(self._lines, len(self._servers)))
+        self._lines = len(self._servers)
@@ -0,0 +1,135 @@
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__author__ = 'gkralik'
+
+RELAY_MODES = ('copy', 'splice')
+
+SPLICE_AVAILABLE = hasattr(os, 'splice')
+
+# bytes moved per forwarding step
+CHUNK_SIZE = 1024 * 1024
+
+
+class Forwarder:
+    """
+    Moves bytes from one connected socket to another.
+
+    read() pulls data from the source socket into an intermediate buffer, write() pushes it to the destination. Both
+    raise BlockingIOError if the socket is not ready and OSError if the connection is broken.
+    """
+
+    def __init__(self, src, dst):
+        """
+        Initialize the Forwarder.
+        @param src: The source socket.
+        @param dst: The destination socket.
+        """
+        self._src = src
+        self._dst = dst
+        self.pending = 0
+
+    def read(self):
+        """
+        Read from the source socket.
+        @return: The number of bytes read, 0 on EOF.
+        """
+        raise NotImplementedError
+
+    def write(self):
+        """
+        Write pending data to the destination socket.
+        @return: The number of bytes written.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Release the intermediate buffer.
+        """
+        pass
+
+
+class SpliceForwarder(Forwarder):
+    """
+    Forwards data inside the kernel using splice() through a pipe, so payloads are never copied to user space.
+    """
+
+    def __init__(self, src, dst):
+        super().__init__(src, dst)
+        self._pipe_r, self._pipe_w = os.pipe()
+        self._capacity = 65536
+
+        if fcntl is not None and hasattr(fcntl, 'F_SETPIPE_SZ'):
+            try:
+                self._capacity = fcntl.fcntl(self._pipe_w, fcntl.F_SETPIPE_SZ, CHUNK_SIZE)
+            except OSError:
+                # capped by /proc/sys/fs/pipe-max-size
+                pass
+
+        self._flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+
+    def read(self):
+        # only called once the previous chunk has been written completely
+        n = os.splice(self._src.fileno(), self._pipe_w, self._capacity, flags=self._flags)
+        self.pending += n
+        return n
+
+    def write(self):
+        n = os.splice(self._pipe_r, self._dst.fileno(), self.pending, flags=self._flags)
+        self.pending -= n
+        return n
+
+    def close(self):
+        if self._pipe_r is not None:
+            os.close(self._pipe_r)
+            os.close(self._pipe_w)
+            self._pipe_r = self._pipe_w = None
+
+
+class BufferForwarder(Forwarder):
+    """
+    Forwards data through one preallocated buffer with recv_into(), for platforms without splice().
+    """
+
+    def __init__(self, src, dst):
+        super().__init__(src, dst)
+        self._buffer = bytearray(CHUNK_SIZE)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+
+    def read(self):
+        # only called once the previous chunk has been written completely
+        self._start = 0
+        n = self._src.recv_into(self._view)
+        self.pending = n
+        return n
+
+    def write(self):
+        n = self._dst.send(self._view[self._start:self._start + self.pending])
+        self._start += n
+        self.pending -= n
+        return n
+
+    def close(self):
+        self._view.release()
+
+
+def create_forwarder(src, dst):
+    """
+    Create the best forwarder available on this platform.
+    @param src: The source socket.
+    @param dst: The destination socket.
+    @return: A Forwarder instance.
+    """
+    if SPLICE_AVAILABLE:
+        try:
+            return SpliceForwarder(src, dst)
+        except OSError:
+            pass
+
+    return BufferForwarder(src, dst)
@@ -0,0 +1,268 @@
+import logging
+from collections import deque
+
+__author__ = 'gkralik'
+
+# outcomes of SessionTable.acquire()
+START = 'start'
+QUEUED = 'queued'
+REJECTED = 'rejected'
+
+
+class SessionTable:
+    """
+    Tracks the debug sessions of every IDE key and limits how many of them are proxied at the same time.
+
+    An IDE registered with -m 0 gets one session at a time, other IDEs up to max_sessions (0 means no limit). Engine
+    connections above the limit wait in a queue per IDE key and are started in order as sessions end. If the IDE
+    refuses a connection while it has other sessions open, it is assumed not to accept more parallel sessions: the
+    limit of the IDE key is lowered to the number of open sessions and the engine connection goes back to the front of
+    the queue. A new proxyinit resets the learned limit.
+
+    Independent of the IDE key, at most max_connections engine connections are admitted at a time; further ones are
+    closed right after they have been accepted.
+
+    Sessions are objects providing start_session(), reject_session(reason) and a closed attribute.
+    """
+
+    def __init__(self, proxy_manager, max_sessions=0, queue_size=64, queue_timeout=30.0, max_connections=0):
+        """
+        Initialize the SessionTable and register it as a registry listener.
+        @param proxy_manager: The proxy manager instance.
+        @param max_sessions: Sessions per IDE key registered with multi-session support (0 for no limit).
+        @param queue_size: Engine connections waiting per IDE key, further ones are rejected.
+        @param queue_timeout: Seconds an engine connection waits in the queue before it is rejected.
+        @param max_connections: Engine connections open at a time, in any state (0 for no limit).
+        """
+        self._proxy_manager = proxy_manager
+        self._max_sessions = max_sessions
+        self._queue_size = queue_size
+        self._queue_timeout = queue_timeout
+        self._max_connections = max_connections
+
+        # admitted engine connections
+        self.connections = 0
+        self._rejecting = False
+
+        # idekey -> set of sessions
+        self._active = {}
+        # idekey -> deque of [session, timer]
+        self._queues = {}
+        # idekey -> limit learned from a refused connection
+        self._learned = {}
+
+        self.logger = logging.getLogger('dbgpproxy.sessions')
+        proxy_manager.add_registry_listener(self)
+
+    def limit(self, idekey):
+        """
+        @param idekey: The IDE key.
+        @return: The number of sessions the IDE key may have open (0 for no limit).
+        """
+        if idekey in self._learned:
+            return self._learned[idekey]
+
+        server = self._proxy_manager.get_server(idekey)
+        if server is not None and server[1] == '0':
+            return 1
+        return self._max_sessions
+
+    def active(self, idekey):
+        """
+        @param idekey: The IDE key.
+        @return: The number of open sessions of the IDE key.
+        """
+        return len(self._active.get(idekey, ()))
+
+    def queued(self, idekey):
+        """
+        @param idekey: The IDE key.
+        @return: The number of engine connections waiting for the IDE key.
+        """
+        return len(self._queues.get(idekey, ()))
+
+    def admit(self):
+        """
+        Count a new engine connection.
+        @return: True if the connection may proceed, False if it is to be closed. Call connection_closed() for
+                 admitted connections only.
+        """
+        if self._max_connections and self.connections >= self._max_connections:
+            self._proxy_manager.metrics.rejected += 1
+            if not self._rejecting:
+                self._rejecting = True
+                self.logger.warning('{} debugger connections open, rejecting new connections'.format(
+                    self.connections))
+            return False
+
+        self.connections += 1
+        return True
+
+    def connection_closed(self):
+        """
+        Uncount an admitted engine connection.
+        """
+        self.connections -= 1
+        if self._rejecting:
+            self._rejecting = False
+            self.logger.info('accepting debugger connections again')
+
+    def acquire(self, idekey, session):
+        """
+        Start a session or put it into the queue of the IDE key.
+        @param idekey: The IDE key.
+        @param session: The session.
+        @return: START if the session may connect to the IDE now, QUEUED if it has to wait for start_session() or
+                 REJECTED if the queue is full.
+        """
+        if not self.queued(idekey) and self._has_slot(idekey):
+            self._active.setdefault(idekey, set()).add(session)
+            return START
+
+        if self.queued(idekey) >= self._queue_size:
+            self._proxy_manager.metrics.rejected += 1
+            self.logger.warning('session queue of IDE key [{}] is full, rejecting engine connection'.format(idekey))
+            return REJECTED
+
+        self._enqueue(idekey, session)
+        self.logger.info('IDE key [{}] has {} open sessions, engine connection queued ({} waiting)'.format(
+            idekey, self.active(idekey), self.queued(idekey)))
+        return QUEUED
+
+    def release(self, idekey, session):
+        """
+        Remove a session that ended or an engine connection that gave up waiting, and start waiting sessions.
+        @param idekey: The IDE key.
+        @param session: The session.
+        """
+        active = self._active.get(idekey)
+        if active is not None and session in active:
+            active.discard(session)
+            if not active:
+                del self._active[idekey]
+            self._start_waiting(idekey)
+            return
+
+        queue = self._queues.get(idekey)
+        if queue is not None:
+            for entry in queue:
+                if entry[0] is session:
+                    entry[1].cancel()
+                    queue.remove(entry)
+                    break
+            if not queue:
+                del self._queues[idekey]
+
+    def adopt(self, idekey, session):
+        """
+        Count an established session handed over by another process, regardless of the limits.
+        @param idekey: The IDE key.
+        @param session: The session. Call release() and connection_closed() once it ends.
+        """
+        self.connections += 1
+        self._active.setdefault(idekey, set()).add(session)
+
+    def sessions(self):
+        """
+        @return: List of the sessions that have a slot, of all IDE keys.
+        """
+        return [session for active in self._active.values() for session in active]
+
+    def queues(self):
+        """
+        @return: Dict of IDE key to the number of engine connections waiting for it.
+        """
+        return {idekey: len(queue) for idekey, queue in self._queues.items()}
+
+    def refused(self, idekey, session):
+        """
+        Handle a session whose connection to the IDE failed.
+        @param idekey: The IDE key.
+        @param session: The session.
+        @return: True if the IDE has other sessions open and the session has been queued again, False if the session
+                 has been removed and the IDE is to be considered unreachable.
+        """
+        active = self._active.get(idekey)
+        if active is None or session not in active:
+            return False
+
+        active.discard(session)
+        if not active:
+            del self._active[idekey]
+            return False
+
+        self._learned[idekey] = len(active)
+        self.logger.warning('IDE with IDE key [{}] refused a parallel session, limiting it to {}'.format(
+            idekey, len(active)))
+        self._enqueue(idekey, session, front=True)
+        return True
+
+    def server_added(self, idekey, host, port, multi):
+        """
+        Forget the limit learned for a previous registration.
+        """
+        self._learned.pop(idekey, None)
+
+    def server_removed(self, idekey):
+        """
+        Reject the engine connections waiting for a removed IDE key.
+        """
+        self._learned.pop(idekey, None)
+        for session, timer in self._queues.pop(idekey, ()):
+            timer.cancel()
+            session.reject_session('IDE key removed')
+
+    def _has_slot(self, idekey):
+        """
+        @return: True if the IDE key may open another session.
+        """
+        limit = self.limit(idekey)
+        return not limit or self.active(idekey) < limit
+
+    def _enqueue(self, idekey, session, front=False):
+        """
+        Add a session to the queue of the IDE key and start its queue timeout.
+        """
+        entry = [session, None]
+        entry[1] = self._proxy_manager.call_later(self._queue_timeout, self._expire, idekey, entry)
+        queue = self._queues.setdefault(idekey, deque())
+        if front:
+            queue.appendleft(entry)
+        else:
+            queue.append(entry)
+
+    def _expire(self, idekey, entry):
+        """
+        Reject a session that waited too long.
+        """
+        queue = self._queues.get(idekey)
+        if queue is None or entry not in queue:
+            return
+
+        queue.remove(entry)
+        if not queue:
+            del self._queues[idekey]
+        self._proxy_manager.metrics.rejected += 1
+        entry[0].reject_session('timed out waiting for a free session slot')
+
+    def _start_waiting(self, idekey):
+        """
+        Start waiting sessions while the IDE key has free slots.
+        """
+        # start_session() may remove the IDE key, which rejects the queue, or end sessions, so look it up every time
+        while self._has_slot(idekey):
+            queue = self._queues.get(idekey)
+            if not queue:
+                break
+            session, timer = queue.popleft()
+            timer.cancel()
+            if not queue:
+                self._queues.pop(idekey, None)
+            if session.closed:
+                continue
+            self._active.setdefault(idekey, set()).add(session)
+            session.start_session()
+
+        queue = self._queues.get(idekey)
+        if queue is not None and not queue:
+            self._queues.pop(idekey, None)
@@ -0,0 +1,85 @@
+import heapq
+import itertools
+import time
+
+__author__ = 'gkralik'
+
+
+class Timer:
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, callback, args):
+        """
+        Initialize the Timer.
+        @param deadline: The monotonic time the callback is due.
+        @param callback: The callback.
+        @param args: Arguments to the callback.
+        """
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Cancel the timer. Cancelled timers are dropped lazily by the Scheduler.
+        """
+        self.cancelled = True
+        self.callback = self.args = None
+
+
+class Scheduler:
+    """
+    Heap of timers for event loops without built-in timer support (asyncore).
+    """
+
+    def __init__(self, clock=time.monotonic):
+        """
+        Initialize the Scheduler.
+        @param clock: Function returning the current time in seconds.
+        """
+        self._clock = clock
+        self._heap = []
+        self._counter = itertools.count()
+
+    def call_later(self, delay, callback, *args):
+        """
+        Schedule a callback.
+        @param delay: Delay in seconds.
+        @param callback: The callback.
+        @param args: Arguments to the callback.
+        @return: The Timer.
+        """
+        timer = Timer(self._clock() + delay, callback, args)
+        heapq.heappush(self._heap, (timer.deadline, next(self._counter), timer))
+        return timer
+
+    def timeout(self, default):
+        """
+        Get the time until the next timer is due.
+        @param default: Returned if no timer is scheduled.
+        @return: Seconds (>= 0).
+        """
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+
+        if not self._heap:
+            return default
+
+        return max(0.0, min(default, self._heap[0][0] - self._clock()))
+
+    def run(self, monitor=None):
+        """
+        Run all timers that are due.
+        @param monitor: LoopMonitor to time the callbacks with (optional, see dbgpproxy.monitor).
+        """
+        now = self._clock()
+        while self._heap and self._heap[0][0] <= now:
+            timer = heapq.heappop(self._heap)[2]
+            if not timer.cancelled:
+                callback, args = timer.callback, timer.args
+                timer.cancel()
+                if monitor is None:
+                    callback(*args)
+                else:
+                    monitor.call(callback, callback, *args)
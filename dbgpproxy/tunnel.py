@@ -0,0 +1,777 @@
+import errno
+import itertools
+import json
+import logging
+import socket
+import struct
+import zlib
+from dbgpproxy.address import address_family, create_socket, format_address, set_nodelay, socket_address
+from dbgpproxy.buffers import SendBuffer
+
+__author__ = 'gkralik'
+
+# frame header: frame type, stream id, payload length
+HEADER = struct.Struct('!BII')
+
+# frame types
+REGISTER = 1
+UNREGISTER = 2
+OPEN = 3
+DATA = 4
+CLOSE = 5
+
+COMPRESSION_LEVEL = 6
+RECV_SIZE = 65536
+
+# longest accepted frame payload, streams send at most RECV_SIZE bytes per frame
+MAX_FRAME_SIZE = RECV_SIZE
+
+# connections accepted per readiness event of a listening socket
+ACCEPT_BUDGET = 64
+
+# seconds between attempts to connect a lost link, doubled up to the maximum
+RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 30.0
+
+# TCP keepalive of links: idle seconds, seconds between probes, probes
+KEEPALIVE = (30, 10, 3)
+
+
+def parse_registration(payload):
+    """
+    Parse the payload of a REGISTER frame.
+    @param payload: The payload (bytes).
+    @return: Tuple of the IDE key and the -m flag (str or None), or None if the payload is invalid.
+    """
+    try:
+        idekey, multi = json.loads(payload.decode())
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(idekey, str) or not idekey or not (multi is None or isinstance(multi, str)):
+        return None
+    return idekey, multi
+
+
+class Channel:
+    """
+    A non-blocking socket with a SendBuffer, watched through the proxy manager's event loop.
+    """
+
+    def __init__(self, proxy_manager, sock):
+        """
+        Initialize the Channel.
+        @param proxy_manager: The proxy manager instance.
+        @param sock: The socket.
+        """
+        self._proxy_manager = proxy_manager
+        self.sock = sock
+        sock.setblocking(False)
+        self.send_buffer = SendBuffer(proxy_manager.buffer_size)
+        self.closed = False
+        self._reading = False
+        self._writing = False
+
+    def start_reading(self):
+        """
+        Call handle_read() whenever the socket is readable.
+        """
+        if not self._reading and not self.closed:
+            self._reading = True
+            self._proxy_manager.add_reader(self.sock, self.handle_read)
+
+    def stop_reading(self):
+        """
+        Stop watching the socket for readability.
+        """
+        if self._reading:
+            self._reading = False
+            self._proxy_manager.remove_reader(self.sock)
+
+    def handle_read(self):
+        """
+        Called when the socket is readable.
+        """
+        raise NotImplementedError
+
+    def write(self, data):
+        """
+        Queue data and send as much as possible right away.
+        @param data: The data.
+        """
+        if self.closed:
+            return
+
+        self.send_buffer.append(data)
+        if not self._writing:
+            self.flush()
+
+    def flush(self):
+        """
+        Send queued data until the buffer is empty or the socket would block, then watch for writability if needed.
+        """
+        buffer = self.send_buffer
+        while buffer:
+            chunks = buffer.peek()
+            try:
+                n = self.sock.sendmsg(chunks)
+            except BlockingIOError:
+                break
+            except OSError:
+                self.close()
+                return
+
+            buffer.consume(n)
+            if n < sum(map(len, chunks)):
+                break
+
+        if buffer and not self._writing:
+            self._writing = True
+            self._proxy_manager.add_writer(self.sock, self.flush)
+        elif not buffer and self._writing:
+            self._writing = False
+            self._proxy_manager.remove_writer(self.sock)
+        self.flushed()
+
+    def flushed(self):
+        """
+        Called after queued data has been sent.
+        """
+        pass
+
+    def close(self):
+        """
+        Stop watching and close the socket.
+        """
+        if self.closed:
+            return
+
+        self.stop_reading()
+        if self._writing:
+            self._writing = False
+            self._proxy_manager.remove_writer(self.sock)
+        self.closed = True
+        self.send_buffer.clear()
+        self.sock.close()
+
+
+class Stream(Channel):
+    """
+    One session carried over a link, connected to a local socket.
+
+    On the datacenter side, the local socket is the connection the DebugConnectionHandler made to the link's session
+    listener as if it were the IDE; the OPEN frame is only sent with the first data, so connections that close
+    without sending anything (like probes) never reach the other side. On the developer side, the local socket is
+    connected to this proxy's own debugger port, so the session is handled like any other debugger connection.
+    """
+
+    def __init__(self, link, stream_id, sock, opened=True):
+        """
+        Initialize the Stream and add it to the link.
+        @param link: The Link.
+        @param stream_id: The stream id.
+        @param sock: The local socket.
+        @param opened: False if the OPEN frame has still to be sent.
+        """
+        super().__init__(link._proxy_manager, sock)
+        self.link = link
+        self.stream_id = stream_id
+        self.opened = opened
+        self.connecting = False
+        link.streams[stream_id] = self
+
+    def connect(self, address):
+        """
+        Start connecting the local socket. Data written in the meantime is sent once the connection is up.
+        @param address: Tuple of host and port (see dbgpproxy.address).
+        """
+        error = self.sock.connect_ex(socket_address(*address))
+        if error == 0:
+            self.start_reading()
+        elif error == errno.EINPROGRESS:
+            self.connecting = True
+            self._writing = True
+            self._proxy_manager.add_writer(self.sock, self._handle_connect)
+        else:
+            self.link.logger.warning('unable to connect stream to {}: {}'.format(format_address(*address),
+                                                                                errno.errorcode.get(error)))
+            self.close()
+
+    def _handle_connect(self):
+        """
+        Finish connecting the local socket.
+        """
+        self.connecting = False
+        self._writing = False
+        self._proxy_manager.remove_writer(self.sock)
+        if self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+            self.close()
+            return
+
+        self.start_reading()
+        self.flush()
+
+    def start_reading(self):
+        """
+        Read from the local socket unless it is still connecting or the link is backed up.
+        """
+        if not self.connecting and not self.link.streams_paused:
+            super().start_reading()
+
+    def handle_read(self):
+        """
+        Forward data from the local socket to the link.
+        """
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+
+        if not data:
+            self.close()
+            return
+
+        if not self.opened:
+            self.opened = True
+            self.link.send_frame(OPEN, self.stream_id)
+        self.link.send_frame(DATA, self.stream_id, data)
+
+    def write(self, data):
+        """
+        Queue data from the link for the local socket; while it does not keep up, the link stops reading.
+        @param data: The data.
+        """
+        super().write(data)
+        if self.send_buffer.paused:
+            self.link.stream_blocked(self)
+
+    def flushed(self):
+        """
+        Let the link read again once the buffer has drained.
+        """
+        if not self.send_buffer.paused:
+            self.link.stream_unblocked(self)
+
+    def close(self, notify=True):
+        """
+        Close the local socket and remove the stream from the link.
+        @param notify: Send a CLOSE frame to the other side.
+        """
+        if self.closed:
+            return
+
+        super().close()
+        self.link.streams.pop(self.stream_id, None)
+        self.link.stream_unblocked(self)
+        if notify and self.opened and not self.link.closed:
+            self.link.send_frame(CLOSE, self.stream_id)
+
+
+class Link(Channel):
+    """
+    One end of a tunnel link between two proxies.
+
+    Frames (HEADER followed by the payload) are sent through one zlib stream per direction, flushed with
+    Z_SYNC_FLUSH after every frame, so the dictionary built from earlier traffic of all sessions compresses later
+    frames. While the link's send buffer is paused, no stream reads from its local socket; while a stream's send
+    buffer is paused, the link stops reading, which holds up the other streams as well.
+    """
+
+    def __init__(self, proxy_manager, sock):
+        """
+        Initialize the Link and start reading.
+        @param proxy_manager: The proxy manager instance.
+        @param sock: The connected socket.
+        """
+        super().__init__(proxy_manager, sock)
+        set_nodelay(sock)
+        if sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                for option, value in zip((socket.TCP_KEEPIDLE, socket.TCP_KEEPINTVL, socket.TCP_KEEPCNT), KEEPALIVE):
+                    sock.setsockopt(socket.IPPROTO_TCP, option, value)
+
+        self.peer = sock.getpeername()
+        self.streams = {}
+        self.streams_paused = False
+        self._blocked = set()
+        self._compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        self._decompressor = zlib.decompressobj()
+        self._frames = bytearray()
+
+        # frame bytes before compression and bytes on the wire
+        self.bytes_framed = 0
+        self.bytes_sent = 0
+
+        self.logger = logging.getLogger('dbgpproxy.tunnel')
+        self.start_reading()
+
+    def send_frame(self, frame_type, stream_id, payload=b''):
+        """
+        Compress and send a frame.
+        @param frame_type: The frame type.
+        @param stream_id: The stream id (0 for frames not belonging to a stream).
+        @param payload: The payload (bytes).
+        """
+        if self.closed:
+            return
+
+        compressor = self._compressor
+        data = compressor.compress(HEADER.pack(frame_type, stream_id, len(payload)))
+        if payload:
+            data += compressor.compress(payload)
+        data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.bytes_framed += HEADER.size + len(payload)
+        self.bytes_sent += len(data)
+
+        self.write(data)
+        if self.send_buffer.paused and not self.streams_paused:
+            self.streams_paused = True
+            for stream in list(self.streams.values()):
+                stream.stop_reading()
+
+    def flushed(self):
+        """
+        Let the streams read again once the buffer has drained.
+        """
+        if self.streams_paused and not self.send_buffer.paused:
+            self.streams_paused = False
+            for stream in list(self.streams.values()):
+                stream.start_reading()
+
+    def stream_blocked(self, stream):
+        """
+        Stop reading from the link while a stream does not keep up.
+        @param stream: The Stream.
+        """
+        self._blocked.add(stream)
+        self.stop_reading()
+
+    def stream_unblocked(self, stream):
+        """
+        Read from the link again once no stream is blocked.
+        @param stream: The Stream.
+        """
+        if stream in self._blocked:
+            self._blocked.discard(stream)
+            if not self._blocked:
+                self.start_reading()
+
+    def handle_read(self):
+        """
+        Decompress received data and handle the complete frames.
+        """
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+
+        if not data:
+            self.close()
+            return
+
+        while data:
+            # decompressed in steps of RECV_SIZE, so little more than one frame is buffered at a time
+            try:
+                self._frames += self._decompressor.decompress(data, RECV_SIZE)
+            except zlib.error as e:
+                self.logger.error('invalid data from {}: {}'.format(self.peer, e))
+                self.close()
+                return
+            data = self._decompressor.unconsumed_tail
+
+            if not self._handle_frames():
+                return
+
+    def _handle_frames(self):
+        """
+        Handle the complete frames that have been decompressed.
+        @return: False if the link has been closed.
+        """
+        frames = self._frames
+        offset = 0
+        while len(frames) - offset >= HEADER.size:
+            frame_type, stream_id, length = HEADER.unpack_from(frames, offset)
+            if length > MAX_FRAME_SIZE:
+                self.logger.error('frame of {} bytes from {} exceeds {} bytes'.format(
+                    length, self.peer, MAX_FRAME_SIZE))
+                self.close()
+                return False
+            end = offset + HEADER.size + length
+            if len(frames) < end:
+                break
+            payload = bytes(frames[offset + HEADER.size:end])
+            offset = end
+
+            self.handle_frame(frame_type, stream_id, payload)
+            if self.closed:
+                return False
+        del frames[:offset]
+        return True
+
+    def handle_frame(self, frame_type, stream_id, payload):
+        """
+        Handle a frame. DATA and CLOSE frames are passed to their stream, others to handle_control().
+        @param frame_type: The frame type.
+        @param stream_id: The stream id.
+        @param payload: The payload (bytes).
+        """
+        if frame_type == DATA:
+            stream = self.streams.get(stream_id)
+            if stream is not None:
+                stream.write(payload)
+        elif frame_type == CLOSE:
+            stream = self.streams.get(stream_id)
+            if stream is not None:
+                stream.close(notify=False)
+        else:
+            self.handle_control(frame_type, stream_id, payload)
+
+    def handle_control(self, frame_type, stream_id, payload):
+        """
+        Handle a REGISTER, UNREGISTER or OPEN frame.
+        """
+        self.logger.warning('unexpected frame type {} from {}'.format(frame_type, self.peer))
+
+    def close(self):
+        """
+        Close the link and all of its streams.
+        """
+        if self.closed:
+            return
+
+        super().close()
+        for stream in list(self.streams.values()):
+            stream.close(notify=False)
+        self.logger.info('tunnel link to {} closed, {} bytes sent for {} bytes of frames'.format(
+            self.peer, self.bytes_sent, self.bytes_framed))
+
+
+class HubLink(Link):
+    """
+    Datacenter side of a link: registers the developer side's IDE keys with this proxy and carries their sessions.
+
+    The IDE keys are registered with the address of a loopback listener of the link, so the debugger engine handlers
+    connect to it like to any IDE; every accepted connection becomes a stream.
+    """
+
+    def __init__(self, server, sock):
+        """
+        Initialize the HubLink and start its session listener.
+        @param server: The TunnelServer.
+        @param sock: The accepted socket.
+        """
+        super().__init__(server._proxy_manager, sock)
+        self._server = server
+        self.idekeys = set()
+        self._stream_ids = itertools.count(1)
+
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.bind(('127.0.0.1', 0))
+        self._listener.listen(self._proxy_manager.backlog)
+        self._listener.setblocking(False)
+        self.address = list(self._listener.getsockname())
+        self._proxy_manager.add_reader(self._listener, self._accept)
+
+        self.logger.info('tunnel link from {} connected'.format(self.peer))
+
+    def _accept(self):
+        """
+        Turn connections to the session listener into streams.
+        """
+        for i in range(ACCEPT_BUDGET):
+            try:
+                sock, addr = self._listener.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                self.logger.error('unable to accept session connection: {}'.format(e))
+                return
+            stream = Stream(self, next(self._stream_ids), sock, opened=False)
+            stream.start_reading()
+
+    def handle_control(self, frame_type, stream_id, payload):
+        """
+        Register and unregister IDE keys of the developer side.
+        """
+        if frame_type == REGISTER:
+            # only the IDE key and -m flag are taken from the peer, the address is this link's session listener
+            registration = parse_registration(payload)
+            if registration is None:
+                self.logger.error('invalid REGISTER frame from {}, closing link'.format(self.peer))
+                self.close()
+                return
+            self._server.register(self, *registration)
+        elif frame_type == UNREGISTER:
+            try:
+                idekey = payload.decode()
+            except UnicodeDecodeError:
+                self.logger.error('invalid UNREGISTER frame from {}, closing link'.format(self.peer))
+                self.close()
+                return
+            self._server.withdraw(self, idekey)
+            self._server.unregister(self, idekey)
+        else:
+            super().handle_control(frame_type, stream_id, payload)
+
+    def close(self):
+        """
+        Close the link, its session listener and remove its IDE keys.
+        """
+        if self.closed:
+            return
+
+        self._proxy_manager.remove_reader(self._listener)
+        self._listener.close()
+        super().close()
+        self._server.links.discard(self)
+        for idekey in list(self.idekeys):
+            self._server.unregister(self, idekey)
+        self._server.withdraw(self)
+
+
+class TunnelServer:
+    """
+    Accepts links from developer-side proxies (started with --tunnel).
+    """
+
+    def __init__(self, proxy_manager, host, port):
+        """
+        Initialize the TunnelServer and start listening.
+        @param proxy_manager: The proxy manager instance.
+        @param host: The host to listen on.
+        @param port: The port to listen on.
+        """
+        self._proxy_manager = proxy_manager
+        self.links = set()
+        # idekey -> HubLink
+        self._owners = {}
+        # idekey -> HubLink registering it once its owner is gone
+        self._claims = {}
+        self.logger = logging.getLogger('dbgpproxy.tunnel')
+
+        self._sock = proxy_manager.create_listener('tunnel', host, port)
+        proxy_manager.add_reader(self._sock, self._accept)
+
+        self.logger.info('listening for tunnel links on {}:{}'.format(host, port))
+
+    def _accept(self):
+        """
+        Accept pending links.
+        """
+        for i in range(ACCEPT_BUDGET):
+            try:
+                sock, addr = self._sock.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                self.logger.error('unable to accept tunnel link: {}'.format(e))
+                return
+            self.links.add(HubLink(self, sock))
+
+    def register(self, link, idekey, multi):
+        """
+        Register an IDE key of a link. An IDE key registered by another link stays with it; the link registers it once
+        the other link has unregistered it or is closed (e.g. a stale connection of the same developer side, closed
+        by TCP keepalive).
+        @param link: The HubLink.
+        @param idekey: The IDE key.
+        @param multi: The -m flag of the registration.
+        """
+        owner = self._owners.get(idekey)
+        if owner is not None and owner is not link:
+            self.logger.warning('IDE key [{}] from tunnel link {} is registered by tunnel link {}, waiting for '
+                                'it'.format(idekey, link.peer, owner.peer))
+            self._claims[idekey] = (link, multi)
+            return
+
+        if not self._proxy_manager.add_server(idekey, link.address[0], link.address[1], multi):
+            self.logger.warning('IDE key [{}] from tunnel link {} is already registered'.format(idekey, link.peer))
+            return
+
+        link.idekeys.add(idekey)
+        self._owners[idekey] = link
+
+    def unregister(self, link, idekey):
+        """
+        Remove an IDE key registered by a link.
+        @param link: The HubLink.
+        @param idekey: The IDE key.
+        """
+        if self._owners.get(idekey) is not link:
+            return
+
+        del self._owners[idekey]
+        link.idekeys.discard(idekey)
+        self._proxy_manager.remove_server(idekey)
+
+        claim = self._claims.pop(idekey, None)
+        if claim is not None and not claim[0].closed:
+            self.register(claim[0], idekey, claim[1])
+
+    def withdraw(self, link, idekey=None):
+        """
+        Drop the IDE keys a link waits to register.
+        @param link: The HubLink.
+        @param idekey: Only drop this IDE key (all if None).
+        """
+        for key, claim in list(self._claims.items()):
+            if claim[0] is link and idekey in (None, key):
+                del self._claims[key]
+
+    def close(self):
+        """
+        Stop listening and close all links.
+        """
+        self._proxy_manager.remove_reader(self._sock)
+        self._sock.close()
+        for link in list(self.links):
+            link.close()
+        self.links.clear()
+
+
+class EdgeLink(Link):
+    """
+    Developer side of a link: connects the streams opened by the datacenter side to this proxy's debugger port.
+    """
+
+    def __init__(self, client, sock):
+        """
+        Initialize the EdgeLink.
+        @param client: The TunnelClient.
+        @param sock: The connected socket.
+        """
+        super().__init__(client._proxy_manager, sock)
+        self._client = client
+        self.logger.info('tunnel link to {} connected'.format(self.peer))
+
+    def handle_control(self, frame_type, stream_id, payload):
+        """
+        Connect a stream opened by the datacenter side.
+        """
+        if frame_type == OPEN:
+            sock = create_socket(self._proxy_manager.dbg_address[0])
+            Stream(self, stream_id, sock).connect(self._proxy_manager.dbg_address)
+        else:
+            super().handle_control(frame_type, stream_id, payload)
+
+    def close(self):
+        """
+        Close the link and let the client reconnect.
+        """
+        if self.closed:
+            return
+
+        super().close()
+        self._client.link_closed(self)
+
+
+class TunnelClient:
+    """
+    Keeps a link to a datacenter proxy (started with --tunnel-listen) and mirrors this proxy's registrations there.
+    """
+
+    def __init__(self, proxy_manager, host, port):
+        """
+        Initialize the TunnelClient, register it as a registry listener and start connecting.
+        @param proxy_manager: The proxy manager instance.
+        @param host: The host of the datacenter proxy's tunnel listener.
+        @param port: The port of the datacenter proxy's tunnel listener.
+        """
+        self._proxy_manager = proxy_manager
+        self._address = (host, port)
+        self._delay = RECONNECT_DELAY
+        self._sock = None
+        self._timer = None
+        self._closed = False
+        self.link = None
+        self.logger = logging.getLogger('dbgpproxy.tunnel')
+
+        proxy_manager.add_registry_listener(self)
+        self._connect()
+
+    def _connect(self):
+        """
+        Start connecting the link.
+        """
+        self._timer = None
+        self._sock = socket.socket(address_family(self._address[0]), socket.SOCK_STREAM)
+        self._sock.setblocking(False)
+        error = self._sock.connect_ex(socket_address(*self._address))
+        if error not in (0, errno.EINPROGRESS):
+            self._connect_failed(errno.errorcode.get(error))
+            return
+        self._proxy_manager.add_writer(self._sock, self._handle_connect)
+
+    def _handle_connect(self):
+        """
+        Finish connecting the link and register all known IDE keys.
+        """
+        self._proxy_manager.remove_writer(self._sock)
+        error = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self._connect_failed(errno.errorcode.get(error))
+            return
+
+        sock, self._sock = self._sock, None
+        self._delay = RECONNECT_DELAY
+        self.link = EdgeLink(self, sock)
+        for idekey, ((host, port), multi) in self._proxy_manager.list_servers():
+            self.server_added(idekey, host, port, multi)
+
+    def _connect_failed(self, reason):
+        """
+        Retry connecting later.
+        """
+        self._sock.close()
+        self._sock = None
+        self.logger.warning('unable to connect tunnel link to {}:{} ({}), retrying in {:g}s'.format(
+            self._address[0], self._address[1], reason, self._delay))
+        self._schedule_connect()
+
+    def _schedule_connect(self):
+        """
+        Connect again after the current delay and double the delay.
+        """
+        if not self._closed:
+            self._timer = self._proxy_manager.call_later(self._delay, self._connect)
+            self._delay = min(self._delay * 2, MAX_RECONNECT_DELAY)
+
+    def link_closed(self, link):
+        """
+        Called by the EdgeLink when the link has been lost.
+        @param link: The EdgeLink.
+        """
+        if link is self.link:
+            self.link = None
+            self._schedule_connect()
+
+    def server_added(self, idekey, host, port, multi):
+        """
+        Register an IDE key with the datacenter proxy.
+        """
+        if self.link is not None:
+            self.link.send_frame(REGISTER, 0, json.dumps([idekey, multi]).encode())
+
+    def server_removed(self, idekey):
+        """
+        Remove an IDE key from the datacenter proxy.
+        """
+        if self.link is not None:
+            self.link.send_frame(UNREGISTER, 0, idekey.encode())
+
+    def close(self):
+        """
+        Close the link and stop reconnecting.
+        """
+        self._closed = True
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._sock is not None:
+            self._proxy_manager.remove_writer(self._sock)
+            self._sock.close()
+        if self.link is not None:
+            self.link.close()
@@ -0,0 +1,377 @@
+import json
+import logging
+import os
+import select
+import signal
+import socket
+from collections import deque
+
+__author__ = 'gkralik'
+
+# maximum size of one registry update datagram
+MAX_MESSAGE_SIZE = 65536
+
+# servers per snapshot datagram sent to a new worker
+SNAPSHOT_CHUNK = 200
+
+# registry updates queued for a worker that does not read them, once they are exceeded the worker is restarted
+MAX_PENDING = 10000
+
+# signals passed on to the workers (state dump and sampling profiler, see dbgpproxy.monitor)
+FORWARDED_SIGNALS = (signal.SIGUSR1, signal.SIGUSR2)
+
+
+class RegistryReplica:
+    """
+    Keeps the list of known servers of a worker in sync with all other workers.
+
+    Local changes are sent to the WorkerPool in the parent process, which passes them on to the other workers. Changes
+    made by other workers are applied without notifying the registry listeners again. Changes the socket cannot take
+    right away are queued and sent once it is writable.
+    """
+
+    def __init__(self, proxy_manager, sock):
+        """
+        Initialize the RegistryReplica and attach it to the proxy manager.
+        @param proxy_manager: The proxy manager instance of the worker.
+        @param sock: The worker's end of the datagram socket pair to the parent.
+        """
+        self._proxy_manager = proxy_manager
+        self._sock = sock
+        self._sock.setblocking(False)
+        # updates not sent to the parent yet
+        self._pending = deque()
+        self.logger = logging.getLogger('dbgpproxy.workers')
+
+        proxy_manager.add_registry_listener(self)
+        proxy_manager.add_reader(sock, self.handle_read)
+
+    def server_added(self, idekey, host, port, multi):
+        """
+        Publish a registration made by this worker.
+        """
+        self._publish({'op': 'add', 'idekey': idekey, 'host': host, 'port': port, 'multi': multi})
+
+    def server_removed(self, idekey):
+        """
+        Publish a removal made by this worker.
+        """
+        self._publish({'op': 'remove', 'idekey': idekey})
+
+    def _publish(self, message):
+        """
+        Send an update to the parent.
+        @param message: The update (dict).
+        """
+        data = json.dumps(message).encode()
+        if not self._pending:
+            try:
+                self._sock.send(data)
+                return
+            except BlockingIOError:
+                self._proxy_manager.add_writer(self._sock, self._flush)
+            except OSError as e:
+                self.logger.error('unable to publish registry update: {}'.format(e))
+                return
+        self._pending.append(data)
+
+    def _flush(self):
+        """
+        Send the queued updates to the parent.
+        """
+        pending = self._pending
+        while pending:
+            try:
+                self._sock.send(pending[0])
+            except BlockingIOError:
+                return
+            except OSError as e:
+                self.logger.error('unable to publish registry update: {}'.format(e))
+                pending.clear()
+                break
+            pending.popleft()
+        self._proxy_manager.remove_writer(self._sock)
+
+    def handle_read(self):
+        """
+        Apply updates made by other workers.
+        """
+        while True:
+            try:
+                data = self._sock.recv(MAX_MESSAGE_SIZE)
+            except BlockingIOError:
+                return
+
+            if not data:
+                return
+
+            apply_update(self._proxy_manager, json.loads(data.decode()))
+
+
+def apply_update(proxy_manager, message):
+    """
+    Apply a registry update to a proxy manager without notifying its registry listeners.
+    @param proxy_manager: The proxy manager instance.
+    @param message: The update (dict).
+    """
+    if message['op'] == 'add':
+        proxy_manager.restore_server(message['idekey'], message['host'], message['port'], message['multi'])
+    elif message['op'] == 'remove':
+        proxy_manager.discard_server(message['idekey'])
+    elif message['op'] == 'snapshot':
+        for idekey, (host, port, multi) in message['servers'].items():
+            proxy_manager.restore_server(idekey, host, port, multi)
+
+
+class WorkerPool:
+    """
+    Runs the proxy in several forked worker processes.
+
+    Every worker binds its own listening sockets with SO_REUSEPORT, so the kernel spreads incoming connections over
+    them. The parent keeps the authoritative list of known servers, passes every registry update on to all other
+    workers and restarts workers that die. Its sockets are non-blocking: updates a worker cannot take yet are queued
+    and sent once it has read the previous ones, so a slow worker does not hold up the others.
+    """
+
+    def __init__(self, workers, proxy_factory, registry_log=None):
+        """
+        Initialize the WorkerPool.
+        @param workers: Number of worker processes.
+        @param proxy_factory: Called in every worker to create its proxy manager (with reuse_port=True).
+        @param registry_log: RegistryLog the parent keeps the list of known servers in (optional).
+        """
+        self._workers = workers
+        self._proxy_factory = proxy_factory
+        # pid -> parent's end of the socket pair
+        self._children = {}
+        # parent's end of the socket pair -> deque of updates not sent yet
+        self._pending = {}
+        # idekey -> [host, port, multi]
+        self._servers = {}
+        self._running = False
+        self._registry_log = registry_log
+
+        self.logger = logging.getLogger('dbgpproxy.workers')
+
+    def start(self):
+        """
+        Start the workers and relay registry updates until SIGTERM or SIGINT.
+        """
+        self._running = True
+        if self._registry_log is not None:
+            self._servers = self._registry_log.load()
+
+        for i in range(self._workers):
+            self._spawn()
+
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        for signum in FORWARDED_SIGNALS:
+            signal.signal(signum, self._forward_signal)
+
+        try:
+            while self._running:
+                self._reap()
+                waiting = [sock for sock, pending in self._pending.items() if pending]
+                try:
+                    readable, writable, _ = select.select(list(self._children.values()), waiting, [], 1.0)
+                except InterruptedError:
+                    continue
+
+                for sock in writable:
+                    self._flush(sock)
+                for sock in readable:
+                    self._relay(sock)
+        finally:
+            self.stop()
+
+    def stop(self):
+        """
+        Terminate all workers.
+        """
+        self._running = False
+        for pid, sock in list(self._children.items()):
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            sock.close()
+        self._children.clear()
+        self._pending.clear()
+
+        if self._registry_log is not None:
+            self._registry_log.close()
+            self._registry_log = None
+
+    def _handle_signal(self, signum, frame):
+        """
+        Stop the pool.
+        """
+        self._running = False
+
+    def _forward_signal(self, signum, frame):
+        """
+        Pass a signal on to all workers.
+        """
+        for pid in self._children:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def _spawn(self):
+        """
+        Fork a worker and send it the current list of known servers.
+        """
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+        pid = os.fork()
+        if pid == 0:
+            parent_sock.close()
+            for sock in self._children.values():
+                sock.close()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            # until the proxy manager handles them
+            for signum in FORWARDED_SIGNALS:
+                signal.signal(signum, signal.SIG_IGN)
+            self._run_worker(child_sock)
+            os._exit(0)
+
+        child_sock.close()
+        parent_sock.setblocking(False)
+        self._children[pid] = parent_sock
+        self._pending[parent_sock] = deque()
+        self.logger.info('started worker {}'.format(pid))
+
+        items = list(self._servers.items())
+        for i in range(0, len(items), SNAPSHOT_CHUNK):
+            message = {'op': 'snapshot', 'servers': dict(items[i:i + SNAPSHOT_CHUNK])}
+            self._send(parent_sock, json.dumps(message).encode())
+
+    def _run_worker(self, sock):
+        """
+        Run a worker process.
+        @param sock: The worker's end of the socket pair.
+        """
+        try:
+            proxy = self._proxy_factory()
+            RegistryReplica(proxy, sock)
+            proxy.start()
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            self.logger.critical('worker {} failed: {}'.format(os.getpid(), e))
+            os._exit(2)
+
+    def _reap(self):
+        """
+        Restart workers that have been killed. If a worker exited on its own, the whole pool is stopped.
+        """
+        for pid in list(self._children):
+            try:
+                done, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done, status = pid, 0
+
+            if not done:
+                continue
+
+            sock = self._children.pop(pid)
+            self._pending.pop(sock, None)
+            sock.close()
+            if not self._running:
+                continue
+
+            if os.WIFSIGNALED(status):
+                self.logger.warning('worker {} killed by signal {}, restarting'.format(pid, os.WTERMSIG(status)))
+                self._spawn()
+            else:
+                self.logger.critical('worker {} exited with status {}, stopping'.format(pid, os.WEXITSTATUS(status)))
+                self._running = False
+
+    def _relay(self, sock):
+        """
+        Apply an update from a worker and pass it on to all other workers.
+        @param sock: The parent's end of the socket pair of the worker.
+        """
+        try:
+            data = sock.recv(MAX_MESSAGE_SIZE)
+        except OSError:
+            return
+
+        if not data:
+            return
+
+        try:
+            message = json.loads(data.decode())
+            op = message['op']
+            if op not in ('add', 'remove') or not isinstance(message['idekey'], str):
+                raise ValueError('unknown op {!r}'.format(op))
+        except (ValueError, KeyError, TypeError) as e:
+            self.logger.error('invalid registry update from a worker: {}'.format(e))
+            return
+
+        if op == 'add':
+            self._servers[message['idekey']] = [message['host'], message['port'], message['multi']]
+            if self._registry_log is not None:
+                self._registry_log.server_added(message['idekey'], message['host'], message['port'],
+                                                message['multi'])
+        elif op == 'remove':
+            # with expiry, every worker removes the IDE key on its own
+            if self._servers.pop(message['idekey'], None) is not None and self._registry_log is not None:
+                self._registry_log.server_removed(message['idekey'])
+
+        for other in self._children.values():
+            if other is not sock:
+                self._send(other, data)
+
+    def _send(self, sock, data):
+        """
+        Send an update to a worker, or queue it while the worker has not read the previous ones. A worker that leaves
+        MAX_PENDING updates unread is killed, it is restarted with the current registrations by _reap().
+        @param sock: The parent's end of the socket pair of the worker.
+        @param data: The update (bytes).
+        """
+        pending = self._pending[sock]
+        if pending is None:
+            # being restarted
+            return
+        if not pending:
+            try:
+                sock.send(data)
+                return
+            except BlockingIOError:
+                pass
+            except OSError as e:
+                self.logger.error('unable to pass on registry update: {}'.format(e))
+                return
+
+        if len(pending) >= MAX_PENDING:
+            pid = next(pid for pid, child in self._children.items() if child is sock)
+            self.logger.error('worker {} does not read registry updates, restarting it'.format(pid))
+            self._pending[sock] = None
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+            return
+        pending.append(data)
+
+    def _flush(self, sock):
+        """
+        Send the updates queued for a worker.
+        @param sock: The parent's end of the socket pair of the worker.
+        """
+        pending = self._pending.get(sock)
+        while pending:
+            try:
+                sock.send(pending[0])
+            except BlockingIOError:
+                return
+            except OSError as e:
+                self.logger.error('unable to pass on registry update: {}'.format(e))
+                pending.clear()
+                return
+            pending.popleft()
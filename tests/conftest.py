@@ -0,0 +1,89 @@
+import logging
+import select
+
+import pytest
+
+from dbgpproxy.metrics import Metrics
+from dbgpproxy.proxy import Proxy
+from dbgpproxy.sessions import SessionTable
+from dbgpproxy.timers import Scheduler
+
+__author__ = 'gkralik'
+
+
+class FakeProxy(Proxy):
+    """
+    Proxy manager without an engine. Registrations work like in Proxy, timers run when the clock is advanced.
+    """
+
+    def __init__(self, registration_ttl=None):
+        self.logger = logging.getLogger('dbgpproxy')
+        self._servers = {}
+        self._registry_listeners = []
+        self._health = None
+        self.registration_ttl = registration_ttl
+        self.cluster = None
+        self.relay_scheduler = None
+        self.metrics = Metrics()
+        self.now = 0.0
+        self._scheduler = Scheduler(clock=lambda: self.now)
+        self.sessions = SessionTable(self)
+
+    def call_later(self, delay, callback, *args):
+        return self._scheduler.call_later(delay, callback, *args)
+
+    def call_soon(self, callback, *args):
+        self._scheduler.call_later(0, callback, *args)
+
+    def advance(self, seconds):
+        """
+        Move the clock forward and run the timers that are due.
+        @param seconds: Seconds.
+        """
+        self.now += seconds
+        self._scheduler.run()
+
+
+class LoopProxy(FakeProxy):
+    """
+    FakeProxy with readers and writers, run by poll().
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.listen_sockets = {}
+        self.listeners = {}
+        self.reuse_port = False
+        self.backlog = 16
+        self.buffer_size = 65536
+        self._readers = {}
+        self._writers = {}
+
+    def add_reader(self, sock, callback):
+        self._readers[sock] = callback
+
+    def remove_reader(self, sock):
+        self._readers.pop(sock, None)
+
+    def add_writer(self, sock, callback):
+        self._writers[sock] = callback
+
+    def remove_writer(self, sock):
+        self._writers.pop(sock, None)
+
+    def poll(self, timeout=0.5):
+        """
+        Run the callbacks of the ready sockets once.
+        """
+        readable, writable, _ = select.select(list(self._readers), list(self._writers), [], timeout)
+        for sock in readable:
+            if sock in self._readers:
+                self._readers[sock]()
+        for sock in writable:
+            if sock in self._writers:
+                self._writers[sock]()
+
+
+@pytest.fixture
+def proxy():
+    return FakeProxy()
@@ -0,0 +1,189 @@
+import asyncio
+import socket
+import threading
+
+import pytest
+
+from dbgpproxy import aio
+from dbgpproxy.aio import MonitoredEventLoop, RelayProtocol
+from dbgpproxy.fairness import RelayScheduler
+from dbgpproxy.monitor import LoopMonitor
+from dbgpproxy.protocol import frame_message
+from dbgpproxy.proxy import Proxy
+
+__author__ = 'gkralik'
+
+
+class FakeTransport:
+    def __init__(self):
+        self.reading = True
+        self.closing = False
+
+    def pause_reading(self):
+        assert not self.closing
+        self.reading = False
+
+    def resume_reading(self):
+        assert not self.closing
+        self.reading = True
+
+    def is_closing(self):
+        return self.closing
+
+
+class FakeSession(RelayProtocol):
+    def __init__(self, proxy):
+        self._proxy_manager = proxy
+        self.transport = FakeTransport()
+
+
+def test_reading_resumes_once_all_reasons_are_released(proxy):
+    session = FakeSession(proxy)
+    session.hold_reading('connect')
+    session.hold_reading('ide')
+    session.release_reading('connect')
+    assert not session.transport.reading
+    # releasing a reason that is not held does not resume reading
+    session.release_reading('budget')
+    assert not session.transport.reading
+    session.release_reading('ide')
+    assert session.transport.reading
+
+
+def test_budget_resume_waits_for_connect(proxy):
+    proxy.relay_scheduler = RelayScheduler(proxy, budget=10)
+    session = FakeSession(proxy)
+    session.hold_reading('connect')
+    session.relayed(session, b'x' * 10)
+
+    proxy.advance(0)
+    assert not session.transport.reading
+    session.release_reading('connect')
+    assert session.transport.reading
+
+
+def test_budget_resume_after_close(proxy):
+    proxy.relay_scheduler = RelayScheduler(proxy, budget=10)
+    session = FakeSession(proxy)
+    session.relayed(session, b'x' * 10)
+    assert not session.transport.reading
+
+    session.transport.closing = True
+    proxy.relay_scheduler.discard(session)
+    proxy.advance(0)
+    assert not session.transport.reading
+
+
+def test_monitored_loop_patches_handles_only_while_running():
+    original = asyncio.Handle._run
+    monitor = LoopMonitor(slow_callback=1.0)
+    loop = MonitoredEventLoop(monitor)
+    patched = []
+
+    def callback():
+        patched.append(asyncio.Handle._run is not original)
+        loop.stop()
+
+    try:
+        assert asyncio.Handle._run is original
+        loop.call_soon(callback)
+        loop.run_forever()
+    finally:
+        loop.close()
+
+    assert patched == [True]
+    assert asyncio.Handle._run is original
+    assert sum(stats[0] for stats in monitor.handlers.values()) >= 1
+
+
+def listening_socket():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(4)
+    return sock
+
+
+def read_until_nul(sock, count=1):
+    data = b''
+    while data.count(b'\0') < count:
+        chunk = sock.recv(65536)
+        assert chunk
+        data += chunk
+    return data
+
+
+@pytest.mark.parametrize('relay', ['copy', 'splice'])
+def test_asyncio_engine_relays_session(relay, monkeypatch):
+    spliced = []
+
+    class RecordingSpliceRelay(aio.SpliceRelay):
+        def __init__(self, debug_handler):
+            super().__init__(debug_handler)
+            spliced.append(self)
+
+    monkeypatch.setattr(aio, 'SpliceRelay', RecordingSpliceRelay)
+
+    ide_listener, dbg_listener, ide = listening_socket(), listening_socket(), listening_socket()
+    dbgport = dbg_listener.getsockname()[1]
+    proxy = Proxy('127.0.0.1', ide_listener.getsockname()[1], '127.0.0.1', dbgport, engine='asyncio', relay=relay,
+                  listen_sockets={'ide': ide_listener, 'dbg': dbg_listener})
+    thread = threading.Thread(target=proxy.start)
+    thread.start()
+    try:
+        with socket.create_connection(ide_listener.getsockname()) as registration:
+            registration.sendall('proxyinit -p {} -k key -m 0\0'.format(ide.getsockname()[1]).encode())
+            assert b'success="1"' in read_until_nul(registration)
+
+        engine = socket.create_connection(('127.0.0.1', dbgport), timeout=5)
+        engine.sendall(frame_message('<init xmlns="urn:debugger_protocol_v1" idekey="key" appid="1"/>'))
+        ide.settimeout(5)
+        ide_sock, _ = ide.accept()
+        assert b'idekey="key"' in read_until_nul(ide_sock, 2)
+
+        ide_sock.sendall(b'property_get -i 1 -n $x\0')
+        assert read_until_nul(engine) == b'property_get -i 1 -n $x\0'
+        payload = b'A' * 300000
+        engine.sendall(frame_message('<response transaction_id="1">{}</response>'.format(payload.decode())))
+        assert payload in read_until_nul(ide_sock, 2)
+
+        engine.close()
+        assert ide_sock.recv(1) == b''
+        ide_sock.close()
+    finally:
+        proxy._engine._loop.call_soon_threadsafe(proxy.stop)
+        thread.join(5)
+        proxy._engine._loop.close()
+        ide.close()
+
+    assert len(spliced) == (1 if relay == 'splice' else 0)
+    bytes_to_ide, bytes_to_engine, _, _ = proxy.metrics.totals()
+    assert bytes_to_ide > len(payload)
+    assert bytes_to_engine == len(b'property_get -i 1 -n $x\0')
+
+
+def test_asyncio_engine_handles_registrations():
+    ide_listener, dbg_listener = listening_socket(), listening_socket()
+    dbgport = dbg_listener.getsockname()[1]
+    proxy = Proxy('127.0.0.1', ide_listener.getsockname()[1], '127.0.0.1', dbgport, engine='asyncio',
+                  listen_sockets={'ide': ide_listener, 'dbg': dbg_listener})
+    thread = threading.Thread(target=proxy.start)
+    thread.start()
+    try:
+        with socket.create_connection(ide_listener.getsockname(), timeout=5) as registration:
+            registration.sendall(b'proxyinit -p 9000 -k a -m 1\0proxylist\0proxystop -k a\0proxylist\0')
+            # framed like engine messages, the payloads are every other part
+            responses = read_until_nul(registration, 8).split(b'\0')[1::2]
+        assert '<proxyinit success="1" idekey="a" address="127.0.0.1" port="{}"/>'.format(dbgport).encode() in \
+            responses[0]
+        assert b'<server idekey="a" address="127.0.0.1" port="9000" multi="1"/>' in responses[1]
+        assert responses[2].endswith(b'<proxystop success="1" idekey="a"/>')
+        assert b'<server ' not in responses[3]
+
+        # a debugger engine with an unknown IDE key is disconnected
+        with socket.create_connection(('127.0.0.1', dbgport), timeout=5) as engine:
+            engine.sendall(frame_message('<init xmlns="urn:debugger_protocol_v1" idekey="b" appid="1"/>'))
+            assert engine.recv(1) == b''
+    finally:
+        proxy._engine._loop.call_soon_threadsafe(proxy.stop)
+        thread.join(5)
+        proxy._engine._loop.close()
@@ -0,0 +1,71 @@
+from dbgpproxy import cache
+from dbgpproxy.cache import ResponseCache
+from dbgpproxy.protocol import frame_message, parse_init_packet
+
+__author__ = 'gkralik'
+
+INIT = (b'<init xmlns="urn:debugger_protocol_v1" appid="1" language="PHP" fileuri="file:///app/index.php" '
+        b'proxied="192.0.2.1"/>')
+
+
+def open_session(response_cache):
+    return response_cache.open_session(parse_init_packet(INIT))
+
+
+def source(transaction_id):
+    return 'source -i {} -f file:///app/index.php\0'.format(transaction_id).encode()
+
+
+def response(transaction_id, body='<![CDATA[Zm9v]]>'):
+    return frame_message('<response command="source" transaction_id="{}">{}</response>'.format(transaction_id, body))
+
+
+def test_response_served_from_cache(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    response_cache = ResponseCache(4096, ttl=60)
+
+    first = open_session(response_cache)
+    assert first.from_ide(source(1)) == (source(1), [])
+    now[0] += 0.25
+    first.from_engine(response(1))
+    assert len(response_cache) == 1 and response_cache.misses == 1
+
+    # another session of the same engine gets the response with its own transaction id
+    second = open_session(response_cache)
+    assert second.from_ide(source(7)) == (b'', [response(7)])
+    assert response_cache.hits == 1 and response_cache.saved == 0.25
+
+    # a different file and a session that changed a feature are not served
+    assert second.from_ide(b'source -i 8 -f file:///app/other.php\0')[1] == []
+    second.from_engine(response(8))
+    third = open_session(response_cache)
+    third.from_ide(b'feature_set -i 1 -n max_depth -v 5\0')
+    third.from_engine(frame_message('<response command="feature_set" transaction_id="1" success="1"/>'))
+    assert third.from_ide(source(2))[1] == []
+
+
+def test_cached_response_expires(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    response_cache = ResponseCache(4096, ttl=60)
+
+    session = open_session(response_cache)
+    session.from_ide(source(1))
+    session.from_engine(response(1))
+    now[0] += 59
+    assert session.from_ide(source(2))[1] == [response(2)]
+
+    now[0] += 2
+    assert session.from_ide(source(3)) == (source(3), [])
+    assert len(response_cache) == 0 and response_cache.size == 0
+
+
+def test_error_responses_and_oversized_entries_not_cached():
+    response_cache = ResponseCache(64)
+    session = open_session(response_cache)
+    session.from_ide(b'source -i 1 -f file:///app/a.php\0')
+    session.from_engine(response(1, '<error code="100"/>'))
+    session.from_ide(b'source -i 2 -f file:///app/b.php\0')
+    session.from_engine(response(2, 'x' * 100))
+    assert len(response_cache) == 0
@@ -0,0 +1,36 @@
+import logging
+import os
+
+from dbgpproxy.capture import TO_ENGINE, TO_IDE, Capture, read_capture
+
+__author__ = 'gkralik'
+
+
+def test_session_is_captured(tmp_path):
+    capture = Capture(str(tmp_path))
+    session = capture.open_session('k/1', '192.0.2.1')
+    session.record(TO_ENGINE, b'run -i 1\0')
+    session.record(TO_IDE, b'10\0<response/>\0')
+    session.close()
+    capture.close()
+
+    assert os.path.basename(session.path).startswith('k_1-192.0.2.1-')
+    assert [(direction, data) for _, direction, data in read_capture(session.path)] == [
+        (TO_ENGINE, b'run -i 1\0'), (TO_IDE, b'10\0<response/>\0')]
+
+
+def test_capture_stops_after_write_failure(tmp_path, caplog):
+    capture = Capture(str(tmp_path))
+    session = capture.open_session('k', '192.0.2.1')
+    # the capture file cannot be opened
+    os.mkdir(session.path)
+    with caplog.at_level(logging.ERROR, logger='dbgpproxy.capture'):
+        for i in range(3):
+            session.record(TO_IDE, b'x')
+        capture.close()
+
+    assert session.failed
+    assert len(caplog.records) == 1
+    queued = capture.queued
+    session.record(TO_IDE, b'x')
+    assert capture.queued == queued
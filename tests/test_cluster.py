@@ -0,0 +1,131 @@
+import logging
+import socket
+
+from conftest import LoopProxy
+from dbgpproxy.cluster import HEADER, MAX_MESSAGE_SIZE, ClusterNode, PeerLink
+
+__author__ = 'gkralik'
+
+
+class FakeLink:
+    """
+    PeerLink without a socket.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def make_node(proxy, route='direct'):
+    """
+    @return: A ClusterNode of proxy that neither listens nor connects to peers.
+    """
+    node = ClusterNode.__new__(ClusterNode)
+    node._proxy_manager = proxy
+    node.advertise = ('proxy1', 9000)
+    node.name = 'proxy1:9000'
+    node.route_mode = route
+    node._owners = {}
+    node.nodes = {}
+    node.links = set()
+    node._clients = []
+    node.logger = logging.getLogger('dbgpproxy.cluster')
+    proxy.cluster = node
+    proxy.add_registry_listener(node)
+    return node
+
+
+def test_route_direct_and_forwarded(proxy):
+    node = make_node(proxy)
+    link = FakeLink()
+    node.handle_message(link, {'op': 'hello', 'node': 'proxy2:9000', 'dbg': ['proxy2', 9000]})
+    node.handle_message(link, {'op': 'add', 'idekey': 'remote', 'host': '192.0.2.1', 'port': 9000, 'multi': None})
+    node.handle_message(link, {'op': 'add', 'idekey': 'sock', 'host': 'unix', 'port': '/tmp/ide.sock', 'multi': None})
+
+    assert proxy.get_server('remote') == [['192.0.2.1', 9000], None]
+    # a Unix domain socket of the owner's host is reached through the owner's debugger port
+    assert proxy.get_server('sock') == [['proxy2', 9000], None]
+
+
+def test_owner_host_address_not_connected_locally(proxy):
+    node = make_node(proxy)
+    link = FakeLink('proxy2:9000')
+    node.handle_message(link, {'op': 'add', 'idekey': 'sock', 'host': 'unix', 'port': '/run/docker.sock',
+                               'multi': None})
+    node.handle_message(link, {'op': 'add', 'idekey': 'lo', 'host': '127.0.0.1', 'port': 22, 'multi': None})
+
+    # the owner's debugger port is unknown, so neither can be forwarded
+    assert proxy.get_server('sock') is None
+    assert proxy.get_server('lo') is None
+
+
+def test_snapshot_replaces_registrations_of_node(proxy):
+    node = make_node(proxy)
+    link = FakeLink('proxy2:9000')
+    node.handle_message(link, {'op': 'add', 'idekey': 'old', 'host': '192.0.2.1', 'port': 9000, 'multi': None})
+    node.handle_message(link, {'op': 'snapshot', 'servers': {'new': ['192.0.2.2', 9000, '1']}})
+
+    assert proxy.get_server('old') is None
+    assert proxy.get_server('new') == [['192.0.2.2', 9000], '1']
+    assert node.owner('new') == 'proxy2:9000'
+    assert node.own_servers() == {}
+
+
+def test_remove_only_by_owner(proxy):
+    node = make_node(proxy)
+    owner, other = FakeLink('proxy2:9000'), FakeLink('proxy3:9000')
+    proxy.add_server('local', '192.0.2.1', 9000, None)
+    node.handle_message(owner, {'op': 'add', 'idekey': 'k', 'host': '192.0.2.2', 'port': 9000, 'multi': None})
+
+    node.handle_message(other, {'op': 'remove', 'idekey': 'local'})
+    node.handle_message(other, {'op': 'remove', 'idekey': 'k'})
+    assert proxy.get_server('local') is not None and proxy.get_server('k') is not None
+    assert not other.closed
+
+    node.handle_message(owner, {'op': 'remove', 'idekey': 'k'})
+    assert proxy.get_server('k') is None
+
+
+def test_message_before_hello_closes_link(proxy):
+    node = make_node(proxy)
+    link = FakeLink()
+    node.handle_message(link, {'op': 'add', 'idekey': 'k', 'host': '192.0.2.1', 'port': 9000, 'multi': None})
+    assert link.closed and proxy.get_server('k') is None
+
+
+def test_invalid_messages_close_link(proxy):
+    node = make_node(proxy)
+    messages = [
+        [],
+        {'op': 'hello', 'node': 'proxy2:9000'},
+        {'op': 'hello', 'node': 'proxy2:9000', 'dbg': 'proxy2'},
+        {'op': 'snapshot'},
+        {'op': 'snapshot', 'servers': {'k': ['192.0.2.1', 9000]}},
+        {'op': 'add', 'idekey': 'k', 'host': '192.0.2.1'},
+        {'op': 'add', 'idekey': 'k', 'host': '192.0.2.1', 'port': [9000], 'multi': None},
+        {'op': 'remove'},
+        {'op': 'drop'},
+    ]
+    for message in messages:
+        link = FakeLink('proxy2:9000')
+        node.handle_message(link, message)
+        assert link.closed, message
+    assert proxy.list_servers() == []
+
+
+def test_oversized_message_closes_link():
+    proxy = LoopProxy()
+    node = make_node(proxy)
+    a, b = socket.socketpair()
+    link = PeerLink(node, a)
+    node.links.add(link)
+
+    b.sendall(HEADER.pack(MAX_MESSAGE_SIZE + 1) + b'{')
+    proxy.poll()
+    assert link.closed and link not in node.links
+    assert proxy._readers == {}
+    b.close()
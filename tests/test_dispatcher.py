@@ -0,0 +1,60 @@
+import errno
+import logging
+import select
+import socket
+
+import pytest
+
+from conftest import LoopProxy
+from dbgpproxy.dispatcher import ACCEPT_RETRY_DELAY, DebugConnectionServer, ListeningDispatcher, accept_pending
+from dbgpproxy.sessions import SessionTable
+
+__author__ = 'gkralik'
+
+
+class ExhaustedListener(ListeningDispatcher):
+    """
+    Listener whose process is out of file descriptors.
+    """
+
+    def __init__(self, proxy):
+        self._proxy_manager = proxy
+        self.logger = logging.getLogger('dbgpproxy.dbg')
+        self.accepts = 0
+
+    def accept(self):
+        self.accepts += 1
+        raise OSError(errno.EMFILE, 'Too many open files')
+
+
+def test_accept_paused_when_out_of_descriptors(proxy):
+    listener = ExhaustedListener(proxy)
+    assert list(accept_pending(listener)) == []
+    assert listener.accepts == 1
+    assert not listener.readable()
+
+    proxy.advance(ACCEPT_RETRY_DELAY / 2)
+    assert not listener.readable()
+    proxy.advance(ACCEPT_RETRY_DELAY / 2)
+    assert listener.readable()
+
+
+@pytest.fixture
+def loop_proxy():
+    return LoopProxy()
+
+
+def test_connections_over_limit_rejected(loop_proxy):
+    loop_proxy.sessions = SessionTable(loop_proxy, max_connections=1)
+    loop_proxy.sessions.admit()
+    server = DebugConnectionServer('127.0.0.1', 0, loop_proxy)
+    try:
+        client = socket.create_connection(server.socket.getsockname(), timeout=5)
+        select.select([server.socket], [], [], 5)
+        server.handle_accept()
+        assert client.recv(1) == b''
+        assert loop_proxy.metrics.rejected == 1
+        assert loop_proxy.sessions.connections == 1
+        client.close()
+    finally:
+        server.close()
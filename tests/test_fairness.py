@@ -0,0 +1,54 @@
+from dbgpproxy.fairness import BULK_BYTES, RelayScheduler
+
+__author__ = 'gkralik'
+
+
+def test_budget_shared_by_both_directions_and_reset(proxy):
+    scheduler = RelayScheduler(proxy, budget=100)
+    session, other = object(), object()
+
+    assert scheduler.allowance(session, 4096) == 100
+    assert not scheduler.relayed(session, b'x' * 60)
+    assert scheduler.allowance(session, 4096) == 40
+    # the other direction of the session counts against the same budget
+    assert scheduler.relayed(session, b'y' * 40)
+    assert scheduler.allowance(session, 4096) == 0
+    assert scheduler.deferred == 1
+    # other sessions have their own budget
+    assert scheduler.allowance(other, 4096) == 100
+
+    resumed = []
+    scheduler.hold(lambda: resumed.append(session))
+    assert scheduler.deferred == 2
+    proxy.advance(0)
+    assert resumed == [session]
+    assert scheduler.allowance(session, 4096) == 100
+
+
+def test_priority_only_limits_bulk_transfers(proxy):
+    scheduler = RelayScheduler(proxy, budget=100, priority=True)
+    session = object()
+
+    # small frames are not held to the budget
+    assert not scheduler.relayed(session, b'x' * 200 + b'\0')
+    assert scheduler.allowance(session, 4096) == 4096
+
+    scheduler.relayed(session, b'x' * BULK_BYTES)
+    assert not scheduler.bulk(session)
+    assert scheduler.relayed(session, b'x')
+    assert scheduler.bulk(session)
+    assert scheduler.allowance(session, 4096) == 0
+
+    # the end of a frame ends the bulk transfer
+    proxy.advance(0)
+    assert not scheduler.relayed(session, b'x' * 200 + b'\0')
+    assert not scheduler.bulk(session)
+
+
+def test_discarded_session_forgotten(proxy):
+    scheduler = RelayScheduler(proxy, budget=100, priority=True)
+    session = object()
+    scheduler.relayed(session, b'x' * (BULK_BYTES + 1))
+    scheduler.discard(session)
+    assert not scheduler.bulk(session)
+    assert scheduler.allowance(session, 4096) == 4096
@@ -0,0 +1,72 @@
+import pytest
+
+from dbgpproxy.framing import CommandFramer, EngineFramer, FrameError
+
+__author__ = 'gkralik'
+
+
+def frame(payload):
+    return str(len(payload)).encode() + b'\0' + payload + b'\0'
+
+
+def test_engine_frames_fed_byte_by_byte():
+    framer = EngineFramer()
+    frames = []
+    for byte in frame(b'<init/>') + frame(b'') + frame(b'<response/>'):
+        framer.feed(bytes([byte]))
+        frames.extend(framer)
+    assert frames == [b'<init/>', b'', b'<response/>']
+    assert framer.buffered() == 0
+
+
+def test_engine_frame_remaining():
+    framer = EngineFramer()
+    framer.feed(frame(b'<init/>') + b'12\0<resp')
+    assert framer.next_frame() == b'<init/>'
+    assert framer.next_frame() is None
+    assert framer.remaining() == b'<resp'
+    assert framer.buffered() == 0
+
+
+@pytest.mark.parametrize('data', [b'12a\0', b'1' * 30, b'3\0abcX', b'-1\0'])
+def test_engine_invalid_framing(data):
+    framer = EngineFramer()
+    framer.feed(data)
+    with pytest.raises(FrameError):
+        framer.next_frame()
+
+
+def test_engine_frame_too_large():
+    framer = EngineFramer(max_size=100)
+    framer.feed(frame(b'x' * 100))
+    assert framer.next_frame() == b'x' * 100
+    # rejected as soon as the length prefix is known
+    framer.feed(b'101\0')
+    with pytest.raises(FrameError):
+        framer.next_frame()
+    framer = EngineFramer()
+    framer.feed(b'999999999999\0')
+    with pytest.raises(FrameError):
+        framer.next_frame()
+
+
+def test_commands_with_several_terminators():
+    framer = CommandFramer(b'\0\n')
+    framer.feed(b'proxyinit -p 9000 -k a\0proxystop -k a\nproxyl')
+    assert list(framer) == [b'proxyinit -p 9000 -k a', b'proxystop -k a']
+    assert framer.buffered() == 6
+    framer.feed(b'ist\0')
+    assert list(framer) == [b'proxylist']
+
+
+def test_commands_compact_large_buffers():
+    framer = CommandFramer()
+    command = b'x' * 1000 + b'\0'
+    commands = []
+    for i in range(200):
+        framer.feed(command[:500])
+        commands.extend(framer)
+        framer.feed(command[500:])
+        commands.extend(framer)
+    assert commands == [command[:-1]] * 200
+    assert framer.buffered() == 0
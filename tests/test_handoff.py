@@ -0,0 +1,101 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+
+import pytest
+
+from dbgpproxy.handoff import HEADER, recv_message, send_message
+
+__author__ = 'gkralik'
+
+# takes the listening sockets passed as arguments at the descriptors systemd would use
+CHILD = '''
+import json, os, socket, sys
+from dbgpproxy.handoff import SD_LISTEN_FDS_START, inherited_sockets
+# out of the way first, a passed descriptor may be one of the targets
+fds = [os.dup2(int(fd), 100 + i) for i, fd in enumerate(sys.argv[2:])]
+for i, fd in enumerate(fds):
+    os.dup2(fd, SD_LISTEN_FDS_START + i)
+os.environ.update(LISTEN_PID=str(os.getpid()) if sys.argv[1] == 'own' else '1', LISTEN_FDS=str(len(fds)),
+                  LISTEN_FDNAMES='dbg::unknown')
+sockets = inherited_sockets({'ide': ('127.0.0.1', int(os.environ['IDE_PORT'])), 'dbg': ('127.0.0.1', 9000),
+                             'stats': None})
+print(json.dumps({'sockets': {name: sock.getsockname()[1] for name, sock in sockets.items()},
+                  'env': sorted(name for name in os.environ if name.startswith('LISTEN_'))}))
+'''
+
+
+def test_control_message_with_descriptors():
+    a, b = socket.socketpair()
+    r, w = os.pipe()
+    try:
+        send_message(a, {'op': 'session', 'state': {'idekey': 'k'}}, [r, w])
+        message, fds = recv_message(b)
+        assert message == {'op': 'session', 'state': {'idekey': 'k'}}
+        assert len(fds) == 2
+        os.write(fds[1], b'x')
+        assert os.read(r, 1) == b'x'
+        for fd in fds:
+            os.close(fd)
+
+        a.close()
+        assert recv_message(b) == (None, [])
+    finally:
+        os.close(r)
+        os.close(w)
+        b.close()
+
+
+def test_truncated_control_message():
+    a, b = socket.socketpair()
+    a.sendall(HEADER.pack(10) + b'{"op"')
+    a.close()
+    with pytest.raises(ConnectionError):
+        recv_message(b)
+    b.close()
+
+
+def run_child(pid, sockets):
+    env = dict(os.environ, IDE_PORT=str(sockets[1].getsockname()[1]))
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', CHILD, pid] + [str(sock.fileno()) for sock in sockets],
+                                     pass_fds=[sock.fileno() for sock in sockets], env=env, cwd=root)
+    return json.loads(output)
+
+
+def listening_sockets(count):
+    sockets = []
+    for i in range(count):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+        sockets.append(sock)
+    return sockets
+
+
+def test_inherited_sockets_matched_by_name_and_port():
+    sockets = listening_sockets(3)
+    ports = [sock.getsockname()[1] for sock in sockets]
+    try:
+        result = run_child('own', sockets)
+    finally:
+        for sock in sockets:
+            sock.close()
+
+    # the first one by its name, the second one by its port, the third one matches no listener
+    assert result['sockets'] == {'dbg': ports[0], 'ide': ports[1]}
+    assert result['env'] == []
+
+
+def test_sockets_of_other_process_ignored():
+    sockets = listening_sockets(2)
+    try:
+        result = run_child('other', sockets)
+    finally:
+        for sock in sockets:
+            sock.close()
+
+    assert result['sockets'] == {}
+    assert result['env'] == ['LISTEN_FDNAMES', 'LISTEN_FDS', 'LISTEN_PID']
@@ -0,0 +1,75 @@
+import random
+
+from dbgpproxy.health import ExpiryHeap
+
+__author__ = 'gkralik'
+
+
+def test_keys_expire_in_order():
+    heap = ExpiryHeap()
+    heap.touch('b', 20)
+    heap.touch('a', 10)
+    heap.touch('c', 30)
+    assert len(heap) == 3 and heap.next_deadline() == 10
+
+    assert heap.pop_expired(9) == []
+    assert heap.pop_expired(20) == ['a', 'b']
+    assert len(heap) == 1 and heap.next_deadline() == 30
+
+
+def test_refresh_moves_deadline_later():
+    heap = ExpiryHeap()
+    heap.touch('k', 10)
+    heap.touch('k', 25)
+    # the entry keeps its old place in the heap until it reaches the top
+    assert heap.next_deadline() == 10
+    assert heap.pop_expired(10) == []
+    assert heap.next_deadline() == 25
+    assert heap.pop_expired(25) == ['k']
+
+
+def test_deadline_moved_earlier():
+    heap = ExpiryHeap()
+    heap.touch('k', 30)
+    heap.touch('k', 10)
+    assert heap.pop_expired(10) == ['k']
+    assert heap.pop_expired(30) == [] and len(heap) == 0
+
+
+def test_discarded_keys_do_not_expire():
+    heap = ExpiryHeap()
+    heap.touch('a', 10)
+    heap.touch('b', 20)
+    heap.discard('a')
+    heap.discard('missing')
+    assert heap.next_deadline() == 20
+    # a key added again gets a new entry
+    heap.touch('a', 30)
+    assert heap.pop_expired(25) == ['b']
+    assert heap.pop_expired(30) == ['a']
+
+
+def test_matches_dict_of_deadlines():
+    rng = random.Random(14)
+    heap = ExpiryHeap()
+    deadlines = {}
+    now = 0
+    for i in range(5000):
+        key = rng.randrange(50)
+        action = rng.random()
+        if action < 0.7:
+            deadline = now + rng.randrange(1, 100)
+            heap.touch(key, deadline)
+            deadlines[key] = deadline
+        elif action < 0.8:
+            heap.discard(key)
+            deadlines.pop(key, None)
+        else:
+            now += rng.randrange(10)
+            expected = {key for key, deadline in deadlines.items() if deadline <= now}
+            assert set(heap.pop_expired(now)) == expected
+            for key in expected:
+                del deadlines[key]
+        assert len(heap) == len(deadlines)
+        if deadlines:
+            assert heap.next_deadline() <= min(deadlines.values())
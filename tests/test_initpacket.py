@@ -0,0 +1,85 @@
+from xml.dom import minidom
+from xml.parsers.expat import ExpatError
+
+import pytest
+
+from dbgpproxy.framing import EngineFramer
+from dbgpproxy.initpacket import InitPacket
+from dbgpproxy.protocol import build_init_packet, parse_init_packet
+
+__author__ = 'gkralik'
+
+XDEBUG_INIT = (b'<?xml version="1.0" encoding="iso-8859-1"?>\n'
+               b'<init xmlns="urn:debugger_protocol_v1" xmlns:xdebug="https://xdebug.org/dbgp/xdebug" '
+               b'fileuri="file:///var/www/index.php" language="PHP" xdebug:language_version="8.2.0" '
+               b'protocol_version="1.0" appid="1234" idekey="PHPSTORM">'
+               b'<engine version="3.2.0"><![CDATA[Xdebug]]></engine></init>')
+
+
+def rewrite(data, dbghost='127.0.0.1'):
+    """
+    @return: The document element of the init packet forwarded to the IDE (minidom node).
+    """
+    framer = EngineFramer()
+    framer.feed(build_init_packet(parse_init_packet(data), dbghost))
+    return minidom.parseString(framer.next_frame()).documentElement
+
+
+def test_xdebug_init_packet():
+    packet = parse_init_packet(XDEBUG_INIT)
+    assert isinstance(packet, InitPacket)
+    assert packet.getAttribute('idekey') == 'PHPSTORM'
+
+    init = rewrite(XDEBUG_INIT, 'proxy.example.com')
+    assert init.getAttribute('hostname') == 'proxy.example.com'
+    assert init.getAttribute('idekey') == 'PHPSTORM'
+    assert init.getAttribute('xdebug:language_version') == '8.2.0'
+    assert init.getElementsByTagName('engine')[0].firstChild.data == 'Xdebug'
+
+
+def test_rest_of_packet_is_passed_on_unchanged():
+    packet = InitPacket.parse(XDEBUG_INIT)
+    packet.setAttribute('hostname', 'h')
+    data = packet.to_bytes()
+    assert data.startswith(XDEBUG_INIT[:XDEBUG_INIT.index(b'<init') + 5])
+    assert data.endswith(b'idekey="PHPSTORM" hostname="h"><engine version="3.2.0"><![CDATA[Xdebug]]></engine></init>')
+
+
+def test_hostname_of_engine_is_kept():
+    init = rewrite(b'<init idekey="k" hostname="engine.example.com"/>')
+    assert init.getAttribute('hostname') == 'engine.example.com'
+
+
+def test_unix_listener_reports_localhost():
+    assert rewrite(b'<init idekey="k"/>', 'unix').getAttribute('hostname') == '127.0.0.1'
+
+
+def test_escaped_and_single_quoted_attributes():
+    init = rewrite(b"<init idekey='a\"b' fileuri=\"file:///x?a=1&amp;b=&quot;2&quot;\"/>")
+    assert init.getAttribute('idekey') == 'a"b'
+    assert init.getAttribute('fileuri') == 'file:///x?a=1&b="2"'
+
+
+@pytest.mark.parametrize('data', [
+    b'<?xml version="1.0" encoding="utf-8"?>\n<init idekey="k\xc3\xa4"/>',
+    b'<?xml version="1.0" encoding="iso-8859-1"?>\n<init idekey="k\xe4"/>',
+])
+def test_encodings(data):
+    assert rewrite(data, 'hést').getAttribute('idekey') == 'kä'
+    assert rewrite(data, 'hést').getAttribute('hostname') == 'hést'
+
+
+def test_minidom_fallback():
+    data = b'<!-- comment --><init idekey="k"/>'
+    assert InitPacket.parse(data) is None
+    init = rewrite(data, 'proxy')
+    assert init.getAttribute('idekey') == 'k' and init.getAttribute('hostname') == 'proxy'
+
+
+def test_unknown_encoding_is_not_rewritten_in_place():
+    assert InitPacket.parse(b'<?xml version="1.0" encoding="x-unknown"?>\n<init idekey="k"/>') is None
+
+
+def test_invalid_init_packet():
+    with pytest.raises(ExpatError):
+        parse_init_packet(b'<init idekey=k/>')
@@ -0,0 +1,26 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import loadtest
+from fakes import ProxyProcess
+
+__author__ = 'gkralik'
+
+
+@pytest.mark.parametrize('engine', ['asyncore', 'asyncio'])
+def test_load_test_against_engine(engine):
+    proxy = ProxyProcess(engine)
+    try:
+        result = asyncio.run(loadtest.run(proxy, sessions=4, commands=3, response_size=512, megabytes=1,
+                                          concurrency=2))
+    finally:
+        proxy.stop()
+
+    assert result['sessions'] == 4
+    for name in ('registrations_s', 'setups_s', 'rtt_p50_ms', 'rtt_p99_ms', 'relay_mb_s', 'rss_peak_kb'):
+        assert result[name] > 0, name
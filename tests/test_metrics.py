@@ -0,0 +1,76 @@
+import socket
+
+import pytest
+
+from conftest import LoopProxy
+from dbgpproxy.metrics import MAX_REQUEST, StatsEndpoint
+
+__author__ = 'gkralik'
+
+
+@pytest.fixture
+def loop_proxy():
+    return LoopProxy()
+
+
+@pytest.fixture
+def endpoint(loop_proxy):
+    endpoint = StatsEndpoint(loop_proxy, '127.0.0.1', 0)
+    yield endpoint
+    endpoint.close()
+
+
+def connect(endpoint, loop_proxy):
+    client = socket.create_connection(endpoint._sock.getsockname(), timeout=5)
+    while not endpoint.clients:
+        loop_proxy.poll()
+    return client
+
+
+def read_response(client, loop_proxy):
+    client.setblocking(False)
+    response = b''
+    while True:
+        loop_proxy.poll(0.01)
+        try:
+            while True:
+                data = client.recv(1 << 20)
+                if not data:
+                    return response
+                response += data
+        except BlockingIOError:
+            pass
+
+
+def test_stats_endpoint_waits_for_request_headers(endpoint, loop_proxy):
+    loop_proxy.metrics.open_session('k').to_ide(b'x' * 100)
+    client = connect(endpoint, loop_proxy)
+    client.sendall(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n')
+    loop_proxy.poll(0.1)
+    assert loop_proxy._writers == {}
+
+    client.sendall(b'\r\n')
+    header, body = read_response(client, loop_proxy).split(b'\r\n\r\n', 1)
+    assert header.startswith(b'HTTP/1.0 200 OK\r\n')
+    assert 'Content-Length: {}'.format(len(body)).encode() in header
+    assert b'dbgpproxy_bytes_total{direction="to_ide"} 100\n' in body
+    assert not endpoint.clients
+    client.close()
+
+
+def test_stats_endpoint_sends_large_response_completely(endpoint, loop_proxy, monkeypatch):
+    monkeypatch.setattr(loop_proxy.metrics, 'to_text', lambda: 'x' * (16 << 20))
+    client = connect(endpoint, loop_proxy)
+    client.sendall(b'x' * MAX_REQUEST)
+
+    header, body = read_response(client, loop_proxy).split(b'\r\n\r\n', 1)
+    assert body == b'x' * (16 << 20)
+    client.close()
+
+
+def test_stats_endpoint_drops_client_closing_early(endpoint, loop_proxy):
+    client = connect(endpoint, loop_proxy)
+    client.close()
+    while endpoint.clients:
+        loop_proxy.poll()
+    assert loop_proxy._readers == {endpoint._sock: endpoint.handle_accept}
@@ -0,0 +1,98 @@
+from dbgpproxy.protocol import RegistrationCommands
+
+__author__ = 'gkralik'
+
+
+class FakeHandler(RegistrationCommands):
+    """
+    Registration handler collecting its responses instead of sending them.
+    """
+
+    def __init__(self, proxy, peer_host='127.0.0.1'):
+        self._proxy_manager = proxy
+        self._peer_host = peer_host
+        self._dbghost = '127.0.0.1'
+        self._dbgport = 9000
+        self.messages = []
+        self.closed = False
+
+    def send_message(self, message):
+        self.messages.append(message)
+
+    def close(self):
+        self.closed = True
+
+
+def test_proxyinit_registers_peer_port(proxy):
+    handler = FakeHandler(proxy, '192.0.2.1')
+    handler.handle_data(b'proxyinit -p 9000 -k k -m 1\0')
+    assert 'proxyinit success="1"' in handler.messages[-1]
+    assert proxy.get_server('k') == [['192.0.2.1', 9000], '1']
+
+
+def test_unix_socket_registered_from_local_host(proxy):
+    handler = FakeHandler(proxy, '127.0.0.1')
+    handler.handle_data(b'proxyinit -p unix:/tmp/ide.sock -k k\0')
+    assert 'proxyinit success="1"' in handler.messages[-1]
+    assert proxy.get_server('k') == [['unix', '/tmp/ide.sock'], None]
+
+
+def test_unix_socket_rejected_from_remote_host(proxy):
+    handler = FakeHandler(proxy, '192.0.2.1')
+    handler.handle_data(b'proxyinit -p unix:/run/docker.sock -k k\0proxyinit -p 9000 -p unix:/tmp/x -k a -k b\0')
+    assert len(handler.messages) == 2
+    assert all(message.startswith('<?xml version="1.0" encoding="UTF-8"?>\n<proxyerror success="0">')
+               for message in handler.messages)
+    assert proxy.get_server('k') is None and proxy.get_server('a') is None
+    # the connection stays open for the commands pipelined after it
+    assert not handler.closed
+
+
+def test_proxystats_counts_session_traffic(proxy):
+    session = proxy.metrics.open_session('a"b')
+    session.to_engine(b'property_get -i 7 -n $x\0')
+    session.to_ide(b'12\0<response transaction_id="7"/>\0')
+
+    handler = FakeHandler(proxy)
+    handler.handle_data(b'proxystats\0')
+    stats = handler.messages[-1]
+    assert '<sessions total="1" active="1" rejected="0"/>' in stats
+    assert '<traffic bytes_to_ide="34" bytes_to_engine="24" frames_to_ide="1" frames_to_engine="1"/>' in stats
+    assert '<latency unit="ms" count="1"' in stats
+    assert '<session idekey=\'a"b\'' in stats
+
+    session.close((0, 0))
+    handler.handle_data(b'proxystats\0')
+    assert '<sessions total="1" active="0" rejected="0"/>' in handler.messages[-1]
+    assert 'bytes_to_ide="34"' in handler.messages[-1]
+
+
+def test_port_out_of_range_rejected(proxy):
+    handler = FakeHandler(proxy)
+    handler.handle_data(b'proxyinit -p 0 -k a\0proxyinit -p 65536 -k b\0proxyinit -p 65535 -k c\0')
+    assert 'No port defined for proxy.' in handler.messages[0]
+    assert 'No port defined for proxy.' in handler.messages[1]
+    assert proxy.get_server('a') is None and proxy.get_server('b') is None
+    assert proxy.get_server('c') == [['127.0.0.1', 65535], None]
+
+
+def test_idekey_escaped_in_response(proxy):
+    handler = FakeHandler(proxy)
+    handler.handle_data(b'proxyinit -p 9000 -k a"<b>\0proxystop -k a"<b>\0')
+    assert '<proxyinit success="1" idekey=\'a"&lt;b&gt;\' address=' in handler.messages[0]
+    assert handler.messages[1].endswith('<proxystop success="1" idekey=\'a"&lt;b&gt;\'/>')
+
+
+def test_invalid_utf8_answered_with_proxyerror(proxy):
+    handler = FakeHandler(proxy)
+    handler.handle_data(b'proxyinit -p 9000 -k \xff\0proxyinit -p 9000 -k k\0')
+    assert '<proxyerror success="0"><error id="1"><message>Command is not valid UTF-8.' in handler.messages[0]
+    assert 'proxyinit success="1"' in handler.messages[1]
+    assert not handler.closed
+
+
+def test_unknown_command_escaped_in_proxyerror(proxy):
+    handler = FakeHandler(proxy)
+    handler.handle_data(b'proxy<list>\0')
+    assert '<message>Unknown command [proxy&lt;list&gt;]</message>' in handler.messages[0]
+    assert handler.closed
@@ -0,0 +1,71 @@
+from dbgpproxy import registry
+from dbgpproxy.registry import RegistryLog
+
+__author__ = 'gkralik'
+
+
+def reopen(path):
+    """
+    @return: The registrations a new RegistryLog loads from path.
+    """
+    log = RegistryLog(str(path))
+    servers = log.load()
+    log.close()
+    return servers
+
+
+def test_registrations_survive_restart(tmp_path):
+    path = tmp_path / 'registry'
+    log = RegistryLog(str(path))
+    assert log.load() == {}
+    log.server_added('a', '192.0.2.1', 9000, None)
+    log.server_added('b', 'unix', '/tmp/ide.sock', '0')
+    log.server_added('a', '192.0.2.2', 9001, '1')
+    log.server_removed('b')
+    log.server_removed('missing')
+    log.close()
+
+    assert reopen(path) == {'a': ['192.0.2.2', 9001, '1']}
+    # the next run appends to the same log
+    log = RegistryLog(str(path))
+    log.load()
+    log.server_added('c', '192.0.2.3', 9000, None)
+    log.close()
+    assert reopen(path) == {'a': ['192.0.2.2', 9001, '1'], 'c': ['192.0.2.3', 9000, None]}
+
+
+def test_incomplete_last_line_is_dropped(tmp_path):
+    path = tmp_path / 'registry'
+    path.write_bytes(b'["+", "a", "192.0.2.1", 9000, null]\n["+", "b", "192.0.2.2", 90')
+
+    log = RegistryLog(str(path))
+    assert log.load() == {'a': ['192.0.2.1', 9000, None]}
+    log.server_added('c', '192.0.2.3', 9000, None)
+    log.close()
+    assert path.read_bytes().split(b'\n')[1] == b'["+", "c", "192.0.2.3", 9000, null]'
+    assert reopen(path) == {'a': ['192.0.2.1', 9000, None], 'c': ['192.0.2.3', 9000, None]}
+
+
+def test_invalid_lines_are_skipped(tmp_path):
+    path = tmp_path / 'registry'
+    path.write_bytes(b'["+", "a", "192.0.2.1", 9000, null]\nnot json\n["+", "b", "192.0.2.2", 9000, "1"]\n'
+                     b'["-", "a"]\n')
+    assert reopen(path) == {'b': ['192.0.2.2', 9000, '1']}
+
+
+def test_entries_of_wrong_shape_are_skipped(tmp_path):
+    path = tmp_path / 'registry'
+    path.write_bytes(b'["+"]\n{}\n3\n["+", "a", "192.0.2.1", 9000, null]\n["+", "b", "192.0.2.2"]\n'
+                     b'["+", "c", "192.0.2.3", [9000], null]\n["-"]\n["-", "a", "extra"]\n["*", "d"]\n'
+                     b'["+", "e", "192.0.2.5", 9000, "1"]\n')
+    assert reopen(path) == {'a': ['192.0.2.1', 9000, None], 'e': ['192.0.2.5', 9000, '1']}
+
+
+def test_outdated_log_is_compacted(tmp_path, monkeypatch):
+    monkeypatch.setattr(registry, 'COMPACT_MIN_LINES', 10)
+    path = tmp_path / 'registry'
+    path.write_bytes(b''.join(b'["+", "k", "192.0.2.1", %d, null]\n' % (9000 + i) for i in range(20)))
+
+    # compacted by the writer thread once the log has been loaded
+    assert reopen(path) == {'k': ['192.0.2.1', 9019, None]}
+    assert path.read_bytes() == b'["+", "k", "192.0.2.1", 9019, null]\n'
@@ -0,0 +1,64 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import replay
+from fakes import ProxyProcess, frame
+from dbgpproxy.capture import MAGIC, RECORD, TO_ENGINE, TO_IDE
+
+__author__ = 'gkralik'
+
+INIT = b'<init xmlns="urn:debugger_protocol_v1" idekey="recorded" appid="1" language="PHP"/>'
+RESPONSE = b'<response xmlns="urn:debugger_protocol_v1" command="run" transaction_id="1" status="break"/>'
+
+
+def write_capture(path, records):
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        for timestamp, direction, data in records:
+            f.write(RECORD.pack(timestamp, direction, len(data)))
+            f.write(data)
+
+
+def recorded_session(path):
+    response = frame(RESPONSE)
+    # the response and the second command are split across chunks
+    write_capture(path, [
+        (100.0, TO_IDE, frame(INIT)),
+        (100.5, TO_ENGINE, b'run -i 1\0step_'),
+        (100.5, TO_ENGINE, b'into -i 2\0'),
+        (101.0, TO_IDE, response[:20]),
+        (101.25, TO_IDE, response[20:]),
+    ])
+
+
+def test_script_follows_messages_across_chunks(tmp_path):
+    path = str(tmp_path / 'session.dbgpcap')
+    recorded_session(path)
+    script = replay.Script(path)
+
+    assert script.init == INIT
+    assert script.steps == [
+        (replay.IDE, 0.5, 0, b'run -i 1'),
+        (replay.IDE, 0.0, 0, b'step_into -i 2'),
+        (replay.ENGINE, 0.75, 2, RESPONSE),
+    ]
+    assert script.counts == [2, 1]
+    assert script.duration == 1.25
+    assert script.init_packet('replay1') == frame(INIT.replace(b'"recorded"', b'"replay1"'))
+
+
+def test_replay_against_proxy(tmp_path):
+    path = str(tmp_path / 'session.dbgpcap')
+    recorded_session(path)
+    proxy = ProxyProcess('asyncio')
+    try:
+        result = asyncio.run(replay.run(replay.Target.of(proxy), [replay.Script(path)], sessions=3, concurrency=2,
+                                        speed=100.0))
+    finally:
+        proxy.stop()
+
+    assert result['completed'] == 3 and result['failed'] == 0
+    assert result['commands'] == 3
@@ -0,0 +1,169 @@
+from dbgpproxy.sessions import SessionTable, START, QUEUED, REJECTED
+
+__author__ = 'gkralik'
+
+
+class FakeSession:
+    """
+    Debugger engine connection that gives up its slot when it is closed, like the handlers of the engines.
+    """
+
+    def __init__(self, proxy, table, idekey, fail=False):
+        """
+        @param fail: Fail to connect to the IDE right away, which removes the IDE key.
+        """
+        self.proxy = proxy
+        self.table = table
+        self.idekey = idekey
+        self.fail = fail
+        self.closed = False
+        self.started = 0
+        self.rejected = None
+
+    def start_session(self):
+        self.started += 1
+        if self.fail:
+            self.proxy.remove_server(self.idekey)
+            self.close()
+
+    def reject_session(self, reason):
+        self.rejected = reason
+        self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.table.release(self.idekey, self)
+
+
+def open_session(proxy, table, idekey='k', fail=False):
+    session = FakeSession(proxy, table, idekey, fail)
+    return session, table.acquire(idekey, session)
+
+
+def test_single_session_ide_queues_in_order(proxy):
+    table = SessionTable(proxy)
+    proxy.add_server('k', '127.0.0.1', 9000, '0')
+
+    first, state = open_session(proxy, table)
+    assert state == START
+    second, state = open_session(proxy, table)
+    assert state == QUEUED
+    third, state = open_session(proxy, table)
+    assert state == QUEUED
+    assert table.queued('k') == 2
+
+    first.close()
+    assert second.started == 1 and third.started == 0
+    second.close()
+    assert third.started == 1
+    assert table.queued('k') == 0 and table.active('k') == 1
+
+
+def test_max_sessions_and_full_queue(proxy):
+    table = SessionTable(proxy, max_sessions=2, queue_size=1)
+    proxy.add_server('k', '127.0.0.1', 9000, '1')
+
+    assert open_session(proxy, table)[1] == START
+    assert open_session(proxy, table)[1] == START
+    assert open_session(proxy, table)[1] == QUEUED
+    assert open_session(proxy, table)[1] == REJECTED
+    assert proxy.metrics.rejected == 1
+
+
+def test_queue_timeout(proxy):
+    table = SessionTable(proxy, queue_timeout=5.0)
+    proxy.add_server('k', '127.0.0.1', 9000, '0')
+    open_session(proxy, table)
+    waiting, state = open_session(proxy, table)
+    assert state == QUEUED
+
+    proxy.advance(4.9)
+    assert waiting.rejected is None
+    proxy.advance(0.2)
+    assert waiting.rejected is not None and waiting.closed
+    assert table.queued('k') == 0
+
+
+def test_removed_ide_key_rejects_queue(proxy):
+    table = SessionTable(proxy)
+    proxy.add_server('k', '127.0.0.1', 9000, '0')
+    open_session(proxy, table)
+    waiting, state = open_session(proxy, table)
+
+    proxy.remove_server('k')
+    assert waiting.rejected == 'IDE key removed'
+    assert table.queued('k') == 0
+
+
+def test_connect_failure_while_starting_queue(proxy):
+    table = SessionTable(proxy)
+    proxy.add_server('k', 'unix', '/nonexistent/ide.sock', '0')
+    active, state = open_session(proxy, table)
+    failing, state = open_session(proxy, table, fail=True)
+    assert state == QUEUED
+    waiting, state = open_session(proxy, table)
+    assert state == QUEUED
+
+    # the failing session removes the IDE key, which rejects the session still waiting
+    active.close()
+    assert failing.started == 1 and failing.closed
+    assert waiting.rejected == 'IDE key removed' and waiting.started == 0
+    assert table.active('k') == 0 and table.queued('k') == 0
+    assert table.sessions() == []
+
+    # the IDE key is usable again once the IDE registers again
+    proxy.add_server('k', 'unix', '/tmp/ide.sock', '0')
+    assert open_session(proxy, table)[1] == START
+
+
+def test_closed_sessions_are_not_started(proxy):
+    table = SessionTable(proxy)
+    proxy.add_server('k', '127.0.0.1', 9000, '0')
+    active, state = open_session(proxy, table)
+    gone, state = open_session(proxy, table)
+    waiting, state = open_session(proxy, table)
+    # closed without giving up its place, e.g. by a handler that does not release it
+    gone.closed = True
+
+    active.close()
+    assert gone.started == 0 and waiting.started == 1
+
+
+def test_refused_connection_learns_limit(proxy):
+    table = SessionTable(proxy)
+    proxy.add_server('k', '127.0.0.1', 9000, '1')
+    first = open_session(proxy, table)[0]
+    second = open_session(proxy, table)[0]
+
+    assert table.refused('k', second)
+    assert table.limit('k') == 1 and table.queued('k') == 1
+    first.close()
+    assert second.started == 1
+
+    # a new registration forgets the learned limit
+    proxy.remove_server('k')
+    proxy.add_server('k', '127.0.0.1', 9000, '1')
+    assert table.limit('k') == 0
+
+
+def test_admission(proxy):
+    table = SessionTable(proxy, max_connections=2)
+    assert table.admit() and table.admit()
+    assert not table.admit()
+    assert proxy.metrics.rejected == 1
+    table.connection_closed()
+    assert table.admit()
+
+
+def test_replicated_removal_rejects_queue(proxy):
+    # removals made by another worker or cluster node are applied with discard_server()
+    table = proxy.sessions
+    proxy.restore_server('k', '127.0.0.1', 9000, '0')
+    open_session(proxy, table)
+    waiting, state = open_session(proxy, table)
+    assert state == QUEUED
+
+    proxy.discard_server('k')
+    assert waiting.rejected == 'IDE key removed'
+    assert table.queued('k') == 0
@@ -0,0 +1,165 @@
+import json
+import socket
+import zlib
+
+import pytest
+
+from conftest import LoopProxy
+from dbgpproxy.tunnel import DATA, HEADER, REGISTER, UNREGISTER, TunnelServer, parse_registration
+
+__author__ = 'gkralik'
+
+
+class Edge:
+    """
+    Developer side of a link sending frames to the TunnelServer.
+    """
+
+    def __init__(self, proxy, server):
+        self.sock = socket.create_connection(server._sock.getsockname())
+        self._compressor = zlib.compressobj()
+        proxy.poll()
+        self.link = next(link for link in server.links if link.peer == self.sock.getsockname())
+
+    def send(self, frame_type, payload, split=False):
+        data = self._compressor.compress(HEADER.pack(frame_type, 0, len(payload)) + payload)
+        data += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        chunks = [data[:len(data) // 2], data[len(data) // 2:]] if split else [data]
+        for chunk in chunks:
+            self.sock.sendall(chunk)
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def hub():
+    proxy = LoopProxy()
+    server = TunnelServer(proxy, '127.0.0.1', 0)
+    yield proxy, server
+    server.close()
+
+
+def registered(proxy, idekey, link):
+    return proxy.get_server(idekey) == [list(link.address), '1']
+
+
+def test_parse_registration():
+    assert parse_registration(b'["k", "1"]') == ('k', '1')
+    assert parse_registration(b'["k", null]') == ('k', None)
+    for payload in (b'', b'\xff', b'{}', b'["k"]', b'["", "1"]', b'[1, "1"]', b'["k", ["unix", "/x"]]'):
+        assert parse_registration(payload) is None
+
+
+def test_register_and_unregister(hub):
+    proxy, server = hub
+    edge = Edge(proxy, server)
+    edge.send(REGISTER, json.dumps(['k', '1']).encode(), split=True)
+    proxy.poll()
+    assert registered(proxy, 'k', edge.link)
+    assert edge.link.address[0] == '127.0.0.1'
+
+    edge.send(UNREGISTER, b'k')
+    proxy.poll()
+    assert proxy.get_server('k') is None
+    edge.close()
+
+
+def test_key_of_live_link_is_not_taken_over(hub):
+    proxy, server = hub
+    old, new = Edge(proxy, server), Edge(proxy, server)
+    old.send(REGISTER, json.dumps(['k', '1']).encode())
+    proxy.poll()
+    new.send(REGISTER, json.dumps(['k', '1']).encode())
+    proxy.poll()
+    assert registered(proxy, 'k', old.link)
+
+    # the new link gets the key once the old one is gone, e.g. closed by TCP keepalive
+    old.close()
+    for i in range(2):
+        proxy.poll(0.1)
+    assert old.link.closed and registered(proxy, 'k', new.link)
+    new.close()
+
+
+def test_withdrawn_claim_is_not_registered(hub):
+    proxy, server = hub
+    old, new = Edge(proxy, server), Edge(proxy, server)
+    old.send(REGISTER, json.dumps(['k', '1']).encode())
+    proxy.poll()
+    new.send(REGISTER, json.dumps(['k', '1']).encode())
+    new.send(UNREGISTER, b'k')
+    proxy.poll()
+
+    old.send(UNREGISTER, b'k')
+    proxy.poll()
+    assert proxy.get_server('k') is None
+    old.close()
+    new.close()
+
+
+def test_reconnects_do_not_keep_links(hub):
+    proxy, server = hub
+    for i in range(5):
+        edge = Edge(proxy, server)
+        edge.send(REGISTER, json.dumps(['k', '1']).encode())
+        proxy.poll()
+        assert registered(proxy, 'k', edge.link)
+        edge.close()
+        proxy.poll()
+    assert len(server.links) == 0
+
+
+def test_oversized_frame_closes_link(hub):
+    proxy, server = hub
+    edge = Edge(proxy, server)
+    edge.send(REGISTER, json.dumps(['k', '1']).encode())
+    # only the header of a 4 GiB frame is sent
+    data = edge._compressor.compress(HEADER.pack(DATA, 1, 0xffffffff)) + edge._compressor.flush(zlib.Z_SYNC_FLUSH)
+    edge.sock.sendall(data)
+    proxy.poll()
+    assert edge.link.closed and proxy.get_server('k') is None
+    edge.close()
+
+
+def test_large_chunks_are_decompressed_in_steps(hub):
+    proxy, server = hub
+    edge = Edge(proxy, server)
+    # frames for unknown streams are dropped, they compress to a few hundred bytes
+    for i in range(100):
+        edge.send(DATA, b'\0' * 60000)
+    edge.send(REGISTER, json.dumps(['k', '1']).encode())
+    for i in range(5):
+        proxy.poll(0.1)
+    assert len(edge.link._frames) < 2 * 65536
+    assert registered(proxy, 'k', edge.link)
+    edge.close()
+
+
+@pytest.mark.parametrize('frame_type, payload', [
+    (REGISTER, b'["k"]'),
+    (REGISTER, b'not json'),
+    (UNREGISTER, b'\xff'),
+])
+def test_invalid_frame_closes_link(hub, frame_type, payload):
+    proxy, server = hub
+    edge = Edge(proxy, server)
+    edge.send(REGISTER, json.dumps(['k', '1']).encode())
+    edge.send(frame_type, payload)
+    proxy.poll()
+    # the keys of the link are removed with it
+    assert edge.link.closed and proxy.get_server('k') is None
+    edge.close()
+
+
+def test_lost_link_removes_keys(hub):
+    proxy, server = hub
+    edge = Edge(proxy, server)
+    edge.send(REGISTER, json.dumps(['a', '1']).encode())
+    edge.send(REGISTER, json.dumps(['b', '1']).encode())
+    proxy.poll()
+    assert registered(proxy, 'a', edge.link) and registered(proxy, 'b', edge.link)
+
+    edge.close()
+    proxy.poll()
+    assert proxy.list_servers() == []
@@ -0,0 +1,161 @@
+import json
+import os
+import signal
+import socket
+from collections import deque
+
+from conftest import LoopProxy
+from dbgpproxy import workers
+from dbgpproxy.sessions import QUEUED
+from dbgpproxy.workers import RegistryReplica, WorkerPool, apply_update
+
+__author__ = 'gkralik'
+
+
+class FakeSession:
+    def __init__(self):
+        self.closed = False
+        self.rejected = None
+
+    def start_session(self):
+        pass
+
+    def reject_session(self, reason):
+        self.rejected = reason
+        self.closed = True
+
+
+def test_apply_update(proxy):
+    apply_update(proxy, {'op': 'snapshot', 'servers': {'a': ['192.0.2.1', 9000, None], 'b': ['unix', '/x', '0']}})
+    apply_update(proxy, {'op': 'add', 'idekey': 'c', 'host': '192.0.2.3', 'port': 9000, 'multi': '1'})
+    apply_update(proxy, {'op': 'remove', 'idekey': 'a'})
+    assert sorted(idekey for idekey, server in proxy.list_servers()) == ['b', 'c']
+
+
+def test_removal_by_other_worker_rejects_queue(proxy):
+    apply_update(proxy, {'op': 'add', 'idekey': 'k', 'host': '192.0.2.1', 'port': 9000, 'multi': '0'})
+    proxy.sessions.acquire('k', FakeSession())
+    waiting = FakeSession()
+    assert proxy.sessions.acquire('k', waiting) == QUEUED
+
+    apply_update(proxy, {'op': 'remove', 'idekey': 'k'})
+    assert waiting.rejected == 'IDE key removed'
+    assert proxy.sessions.queued('k') == 0
+
+
+def test_updates_queued_for_slow_worker():
+    pool = WorkerPool(2, None)
+    parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    parent.setblocking(False)
+    child.setblocking(False)
+    pool._pending[parent] = deque()
+    try:
+        sent = 0
+        # the worker does not read, the parent must not block
+        while not pool._pending[parent]:
+            pool._send(parent, json.dumps({'op': 'remove', 'idekey': str(sent)}).encode())
+            sent += 1
+        pool._send(parent, json.dumps({'op': 'remove', 'idekey': str(sent)}).encode())
+        sent += 1
+        assert len(pool._pending[parent]) == 2
+
+        received = []
+        while len(received) < sent:
+            pool._flush(parent)
+            try:
+                received.append(json.loads(child.recv(65536).decode())['idekey'])
+            except BlockingIOError:
+                pass
+        assert received == [str(i) for i in range(sent)]
+        assert not pool._pending[parent]
+    finally:
+        parent.close()
+        child.close()
+
+
+def fill(sock):
+    """
+    Send datagrams until the socket would block.
+    @return: The number of datagrams sent.
+    """
+    sent = 0
+    while True:
+        try:
+            sock.send(b'{}')
+        except BlockingIOError:
+            return sent
+        sent += 1
+
+
+def test_worker_not_reading_updates_is_restarted(monkeypatch):
+    monkeypatch.setattr(workers, 'MAX_PENDING', 3)
+    killed = []
+    monkeypatch.setattr(os, 'kill', lambda pid, signum: killed.append((pid, signum)))
+    pool = WorkerPool(2, None)
+    parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    parent.setblocking(False)
+    pool._children[1234] = parent
+    pool._pending[parent] = deque()
+    try:
+        fill(parent)
+        for i in range(5):
+            pool._send(parent, b'{"op": "remove", "idekey": "k"}')
+        assert killed == [(1234, signal.SIGKILL)]
+        # nothing is queued until the worker has been restarted
+        assert not pool._pending[parent]
+    finally:
+        parent.close()
+        child.close()
+
+
+def test_invalid_update_is_dropped():
+    pool = WorkerPool(2, None)
+    parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    other, other_child = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    for sock in (parent, other, other_child):
+        sock.setblocking(False)
+    pool._children.update({1: parent, 2: other})
+    pool._pending.update({parent: deque(), other: deque()})
+    try:
+        for data in (b'\xff', b'not json', b'[]', b'{"op": "snapshot", "servers": {}}', b'{"op": "add"}'):
+            child.send(data)
+            pool._relay(parent)
+        child.send(b'{"op": "add", "idekey": "k", "host": "192.0.2.1", "port": 9000, "multi": null}')
+        pool._relay(parent)
+
+        assert pool._servers == {'k': ['192.0.2.1', 9000, None]}
+        assert json.loads(other_child.recv(65536).decode())['idekey'] == 'k'
+        try:
+            other_child.recv(65536)
+            assert False, 'invalid update passed on'
+        except BlockingIOError:
+            pass
+    finally:
+        for sock in (parent, child, other, other_child):
+            sock.close()
+
+
+def test_replica_queues_updates_parent_cannot_take():
+    proxy = LoopProxy()
+    worker, parent = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    parent.setblocking(False)
+    RegistryReplica(proxy, worker)
+    try:
+        filled = fill(worker)
+        proxy.add_server('a', '192.0.2.1', 9000, None)
+        proxy.remove_server('a')
+
+        received = []
+        while len(received) < filled + 2:
+            proxy.poll(0.1)
+            try:
+                while True:
+                    received.append(parent.recv(65536))
+            except BlockingIOError:
+                pass
+        updates = [json.loads(data.decode()) for data in received[filled:]]
+        assert [update['op'] for update in updates] == ['add', 'remove']
+        assert worker not in proxy._writers
+    finally:
+        worker.close()
+        parent.close()